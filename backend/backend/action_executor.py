@@ -0,0 +1,186 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import defaultdict, deque
+import json
+from threading import Thread, Condition, Lock
+import time
+
+from Queue import Queue
+from requests import RequestException
+
+from .actions import Action, ActionType
+from .helpers import get_redis_logger
+
+# number of worker threads per action type when not set by ``opts.action_workers``
+DEFAULT_ACTION_WORKERS = 2
+# results are sent to frontend at least this often in seconds
+RESULTS_FLUSH_INTERVAL = 1
+# max number of results in one frontend update
+RESULTS_BATCH_SIZE = 100
+
+ACTION_TYPE_NAMES = {
+    ActionType.DELETE: "delete",
+    ActionType.RENAME: "rename",
+    ActionType.LEGAL_FLAG: "legal_flag",
+    ActionType.CREATEREPO: "createrepo",
+    ActionType.UPDATE_COMPS: "update_comps",
+    ActionType.GEN_GPG_KEY: "gen_gpg_key",
+}
+
+
+def get_action_owner(action):
+    """
+    :return str: owner of the project touched by the action, None when unknown
+    """
+    if action.get("old_value"):
+        return action["old_value"].split("/")[0]
+    try:
+        return json.loads(action.get("data") or "{}").get("username")
+    except (ValueError, AttributeError):
+        return None
+
+
+class ActionExecutor(object):
+    """
+    Runs actions in the worker threads so that the job grabber isn't blocked
+    by slow actions like the delete of a huge project.
+
+    Each action type has its own pool of ``opts.action_workers`` threads.
+    Actions of the same owner are run one by one in the order of submission,
+    owner is used rather than project since rename moves the results to
+    another project directory.
+
+    Results are collected and sent to frontend in batches by the reporter thread.
+
+    :param Munch opts: backend config
+    :type frontend_client: FrontendClient
+    """
+
+    def __init__(self, opts, frontend_client):
+        self.opts = opts
+        self.frontend_client = frontend_client
+
+        self.queues = dict((action_type, Queue()) for action_type in ACTION_TYPE_NAMES)
+        # owner -> actions waiting for the running action of the same owner
+        self.waiting = defaultdict(deque)
+        self.lock = Lock()
+
+        self.results = []
+        self.results_cond = Condition()
+
+        self.threads = []
+        self.log = get_redis_logger(self.opts, "backend.action_executor", "actions")
+
+    def get_workers_count(self, action_type):
+        workers = self.opts.get("action_workers") or {}
+        return workers.get(ACTION_TYPE_NAMES[action_type], DEFAULT_ACTION_WORKERS)
+
+    def start(self):
+        """
+        Starts worker and reporter threads
+        """
+        for action_type, queue in self.queues.items():
+            for idx in range(self.get_workers_count(action_type)):
+                self.threads.append(Thread(
+                    target=self.worker, args=(queue,),
+                    name="action-{}-{}".format(ACTION_TYPE_NAMES[action_type], idx)))
+        self.threads.append(Thread(target=self.reporter, name="action-reporter"))
+
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, action):
+        """
+        Schedules the action, never blocks
+
+        :param action: dict-like object with action task
+        """
+        if action.get("action_type") not in self.queues:
+            self.log.error("Unknown action type, ignored: {}".format(action))
+            return
+
+        owner = get_action_owner(action)
+        with self.lock:
+            if owner is not None:
+                # the deque holds the running action of the owner too
+                self.waiting[owner].append(action)
+                if len(self.waiting[owner]) > 1:
+                    return
+        self.queues[action["action_type"]].put((owner, action))
+
+    def done(self, owner):
+        """
+        Passes the next waiting action of the owner to its workers
+        """
+        if owner is None:
+            return
+        with self.lock:
+            waiting = self.waiting[owner]
+            waiting.popleft()
+            if not waiting:
+                del self.waiting[owner]
+                return
+            action = waiting[0]
+        self.queues[action["action_type"]].put((owner, action))
+
+    def execute(self, action):
+        """
+        Runs the action, result is queued for the reporter
+        """
+        start = time.time()
+        result = Action(self.opts, action, frontend_client=self.frontend_client).execute()
+        self.log.debug("Action `{}` done in {:.2f}s".format(action.get("id"), time.time() - start))
+        if result is not None:
+            with self.results_cond:
+                self.results.append(result)
+                if len(self.results) >= RESULTS_BATCH_SIZE:
+                    self.results_cond.notify()
+
+    def worker(self, queue):
+        while True:
+            owner, action = queue.get()
+            try:
+                self.execute(action)
+            except Exception as error:
+                self.log.exception("Error during processing action `{}`: {}".format(action, error))
+            finally:
+                self.done(owner)
+
+    def flush_results(self):
+        """
+        Sends the collected results to frontend, they are kept for the next
+        attempt when frontend is unavailable
+
+        :return int: number of sent results
+        """
+        with self.results_cond:
+            batch = self.results[:RESULTS_BATCH_SIZE]
+        if not batch:
+            return 0
+
+        try:
+            self.frontend_client.update({"actions": batch})
+        except RequestException as error:
+            self.log.exception("Failed to send action results: {}".format(error))
+            return 0
+
+        with self.results_cond:
+            del self.results[:len(batch)]
+        return len(batch)
+
+    def reporter(self):
+        while True:
+            with self.results_cond:
+                if len(self.results) < RESULTS_BATCH_SIZE:
+                    self.results_cond.wait(RESULTS_FLUSH_INTERVAL)
+            try:
+                self.flush_results()
+            except Exception as error:
+                self.log.exception("Action reporter unhandled exception: {}".format(error))
+                time.sleep(RESULTS_FLUSH_INTERVAL)
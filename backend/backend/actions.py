@@ -10,7 +10,7 @@ from copr.exceptions import CoprRequestException
 from .sign import create_user_keys, CoprKeygenRequestError
 from .createrepo import createrepo
 from .exceptions import CreateRepoError
-from .helpers import get_redis_logger, silent_remove
+from .helpers import get_redis_logger, silent_remove, remove_tree
 
 
 class Action(object):
@@ -65,7 +65,7 @@ class Action(object):
             try:
                 createrepo(path=path, front_url=self.front_url,
                            username=username, projectname=projectname,
-                           override_acr_flag=True)
+                           override_acr_flag=True, opts=self.opts)
                 done_count += 1
             except CoprRequestException as err:
                 # fixme: dirty hack to catch case when createrepo invoked upon deleted project
@@ -109,7 +109,8 @@ class Action(object):
         path = os.path.normpath(self.destdir + '/' + project)
         if os.path.exists(path):
             self.log.info("Removing copr {0}".format(path))
-            shutil.rmtree(path)
+            # the whole project could be huge, don't block other action threads
+            remove_tree(path)
 
     def handle_comps_update(self, result):
         self.log.debug("Action delete build")
@@ -200,7 +201,9 @@ class Action(object):
                     createrepo(
                         path=createrepo_target,
                         front_url=self.front_url, base_url=result_base_url,
-                        username=username, projectname=projectname
+                        username=username, projectname=projectname,
+                        removed=[pkg_path],
+                        opts=self.opts,
                     )
                 except CreateRepoError:
                     self.log.exception("Error making local repo: {}".format(createrepo_target))
@@ -234,6 +237,16 @@ class Action(object):
 
     def run(self):
         """ Handle action (other then builds) - like rename or delete of project """
+        result = self.execute()
+        if result is not None:
+            self.frontend_client.update({"actions": [result]})
+
+    def execute(self):
+        """
+        Handle action without sending the result to frontend
+
+        :return Munch: result for frontend, None when there is nothing to report
+        """
         result = Munch()
         result.id = self.data["id"]
 
@@ -264,12 +277,13 @@ class Action(object):
 
         self.log.info("Action result: {}".format(result))
 
-        if "result" in result:
-            if result.result == ActionResult.SUCCESS and \
-                    not getattr(result, "job_ended_on", None):
-                result.job_ended_on = time.time()
+        if "result" not in result:
+            return None
 
-            self.frontend_client.update({"actions": [result]})
+        if result.result == ActionResult.SUCCESS and \
+                not getattr(result, "job_ended_on", None):
+            result.job_ended_on = time.time()
+        return result
 
 
 class ActionType(object):
@@ -0,0 +1,321 @@
+# coding: utf-8
+
+"""
+Build logs stored as compressed segments readable while the build runs.
+
+For the log ``<path>`` the writer maintains:
+
+- ``<path>.gz``: append-only concatenation of gzip members, one per segment,
+  which is itself a valid gzip file of the whole log
+- ``<path>.idx``: one line ``<raw offset> <raw size> <gz offset> <gz size>``
+  per finished segment
+- ``<path>.part-<N>``: plain text of the unfinished segment number N,
+  exists only while the log is written
+
+The part file is never modified after the segment is finished. The next part
+is created before the previous one is removed, so readers find a consistent
+state by re-reading the index when the expected part file is gone.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import errno
+import logging
+import os
+import zlib
+
+from munch import Munch
+from urlparse import parse_qs
+
+# size in bytes of the plain text compressed into one gzip member
+DEFAULT_SEGMENT_SIZE = 256 * 1024
+# max bytes returned by one read of the log
+DEFAULT_READ_LIMIT = 1024 * 1024
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def get_part_path(path, number):
+    return "{0}.part-{1}".format(path, number)
+
+
+def compress_member(data):
+    """
+    :param bytes data: plain text
+    :return bytes: one complete gzip member
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def read_index(path):
+    """
+    :param str path: path of the log
+    :return list: Munch with ``raw_offset``, ``raw_size``, ``gz_offset``
+        and ``gz_size`` for each finished segment
+    """
+    try:
+        with open(path + ".idx", "rb") as handle:
+            content = handle.read().decode("utf-8")
+    except IOError as error:
+        if error.errno == errno.ENOENT:
+            return []
+        raise
+
+    segments = []
+    for line in content.split("\n")[:-1]:
+        # the last, incomplete line might be written right now
+        raw_offset, raw_size, gz_offset, gz_size = [int(x) for x in line.split()]
+        segments.append(Munch(raw_offset=raw_offset, raw_size=raw_size,
+                              gz_offset=gz_offset, gz_size=gz_size))
+    return segments
+
+
+def exists(path):
+    """
+    :return bool: segmented log was started at the ``path``
+    """
+    return os.path.exists(path + ".idx")
+
+
+class SegmentedLogWriter(object):
+    """
+    File-like writer of the segmented log. When the log already exists
+    new data are appended to it.
+
+    :param str path: path of the log
+    :param int segment_size: plain text size of one segment
+    """
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+
+        segments = read_index(path)
+        self.number = len(segments)
+        self.raw_offset = sum(seg.raw_size for seg in segments)
+        self.gz_offset = segments[-1].gz_offset + segments[-1].gz_size if segments else 0
+
+        # touch the index, so the log is visible to the readers
+        open(path + ".idx", "ab").close()
+        self.part = open(get_part_path(path, self.number), "ab")
+        self.part_size = self.part.tell()
+
+    @property
+    def closed(self):
+        return self.part is None
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self.part.write(data)
+        self.part.flush()
+        self.part_size += len(data)
+        if self.part_size >= self.segment_size:
+            self.finish_segment(last=False)
+
+    def flush(self):
+        if self.part is not None:
+            self.part.flush()
+
+    def finish_segment(self, last):
+        """
+        Compresses the current part into a new segment
+
+        :param bool last: don't start the next part
+        """
+        part_path = get_part_path(self.path, self.number)
+        self.part.close()
+        self.part = None
+
+        if self.part_size:
+            with open(part_path, "rb") as handle:
+                member = compress_member(handle.read())
+
+            with open(self.path + ".gz", "r+b" if os.path.exists(self.path + ".gz") else "wb") as gz:
+                # drop a member left unindexed by a crashed writer
+                gz.seek(self.gz_offset)
+                gz.write(member)
+                gz.truncate()
+
+            with open(self.path + ".idx", "ab") as index:
+                index.write("{0} {1} {2} {3}\n".format(
+                    self.raw_offset, self.part_size, self.gz_offset, len(member)).encode("utf-8"))
+
+            self.number += 1
+            self.raw_offset += self.part_size
+            self.gz_offset += len(member)
+            self.part_size = 0
+
+        if not last:
+            self.part = open(get_part_path(self.path, self.number), "ab")
+        os.remove(part_path)
+
+    def close(self):
+        if self.part is not None:
+            self.finish_segment(last=True)
+
+
+def read_log(path, offset=0, limit=DEFAULT_READ_LIMIT):
+    """
+    Reads the plain text of the log starting at ``offset``, works with both
+    finished logs and logs being written.
+
+    :param str path: path of the log
+    :param int offset: position in the plain text
+    :param int limit: max number of returned bytes
+    :return Munch: ``data``, ``offset`` to continue with and ``finished`` when
+        the log was closed by the writer and all data were read
+    """
+    previous = None
+    while True:
+        segments = read_index(path)
+        part_path = get_part_path(path, len(segments))
+        try:
+            part = open(part_path, "rb")
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            part = None
+            if previous != len(segments):
+                # the part was finished in the meantime, look again
+                previous = len(segments)
+                continue
+        break
+
+    chunks = _read_segments(path, segments, offset, limit)
+    wanted = limit - sum(len(chunk) for chunk in chunks)
+    raw_end = segments[-1].raw_offset + segments[-1].raw_size if segments else 0
+
+    if part is not None:
+        with part:
+            if wanted > 0:
+                part.seek(max(0, offset - raw_end))
+                chunks.append(part.read(wanted))
+
+    data = b"".join(chunks)
+    next_offset = max(offset, raw_end) if not data else offset + len(data)
+    return Munch(data=data, offset=next_offset,
+                 finished=part is None and next_offset >= raw_end)
+
+
+def _read_segments(path, segments, offset, limit):
+    chunks = []
+    needed = [seg for seg in segments if seg.raw_offset + seg.raw_size > offset]
+    if not needed:
+        return chunks
+
+    with open(path + ".gz", "rb") as gz:
+        for seg in needed:
+            if limit <= 0:
+                break
+            gz.seek(seg.gz_offset)
+            data = zlib.decompress(gz.read(seg.gz_size), GZIP_WBITS)
+            start = max(0, offset - seg.raw_offset)
+            chunks.append(data[start:start + limit])
+            limit -= len(chunks[-1])
+    return chunks
+
+
+def assemble(path, dst_path):
+    """
+    Creates the gzip file of the whole log at ``dst_path`` by copying the
+    compressed segments, nothing is recompressed. The unfinished part left
+    by a crashed writer is appended as one more gzip member.
+    """
+    segments = read_index(path)
+    gz_size = segments[-1].gz_offset + segments[-1].gz_size if segments else 0
+    part_path = get_part_path(path, len(segments))
+
+    with open(dst_path, "wb") as dst:
+        if gz_size:
+            with open(path + ".gz", "rb") as src:
+                _copy(src, dst, gz_size)
+        if os.path.exists(part_path):
+            with open(part_path, "rb") as part:
+                data = part.read()
+            if data:
+                dst.write(compress_member(data))
+
+
+def _copy(src, dst, size):
+    while size > 0:
+        chunk = src.read(min(size, 64 * 1024))
+        if not chunk:
+            break
+        dst.write(chunk)
+        size -= len(chunk)
+
+
+class SegmentedLogHandler(logging.StreamHandler):
+    """
+    Logging handler writing into the segmented log, the last segment is
+    finished when the handler is closed
+    """
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE):
+        super(SegmentedLogHandler, self).__init__(SegmentedLogWriter(path, segment_size))
+
+    def close(self):
+        self.acquire()
+        try:
+            self.stream.close()
+        finally:
+            self.release()
+        super(SegmentedLogHandler, self).close()
+
+
+def get_log_path(destdir, owner, project, chroot, build_id):
+    """
+    :return str: path of the build log written by the backend worker
+    """
+    return os.path.join(destdir, owner, project, chroot, "build-{0:08d}.log".format(build_id))
+
+
+def make_tail_app(destdir, max_limit=DEFAULT_READ_LIMIT):
+    """
+    WSGI application serving new parts of the build logs::
+
+        GET /<owner>/<project>/<chroot>/<build id>?offset=<N>[&limit=<M>]
+
+    The response body contains the plain text starting at ``offset``,
+    the ``X-Log-Offset`` header tells the offset for the next request and
+    ``X-Log-Finished`` is ``1`` when nothing more will be written.
+
+    :param str destdir: results directory of the backend
+    :param int max_limit: max bytes returned by one request
+    """
+    def application(environ, start_response):
+        def respond(status, body, headers=None):
+            start_response(str(status), [(str(k), str(v)) for k, v in
+                                         [("Content-Type", "text/plain")] + (headers or [])])
+            return [body]
+
+        parts = environ.get("PATH_INFO", "").strip("/").split("/")
+        if len(parts) != 4 or any(part in ["", ".", ".."] for part in parts) \
+                or not parts[3].isdigit():
+            return respond("404 Not Found", b"")
+
+        try:
+            query = parse_qs(environ.get("QUERY_STRING", ""))
+            offset = int(query.get("offset", ["0"])[0])
+            limit = min(int(query.get("limit", [max_limit])[0]), max_limit)
+        except ValueError:
+            return respond("400 Bad Request", b"offset and limit must be integers")
+        if offset < 0 or limit < 0:
+            return respond("400 Bad Request", b"offset and limit must not be negative")
+
+        owner, project, chroot, build_id = parts
+        path = get_log_path(destdir, owner, project, chroot, int(build_id))
+        if not exists(path):
+            return respond("404 Not Found", b"")
+
+        result = read_log(path, offset, limit)
+        return respond("200 OK", result.data, [
+            ("Content-Length", len(result.data)),
+            ("X-Log-Offset", result.offset),
+            ("X-Log-Finished", int(result.finished)),
+        ])
+
+    return application
@@ -13,6 +13,13 @@ DEF_DESTDIR = os.getcwd()
 DEF_MACROS = {}
 DEF_BUILDROOT_PKGS = ""
 
+# log records are sent to the log router in batches of this size
+DEF_LOG_BATCH_SIZE = 100
+# max seconds a log record waits in the batch
+DEF_LOG_FLUSH_INTERVAL = 0.5
+# max records waiting for the log router, the oldest are dropped
+DEF_LOG_QUEUE_MAX_LEN = 1000000
+
 
 DEF_CONSECUTIVE_FAILURE_THRESHOLD = 10
 CONSECUTIVE_FAILURE_REDIS_KEY = "copr:sys:consecutive_build_fails"
@@ -26,8 +33,17 @@ class BuildStatus(object):
     SKIPPED = 5
 
 
-JOB_GRAB_TASK_END_PUBSUB = "copr:backend:daemons:job_grab:task_end:pubsub::"
-LOG_PUB_SUB = "copr:backend:log:pubsub::"
+# redis list, frontend pushes json messages with new build tasks and actions here
+JOB_GRAB_TASK_PUSH_LIST = "copr:backend:daemons:job_grab:task_push:list::"
+# redis hash, task_id -> json with queue position and ETA of tasks waiting in job grabber
+JOB_GRAB_SCHEDULE_HASH = "copr:backend:daemons:job_grab:schedule:hash::"
+# redis hash, group id -> number of tasks waiting in job grabber, expires when not refreshed
+JOB_GRAB_BACKLOG_HASH = "copr:backend:daemons:job_grab:backlog:hash::"
+# redis list of json log records waiting for the log router
+LOG_QUEUE = "copr:backend:log:queue::"
+# redis pubsub channel, any message stops the running build chroots of the build,
+# frontend publishes there when the build is cancelled
+PUBSUB_CANCEL_BUILD = "copr:backend:cancel_build:pubsub::{build_id}"
 
 from logging import Formatter
 default_log_format = Formatter(
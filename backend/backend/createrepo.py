@@ -1,29 +1,54 @@
+import bz2
+from contextlib import closing
+import fcntl
+import gzip
+import json
 import os
+import sqlite3
+import tempfile
+import time
 from subprocess import Popen, PIPE
 
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
 from setproctitle import getproctitle, setproctitle
 from shlex import split
 from lockfile import LockFile
+from munch import Munch
 
 # todo: add logging here
 # from backend.helpers import BackendConfigReader, get_redis_logger
 # opts = BackendConfigReader().read()
 # log = get_redis_logger(opts, "createrepo", "actions")
 
-from .helpers import get_auto_createrepo_status
+from .helpers import get_auto_createrepo_status, get_redis_connection
+from .project_cache import ProjectCache
 from .exceptions import CreateRepoError
 
 
 def run_cmd_unsafe(comm_str, lock_path):
+    """
+    :param str lock_path: lock held while the command runs,
+        None when the caller already holds it
+    """
     # log.info("Running command: {}".format(comm_str))
     comm = split(comm_str)
     title = getproctitle()
     try:
         # TODO change this to logger
         setproctitle("[locked] in createrepo")
-        with LockFile(lock_path):
+        lock = LockFile(lock_path) if lock_path is not None else None
+        if lock is not None:
+            lock.acquire()
+        try:
             cmd = Popen(comm, stdout=PIPE, stderr=PIPE)
             out, err = cmd.communicate()
+        finally:
+            if lock is not None:
+                lock.release()
     except Exception as err:
         raise CreateRepoError(msg="Failed to execute: {}".format(err), cmd=comm_str)
     setproctitle(title)
@@ -35,18 +60,189 @@ def run_cmd_unsafe(comm_str, lock_path):
     return out
 
 
-def createrepo_unsafe(path, dest_dir=None, base_url=None):
+REPO_NS = "http://linux.duke.edu/metadata/repo"
+COMMON_NS = "http://linux.duke.edu/metadata/common"
+
+METADATA_OPENERS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.BZ2File,
+    ".xml": open,
+}
+
+
+def get_metadata_hrefs(repo_dir):
+    """
+    :param str repo_dir: directory with `repodata`
+    :return dict: metadata type -> path relative to `repo_dir`,
+        None when repomd.xml is missing or unreadable
+    """
+    try:
+        repomd = ElementTree.parse(os.path.join(repo_dir, "repodata", "repomd.xml")).getroot()
+    except (IOError, ElementTree.ParseError):
+        return None
+
+    return dict((data.get("type"), data.find("{{{}}}location".format(REPO_NS)).get("href"))
+                for data in repomd.findall("{{{}}}data".format(REPO_NS)))
+
+
+def get_repo_locations(repo_dir):
+    """
+    Reads locations of packages from the primary metadata
+
+    :param str repo_dir: directory with `repodata`
+    :return set: package paths relative to the packages directory,
+        None when metadata are missing or unreadable
+    """
+    packages = read_primary_xml(repo_dir)
+    if packages is None:
+        return None
+    return set(pkg.location for pkg in packages)
+
+
+def read_primary_xml(repo_dir):
+    """
+    Streams the packages from the primary xml metadata
+
+    :param str repo_dir: directory with `repodata`
+    :return list: Munch with `name`, `arch`, `epoch`, `version`, `release`
+        and `location` of each package, None when metadata are missing or unreadable
+    """
+    href = (get_metadata_hrefs(repo_dir) or {}).get("primary")
+    opener = METADATA_OPENERS.get(os.path.splitext(href or "")[1])
+    if opener is None:
+        return None
+
+    tags = dict((name, "{{{}}}{}".format(COMMON_NS, name))
+                for name in ["package", "name", "arch", "version", "location"])
+    packages = []
+    try:
+        with closing(opener(os.path.join(repo_dir, href))) as handle:
+            for _, elem in ElementTree.iterparse(handle):
+                if elem.tag != tags["package"]:
+                    continue
+                version = elem.find(tags["version"])
+                evr = version.attrib if version is not None else {}
+                packages.append(Munch(
+                    name=elem.findtext(tags["name"]),
+                    arch=elem.findtext(tags["arch"]),
+                    epoch=evr.get("epoch"),
+                    version=evr.get("ver"),
+                    release=evr.get("rel"),
+                    location=elem.find(tags["location"]).get("href"),
+                ))
+                elem.clear()
+    except (IOError, EOFError, AttributeError, ElementTree.ParseError):
+        return None
+    return packages
+
+
+def read_primary_db(repo_dir):
+    """
+    Reads the packages from the primary sqlite database, faster than
+    :py:func:`read_primary_xml` but createrepo doesn't have to generate it
+
+    :param str repo_dir: directory with `repodata`
+    :return list: same as :py:func:`read_primary_xml`, None when the database
+        is missing or unreadable
+    """
+    href = (get_metadata_hrefs(repo_dir) or {}).get("primary_db")
+    opener = METADATA_OPENERS.get(os.path.splitext(href or "")[1])
+    if opener is None or opener is open:
+        return None
+
+    # sqlite needs the uncompressed file
+    with tempfile.NamedTemporaryFile(suffix=".sqlite") as db_file:
+        try:
+            with closing(opener(os.path.join(repo_dir, href))) as handle:
+                for chunk in iter(lambda: handle.read(64 * 1024), b""):
+                    db_file.write(chunk)
+            db_file.flush()
+
+            with closing(sqlite3.connect(db_file.name)) as conn:
+                rows = conn.execute("SELECT name, arch, epoch, version, release, location_href "
+                                    "FROM packages").fetchall()
+        except (IOError, EOFError, sqlite3.Error):
+            return None
+
+    return [Munch(name=name, arch=arch, epoch=epoch, version=version, release=release,
+                  location=location)
+            for name, arch, epoch, version, release, location in rows]
+
+
+def get_repo_packages(repo_dir):
+    """
+    :param str repo_dir: directory with `repodata`
+    :return list: see :py:func:`read_primary_xml`, None when metadata are missing
+    """
+    packages = read_primary_db(repo_dir)
+    if packages is None:
+        packages = read_primary_xml(repo_dir)
+    return packages
+
+
+def get_dir_prefixes(path, dirs):
+    """
+    :param list dirs: build directories, absolute or relative to `path`
+    :return tuple: prefixes of the package locations in these directories
+    """
+    return tuple(os.path.relpath(os.path.join(path, name), path) + "/" for name in dirs)
+
+
+def get_incremental_pkglist(path, repo_dir, changed_dirs, locations=None):
+    """
+    Lists packages of the repository after the change of the given build
+    directories. Packages from other directories are taken from the existing
+    metadata, changed directories are listed on the disk.
+
+    :param str path: packages directory
+    :param str repo_dir: directory with the existing `repodata`
+    :param list changed_dirs: added or removed build directories,
+        absolute or relative to `path`
+    :param set locations: [optional] result of :py:func:`get_repo_locations`, when already read
+    :return list: package paths relative to `path`, None when
+        the existing metadata can't be used
+    """
+    if locations is None:
+        locations = get_repo_locations(repo_dir)
+    if locations is None:
+        return None
+
+    prefixes = get_dir_prefixes(path, changed_dirs)
+    changed = [prefix[:-1] for prefix in prefixes]
+    pkglist = set(location for location in locations if not location.startswith(prefixes))
+    for name in changed:
+        dir_path = os.path.join(path, name)
+        if os.path.isdir(dir_path):
+            pkglist.update(os.path.join(name, filename) for filename in os.listdir(dir_path)
+                           if filename.endswith(".rpm"))
+    return sorted(pkglist)
+
+
+def createrepo_unsafe(path, dest_dir=None, base_url=None, added=None, removed=None):
     """
         Run createrepo_c on the given path
 
         Warning! This function doesn't check user preferences.
         In most cases use `createrepo(...)`
 
+        When `added` or `removed` build directories are provided and the repo
+        already has metadata, runs incremental update: createrepo_c gets the
+        complete package list and reuses the old metadata of unchanged packages
+        without stat-ing them, only packages of the changed directories are read.
+        Rebuilds reuse the build directory and the package file names, when the
+        old metadata already list packages of an added directory, all packages
+        are stat-ed so the rebuilt ones are read again.
+        Without them the whole directory is scanned.
+        The package list is read under the same `createrepo.lock` as createrepo_c
+        runs, so it can't be computed from metadata a concurrent run replaces.
+
     :param string path: target location to create repo
     :param lock: [optional]
     :param str dest_dir: [optional] relative to path location for repomd, in most cases
         you should also provide base_url.
     :param str base_url: optional parameter for createrepo_c, "--baseurl"
+    :param list added: [optional] build directories with the new packages
+    :param list removed: [optional] deleted build directories
 
     :return tuple: (return_code,  stdout, stderr)
     """
@@ -58,11 +254,13 @@ def createrepo_unsafe(path, dest_dir=None, base_url=None):
         # this is because rhel-5 doesn't know sha256
         comm.extend(['-s', 'sha', '--checksum', 'md5'])
 
+    repo_dir = path
     if dest_dir:
         dest_dir_path = os.path.join(path, dest_dir)
         comm.extend(['--outputdir', dest_dir_path])
         if not os.path.exists(dest_dir_path):
             os.makedirs(dest_dir_path)
+        repo_dir = dest_dir_path
 
     if base_url:
         comm.extend(['--baseurl', base_url])
@@ -71,9 +269,43 @@ def createrepo_unsafe(path, dest_dir=None, base_url=None):
     if os.path.exists(mb_comps_xml_path):
         comm.extend(['--groupfile', mb_comps_xml_path, '--keep-all-metadata'])
 
-    comm.append(path)
+    lock_path = os.path.join(path, "createrepo.lock")
+    if added is None and removed is None:
+        comm.append(path)
+        return run_cmd_unsafe(" ".join(map(str, comm)), lock_path)
 
-    return run_cmd_unsafe(" ".join(map(str, comm)), os.path.join(path, "createrepo.lock"))
+    # package list must be read from the metadata the command is going to update,
+    # concurrent createrepo could publish packages of the removed directory again
+    try:
+        lock = LockFile(lock_path)
+        lock.acquire()
+    except Exception as err:
+        raise CreateRepoError(msg="Failed to lock: {}".format(err), cmd=" ".join(comm))
+    try:
+        locations = get_repo_locations(repo_dir)
+        pkglist = get_incremental_pkglist(path, repo_dir, (added or []) + (removed or []),
+                                          locations=locations)
+        if pkglist is None:
+            comm.append(path)
+            return run_cmd_unsafe(" ".join(map(str, comm)), None)
+
+        reused = get_dir_prefixes(path, added or [])
+        skip_stat = not any(location.startswith(reused) for location in locations)
+
+        fd, pkglist_path = tempfile.mkstemp(prefix="copr-pkglist-")
+        try:
+            with os.fdopen(fd, "w") as handle:
+                handle.write("".join(name + "\n" for name in pkglist))
+            if "--update" not in comm:
+                comm.append("--update")
+            if skip_stat:
+                comm.append("--skip-stat")
+            comm.extend(["--pkglist", pkglist_path, path])
+            return run_cmd_unsafe(" ".join(map(str, comm)), None)
+        finally:
+            os.remove(pkglist_path)
+    finally:
+        lock.release()
 
 
 APPDATA_CMD_TEMPLATE = \
@@ -136,7 +368,7 @@ def add_appdata(path, username, projectname, lock=None):
 
 
 def createrepo(path, front_url, username, projectname,
-               override_acr_flag=False, base_url=None):
+               override_acr_flag=False, base_url=None, added=None, removed=None, opts=None):
     """
         Creates repo depending on the project setting "auto_createrepo".
         When enabled creates `repodata` at the provided path, otherwise
@@ -146,7 +378,11 @@ def createrepo(path, front_url, username, projectname,
     :param username: copr project owner username
     :param projectname: copr project name
     :param base_url: base_url to access rpms independently of repomd location
+    :param added: [optional] build directories with new packages, see `createrepo_unsafe`
+    :param removed: [optional] deleted build directories, see `createrepo_unsafe`
     :param Multiprocessing.Lock lock:  [optional] global copr-backend lock
+    :param Munch opts: [optional] backend config, project setting is taken from
+        the :py:class:`~backend.project_cache.ProjectCache` when provided
 
     :return: tuple(returncode, stdout, stderr) produced by `createrepo_c`
     """
@@ -154,10 +390,180 @@ def createrepo(path, front_url, username, projectname,
 
     base_url = base_url or ""
 
-    acr_flag = get_auto_createrepo_status(front_url, username, projectname)
+    if opts is not None:
+        acr_flag = ProjectCache(opts).get_auto_createrepo(username, projectname)
+    else:
+        acr_flag = get_auto_createrepo_status(front_url, username, projectname)
     if override_acr_flag or acr_flag:
-        out_cr = createrepo_unsafe(path)
+        out_cr = createrepo_unsafe(path, added=added, removed=removed)
         out_ad = add_appdata(path, username, projectname)
         return "\n".join([out_cr, out_ad])
     else:
-        return createrepo_unsafe(path, base_url=base_url, dest_dir="devel")
+        return createrepo_unsafe(path, base_url=base_url, dest_dir="devel",
+                                 added=added, removed=removed)
+
+
+KEY_CREATEREPO_REQUESTED = "copr:backend:createrepo:requested::{path}"
+KEY_CREATEREPO_PUBLISHED = "copr:backend:createrepo:published::{path}"
+KEY_CREATEREPO_CHANGES = "copr:backend:createrepo:changes:list::{path}"
+KEY_CREATEREPO_STATS = "copr:backend:createrepo:stats:hash::"
+
+# serializes regenerations of one directory, kept apart from createrepo.lock
+# which guards the single createrepo_c/appdata commands
+COALESCE_LOCK_NAME = "createrepo.queue.lock"
+
+# numbers the request and stores its changes in one step,
+# so the changes list is ordered by the ticket numbers
+request_lua = """
+local number = redis.call("INCR", KEYS[1])
+redis.call("RPUSH", KEYS[2], number .. ":" .. ARGV[1])
+redis.call("HINCRBY", KEYS[3], "requests", 1)
+return number
+"""
+
+
+class CreaterepoTicket(object):
+    """
+    Request to publish new packages in the repository directory,
+    obtained from :py:meth:`CreaterepoCoalescer.request`
+
+    :ivar str path: repository directory
+    :ivar int number: sequence number of the request for the directory
+    :ivar float requested_on: timestamp of the request
+    """
+    def __init__(self, coalescer, path, number):
+        self.coalescer = coalescer
+        self.path = path
+        self.number = number
+        self.requested_on = time.time()
+
+    @property
+    def published(self):
+        """
+        True when repodata covering this request were generated
+        """
+        return self.coalescer.get_published(self.path) >= self.number
+
+    def wait(self, regenerate):
+        """
+        See :py:meth:`CreaterepoCoalescer.process`
+        """
+        return self.coalescer.process(self, regenerate)
+
+    def __repr__(self):
+        return "<CreaterepoTicket {}#{}>".format(self.path, self.number)
+
+
+class CreaterepoCoalescer(object):
+    """
+    Coalesce repository regenerations requested by concurrent workers.
+
+    Each worker gets a numbered ticket for the directory and waits on the
+    per-directory file lock. The lock holder waits ``createrepo_batch_delay``
+    seconds for more requests, notes the latest ticket number and runs one
+    regeneration which publishes packages of all tickets up to that number.
+    Workers which get the lock later with the already published ticket
+    return without running createrepo. When the regeneration fails, waiting
+    workers aren't marked as published and the next one tries again.
+
+    File lock is released by the kernel when the worker dies, so no lock
+    could be left behind.
+
+    :param Munch opts: backend config, uses redis settings
+        and ``createrepo_batch_delay``
+    :param rc: [optional] redis connection
+    """
+    def __init__(self, opts, rc=None):
+        self.opts = opts
+        self.rc = rc or get_redis_connection(opts)
+        self.batch_delay = opts.get("createrepo_batch_delay", 0)
+
+        self.request_script = self.rc.register_script(request_lua)
+
+    def request(self, path, added=None, removed=None):
+        """
+        Notes that packages in the directory were changed
+
+        :param str path: repository directory
+        :param list added: [optional] build directories with new packages
+        :param list removed: [optional] deleted build directories
+        :rtype: CreaterepoTicket
+
+        Without ``added`` and ``removed`` the whole repository is regenerated.
+        """
+        path = os.path.normpath(path)
+        changes = None
+        if added is not None or removed is not None:
+            changes = {"added": added or [], "removed": removed or []}
+        number = self.request_script(
+            keys=[KEY_CREATEREPO_REQUESTED.format(path=path),
+                  KEY_CREATEREPO_CHANGES.format(path=path),
+                  KEY_CREATEREPO_STATS],
+            args=[json.dumps(changes)])
+        return CreaterepoTicket(self, path, int(number))
+
+    def _take_changes(self, path, covered):
+        """
+        :return tuple: (count of the covered requests in the changes list,
+            merged changes or None when the whole repository should be regenerated)
+        """
+        count = 0
+        merged = Munch(added=[], removed=[])
+        for item in self.rc.lrange(KEY_CREATEREPO_CHANGES.format(path=path), 0, -1):
+            number, changes = item.split(":", 1)
+            if int(number) > covered:
+                break
+            count += 1
+            changes = json.loads(changes)
+            if changes is None:
+                merged = None
+            elif merged is not None:
+                merged.added.extend(changes["added"])
+                merged.removed.extend(changes["removed"])
+        return count, merged
+
+    def get_published(self, path):
+        """
+        :return int: number of the last ticket covered by generated repodata
+        """
+        return int(self.rc.get(KEY_CREATEREPO_PUBLISHED.format(path=path)) or 0)
+
+    def process(self, ticket, regenerate):
+        """
+        Blocks until packages of the ticket are published
+
+        :param CreaterepoTicket ticket:
+        :param callable regenerate: function which regenerates repodata
+            in ``ticket.path``, gets merged changes of all covered requests:
+            Munch with ``added`` and ``removed`` lists, or None when
+            the whole repository should be regenerated
+        :return bool: True when this call ran ``regenerate``, False when
+            the ticket was published by another worker
+        :raises CreateRepoError: when ``regenerate`` failed
+        """
+        with open(os.path.join(ticket.path, COALESCE_LOCK_NAME), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if ticket.published:
+                    return False
+
+                if self.batch_delay:
+                    time.sleep(self.batch_delay)
+                covered = int(self.rc.get(KEY_CREATEREPO_REQUESTED.format(path=ticket.path)))
+                count, changes = self._take_changes(ticket.path, covered)
+
+                regenerate(changes)
+                # only the lock holder writes, so the value never decreases
+                self.rc.set(KEY_CREATEREPO_PUBLISHED.format(path=ticket.path), covered)
+                self.rc.ltrim(KEY_CREATEREPO_CHANGES.format(path=ticket.path), count, -1)
+                self.rc.hincrby(KEY_CREATEREPO_STATS, "runs", 1)
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get_stats(self):
+        """
+        :return dict: total number of ``requests`` and createrepo ``runs``
+        """
+        stats = self.rc.hgetall(KEY_CREATEREPO_STATS)
+        return {key: int(stats.get(key, 0)) for key in ["requests", "runs"]}
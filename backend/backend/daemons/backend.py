@@ -14,13 +14,13 @@ from collections import defaultdict
 
 import lockfile
 from daemon import DaemonContext
+from redis.exceptions import ConnectionError
 from requests import RequestException
-from retask.queue import Queue
-from retask import ConnectionError
 from backend.frontend import FrontendClient
 
 from ..exceptions import CoprBackendError
 from ..helpers import BackendConfigReader, get_redis_logger
+from ..task_queue import get_group_task_queue
 from .dispatcher import Worker
 
 
@@ -63,22 +63,19 @@ class CoprBackend(object):
         """
         try:
             for queue in self.task_queues.values():
-                while queue.length:
-                    queue.dequeue()
+                queue.clean()
         except ConnectionError:
             raise CoprBackendError(
                 "Could not connect to a task queue. Is Redis running?")
 
     def init_task_queues(self):
         """
-        Connect to the retask.Queue for each group_id. Remove old tasks from queues.
+        Connect to the task queue for each group_id. Remove old tasks from queues.
         """
         try:
             for group in self.opts.build_groups:
                 group_id = group["id"]
-                queue = Queue("copr-be-{0}".format(group_id))
-                queue.connect()
-                self.task_queues[group_id] = queue
+                self.task_queues[group_id] = get_group_task_queue(self.opts, group_id)
         except ConnectionError:
             raise CoprBackendError(
                 "Could not connect to a task queue. Is Redis running?")
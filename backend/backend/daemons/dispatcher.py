@@ -1,21 +1,24 @@
+from contextlib import contextmanager
 from datetime import datetime
-import json
 import os
+import threading
 import time
 import gzip
 import shutil
 import multiprocessing
 from setproctitle import setproctitle
 
-from retask.queue import Queue
-
 from ..vm_manage.manager import VmManager
-from ..exceptions import MockRemoteError, CoprWorkerError, VmError, NoVmAvailable
+from ..exceptions import MockRemoteError, CoprWorkerError, VmError, NoVmAvailable, TaskLeaseLost
 from ..job import BuildJob
 from ..mockremote import MockRemote
-from ..constants import BuildStatus, JOB_GRAB_TASK_END_PUBSUB, build_log_format
-from ..helpers import register_build_result, get_redis_connection, get_redis_logger, \
-    local_file_logger
+from ..createrepo import CreaterepoCoalescer
+from .. import build_log
+from ..build_log import DEFAULT_SEGMENT_SIZE
+from ..constants import BuildStatus, build_log_format
+from ..helpers import register_build_result, get_redis_logger, local_file_logger
+from ..task_queue import get_group_task_queue
+from ..vm_manage import PUBSUB_INTERRUPT_BUILDER
 
 
 # ansible_playbook = "ansible-playbook"
@@ -32,7 +35,8 @@ class Worker(multiprocessing.Process):
     Worker process dispatches building tasks. Backend spin-up multiple workers, each
     worker associated to one group_id and process one task at the each moment.
 
-    Worker listens for the new tasks from :py:class:`retask.Queue` associated with its group_id
+    Worker acquires new tasks from :py:class:`~backend.task_queue.TaskQueue` associated with its group_id
+    and holds the task lease until the build is finished
 
     :param Munch opts: backend config
     :param int worker_num: worker number
@@ -52,9 +56,11 @@ class Worker(multiprocessing.Process):
         self.log = get_redis_logger(self.opts, self.logger_name, "worker")
 
         # job management stuff
-        self.task_queue = Queue("copr-be-{0}".format(str(group_id)))
-        self.task_queue.connect()
-        # event queue for communicating back to dispatcher
+        self.task_queue = get_group_task_queue(self.opts, group_id)
+        # lease of the currently processed task
+        self.task_lease = None
+        # set when the lease couldn't be renewed, the task mustn't be reported then
+        self.task_lease_lost = threading.Event()
 
         self.kill_received = False
 
@@ -62,8 +68,8 @@ class Worker(multiprocessing.Process):
         self.vm_name = None
         self.vm_ip = None
 
-        self.rc = None
         self.vmm = VmManager(self.opts)
+        self.createrepo_coalescer = CreaterepoCoalescer(self.opts)
 
     @property
     def logger_name(self):
@@ -226,7 +232,7 @@ class Worker(multiprocessing.Process):
     #     self._announce_start(job)
     #     self.log.info("Skipping: package {} has been already built before.".format(job.pkg))
     #     job.status = BuildStatus.SKIPPED
-    #     self.notify_job_grab_about_task_end(job)
+    #     self.release_task()
     #     self._announce_end(job)
 
     def obtain_job(self):
@@ -234,18 +240,12 @@ class Worker(multiprocessing.Process):
         Retrieves new build task from queue.
         Checks if the new job can be started and not skipped.
         """
-        # ToDo: remove retask, use redis lua fsm logic similiar to VMM
-        # this sometimes caused TypeError in random worker
-        # when another one  picekd up a task to build
-        # why?
-        try:
-            task = self.task_queue.dequeue()
-        except TypeError:
-            return
-        if not task:
+        lease = self.task_queue.acquire(timeout=self.opts.sleeptime)
+        if not lease:
             return
 
-        job = BuildJob(task.data, self.opts)
+        self.task_lease = lease
+        job = BuildJob(lease.data, self.opts)
         self.update_process_title(suffix="Task: {} chroot: {}, obtained at {}"
                                   .format(job.build_id, job.chroot, str(datetime.now())))
 
@@ -256,7 +256,9 @@ class Worker(multiprocessing.Process):
         Executes new job.
 
         :param job: :py:class:`~backend.job.BuildJob`
+        :raises TaskLeaseLost: the task belongs to another worker, nothing was reported
         """
+        self.check_task_lease()
 
         self._announce_start(job)
         self.update_process_title(suffix="Task: {} chroot: {} build started"
@@ -289,13 +291,15 @@ class Worker(multiprocessing.Process):
             with local_file_logger(
                 "{}.builder.mr".format(self.logger_name),
                 job.chroot_log_path,
-                fmt=build_log_format) as build_logger:
+                fmt=build_log_format,
+                segment_size=self.opts.get("build_log_segment_size", DEFAULT_SEGMENT_SIZE)) as build_logger:
                 try:
                     mr = MockRemote(
                         builder_host=self.vm_ip,
                         job=job,
                         logger=build_logger,
-                        opts=self.opts
+                        opts=self.opts,
+                        createrepo_coalescer=self.createrepo_coalescer,
                     )
                     mr.check()
 
@@ -325,6 +329,7 @@ class Worker(multiprocessing.Process):
             self.copy_mock_logs(job)
 
         job.status = status
+        self.check_task_lease()
         self._announce_end(job)
         self.update_process_title(suffix="Task: {} chroot: {} done"
                                   .format(job.build_id, job.chroot))
@@ -341,6 +346,10 @@ class Worker(multiprocessing.Process):
         for src_name, dst_name in log_names:
             src = os.path.join(job.chroot_dir, src_name)
             dst = os.path.join(job.results_dir, dst_name)
+            if build_log.exists(src):
+                # segments are already compressed
+                build_log.assemble(src, dst)
+                continue
             try:
                 with open(src, "rb") as f_src, gzip.open(dst, "wb") as f_dst:
                     f_dst.writelines(f_src)
@@ -385,17 +394,135 @@ class Worker(multiprocessing.Process):
 
         setproctitle(title)
 
-    def notify_job_grab_about_task_end(self, job, do_reschedule=False):
-        # TODO: Current notification method is unreliable,
-        # we should retask and use redis + lua for atomic acquire/release tasks
-        request = {
-            "action": "reschedule" if do_reschedule else "remove",
-            "build_id": job.build_id,
-            "task_id": job.task_id,
-            "chroot": job.chroot,
-        }
+    def check_task_lease(self):
+        """
+        :raises TaskLeaseLost: when the lease of the current task couldn't be renewed
+        """
+        if self.task_lease_lost.is_set():
+            raise TaskLeaseLost("Lease of the task was lost, it's processed by another worker")
+
+    def interrupt_build(self, reason):
+        """
+        Stop the build running on the current VM,
+        see :py:meth:`Builder.check_pubsub <backend.mockremote.builder.Builder.check_pubsub>`
+        """
+        if self.vm_ip is None:
+            return
+        try:
+            self.vmm.rc.publish(PUBSUB_INTERRUPT_BUILDER.format(self.vm_ip), reason)
+        except Exception as error:
+            self.log.exception("Failed to interrupt build on {}: {}".format(self.vm_ip, error))
+
+    @contextmanager
+    def _renew_in_background(self, name, lease_timeout, renew, on_lost):
+        """
+        Call ``renew`` every third of ``lease_timeout`` in the background thread
+        until the context is left. Errors (e.g. redis restart) are retried more
+        often, ``on_lost`` is called and renewing stops when ``renew`` returns False.
+        """
+        stop_event = threading.Event()
+
+        def run():
+            delay = lease_timeout / 3
+            while not stop_event.wait(delay):
+                try:
+                    renewed = renew()
+                except Exception as error:
+                    self.log.exception("Failed to renew lease in {}, retrying: {}".format(name, error))
+                    delay = lease_timeout / 10
+                    continue
+
+                if not renewed:
+                    on_lost()
+                    return
+                delay = lease_timeout / 3
+
+        thread = threading.Thread(target=run, name=name)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield
+        finally:
+            stop_event.set()
+            thread.join()
+
+    @contextmanager
+    def keep_task_lease(self):
+        """
+        Periodically renew lease of the current task in the background thread
+        """
+        self.task_lease_lost.clear()
+        lease = self.task_lease
+        if lease is None:
+            yield
+            return
+
+        def renew():
+            return self.task_queue.renew(lease.task_id, lease.token)
+
+        def on_lost():
+            self.log.error("Lost lease of the task `{}`, stopping the build".format(lease.task_id))
+            self.task_lease_lost.set()
+            self.interrupt_build("task lease lost")
+
+        with self._renew_in_background("task-lease-renew", self.task_queue.lease_timeout,
+                                       renew, on_lost):
+            yield
+
+    @contextmanager
+    def keep_vm_lease(self, vm_name):
+        """
+        Periodically renew lease of the acquired VM in the background thread,
+        VM master terminates VMs with expired lease, so the build is stopped
+        and rescheduled when the lease is lost
+        """
+        pid = os.getpid()
+
+        def renew():
+            return self.vmm.renew_vm_lease(vm_name, pid)
+
+        def on_lost():
+            self.log.error("Lost lease of the VM `{}`, stopping the build".format(vm_name))
+            self.interrupt_build("vm lease lost")
+
+        with self._renew_in_background("vm-lease-renew", self.opts.vm_lease_timeout,
+                                       renew, on_lost):
+            yield
+
+    def release_task(self, requeue=False):
+        """
+        Tell the task queue that we are done with the current task
+
+        :param bool requeue: return task to the queue, so it would be built again
+        """
+        lease, self.task_lease = self.task_lease, None
+        if lease is None:
+            return
+
+        if requeue:
+            released = self.task_queue.nack(lease.task_id, lease.token)
+        else:
+            released = self.task_queue.ack(lease.task_id, lease.token)
+
+        if not released:
+            self.log.warn("Lease of the task `{}` was lost before release".format(lease.task_id))
+
+    def reschedule_task(self, job):
+        """
+        Return task to the queue and set it to pending state at frontend
+        """
+        if self.task_lease_lost.is_set():
+            # frontend state belongs to the worker which builds the task now
+            self.log.error("Lease of the task `{}` was lost, it's not rescheduled".format(job.task_id))
+            self.task_lease = None
+            return
 
-        self.rc.publish(JOB_GRAB_TASK_END_PUBSUB, json.dumps(request))
+        self.log.info("Rescheduling task `{}`".format(job.task_id))
+        try:
+            self.frontend_client.reschedule_build(job.build_id, job.chroot)
+        except Exception as error:
+            self.log.exception("Failed to reschedule build at frontend: {}".format(error))
+        self.release_task(requeue=True)
 
     def acquire_vm_for_job(self, job):
         # TODO: replace acquire/release with context manager
@@ -403,69 +530,78 @@ class Worker(multiprocessing.Process):
         self.log.info("got job: {}, acquiring VM for build".format(str(job)))
         start_vm_wait_time = time.time()
         vmd = None
-        while vmd is None:
-            try:
-                self.update_process_title(suffix="trying to acquire VM for job {} for {}s"
-                                          .format(job.task_id, time.time() - start_vm_wait_time))
-                vmd = self.vmm.acquire_vm(self.group_id, job.project_owner, os.getpid(),
-                                          job.task_id, job.build_id, job.chroot)
-            except NoVmAvailable as error:
-                self.log.debug("No VM yet: {}".format(error))
-                time.sleep(self.opts.sleeptime)
-                continue
-            except Exception as error:
-                self.log.exception("Unhandled exception during VM acquire :{}".format(error))
-                break
+        pubsub = self.vmm.subscribe_vm_ready(self.group_id)
+        try:
+            while vmd is None and not self.task_lease_lost.is_set():
+                try:
+                    self.update_process_title(suffix="trying to acquire VM for job {} for {}s"
+                                              .format(job.task_id, time.time() - start_vm_wait_time))
+                    vmd = self.vmm.acquire_vm(self.group_id, job.project_owner, os.getpid(),
+                                              job.task_id, job.build_id, job.chroot)
+                except NoVmAvailable as error:
+                    self.log.debug("No VM yet: {}".format(error))
+                    # woken up when VM is released or passes health check
+                    self.vmm.wait_vm_ready(pubsub, self.opts.sleeptime)
+                    continue
+                except Exception as error:
+                    self.log.exception("Unhandled exception during VM acquire :{}".format(error))
+                    break
+        finally:
+            pubsub.close()
         return vmd
 
     def run_cycle(self):
         self.update_process_title(suffix="trying to acquire job")
 
-        time.sleep(self.opts.sleeptime)
+        # blocks up to sleeptime until a task is available
         job = self.obtain_job()
         if not job:
             return
 
-        try:
-            if not self.starting_build(job):
-                self.notify_job_grab_about_task_end(job)
+        with self.keep_task_lease():
+            try:
+                if not self.starting_build(job):
+                    self.release_task()
+                    return
+            except Exception:
+                self.log.exception("Failed to check if job can be started")
+                self.release_task(requeue=True)
                 return
-        except Exception:
-            self.log.exception("Failed to check if job can be started")
-            self.notify_job_grab_about_task_end(job)
-            return
 
-        vmd = self.acquire_vm_for_job(job)
+            vmd = self.acquire_vm_for_job(job)
 
-        if vmd is None:
-            self.notify_job_grab_about_task_end(job, do_reschedule=True)
-        else:
-            self.log.info("acquired VM: {} ip: {} for build {}".format(vmd.vm_name, vmd.vm_ip, job.task_id))
-            # TODO: store self.vmd = vmd and use it
-            self.vm_name = vmd.vm_name
-            self.vm_ip = vmd.vm_ip
+            if vmd is None:
+                self.reschedule_task(job)
+            else:
+                self.log.info("acquired VM: {} ip: {} for build {}".format(vmd.vm_name, vmd.vm_ip, job.task_id))
+                # TODO: store self.vmd = vmd and use it
+                self.vm_name = vmd.vm_name
+                self.vm_ip = vmd.vm_ip
 
-            try:
-                self.do_job(job)
-                self.notify_job_grab_about_task_end(job)
-            except VmError as error:
-                self.log.exception("Builder error, re-scheduling task: {}".format(error))
-                self.notify_job_grab_about_task_end(job, do_reschedule=True)
-            except Exception as error:
-                self.log.exception("Unhandled build error: {}".format(error))
-                self.notify_job_grab_about_task_end(job, do_reschedule=True)
-            finally:
-                # clean up the instance
-                self.vmm.release_vm(vmd.vm_name)
-                self.vm_ip = None
-                self.vm_name = None
+                try:
+                    with self.keep_vm_lease(vmd.vm_name):
+                        self.do_job(job)
+                    self.release_task()
+                except TaskLeaseLost as error:
+                    self.log.error("Build of the task `{}` abandoned: {}".format(job.task_id, error))
+                    self.task_lease = None
+                except VmError as error:
+                    self.log.exception("Builder error, re-scheduling task: {}".format(error))
+                    self.reschedule_task(job)
+                except Exception as error:
+                    self.log.exception("Unhandled build error: {}".format(error))
+                    self.reschedule_task(job)
+                finally:
+                    # clean up the instance
+                    self.vmm.release_vm(vmd.vm_name)
+                    self.vm_ip = None
+                    self.vm_name = None
 
     def run(self):
         self.log.info("Starting worker")
         self.init_fedmsg()
         self.vmm.post_init()
 
-        self.rc = get_redis_connection(self.opts)
         self.update_process_title(suffix="trying to acquire job")
         while not self.kill_received:
             self.run_cycle()
@@ -4,31 +4,41 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 from __future__ import absolute_import
+from collections import defaultdict, deque, Counter
+from functools import partial
 import json
 
 import time
 from setproctitle import setproctitle
 
 from requests import get, RequestException
-from retask.task import Task
-from retask.queue import Queue
-
-from ..actions import Action
-from ..constants import JOB_GRAB_TASK_END_PUBSUB
+from ..action_executor import ActionExecutor
+from ..actions import ActionType
+from ..constants import JOB_GRAB_TASK_PUSH_LIST, JOB_GRAB_SCHEDULE_HASH, JOB_GRAB_BACKLOG_HASH
 from ..helpers import get_redis_connection, get_redis_logger
+from ..project_cache import ProjectCache
 from ..exceptions import CoprJobGrabError
+from ..scheduler import get_scheduler
+from ..task_queue import get_group_task_queue
+
 
+# max number of pushed messages fetched from redis at once
+PUSHED_BATCH_SIZE = 500
 
-# TODO: Replace entire model with asynchronous queue, so that frontend push task,
-# and workers listen for them
 
 class CoprJobGrab(object):
 
     """
     Fetch jobs from the Frontend
 
-        - submit build task to the jobs queue for workers
-        - run Action handler for action tasks
+        - submit build task to the :py:class:`~backend.task_queue.TaskQueue` of
+          the builders group, workers acquire tasks from there
+        - submit action tasks to the :py:class:`~backend.action_executor.ActionExecutor`,
+          actions run in its threads and never block routing of builds
+
+    Frontend pushes new tasks into the redis list ``JOB_GRAB_TASK_PUSH_LIST``,
+    job grabber consumes them with blocking reads. Full ``/backend/waiting/``
+    query is done only once per ``opts.tasks_reconcile_period`` as a safety net.
 
 
     :param Munch opts: backend config
@@ -49,89 +59,246 @@ class CoprJobGrab(object):
         self.task_queues_by_arch = {}
         self.task_queues_by_group = {}
 
-        self.added_jobs_dict = dict()  # task_id -> task dict
+        # group_id -> project_owner -> # of tasks in the group queue
+        self.owner_jobs_count = defaultdict(Counter)
+        # group_id -> # of tasks in the group queue
+        self.group_jobs_count = Counter()
+
+        # group_id -> backlog of tasks waiting for the room in the group queue
+        self.schedulers = dict((group["id"], get_scheduler(self.opts))
+                               for group in self.opts.build_groups)
+        # group_id -> times when recent tasks were given to the group queue
+        self.dispatched_on = defaultdict(lambda: deque(maxlen=100))
+
+        # ids of actions which were already processed, the same action
+        # could be received both from push list and from the reconcile query
+        self.processed_action_ids = deque(maxlen=1000)
 
         self.frontend_client = frontend_client
+        self.action_executor = ActionExecutor(self.opts, self.frontend_client)
 
         self.rc = None
-        self.channel = None
-        self.ps_thread = None
+        self.project_cache = None
 
         self.log = get_redis_logger(self.opts, "backend.job_grab", "job_grab")
 
     def connect_queues(self):
         """
-        Connects to the retask queues. One queue per builders group.
+        Connects to the task queues. One queue per builders group.
         """
+        self.rc = get_redis_connection(self.opts)
+        self.project_cache = ProjectCache(self.opts, rc=self.rc, frontend_client=self.frontend_client)
         for group in self.opts.build_groups:
-            queue = Queue("copr-be-{0}".format(group["id"]))
-            queue.connect()
+            queue = get_group_task_queue(self.opts, group["id"], rc=self.rc)
 
             self.task_queues_by_group[group["name"]] = queue
             for arch in group["archs"]:
                 self.task_queues_by_arch[arch] = queue
 
-    def listen_to_pubsub(self):
+    def sync_job_counters(self, full=False):
         """
-        Listens for job reschedule queries. Spawns self.ps_thread, don't forget to stop it.
-        """
-        self.rc = get_redis_connection(self.opts)
-        self.channel = self.rc.pubsub(ignore_subscribe_messages=True)
+        Reload number of queued tasks from the task queues.
 
-        self.channel.subscribe(**{JOB_GRAB_TASK_END_PUBSUB: self.on_pubsub_event})
-        self.ps_thread = self.channel.run_in_thread(sleep_time=0.05)
+        Job grabber increments counters itself when it adds new tasks,
+        tasks are removed by workers, so only owners with removed tasks
+        are reloaded. Rescheduled task stays in the queue and is still counted.
 
-        self.log.info("Subscribed to {} channel".format(JOB_GRAB_TASK_END_PUBSUB))
+        :param bool full: reload counters of all owners
+        """
+        for group in self.opts.build_groups:
+            queue = self.task_queues_by_group[group["name"]]
+            owner_counts = self.owner_jobs_count[group["id"]]
+
+            if full:
+                queue.pop_released_owners()
+                counts, total = queue.get_counts()
+                owner_counts.clear()
+                owner_counts.update(counts)
+            else:
+                owners = queue.pop_released_owners()
+                counts, total = queue.get_counts(owners)
+                for owner in owners:
+                    owner_counts.pop(owner, None)
+                owner_counts.update(counts)
+
+            self.group_jobs_count[group["id"]] = total
+
+    def get_task_group_id(self, task):
+        """
+        :return int: id of the builders group for the task
+        :raises CoprJobGrabError: when there is no builders group for the task arch
+        """
+        arch = task["chroot"].split("-")[2]
+        if arch not in self.arch_to_group_id_map:
+            raise CoprJobGrabError("No builder group for architecture: {}, task: {}"
+                                   .format(arch, task))
+        return int(self.arch_to_group_id_map[arch])
 
-    def route_build_task(self, task):
+    def is_owner_blocked(self, group_id, owner):
         """
-        Route build task to the appropriate queue.
-        :param task: dict-like object which represent build task
+        :return bool: True when the owner already has ``max_vm_per_user``
+            tasks in the group queue
+        """
+        return (self.owner_jobs_count[group_id][owner] >=
+                self.opts.build_groups[group_id]["max_vm_per_user"])
+
+    def route_build_tasks(self, tasks):
+        """
+        Add build tasks to the scheduler of the appropriate builders group
+        and dispatch tasks from schedulers to the task queues.
+        Tasks with error are logged and skipped.
+
+        :param list tasks: dict-like objects which represent build tasks
 
-        Utilized **task** keys:
+            Utilized **task** keys:
 
-            - ``task_id``
-            - ``chroot``
-            - ``arch``
+                - ``task_id``
+                - ``chroot``
+                - ``project_owner``
+                - ``project_name``
 
-        :return int: Count of the successfully routed tasks
+        :return int: Count of the tasks added to the task queues
         """
-        count = 0
-        if "task_id" in task:
-            if task["task_id"] not in self.added_jobs_dict:
-                arch = task["chroot"].split("-")[2]
-                if arch not in self.task_queues_by_arch:
-                    raise CoprJobGrabError("No builder group for architecture: {}, task: {}"
-                                           .format(arch, task))
+        tasks_by_group = defaultdict(list)
+        for task in tasks:
+            if "task_id" not in task:
+                self.log.info("Task missing field `task_id`, raw task: {}".format(task))
+                continue
+            try:
+                group_id = self.get_task_group_id(task)
+            except CoprJobGrabError as err:
+                self.log.exception("Failed to enqueue new job: {} with error: {}".format(task, err))
+                continue
+
+            if task["task_id"] not in self.schedulers[group_id]:
+                tasks_by_group[group_id].append(task)
+
+        for group_id, group_tasks in tasks_by_group.items():
+            queue = self.task_queues_by_group[self.opts.build_groups[group_id]["name"]]
+            # tasks already given to workers are reported by frontend until they finish
+            queued = queue.contains_many([task["task_id"] for task in group_tasks])
+            for task, is_queued in zip(group_tasks, queued):
+                if not is_queued:
+                    self.schedulers[group_id].add(task)
+
+        return self.dispatch_tasks()
+
+    def dispatch_tasks(self):
+        """
+        Move tasks from schedulers to the task queues in the order decided by
+        the schedulers. Group queue holds at most ``max_queued_tasks``, owner
+        could have at most ``max_vm_per_user`` tasks there.
 
-                username = task["project_owner"]
-                group_id = int(self.arch_to_group_id_map[arch])
-                active_jobs_count = len([t for t_id, t in self.added_jobs_dict.items()
-                                         if t["project_owner"] == username])
+        :return int: Count of the tasks added to the task queues
+        """
+        count = 0
+        for group in self.opts.build_groups:
+            group_id = group["id"]
+            scheduler = self.schedulers[group_id]
+            room = group["max_queued_tasks"] - self.group_jobs_count[group_id]
+            if room <= 0 or not scheduler:
+                continue
+
+            is_blocked = partial(self.is_owner_blocked, group_id)
+            owner_counts = self.owner_jobs_count[group_id]
+            tasks = []
+            while len(tasks) < room:
+                task = scheduler.pop(is_blocked)
+                if task is None:
+                    break
+                owner_counts[task["project_owner"]] += 1
+                tasks.append(task)
+
+            if not tasks:
+                continue
+
+            added = self.task_queues_by_group[group["name"]].enqueue_many(tasks)
+            now = time.time()
+            for task, is_added in zip(tasks, added):
+                if is_added:
+                    count += 1
+                    self.group_jobs_count[group_id] += 1
+                    self.dispatched_on[group_id].append(now)
+                else:
+                    # already in the queue
+                    owner_counts[task["project_owner"]] -= 1
+        return count
 
-                if active_jobs_count > self.opts.build_groups[group_id]["max_vm_per_user"]:
-                    self.log.debug("User can not acquire more VM (active builds #{}), "
-                                   "don't schedule more tasks".format(active_jobs_count))
-                    return 0
+    def get_dispatch_rate(self, group_id):
+        """
+        :return float: recent number of tasks per second given to the group queue
+        """
+        dispatched_on = self.dispatched_on[group_id]
+        if not dispatched_on:
+            return 0
+        return len(dispatched_on) / max(time.time() - dispatched_on[0], 1)
 
-                self.added_jobs_dict[task["task_id"]] = task
+    def publish_schedule(self):
+        """
+        Store queue position and ETA of tasks waiting in schedulers into the redis hash
+        ``JOB_GRAB_SCHEDULE_HASH``, task_id -> json with fields:
 
-                task_obj = Task(task)
-                self.task_queues_by_arch[arch].enqueue(task_obj)
-                count += 1
+            - position: order of the task in its builders group, counted from 1
+            - eta: estimated number of seconds until the task is given
+              to workers, null when unknown
 
-        else:
-            self.log.info("Task missing field `task_id`, raw task: {}".format(task))
-        return count
+        Number of the waiting tasks per group goes to ``JOB_GRAB_BACKLOG_HASH``,
+        VM autoscaler adds them to the tasks in the capped group queue.
+        """
+        pipe = self.rc.pipeline(transaction=True)
+        pipe.delete(JOB_GRAB_SCHEDULE_HASH, JOB_GRAB_BACKLOG_HASH)
+        for group in self.opts.build_groups:
+            order = self.schedulers[group["id"]].get_order()
+            if not order:
+                continue
+            pipe.hset(JOB_GRAB_BACKLOG_HASH, group["id"], len(order))
+            rate = self.get_dispatch_rate(group["id"])
+            pipe.hmset(JOB_GRAB_SCHEDULE_HASH, dict(
+                (task_id, json.dumps({
+                    "position": position,
+                    "eta": int(position / rate) if rate else None,
+                }))
+                for position, task_id in enumerate(order, 1)
+            ))
+        # stale backlog of stopped job grabber must not keep VMs spawned
+        pipe.expire(JOB_GRAB_BACKLOG_HASH, max(60, int(3 * self.opts.sleeptime)))
+        pipe.execute()
 
     def process_action(self, action):
         """
-        Run action task handler, see :py:class:`~backend.action.Action`
+        Submit action task to the executor, see :py:class:`~backend.action.Action`
 
         :param action: dict-like object with action task
         """
-        ao = Action(self.opts, action, frontend_client=self.frontend_client)
-        ao.run()
+        if "id" in action:
+            if action["id"] in self.processed_action_ids:
+                self.log.debug("Action `{}` was already processed, skipped".format(action["id"]))
+                return
+            self.processed_action_ids.append(action["id"])
+
+        self.invalidate_action_projects(action)
+        self.action_executor.submit(action)
+
+    def invalidate_action_projects(self, action):
+        """
+        Drop projects changed by the action from the project cache,
+        e.g. createrepo action is sent when auto_createrepo is enabled again
+        """
+        names = []
+        if action.get("action_type") == ActionType.RENAME:
+            names = [action.get("old_value"), action.get("new_value")]
+        elif action.get("action_type") == ActionType.DELETE and action.get("object_type") == "copr":
+            names = [action.get("old_value")]
+        elif action.get("action_type") == ActionType.CREATEREPO:
+            try:
+                data = json.loads(action["data"])
+                names = ["{}/{}".format(data["username"], data["projectname"])]
+            except (ValueError, KeyError, TypeError):
+                pass
+
+        for name in names:
+            if name and "/" in name and self.project_cache is not None:
+                self.project_cache.invalidate(*name.split("/", 1))
 
     def load_tasks(self):
         """
@@ -153,13 +320,8 @@ class CoprJobGrab(object):
 
         if r_json.get("builds"):
             self.log.debug("{0} jobs returned".format(len(r_json["builds"])))
-            count = 0
-            for task in r_json["builds"]:
-                try:
-                    count += self.route_build_task(task)
-                except CoprJobGrabError as err:
-                    self.log.exception("Failed to enqueue new job: {} with error: {}".format(task, err))
-
+            self.sync_job_counters(full=True)
+            count = self.route_build_tasks(r_json["builds"])
             if count:
                 self.log.info("New build jobs: %s" % count)
 
@@ -168,66 +330,85 @@ class CoprJobGrab(object):
             self.log.info("{0} actions returned".format(len(r_json["actions"])))
 
             for action in r_json["actions"]:
-                start = time.time()
                 try:
                     self.process_action(action)
                 except Exception as error:
                     self.log.exception("Error during processing action `{}`: {}".format(action, error))
-                if time.time() - start > 2*self.opts.sleeptime:
-                    # we are processing actions for too long, stop and fetch everything again (including new builds)
-                    break
-                    
 
-    def on_pubsub_event(self, raw):
-        # from celery.contrib import rdb; rdb.set_trace()
+    def fetch_pushed_messages(self):
+        """
+        Blocks until frontend pushes something or until ``opts.sleeptime`` expires.
+
+        :return list: raw messages in the order of arrival
+        """
+        raw = self.rc.brpop(JOB_GRAB_TASK_PUSH_LIST, timeout=max(1, int(self.opts.sleeptime)))
         if raw is None:
-            return
-        if "type" not in raw or raw["type"] != "message":
-            self.log.warn("Missing type or wrong type in pubsub msg: {}, ignored".format(raw))
-            return
+            return []
+
+        messages = [raw[1]]
+        # drain everything what came together with the first message
+        pipe = self.rc.pipeline()
+        pipe.lrange(JOB_GRAB_TASK_PUSH_LIST, -PUSHED_BATCH_SIZE, -1)
+        pipe.ltrim(JOB_GRAB_TASK_PUSH_LIST, 0, -PUSHED_BATCH_SIZE - 1)
+        rest, _ = pipe.execute()
+        messages.extend(reversed(rest))
+        return messages
+
+    def process_pushed_msg(self, raw, build_tasks):
+        """
+        Handle one message pushed by frontend. Actions are submitted right away,
+        build tasks are collected to be routed together.
+
+        :param raw: json string, expected fields:
+            - type: "build", "action" or "project"
+            - task: build task dict, the same as returned by ``/backend/waiting/``
+            - action: action dict, the same as returned by ``/backend/waiting/``
+            - owner, project: changed project, dropped from the project cache
+            [- pushed_on: unixtime when frontend pushed the message]
+        :param list build_tasks: build task from the message is appended here
+        """
         try:
-            msg = json.loads(raw["data"])
-            # msg: {"action": ("remove"|"reschedule"), "task_id": ..., "build_id"..., "chroot": ...}
-            # Actions: "remove" simply remove `task_id` from self.added_job
-            #          "reschedule" additionally call frontend and set pending state before removal
-            if "action" not in msg:
-                self.log.warn("Missing required field `action`, msg ignored: {}".format(msg))
-                return
-            action = msg["action"]
-            if action not in ["remove", "reschedule"]:
-                self.log.warn("Action `{}` not allowed, msg ignored: {} ".format(action, msg))
-                return
-
-            if "task_id" not in msg:
-                self.log.warn("Missing required field `task_id`, msg ignored: {}".format(msg))
-                return
-
-            task_id = msg["task_id"]
-            if action == "reschedule" and "build_id" in msg and "chroot" in msg:
-                # TODO: dirty dependency to frontend, Job management should be re-done (
-                self.log.info("Rescheduling task `{}`".format(task_id))
-                self.frontend_client.reschedule_build(msg["build_id"], msg["chroot"])
+            msg = json.loads(raw)
+        except ValueError:
+            self.log.warn("Malformed pushed message, ignored: {}".format(raw))
+            return
 
-            if task_id not in self.added_jobs_dict:
-                self.log.debug("Task `{}` not present in added jobs,  msg ignored: {}".format(task_id, msg))
-                return
+        if "pushed_on" in msg:
+            self.log.debug("Got pushed message after {:.3f}s".format(time.time() - msg["pushed_on"]))
 
-            if action in ["remove", "reschedule"]:
-                self.added_jobs_dict.pop(task_id)
-                self.log.info("Removed task `{}` from added_jobs".format(task_id))
+        msg_type = msg.get("type")
+        if msg_type == "build" and "task" in msg:
+            build_tasks.append(msg["task"])
+        elif msg_type == "action" and "action" in msg:
+            self.process_action(msg["action"])
+        elif msg_type == "project" and "owner" in msg and "project" in msg:
+            self.project_cache.invalidate(msg["owner"], msg["project"])
+        else:
+            self.log.warn("Unknown pushed message, ignored: {}".format(msg))
 
-        except Exception as err:
-            self.log.exception("Error receiving message from remove pubsub: raw msg: {}, error: {}"
-                               .format(raw, err))
+    def consume_pushed_tasks(self):
+        """
+        Wait for tasks pushed by frontend and process them,
+        then dispatch tasks waiting in schedulers
+        """
+        build_tasks = []
+        for raw in self.fetch_pushed_messages():
+            try:
+                self.process_pushed_msg(raw, build_tasks)
+            except Exception as error:
+                self.log.exception("Error during processing pushed message `{}`: {}".format(raw, error))
+
+        self.sync_job_counters()
+        count = self.route_build_tasks(build_tasks)
+        if count:
+            self.log.info("New pushed build jobs: %s" % count)
 
     def log_queue_info(self):
-        if self.added_jobs_dict:
-            self.log.debug("Added jobs after remove and load: {}".format(self.added_jobs_dict))
-            self.log.debug("# of executed jobs: {}".format(len(self.added_jobs_dict)))
-
-        for group, queue in self.task_queues_by_group.items():
-            if queue.length > 0:
-                self.log.debug("# of pending jobs for `{}`: {}".format(group, queue.length))
+        for group in self.opts.build_groups:
+            if self.group_jobs_count[group["id"]] or self.schedulers[group["id"]]:
+                self.log.debug("# of jobs for `{}`: {}, waiting in scheduler: {}".format(
+                    group["name"], self.group_jobs_count[group["id"]],
+                    len(self.schedulers[group["id"]])))
 
     def run(self):
         """
@@ -235,23 +416,26 @@ class CoprJobGrab(object):
         """
         setproctitle("CoprJobGrab")
         self.connect_queues()
-        self.listen_to_pubsub()
+        self.action_executor.start()
 
         self.log.info("JobGrub started.")
+        last_reconcile = 0
+        last_publish = 0
         try:
             while True:
                 try:
-                    self.load_tasks()
-                    self.log_queue_info()
-                    time.sleep(self.opts.sleeptime)
+                    if time.time() - last_reconcile >= self.opts.tasks_reconcile_period:
+                        last_reconcile = time.time()
+                        self.load_tasks()
+                        self.log_queue_info()
+
+                    self.consume_pushed_tasks()
+
+                    if time.time() - last_publish >= self.opts.sleeptime:
+                        last_publish = time.time()
+                        self.publish_schedule()
                 except Exception as err:
                     self.log.exception("Job Grab unhandled exception: {}".format(err))
 
         except KeyboardInterrupt:
             return
-
-    def terminate(self):
-        if self.ps_thread:
-            self.ps_thread.stop()
-            self.ps_thread.join()
-        super(CoprJobGrab, self).terminate()
@@ -21,59 +21,65 @@ from ..constants import default_log_format
 level_map = {
     "info": logging.INFO,
     "debug": logging.DEBUG,
+    "warning": logging.WARNING,
     "error": logging.ERROR,
+    "critical": logging.CRITICAL,
 }
 
+# max number of records taken from the queue at once
+DEFAULT_BATCH_SIZE = 1000
+# how long the router blocks waiting for records
+QUEUE_WAIT_TIMEOUT = 1
 
-class LogRouterFilter(logging.Filter):
-    def __init__(self, who):
-        """
-        Value of field `who` which should be present to propagate LogRecord
-        """
-        super(LogRouterFilter, self).__init__()
-        self.who = who
-
-    def filter(self, record):
-        if record.event.get("who") == self.who:
-            return True
-        else:
-            return False
 
+class BatchFileHandler(logging.handlers.WatchedFileHandler):
+    """
+    File handler flushed once per batch of records instead of after each record
+    """
+    def flush(self):
+        pass
 
-class CustomFilter(logging.Filter):
-
-    def filter(self, record):
-        if not hasattr(record, "event"):
-            return False
+    def flush_batch(self):
+        super(BatchFileHandler, self).flush()
 
-        event = record.event
-        if "traceback" in event:
-            record.msg = "{}\n{}".format(record.msg, event.pop("traceback"))
 
-        record.lineno = int(event.pop("lineno", "-1"))
-        record.funcName = event.pop("funcName", None)
-        record.pathname = event.pop("pathname", None)
-        for k, v in event.items():
-            setattr(record, k, v)
+def make_record(event, level, msg):
+    """
+    Recreates LogRecord from the event sent by :py:class:`backend.helpers.RedisPublishHandler`
+    """
+    if "traceback" in event:
+        msg = "{}\n{}".format(msg, event.pop("traceback"))
 
-        return True
+    record = logging.makeLogRecord(event)
+    record.msg = msg
+    record.args = None
+    record.levelno = level
+    record.levelname = logging.getLevelName(level)
+    record.lineno = int(event.get("lineno") or -1)
+    return record
 
 
 class RedisLogHandler(object):
     """
-    Single point to collect logs through redis pub/sub and write
+    Single point to collect logs through redis list and write
         them through standard python logging lib
+
+    Records are taken from the queue in batches and dispatched by the ``who``
+    field to the writer of the component. Records are removed from the queue
+    only after they were written, so nothing is lost when the router restarts.
     """
 
-    def __init__(self, opts):
+    def __init__(self, opts, batch_size=DEFAULT_BATCH_SIZE):
         self.opts = opts
+        self.batch_size = batch_size
 
         self.log_dir = os.path.dirname(self.opts.log_dir)
         if not os.path.exists(self.log_dir):
             os.makedirs(self.log_dir, mode=0o750)
 
         self.components = ["spawner", "terminator", "vmm", "job_grab",
-                           "backend", "actions", "worker"]
+                           "backend", "actions", "worker", "update_aggregator"]
+        self.writers = {}
 
     def setup_logging(self):
 
@@ -83,23 +89,19 @@ class RedisLogHandler(object):
         self.main_handler.setFormatter(default_log_format)
         self.main_logger.addHandler(self.main_handler)
 
-        self.router_logger = logging.Logger("log_router")
-        self.router_logger.addFilter(CustomFilter())
-
         for component in self.components:
-            handler = logging.handlers.WatchedFileHandler(
+            handler = BatchFileHandler(
                 filename=os.path.join(self.log_dir, "{}.log".format(component)))
             handler.setFormatter(default_log_format)
             handler.setLevel(level=level_map[self.opts.log_level])
-            # not very good from performance point:
-            #   filter called for each message, but only one handler process record
-            # but it shouldn't be a real problem
-            handler.addFilter(filter=LogRouterFilter(component))
-            self.router_logger.addHandler(handler)
+            self.writers[component] = handler
 
     def handle_msg(self, raw):
+        """
+        :param str raw: json with the log record
+        """
         try:
-            event = json.loads(raw["data"])
+            event = json.loads(raw)
 
             # expected fields:
             #   - who: self.components
@@ -112,26 +114,47 @@ class RedisLogHandler(object):
                 if key not in event:
                     raise Exception("Handler received msg without `{}` field, msg: {}".format(key, event))
 
-            who = event["who"]
-            if who not in self.components:
+            writer = self.writers.get(event["who"])
+            if writer is None:
                 raise Exception("Handler received msg with unknown `who` field, msg: {}".format(event))
 
             level = level_map[event.pop("level", "info")]
-            msg = event.pop("msg")
-
-            self.router_logger.log(level, msg, extra={"event": event})
+            if level < writer.level:
+                return
+            writer.handle(make_record(event, level, event.pop("msg")))
 
         except Exception as err:
             self.main_logger.exception(err)
 
+    def handle_batch(self, batch):
+        for raw in batch:
+            self.handle_msg(raw)
+        for writer in self.writers.values():
+            writer.flush_batch()
+
+    def process_queue(self, rc):
+        """
+        Writes the next batch of records from the queue, waits for new records
+        when the queue is empty
+
+        :return int: number of processed records
+        """
+        batch = rc.lrange(constants.LOG_QUEUE, 0, self.batch_size - 1)
+        if batch:
+            self.handle_batch(batch)
+            rc.ltrim(constants.LOG_QUEUE, len(batch), -1)
+            return len(batch)
+
+        item = rc.blpop([constants.LOG_QUEUE], timeout=QUEUE_WAIT_TIMEOUT)
+        if item is None:
+            return 0
+        self.handle_batch([item[1]])
+        return 1
+
     def run(self):
         self.setup_logging()
         setproctitle("RedisLogHandler")
 
         rc = helpers.get_redis_connection(self.opts)
-        channel = rc.pubsub(ignore_subscribe_messages=True)
-        channel.subscribe(constants.LOG_PUB_SUB)
-
-        for raw in channel.listen():
-            if raw is not None and raw.get("type") == "message" and "data" in raw:
-                self.handle_msg(raw)
+        while True:
+            self.process_queue(rc)
@@ -0,0 +1,167 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import time
+
+from requests import RequestException
+from setproctitle import setproctitle
+
+from ..frontend import FrontendRejectedError, next_backoff
+from ..helpers import get_redis_logger
+
+
+# how often (in seconds) the spool is checked for new updates when it's empty
+SPOOL_POLL_INTERVAL = 0.5
+
+
+class CoprUpdateAggregator(object):
+    """
+    Deliver updates spooled by workers and actions to the frontend.
+
+    Workers put build updates into the :py:class:`~backend.update_spool.UpdateSpool`
+    through :py:meth:`FrontendClient.update <backend.frontend.FrontendClient.update>`
+    and continue immediately. Aggregator merges spooled updates into one
+    ``{"builds": [...], "actions": [...]}`` payload, sends it to
+    ``/backend/update/`` and removes them from the spool only when frontend
+    accepted the batch. When frontend is not available, delivery is retried
+    with exponential backoff, updates are kept on disk meanwhile. When frontend
+    rejects the batch, updates are resent one by one and the rejected ones are
+    moved aside by :py:meth:`UpdateSpool.reject <backend.update_spool.UpdateSpool.reject>`.
+    Spooled reschedule requests are sent separately, in the spool order.
+
+    :param Munch opts: backend config
+    :type frontend_client: FrontendClient
+    """
+
+    def __init__(self, opts, frontend_client):
+        self.opts = opts
+        self.frontend_client = frontend_client
+        self.spool = frontend_client.update_spool
+        self.backoff = 0
+
+        self.log = get_redis_logger(self.opts, "backend.update_aggregator", "update_aggregator")
+
+    @staticmethod
+    def merge(updates):
+        """
+        :param list updates: update dicts in the order they were spooled
+        :return dict: one payload with builds and actions from all updates
+        """
+        payload = {}
+        for data in updates:
+            for key in ["builds", "actions"]:
+                if data.get(key):
+                    payload.setdefault(key, []).extend(data[key])
+        return payload
+
+    @staticmethod
+    def split(updates):
+        """
+        :param list updates: (name, data) pairs in the order they were spooled
+        :return list: groups of updates to be sent by one request, reschedule
+            is alone in its group, so it's sent after the preceding updates
+        """
+        groups = []
+        for name, data in updates:
+            if "reschedule" in data or not groups or "reschedule" in groups[-1][-1][1]:
+                groups.append([])
+            groups[-1].append((name, data))
+        return groups
+
+    def post(self, updates):
+        if "reschedule" in updates[0][1]:
+            self.frontend_client.post_reschedule(updates[0][1]["reschedule"])
+        else:
+            self.frontend_client.post_update(self.merge([data for _, data in updates]))
+
+    def deliver(self, updates):
+        """
+        Send updates by one request, resend them one by one when frontend rejects them
+
+        :raises RequestException: when frontend is not available
+        """
+        try:
+            self.post(updates)
+        except FrontendRejectedError as err:
+            if len(updates) == 1:
+                self.log.error("Frontend rejected update {}, moved to {}: {}"
+                               .format(updates[0][0], self.spool.rejected_dir, err))
+                self.spool.reject([updates[0][0]])
+            else:
+                self.log.warn("Frontend rejected batch of {} updates, sending them one by one: {}"
+                              .format(len(updates), err))
+                for update in updates:
+                    self.deliver([update])
+            return
+        self.spool.remove([name for name, _ in updates])
+
+    def flush(self):
+        """
+        Deliver one batch of the oldest spooled updates
+
+        :return int: number of delivered or rejected updates
+        :raises RequestException: when frontend is not available, undelivered
+            updates stay in the spool
+        """
+        batch = self.spool.take(self.opts.update_batch_size)
+        if not batch:
+            return 0
+
+        broken = [name for name, data in batch if data is None]
+        if broken:
+            self.log.error("Dropping unreadable spooled updates: {}".format(broken))
+            self.spool.remove(broken)
+
+        updates = [(name, data) for name, data in batch if data is not None]
+        for group in self.split(updates):
+            self.deliver(group)
+        return len(updates)
+
+    def next_backoff(self):
+        """
+        :return float: how long to wait after the failed delivery
+        """
+        self.backoff = next_backoff(self.backoff, self.opts.update_max_backoff)
+        return self.backoff
+
+    def run_cycle(self):
+        """
+        Deliver spooled updates or wait for new ones
+        """
+        try:
+            count = self.flush()
+        except RequestException as err:
+            delay = self.next_backoff()
+            self.log.warn("Failed to deliver updates to frontend, {} waiting in spool, "
+                          "retry in {}s: {}".format(len(self.spool), delay, err))
+            time.sleep(delay)
+            return
+
+        if self.backoff:
+            self.log.info("Frontend is available again")
+            self.backoff = 0
+
+        if count:
+            self.log.debug("Delivered {} updates".format(count))
+        else:
+            time.sleep(SPOOL_POLL_INTERVAL)
+
+    def run(self):
+        """
+        Starts update aggregator process
+        """
+        setproctitle("CoprUpdateAggregator")
+        self.log.info("Update aggregator started, {} updates in spool".format(len(self.spool)))
+        try:
+            while True:
+                try:
+                    self.run_cycle()
+                except Exception as err:
+                    self.log.exception("Update aggregator unhandled exception: {}".format(err))
+                    time.sleep(SPOOL_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            return
@@ -4,25 +4,29 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 from __future__ import absolute_import
-import json
 
+from collections import OrderedDict
 from multiprocessing import Process
 import time
 from setproctitle import setproctitle
 import traceback
-import psutil
 
-from ..constants import JOB_GRAB_TASK_END_PUBSUB
+from ..constants import JOB_GRAB_BACKLOG_HASH
 from ..vm_manage import VmStates
-from ..exceptions import VmSpawnLimitReached
+from ..vm_manage.autoscale import AutoscalePolicy
+from ..exceptions import VmSpawnLimitReached, VmDescriptorNotFound
 
 from ..helpers import get_redis_logger
+from ..task_queue import get_group_task_queue
 
 
 class VmMaster(Process):
     """
     Spawns and terminate VM for builder process.
 
+    VM pool is loaded once per :py:meth:`do_cycle` into
+    :py:class:`~backend.vm_manage.models.VmPoolSnapshot`, all checks of the cycle use it.
+
     :type vmm: backend.vm_manage.manager.VmManager
     :type spawner: backend.vm_manage.spawn.Spawner
     :type checker: backend.vm_manage.check.HealthChecker
@@ -36,17 +40,33 @@ class VmMaster(Process):
         self.checker = checker
 
         self.kill_received = False
+        self.snapshot = None
+        # phase name -> duration in seconds, of the latest cycle
+        self.cycle_timings = OrderedDict()
+        # group -> AutoscalePolicy, for groups with vm_autoscale
+        self.autoscalers = {}
+        # group -> TaskQueue
+        self.task_queues = {}
 
         self.log = get_redis_logger(self.opts, "vmm.vm_master", "vmm")
         self.vmm.set_logger(self.log)
 
+    def get_snapshot(self):
+        """
+        :return: VM pool snapshot of the current cycle, fresh one outside of :py:meth:`do_cycle`
+        :rtype: backend.vm_manage.models.VmPoolSnapshot
+        """
+        if self.snapshot is not None:
+            return self.snapshot
+        return self.vmm.get_snapshot()
+
     def remove_old_dirty_vms(self):
         # terminate vms bound_to user and time.time() - vm.last_release_time > threshold_keep_vm_for_user_timeout
         #  or add field to VMD ot override common threshold
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.READY]):
-            if vmd.get_field(self.vmm.rc, "bound_to_user") is None:
+        for vmd in self.get_snapshot().get_vm_by_group_and_state_list(None, [VmStates.READY]):
+            if vmd.bound_to_user is None:
                 continue
-            last_release = vmd.get_field(self.vmm.rc, "last_release")
+            last_release = getattr(vmd, "last_release", None)
             if last_release is None:
                 continue
             not_re_acquired_in = time.time() - float(last_release)
@@ -55,91 +75,26 @@ class VmMaster(Process):
                               .format(vmd.vm_name, not_re_acquired_in))
                 self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.READY)
 
-    def request_build_reschedule(self, vmd):
-        self.log.info("trying to publish reschedule")
-        vmd_dict = vmd.to_dict()
-        if all(x in vmd_dict for x in ["build_id", "task_id", "chroot"]):
-            request = {
-                "action": "reschedule",
-                "build_id": vmd.build_id,
-                "task_id": vmd.task_id,
-                "chroot": vmd.chroot,
-            }
-            self.log.info("trying to publish reschedule: {}".format(request))
-            self.vmm.rc.publish(JOB_GRAB_TASK_END_PUBSUB, json.dumps(request))
-            # else:
-            # self.log.info("Failed to  release VM: {}".format(vmd.vm_name))
-
-    def check_one_vm_for_dead_builder(self, vmd):
-        # TODO: builder should renew lease periodically
-        # and we should use that time instead of in_use_since and pid checks
-        in_use_since = vmd.get_field(self.vmm.rc, "in_use_since")
-        pid = vmd.get_field(self.vmm.rc, "used_by_pid")
-
-        if not in_use_since or not pid:
-            return
-        in_use_time_elapsed = time.time() - float(in_use_since)
-
-        # give a minute for worker to set correct title
-        if in_use_time_elapsed < 60 and str(pid) == "None":
-            return
-
-        pid = int(pid)
-        # try:
-        #     # here we can catch race condition: worker acquired VM but haven't set process title yet
-        #     if psutil.pid_exists(pid) and vmd.vm_name in psutil.Process(pid).cmdline[0]:
-        #         return
-        #
-        #     self.log.info("Process `{}` not exists anymore, doing second try. VM data: {}"
-        #                   .format(pid, vmd))
-        #     # dirty hack: sleep and check again
-        #     time.sleep(5)
-        #     if psutil.pid_exists(pid) and vmd.vm_name in psutil.Process(pid).cmdline[0]:
-        #         return
-        # except Exception:
-        #     self.log.exception("Failed do determine if process `{}` still alive for VM: {}, assuming alive"
-        #                        .format(pid, vmd))
-        #     return
-
-        # psutil changed Process().cmdline from property to function between f20 and f22
-        # disabling more precise check for now
-        try:
-            # here we can catch race condition: worker acquired VM but haven't set process title yet
-            if psutil.pid_exists(pid):
-                return
-
-            self.log.info("Process `{}` not exists anymore, doing second try. VM data: {}"
-                          .format(pid, vmd))
-            # dirty hack: sleep and check again
-            time.sleep(5)
-            if psutil.pid_exists(pid):
-                return
-
-        except Exception:
-            self.log.exception("Failed do determine if process `{}` still alive for VM: {}, assuming alive"
-                               .format(pid, vmd))
-            return
-
-        self.log.info("Process `{}` not exists anymore, terminating VM: {} ".format(pid, vmd.vm_name))
-        self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.IN_USE)
-        # cause race condition
-        #  self.request_build_reschedule(vmd)
-
     def remove_vm_with_dead_builder(self):
         # TODO: rewrite build manage at backend and move functionality there
         # VMM shouldn't do this
 
-        # check that process who acquired VMD still exists, otherwise release VM
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.IN_USE]):
-            self.check_one_vm_for_dead_builder(vmd)
+        # builder renews VM lease while it's alive, VMs with expired lease are terminated
+        for vm_name in self.vmm.pop_expired_vm_leases():
+            self.log.info("Builder stopped renewing lease, terminating VM: {}".format(vm_name))
+            try:
+                # build task returns to the queue after its lease expires
+                self.vmm.start_vm_termination(vm_name, allowed_pre_state=VmStates.IN_USE)
+            except VmDescriptorNotFound:
+                self.log.debug("VM record disappeared: {}".format(vm_name))
 
     def check_vms_health(self):
         # for machines in state ready and time.time() - vm.last_health_check > threshold_health_check_period
         states_to_check = [VmStates.CHECK_HEALTH_FAILED, VmStates.READY,
                            VmStates.GOT_IP, VmStates.IN_USE]
 
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, states_to_check):
-            last_health_check = vmd.get_field(self.vmm.rc, "last_health_check")
+        for vmd in self.get_snapshot().get_vm_by_group_and_state_list(None, states_to_check):
+            last_health_check = getattr(vmd, "last_health_check", None)
             check_period = self.opts.build_groups[vmd.group]["vm_health_check_period"]
             if not last_health_check or time.time() - float(last_health_check) > check_period:
                 self.start_vm_check(vmd.vm_name)
@@ -152,7 +107,7 @@ class VmMaster(Process):
         vmd = self.vmm.get_vm_by_name(vm_name)
         orig_state = vmd.state
 
-        if self.vmm.lua_scripts["set_checking_state"](keys=[vmd.vm_key], args=[time.time()]) == "OK":
+        if self.vmm.set_checking_state(vmd):
             # can start
             try:
                 self.checker.run_check_health(vmd.vm_name, vmd.vm_ip)
@@ -170,7 +125,7 @@ class VmMaster(Process):
         number of running spawn processes is less than
         threshold defined by BackendConfig.build_group[group]["max_vm_total"]
         """
-        active_vmd_list = self.vmm.get_vm_by_group_and_state_list(
+        active_vmd_list = self.get_snapshot().get_vm_by_group_and_state_list(
             group, [VmStates.GOT_IP, VmStates.READY, VmStates.IN_USE,
                     VmStates.CHECK_HEALTH, VmStates.CHECK_HEALTH_FAILED])
         total_vm_estimation = len(active_vmd_list) + self.spawner.get_proc_num_per_group(group)
@@ -205,7 +160,7 @@ class VmMaster(Process):
         """ Check that number of running spawn processes is less than
         threshold defined by BackendConfig.build_group[]["max_spawn_processes"]
         """
-        count_all_vm = len(self.vmm.get_all_vm_in_group(group))
+        count_all_vm = len(self.get_snapshot().get_all_vm_in_group(group))
         if count_all_vm >= 2 * self.opts.build_groups[group]["max_vm_total"]:
             raise VmSpawnLimitReached(
                 "Skip spawn for group {}: #(ALL VM) >= 2 * max_vm_total reached: {}"
@@ -233,24 +188,101 @@ class VmMaster(Process):
         except Exception as error:
             self.log.exception("Error during spawn attempt: {}".format(error))
 
+    def get_task_queue(self, group):
+        if group not in self.task_queues:
+            self.task_queues[group] = get_group_task_queue(self.opts, group, rc=self.vmm.rc)
+        return self.task_queues[group]
+
+    def autoscale(self, group):
+        """
+        Spawn or terminate VMs in batches as decided by
+        :py:class:`~backend.vm_manage.autoscale.AutoscalePolicy`
+        """
+        if group not in self.autoscalers:
+            self.autoscalers[group] = AutoscalePolicy.from_group(self.opts.build_groups[group])
+
+        vmd_list = self.get_snapshot().get_all_vm_in_group(group)
+        ready = [vmd for vmd in vmd_list if vmd.state == VmStates.READY]
+        state = self.get_task_queue(group).get_stats()
+        state.update(
+            backlog=int(self.vmm.rc.hget(JOB_GRAB_BACKLOG_HASH, group) or 0),
+            ready=len(ready),
+            in_use=sum(1 for vmd in vmd_list if vmd.state == VmStates.IN_USE),
+            starting=sum(1 for vmd in vmd_list
+                         if vmd.state in [VmStates.GOT_IP, VmStates.CHECK_HEALTH]),
+            spawning=self.spawner.get_proc_num_per_group(group),
+        )
+        decision = self.autoscalers[group].decide(time.time(), state)
+        if decision.spawn or decision.terminate:
+            self.log.info("Autoscale group {}: {} pending, {} processing, {} ready, {} in use, "
+                          "{} starting, target ready {}, arrival rate {:.4f}/s, "
+                          "completion rate {:.4f}/s: spawning {}, terminating {}"
+                          .format(group, state.pending + state.backlog, state.processing,
+                                  state.ready, state.in_use,
+                                  state.starting + state.spawning, decision.target_ready,
+                                  decision.arrival_rate, decision.completion_rate,
+                                  decision.spawn, decision.terminate))
+
+        if decision.spawn:
+            try:
+                self._check_total_vm_limit(group)
+            except VmSpawnLimitReached as err:
+                self.log.debug(err.msg)
+            else:
+                self.vmm.write_vm_pool_info(group, "last_vm_spawn_start", time.time())
+                for _ in range(decision.spawn):
+                    try:
+                        self.spawner.start_spawn(group)
+                    except Exception as error:
+                        self.log.exception("Error during spawn attempt: {}".format(error))
+                        break
+
+        # VMs dirtied by some user are less useful, the longest unused go first
+        ready.sort(key=lambda vmd: (vmd.bound_to_user is None,
+                                    float(getattr(vmd, "last_release", None) or 0)))
+        for vmd in ready[:decision.terminate]:
+            self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.READY)
+
     def start_spawn_if_required(self):
         for group in self.vmm.vm_groups:
-            self.try_spawn_one(group)
+            if self.opts.build_groups[group]["vm_autoscale"]:
+                self.autoscale(group)
+            else:
+                self.try_spawn_one(group)
 
     def do_cycle(self):
         self.log.debug("starting do_cycle")
 
         # TODO: each check should be executed in threads ... and finish with join?
 
-        self.remove_old_dirty_vms()
-        self.check_vms_health()
-        self.start_spawn_if_required()
-
-        self.remove_vm_with_dead_builder()
-        self.finalize_long_health_checks()
-        self.terminate_again()
-
-        self.spawner.recycle()
+        self.cycle_timings = OrderedDict()
+        cycle_start = time.time()
+        try:
+            self.snapshot = self.vmm.get_snapshot()
+            vm_count = len(self.snapshot)
+            self.cycle_timings["load_snapshot"] = time.time() - cycle_start
+
+            for name, phase in [
+                ("remove_old_dirty_vms", self.remove_old_dirty_vms),
+                ("check_vms_health", self.check_vms_health),
+                ("start_spawn_if_required", self.start_spawn_if_required),
+                ("remove_vm_with_dead_builder", self.remove_vm_with_dead_builder),
+                ("finalize_long_health_checks", self.finalize_long_health_checks),
+                ("terminate_again", self.terminate_again),
+                ("spawner_recycle", self.spawner.recycle),
+            ]:
+                phase_start = time.time()
+                phase()
+                self.cycle_timings[name] = time.time() - phase_start
+        finally:
+            self.snapshot = None
+
+        took = time.time() - cycle_start
+        self.log.debug("do_cycle took {:.3f}s for {} VMs, {}".format(
+            took, vm_count, ", ".join("{}: {:.3f}s".format(name, duration)
+                                      for name, duration in self.cycle_timings.items())))
+        if took > self.opts.vm_cycle_timeout:
+            self.log.warning("do_cycle took {:.3f}s, longer than vm_cycle_timeout".format(took))
 
         # todo: self.terminate_excessive_vms() -- for case when config changed during runtime
 
@@ -261,6 +293,8 @@ class VmMaster(Process):
 
         setproctitle("VM master")
         self.vmm.mark_server_start()
+        self.vmm.restore_vm_leases()
+        self.vmm.rebuild_vm_indexes()
         self.kill_received = False
 
         self.log.info("VM master process started")
@@ -283,9 +317,9 @@ class VmMaster(Process):
         After server crash it's possible that some VM's will remain in `check_health` state
         Here we are looking for such records and mark them with `check_health_failed` state
         """
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.CHECK_HEALTH]):
+        for vmd in self.get_snapshot().get_vm_by_group_and_state_list(None, [VmStates.CHECK_HEALTH]):
 
-            time_elapsed = time.time() - float(vmd.get_field(self.vmm.rc, "last_health_check") or 0)
+            time_elapsed = time.time() - float(getattr(vmd, "last_health_check", None) or 0)
             if time_elapsed > self.opts.build_groups[vmd.group]["vm_health_check_max_time"]:
                 self.log.info("VM marked with check fail state, "
                               "VM stayed too long in health check state, elapsed: {} VM: {}"
@@ -301,10 +335,11 @@ class VmMaster(Process):
         but we have already got a new VM with the same IP => it's safe to remove old vm from pool
         """
 
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.TERMINATING]):
-            time_elapsed = time.time() - float(vmd.get_field(self.vmm.rc, "terminating_since") or 0)
+        snapshot = self.get_snapshot()
+        for vmd in snapshot.get_vm_by_group_and_state_list(None, [VmStates.TERMINATING]):
+            time_elapsed = time.time() - float(getattr(vmd, "terminating_since", None) or 0)
             if time_elapsed > self.opts.build_groups[vmd.group]["vm_terminating_timeout"]:
-                if len(self.vmm.lookup_vms_by_ip(vmd.vm_ip)) > 1:
+                if len(snapshot.lookup_vms_by_ip(vmd.vm_ip)) > 1:
                     self.log.info(
                         "Removing VM record: {}. There are more VM with the same ip, "
                         "it's safe to remove current one from VM pool".format(vmd.vm_name))
@@ -47,6 +47,10 @@ class BuilderTimeOutError(BuilderError):
     pass
 
 
+class BuilderCancelledError(BuilderError):
+    pass
+
+
 class CoprSignError(MockRemoteError):
     """
     Related to invocation of /bin/sign
@@ -121,6 +125,13 @@ class CoprWorkerError(CoprBackendError):
     pass
 
 
+class TaskLeaseLost(CoprWorkerError):
+    """
+    Lease of the processed task expired, another worker builds it now
+    """
+    pass
+
+
 class CoprSpawnFailError(CoprBackendError):
     pass
 
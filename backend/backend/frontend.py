@@ -1,7 +1,29 @@
 import json
-from requests import post, RequestException
+import os
+from requests import Session, RequestException
 import time
 
+from .update_spool import UpdateSpool
+
+
+# frontend or the proxy in front of it is down, the same request can succeed later
+UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+
+
+class FrontendRejectedError(RequestException):
+    """
+    Frontend answered, but didn't accept the request, sending it again won't help
+    """
+    pass
+
+
+def next_backoff(backoff, max_backoff):
+    """
+    :param backoff: previous delay, 0 for the first failure
+    :return: how long to wait before the next attempt, doubles up to max_backoff
+    """
+    return min(max(backoff * 2, 1), max_backoff)
+
 
 class FrontendClient(object):
     """
@@ -12,12 +34,34 @@ class FrontendClient(object):
         super(FrontendClient, self).__init__()
         self.frontend_url = "{}/backend".format(opts.frontend_base_url)
         self.frontend_auth = opts.frontend_auth
+        self.max_backoff = opts.get("update_max_backoff", 300)
+
+        # updates are delivered by the update aggregator when spool is configured
+        self.update_spool = None
+        if opts.get("update_spool_dir"):
+            self.update_spool = UpdateSpool(opts.update_spool_dir)
+
+        self._session = None
+        self._session_pid = None
 
         self.msg = None
 
+    @property
+    def session(self):
+        """
+        Keep-alive session, one per process, since client is shared by forked workers
+        """
+        if self._session is None or self._session_pid != os.getpid():
+            self._session = Session()
+            self._session_pid = os.getpid()
+        return self._session
+
     def _post_to_frontend(self, data, url_path):
         """
         Make a request to the frontend
+
+        :raises FrontendRejectedError: when frontend refused the data
+        :raises RequestException: when frontend is not available
         """
 
         headers = {"content-type": "application/json"}
@@ -27,11 +71,13 @@ class FrontendClient(object):
         self.msg = None
 
         try:
-            response = post(url, data=json.dumps(data), auth=auth, headers=headers)
+            response = self.session.post(url, data=json.dumps(data), auth=auth, headers=headers)
             if response.status_code >= 400:
                 self.msg = "Failed to submit to frontend: {0}: {1}".format(
                     response.status_code, response.text)
-                raise RequestException(self.msg)
+                if response.status_code in UNAVAILABLE_STATUS_CODES:
+                    raise RequestException(self.msg)
+                raise FrontendRejectedError(self.msg)
         except RequestException as e:
             self.msg = "Post request failed: {0}".format(e)
             raise
@@ -39,21 +85,51 @@ class FrontendClient(object):
 
     def _post_to_frontend_repeatedly(self, data, url_path, max_repeats=10):
         """
-        Make a request max_repeats-time to the frontend
+        Make a request max_repeats-time to the frontend, waiting with exponential
+        backoff between attempts. Rejected request is not repeated.
         """
+        backoff = 0
         for i in range(max_repeats):
+            if i:
+                backoff = next_backoff(backoff, self.max_backoff)
+                time.sleep(backoff)
             try:
                 return self._post_to_frontend(data, url_path)
+            except FrontendRejectedError:
+                raise
             except RequestException:
-                time.sleep(5)
-        else:
-            raise RequestException("Failed to post to frontend for {} times".format(max_repeats))
+                pass
+        raise RequestException("Failed to post to frontend for {} times".format(max_repeats))
 
     def update(self, data):
         """
-        Send data to be updated in the frontend
+        Send data to be updated in the frontend. When the update spool is configured,
+        data are only stored there and the call doesn't wait for the frontend.
+        """
+        if self.update_spool is not None:
+            self.update_spool.put(data)
+        else:
+            self._post_to_frontend_repeatedly(data, "update")
+
+    def post_update(self, data):
+        """
+        Send data to be updated in the frontend right now, single attempt
+
+        :return: response json
+        :raises FrontendRejectedError: when frontend refused the data
+        :raises RequestException: when frontend is not available
+        """
+        return self._post_to_frontend(data, "update").json()
+
+    def post_reschedule(self, data):
+        """
+        Ask the frontend to reschedule build chroot right now, single attempt
+
+        :param dict data: with the keys "build_id" and "chroot"
+        :raises FrontendRejectedError: when frontend refused the data
+        :raises RequestException: when frontend is not available
         """
-        self._post_to_frontend_repeatedly(data, "update")
+        self._post_to_frontend(data, "reschedule_build_chroot")
 
     def starting_build(self, build_id, chroot_name):
         """
@@ -70,9 +146,29 @@ class FrontendClient(object):
     def reschedule_build(self, build_id, chroot_name):
         """
         Announce to the frontend that a build should be rescheduled (set pending state).
+        When the update spool is configured, the request is spooled behind the build
+        updates, so an older spooled update can't overwrite the pending state.
         """
         data = {"build_id": build_id, "chroot": chroot_name}
-        self._post_to_frontend_repeatedly(data, "reschedule_build_chroot")
+        if self.update_spool is not None:
+            self.update_spool.put({"reschedule": data})
+        else:
+            self._post_to_frontend_repeatedly(data, "reschedule_build_chroot")
+
+    def get_auto_createrepo_statuses(self):
+        """
+        Fetch auto_createrepo flags of all projects by a single request
+
+        :return dict: (owner, project) -> bool
+        :raises RequestException: when frontend is not available
+        """
+        url = "{}/auto_createrepo/".format(self.frontend_url)
+        response = self.session.get(url, auth=("user", self.frontend_auth))
+        if response.status_code >= 400:
+            raise RequestException("Failed to get auto_createrepo statuses: {0}: {1}"
+                                   .format(response.status_code, response.text))
+        return dict(((project["owner"], project["project"]), project["auto_createrepo"])
+                    for project in response.json()["projects"])
 
     def reschedule_all_running(self):
         response = self._post_to_frontend({}, "reschedule_all_running")
@@ -11,6 +11,9 @@ import ConfigParser
 import os
 import sys
 import errno
+from subprocess import Popen, PIPE
+import threading
+import time
 from contextlib import contextmanager
 
 import traceback
@@ -25,8 +28,10 @@ from . import constants
 
 from copr.client import CoprClient
 from backend.constants import DEF_BUILD_USER, DEF_BUILD_TIMEOUT, DEF_CONSECUTIVE_FAILURE_THRESHOLD, \
-    CONSECUTIVE_FAILURE_REDIS_KEY, default_log_format
+    CONSECUTIVE_FAILURE_REDIS_KEY, default_log_format, DEF_LOG_BATCH_SIZE, DEF_LOG_FLUSH_INTERVAL, \
+    DEF_LOG_QUEUE_MAX_LEN
 from backend.exceptions import CoprBackendError
+from backend.build_log import SegmentedLogHandler, DEFAULT_SEGMENT_SIZE
 
 class SortedOptParser(optparse.OptionParser):
     """Optparser which sorts the options by opt before outputting --help"""
@@ -66,6 +71,24 @@ def _get_conf(cp, section, option, default, mode=None):
             return path
     return default
 
+def _get_shares(value, convert):
+    """
+    Parse config value in the format ``name:value,name:value``
+
+    :param convert: type of values, e.g. int
+    :return dict: name -> converted value
+    """
+    result = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, share = item.rpartition(":")
+        try:
+            result[name.strip()] = convert(share)
+        except ValueError:
+            raise CoprBackendError("Invalid value `{}` in: {}".format(item, value))
+    return result
+
 def chroot_to_branch(chroot):
     """
     Get a git branch name from chroot. Follow the fedora naming standard.
@@ -125,6 +148,12 @@ class BackendConfigReader(object):
         opts.keygen_host = _get_conf(
             cp, "backend", "keygen_host", "copr-keygen.cloud.fedoraproject.org")
 
+        opts.sign_workers = _get_conf(
+            cp, "backend", "sign_workers", 4, mode="int")
+
+        opts.sign_pubkey_ttl = _get_conf(
+            cp, "backend", "sign_pubkey_ttl", 3600, mode="int")
+
         opts.build_user = _get_conf(
             cp, "backend", "build_user", DEF_BUILD_USER)
 
@@ -149,6 +178,9 @@ class BackendConfigReader(object):
                 "max_workers": _get_conf(
                     cp, "backend", "group{0}_max_workers".format(group_id),
                     default=32, mode="int"),
+                "max_queued_tasks": _get_conf(
+                    cp, "backend", "group{0}_max_queued_tasks".format(group_id),
+                    default=64, mode="int"),
                 "max_vm_total": _get_conf(
                     cp, "backend", "group{}_max_vm_total".format(group_id),
                     # default=16, mode="int"),
@@ -168,6 +200,18 @@ class BackendConfigReader(object):
                 "vm_dirty_terminating_timeout": _get_conf(
                     cp, "backend", "group{}_vm_dirty_terminating_timeout".format(group_id),
                     default=120, mode="int"),
+                "vm_autoscale": _get_conf(
+                    cp, "backend", "group{}_vm_autoscale".format(group_id),
+                    default=False, mode="bool"),
+                "vm_warm_pool": _get_conf(
+                    cp, "backend", "group{}_vm_warm_pool".format(group_id),
+                    default=1, mode="int"),
+                "vm_spawn_time": _get_conf(
+                    cp, "backend", "group{}_vm_spawn_time".format(group_id),
+                    default=300, mode="int"),
+                "vm_scale_down_delay": _get_conf(
+                    cp, "backend", "group{}_vm_scale_down_delay".format(group_id),
+                    default=600, mode="int"),
                 "vm_health_check_period": _get_conf(
                     cp, "backend", "group{}_vm_health_check_period".format(group_id),
                     default=120, mode="int"),
@@ -198,6 +242,39 @@ class BackendConfigReader(object):
             cp, "backend", "fedmsg_enabled", False, mode="bool")
         opts.sleeptime = _get_conf(
             cp, "backend", "sleeptime", 10, mode="int")
+        opts.tasks_reconcile_period = _get_conf(
+            cp, "backend", "tasks_reconcile_period", 300, mode="int")
+        opts.task_lease_timeout = _get_conf(
+            cp, "backend", "task_lease_timeout", 600, mode="int")
+        opts.vm_lease_timeout = _get_conf(
+            cp, "backend", "vm_lease_timeout", 120, mode="int")
+        opts.update_spool_dir = _get_conf(
+            cp, "backend", "update_spool_dir", "/var/lib/copr/update_spool", mode="path")
+        opts.update_batch_size = _get_conf(
+            cp, "backend", "update_batch_size", 100, mode="int")
+        opts.update_max_backoff = _get_conf(
+            cp, "backend", "update_max_backoff", 300, mode="int")
+        opts.results_transfer_slots = _get_conf(
+            cp, "backend", "results_transfer_slots", 8, mode="int")
+        opts.results_transfer_bandwidth = _get_conf(
+            cp, "backend", "results_transfer_bandwidth", 0, mode="int")
+        opts.results_transfer_lock_dir = _get_conf(
+            cp, "backend", "results_transfer_lock_dir", "/var/run/copr-backend/transfer_slots",
+            mode="path")
+        opts.build_log_segment_size = _get_conf(
+            cp, "backend", "build_log_segment_size", DEFAULT_SEGMENT_SIZE, mode="int")
+        opts.createrepo_batch_delay = _get_conf(
+            cp, "backend", "createrepo_batch_delay", 2, mode="float")
+        opts.project_cache_ttl = _get_conf(
+            cp, "backend", "project_cache_ttl", 3600, mode="int")
+        opts.scheduler = _get_conf(
+            cp, "backend", "scheduler", "fair")
+        opts.scheduler_weights = _get_shares(
+            _get_conf(cp, "backend", "scheduler_weights", ""), float)
+        opts.scheduler_priorities = _get_shares(
+            _get_conf(cp, "backend", "scheduler_priorities", ""), int)
+        opts.action_workers = _get_shares(
+            _get_conf(cp, "backend", "action_workers", ""), int)
         opts.timeout = _get_conf(
             cp, "builder", "timeout", DEF_BUILD_TIMEOUT, mode="int")
         opts.consecutive_failure_threshold = _get_conf(
@@ -207,10 +284,23 @@ class BackendConfigReader(object):
             cp, "backend", "log_dir", "/var/log/copr/")
         opts.log_level = _get_conf(
             cp, "backend", "log_level", "info")
+        opts.log_batch_size = _get_conf(
+            cp, "backend", "log_batch_size", DEF_LOG_BATCH_SIZE, mode="int")
+        opts.log_flush_interval = _get_conf(
+            cp, "backend", "log_flush_interval", DEF_LOG_FLUSH_INTERVAL, mode="float")
         opts.verbose = _get_conf(
             cp, "backend", "verbose", False, mode="bool")
 
         opts.prune_days = _get_conf(cp, "backend", "prune_days", None, mode="int")
+        opts.prune_keep_builds = _get_conf(cp, "backend", "prune_keep_builds", 1, mode="int")
+        opts.prune_policy_days = _get_shares(
+            _get_conf(cp, "backend", "prune_policy_days", ""), int)
+        opts.prune_policy_keep = _get_shares(
+            _get_conf(cp, "backend", "prune_policy_keep", ""), int)
+        opts.prune_workers = _get_conf(cp, "backend", "prune_workers", 4, mode="int")
+        opts.prune_index_path = _get_conf(
+            cp, "backend", "prune_index_path", "/var/lib/copr/prune/prune_index.json",
+            mode="path")
 
         # ssh options
         opts.ssh = Munch()
@@ -295,32 +385,110 @@ def format_tb(ex, ex_traceback):
     return ''.join(tb_lines)
 
 
+# LogRecord attributes sent to the log router
+LOG_RECORD_FIELDS = ["name", "created", "msecs", "relativeCreated", "process", "processName",
+                     "thread", "threadName", "module", "filename", "pathname", "lineno", "funcName"]
+
+
 class RedisPublishHandler(logging.Handler):
     """
+    Sends log records to the log router :py:class:`backend.daemons.log.RedisLogHandler`
+    through the redis list, so records aren't lost while the router restarts.
+
+    Records are buffered and pushed by one command per batch, when ``batch_size``
+    records are collected or at the latest after ``flush_interval`` seconds.
+    Errors are pushed immediately. When the router doesn't keep up, the oldest
+    records over ``max_queue_len`` are dropped.
+
     :type rc: StrictRedis
     """
-    def __init__(self, rc, who, level=logging.NOTSET,):
+    def __init__(self, rc, who, level=logging.NOTSET, batch_size=DEF_LOG_BATCH_SIZE,
+                 flush_interval=DEF_LOG_FLUSH_INTERVAL, max_queue_len=DEF_LOG_QUEUE_MAX_LEN):
         super(RedisPublishHandler, self).__init__(level)
 
         self.rc = rc
         self.who = who
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_len = max_queue_len
+
+        self.buffer = []
+        self.flusher = None
+        # handlers are often created before the worker processes are forked
+        self.pid = None
+
+    def _ensure_flusher(self):
+        if self.pid == os.getpid():
+            return
+        # records buffered by the parent process are pushed by the parent
+        self.buffer = []
+        self.pid = os.getpid()
+        self.flusher = threading.Thread(target=self._run_flusher, name="RedisPublishHandler")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _run_flusher(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def format_record(self, record):
+        msg = dict((key, getattr(record, key, None)) for key in LOG_RECORD_FIELDS)
+        msg["who"] = self.who
+        msg["level"] = record.levelname.lower()
+        msg["msg"] = record.getMessage()
+        if record.exc_info:
+            _, error, tb = record.exc_info
+            msg["traceback"] = format_tb(error, tb)
+        return json.dumps(msg)
 
     def emit(self, record):
         try:
-            msg = record.__dict__
-            msg["who"] = self.who
+            data = self.format_record(record)
+        # pylint: disable=W0703
+        except Exception as error:
+            _, _, ex_tb = sys.exc_info()
+            sys.stderr.write("Failed to serialize log record, {}".format(format_tb(error, ex_tb)))
+            return
+
+        self.acquire()
+        try:
+            self._ensure_flusher()
+            self.buffer.append(data)
+            full = len(self.buffer) >= self.batch_size
+        finally:
+            self.release()
 
-            if msg.get("exc_info"):
-                # from celery.contrib import rdb; rdb.set_trace()
-                _, error, tb = msg.pop("exc_info")
-                msg["traceback"] = format_tb(error, tb)
+        if full or record.levelno >= logging.ERROR:
+            self.flush()
 
-            self.rc.publish(constants.LOG_PUB_SUB, json.dumps(msg))
+    def flush(self):
+        self.acquire()
+        try:
+            batch, self.buffer = self.buffer, []
+        finally:
+            self.release()
+        if not batch:
+            return
+
+        try:
+            pipe = self.rc.pipeline(transaction=False)
+            pipe.rpush(constants.LOG_QUEUE, *batch)
+            if self.max_queue_len:
+                pipe.ltrim(constants.LOG_QUEUE, -self.max_queue_len, -1)
+            pipe.execute()
         # pylint: disable=W0703
         except Exception as error:
             _, _, ex_tb = sys.exc_info()
-            sys.stderr.write("Failed to publish log record to redis, {}"
-                             .format(format_tb(error, ex_tb)))
+            sys.stderr.write("Failed to publish {} log records to redis, {}"
+                             .format(len(batch), format_tb(error, ex_tb)))
+
+    def close(self):
+        self.flush()
+        # stops the flusher thread
+        self.pid = None
+        super(RedisPublishHandler, self).close()
 
 
 def get_redis_logger(opts, name, who):
@@ -329,7 +497,10 @@ def get_redis_logger(opts, name, who):
 
     if not logger.handlers:
         rc = get_redis_connection(opts)
-        handler = RedisPublishHandler(rc, who, level=logging.DEBUG)
+        handler = RedisPublishHandler(
+            rc, who, level=logging.DEBUG,
+            batch_size=opts.get("log_batch_size", DEF_LOG_BATCH_SIZE),
+            flush_interval=opts.get("log_flush_interval", DEF_LOG_FLUSH_INTERVAL))
         logger.addHandler(handler)
 
     return logger
@@ -363,6 +534,19 @@ def silent_remove(filename):
             raise # re-raise exception if a different error occured
 
 
+def remove_tree(path):
+    """
+    Removes the directory tree by the ``rm`` process, the calling thread waits
+    for it without holding the GIL, unlike with :py:func:`shutil.rmtree`
+
+    :raises OSError: when the tree can't be removed
+    """
+    handle = Popen(["rm", "-rf", "--", path], stdout=PIPE, stderr=PIPE)
+    _, stderr = handle.communicate()
+    if handle.returncode != 0:
+        raise OSError("Failed to remove {}: {}".format(path, stderr))
+
+
 def get_backend_opts():
     args = sys.argv[1:]
     parser = optparse.OptionParser("\ncopr-be [options]")
@@ -381,9 +565,31 @@ def get_backend_opts():
     return config_reader.read()
 
 
+def create_segmented_logger(name, filepath, fmt=None, segment_size=None):
+    """
+    Like :py:func:`create_file_logger` but the log is written as compressed
+    segments, see :py:mod:`backend.build_log`
+    """
+    logger = logging.getLogger(name)
+
+    if not logger.handlers:
+        handler = SegmentedLogHandler(filepath, segment_size or DEFAULT_SEGMENT_SIZE)
+        handler.setFormatter(fmt if fmt is not None else default_log_format)
+        logger.addHandler(handler)
+
+    return logger
+
+
 @contextmanager
-def local_file_logger(name, path, fmt):
-    build_logger = create_file_logger(name, path, fmt)
+def local_file_logger(name, path, fmt, segment_size=None):
+    """
+    :param int segment_size: [optional] write the log as compressed segments
+        of the given size instead of the plain file
+    """
+    if segment_size:
+        build_logger = create_segmented_logger(name, path, fmt, segment_size)
+    else:
+        build_logger = create_file_logger(name, path, fmt)
     try:
         yield build_logger
     finally:
@@ -392,3 +598,4 @@ def local_file_logger(name, path, fmt):
         # to the previous project
         for h in build_logger.handlers[:]:
             build_logger.removeHandler(h)
+            h.close()
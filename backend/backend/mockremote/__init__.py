@@ -45,7 +45,7 @@ from ..exceptions import MockRemoteError, BuilderError, CreateRepoError
 
 
 # TODO: replace sign & createrepo with dependency injection
-from ..sign import sign_rpms_in_dir, get_pubkey
+from ..sign import sign_rpms_in_dir, get_cached_pubkey, DEFAULT_PUBKEY_TTL
 from ..createrepo import createrepo
 
 from .builder import Builder
@@ -80,7 +80,7 @@ class MockRemote(object):
     #   idea: send events according to the build progress to handler
 
     def __init__(self, builder_host, job, logger,
-                 repos=None, opts=None):
+                 repos=None, opts=None, createrepo_coalescer=None):
 
         """
         :param builder_host: builder hostname or ip
@@ -111,6 +111,9 @@ class MockRemote(object):
             :ivar remote_basedir: basedir on builder
             :ivar remote_tempdir: tempdir on builder
 
+        :param CreaterepoCoalescer createrepo_coalescer: [optional] shares createrepo
+            runs with other workers, without it createrepo is run for each build
+
         # Removed:
         # :param cont: if a pkg fails to build, continue to the next one--
         # :param bool recurse: if more than one pkg and it fails to build,
@@ -129,6 +132,7 @@ class MockRemote(object):
 
         self.log = logger
         self.job = job
+        self.createrepo_coalescer = createrepo_coalescer
 
         self.log.info("Setting up builder: {0}".format(builder_host))
         # TODO: add option "builder_log_level" to backend config
@@ -179,7 +183,8 @@ class MockRemote(object):
             # if os.path.exists(pubkey_path):
             #    return
 
-            get_pubkey(user, project, pubkey_path)
+            get_cached_pubkey(user, project, outfile=pubkey_path,
+                              ttl=self.opts.get("sign_pubkey_ttl", DEFAULT_PUBKEY_TTL))
             self.log.info(
                 "Added pubkey for user {} project {} into: {}".
                 format(user, project, pubkey_path))
@@ -228,14 +233,28 @@ class MockRemote(object):
                        .format(self.job.project_owner, self.job.project_name,
                                self.opts.frontend_base_url, self.chroot_dir, base_url))
 
-        try:
-            createrepo(
+        def regenerate(changes):
+            return createrepo(
                 path=self.chroot_dir,
                 front_url=self.opts.frontend_base_url,
                 base_url=base_url,
                 username=self.job.project_owner,
                 projectname=self.job.project_name,
+                added=changes.added if changes else None,
+                removed=changes.removed if changes else None,
+                opts=self.opts,
             )
+
+        added = [self.job.results_dir]
+        try:
+            if self.createrepo_coalescer is None:
+                regenerate(Munch(added=added, removed=[]))
+            else:
+                ticket = self.createrepo_coalescer.request(self.chroot_dir, added=added)
+                ran = ticket.wait(regenerate)
+                self.log.info("Packages published after {:.1f}s, {}".format(
+                    time.time() - ticket.requested_on,
+                    "createrepo finished" if ran else "covered by createrepo of another build"))
         except CreateRepoError:
             self.log.exception("Error making local repo: {}".format(self.chroot_dir))
 
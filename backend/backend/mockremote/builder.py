@@ -1,7 +1,6 @@
 import os
 import pipes
 import socket
-from subprocess import Popen
 import time
 from urlparse import urlparse
 
@@ -9,9 +8,16 @@ from ansible.runner import Runner
 from backend.vm_manage import PUBSUB_INTERRUPT_BUILDER
 from ..helpers import get_redis_connection
 
-from ..exceptions import BuilderError, BuilderTimeOutError, AnsibleCallError, AnsibleResponseError, VmError
+from ..exceptions import BuilderError, BuilderTimeOutError, BuilderCancelledError, \
+    AnsibleCallError, AnsibleResponseError, VmError
 
-from ..constants import mockchain, rsync, DEF_BUILD_TIMEOUT
+from ..constants import mockchain, DEF_BUILD_TIMEOUT, PUBSUB_CANCEL_BUILD
+from .channel import RemoteCommand, SSH_CONNECTION_ERROR
+from .transfer import ResultTransfer, TransferSlots, get_manifest_cmd, parse_manifest
+
+
+# how often in seconds the results download progress is logged
+TRANSFER_PROGRESS_INTERVAL = 10
 
 
 class Builder(object):
@@ -32,6 +38,9 @@ class Builder(object):
         self.remote_pkg_path = None
         self.remote_pkg_name = None
 
+        self.rc = None
+        self.ps = None
+
         # if we're at this point we've connected and done stuff on the host
         self.conn = self._create_ans_conn()
         self.root_conn = self._create_ans_conn(username="root")
@@ -253,43 +262,73 @@ class Builder(object):
         return buildcmd
 
     def run_build_and_wait(self, buildcmd):
+        """
+        Runs the build command over ssh, its output is written into the build
+        log as it arrives. Build is stopped when the message comes to the builder
+        interrupt channel or to the build cancel channel.
+
+        :return: ansible-like results dict, the builder is reported as dark
+            when ssh couldn't connect
+        :raises BuilderTimeOutError: build timeout expired
+        :raises BuilderCancelledError: build was cancelled
+        :raises VmError: builder was interrupted
+        """
         self.log.info("executing: {0}".format(buildcmd))
-        self.conn.module_name = "shell"
-        self.conn.module_args = buildcmd
-        _, poller = self.conn.run_async(self.timeout)
-        waited = 0
-        results = None
-
-        # self.setup_pubsub_handler()
-        while True:
-            # TODO rework Builder and extrace check_pubsub, add method to interrupt build process from dispatcher
-            # self.check_pubsub()
-            results = poller.poll()
-
-            if results["contacted"] or results["dark"]:
-                break
-
-            if waited >= self.timeout:
-                raise BuilderTimeOutError("Build timeout expired. Time limit: {}s, time spent: {}s"
-                                          .format(self.timeout, waited))
-
-            time.sleep(10)
-            waited += 10
-        return results
+        output = []
+        partial_line = [""]
+
+        def on_output(data):
+            output.append(data)
+            lines = (partial_line[0] + data).split("\n")
+            partial_line[0] = lines.pop()
+            for line in lines:
+                self.log.info(line.rstrip("\r"))
+
+        self.setup_pubsub_handler()
+        command = RemoteCommand(self.opts.build_user, self.hostname, buildcmd)
+        try:
+            return_code = command.run(self.timeout, on_output, check_interrupt=self.check_pubsub)
+        finally:
+            self.close_pubsub_handler()
+            if partial_line[0]:
+                self.log.info(partial_line[0].rstrip("\r"))
+
+        stdout = "".join(output)
+        if return_code == SSH_CONNECTION_ERROR:
+            return {"contacted": {}, "dark": {self.hostname: {
+                "failed": True, "msg": "ssh connection failed", "stdout": stdout}}}
+        return {"contacted": {self.hostname: {"rc": return_code, "stdout": stdout}}, "dark": {}}
 
     def setup_pubsub_handler(self):
 
         self.rc = get_redis_connection(self.opts)
-        self.ps = self.rc.pubsub(ignore_subscribe_messages=True)
-        channel_name = PUBSUB_INTERRUPT_BUILDER.format(self.hostname)
-        self.ps.subscribe(channel_name)
+        self.ps = self.rc.pubsub()
+        channel_names = [PUBSUB_INTERRUPT_BUILDER.format(self.hostname),
+                         self.cancel_channel]
+        self.ps.subscribe(*channel_names)
 
-        self.log.info("Subscribed to vm interruptions channel {}".format(channel_name))
+        self.log.info("Subscribed to interruption channels {}".format(channel_names))
+
+    def close_pubsub_handler(self):
+        if self.ps is not None:
+            self.ps.close()
+            self.ps = None
+
+    @property
+    def cancel_channel(self):
+        return PUBSUB_CANCEL_BUILD.format(build_id=self.job.build_id)
 
     def check_pubsub(self):
         # self.log.info("Checking pubsub channel")
-        msg = self.ps.get_message()
-        if msg is not None and msg.get("type") == "message":
+        # read until the queue is empty, subscription confirmations are skipped
+        while True:
+            msg = self.ps.get_message()
+            if msg is None:
+                return
+            if msg.get("type") != "message":
+                continue
+            if msg.get("channel") == self.cancel_channel:
+                raise BuilderCancelledError("Build cancelled by msg: {}".format(msg["data"]))
             raise VmError("Build interrupted by msg: {}".format(msg["data"]))
 
     # def start_build(self, pkg):
@@ -328,37 +367,36 @@ class Builder(object):
         return get_ans_results(ansible_build_results, self.hostname).get("stdout", "")
 
     def download(self, target_dir):
-        if self._get_remote_results_dir():
-            self.log.info("Start retrieve results for: {0}".format(self.job))
-            # download the pkg to destdir using rsync + ssh
-
-            # # make spaces work w/our rsync command below :(
-            destdir = "'" + target_dir.replace("'", "'\\''") + "'"
-
-            # build rsync command line from the above
-            remote_src = "{}@{}:{}/*".format(self.opts.build_user,
-                                             self.hostname,
-                                             self._get_remote_results_dir())
-            ssh_opts = "'ssh -o PasswordAuthentication=no -o StrictHostKeyChecking=no'"
-
-            rsync_log_filepath = os.path.join(destdir, self.job.rsync_log_name)
-            command = "{} -avH -e {} {} {}/ &> {}".format(
-                rsync, ssh_opts, remote_src, destdir,
-                rsync_log_filepath)
-
-            # dirty magic with Popen due to IO buffering
-            # see http://thraxil.org/users/anders/posts/2008/03/13/Subprocess-Hanging-PIPE-is-your-enemy/
-            # alternative: use tempfile.Tempfile as Popen stdout/stderr
-            try:
-                cmd = Popen(command, shell=True)
-                cmd.wait()
-                self.log.info("End retrieve results for: {0}".format(self.job))
-            except Exception as error:
-                raise BuilderError(msg="Failed to download from builder due to rsync error, "
-                                       "see logs dir. Original error: {}".format(error))
-            if cmd.returncode != 0:
-                raise BuilderError(msg="Failed to download from builder due to rsync error, "
-                                       "see logs dir.", return_code=cmd.returncode)
+        remote_dir = self._get_remote_results_dir()
+        if not remote_dir:
+            return
+
+        self.log.info("Start retrieve results for: {0}".format(self.job))
+        results = self.run_ansible_with_check(get_manifest_cmd(remote_dir))
+        manifest = parse_manifest(get_ans_results(results, self.hostname).get("stdout", ""))
+
+        last_report = [time.time()]
+
+        def report_progress(transferred, total):
+            if time.time() - last_report[0] >= TRANSFER_PROGRESS_INTERVAL:
+                last_report[0] = time.time()
+                self.log.info("Retrieved {} of {} bytes".format(transferred, total))
+
+        transfer = ResultTransfer(self.opts.build_user, self.hostname, remote_dir, manifest,
+                                  progress=report_progress,
+                                  bandwidth=self.opts.get("results_transfer_bandwidth", 0))
+        slots = TransferSlots(self.opts.get("results_transfer_lock_dir"),
+                              self.opts.get("results_transfer_slots", 0))
+        with slots.acquire():
+            received = transfer.run(target_dir)
+
+        # list of the received files takes place of the former rsync log
+        with open(os.path.join(target_dir, self.job.rsync_log_name), "w") as handle:
+            for name in sorted(received):
+                handle.write("{}  {}\n".format(received[name], name))
+
+        self.log.info("End retrieve results for: {0}, {1} files, {2} bytes"
+                      .format(self.job, len(received), transfer.transferred))
 
     def check(self):
         # do check of host
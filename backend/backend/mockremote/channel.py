@@ -0,0 +1,96 @@
+# coding: utf-8
+
+"""
+Running commands on the builder with streamed output
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import select
+from subprocess import Popen, PIPE, STDOUT
+import time
+
+from ..exceptions import BuilderError, BuilderTimeOutError
+from .transfer import SSH_OPTS
+
+
+CHUNK_SIZE = 4096
+# ssh exit code when the connection failed
+SSH_CONNECTION_ERROR = 255
+
+
+class RemoteCommand(object):
+    """
+    Runs the shell command on the builder through one ssh connection.
+
+    Output is passed to ``on_output`` as soon as it arrives and the end
+    of the command is noticed immediately. Between the reads ``check_interrupt``
+    is called at least every ``poll_interval`` seconds, it should raise to stop
+    the command. ssh allocates the terminal, so the remote command is killed
+    by SIGHUP when the connection is closed; stdout and stderr are merged.
+
+    :param str user: user on the builder
+    :param str host: builder hostname or ip
+    :param str command: shell command
+    """
+    def __init__(self, user, host, command):
+        self.user = user
+        self.host = host
+        self.command = command
+        self.proc = None
+
+    def get_command(self):
+        return ["ssh", "-tt"] + SSH_OPTS + ["{}@{}".format(self.user, self.host), self.command]
+
+    def run(self, timeout, on_output, check_interrupt=None, poll_interval=0.5):
+        """
+        :param float timeout: max run time in seconds
+        :param callable on_output: called with the chunks of the command output
+        :param callable check_interrupt: [optional] raises to stop the command
+        :param float poll_interval: max time between ``check_interrupt`` calls
+        :return int: exit code of the command, 255 when the connection failed
+        :raises BuilderTimeOutError: timeout expired, the command is killed
+        :raises BuilderError: failed to start ssh
+        """
+        try:
+            self.proc = Popen(self.get_command(), stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        except OSError as error:
+            raise BuilderError("Failed to connect to builder {}: {}".format(self.host, error))
+
+        started_on = time.time()
+        fd = self.proc.stdout.fileno()
+        try:
+            while True:
+                ready, _, _ = select.select([fd], [], [], poll_interval)
+                if ready:
+                    data = os.read(fd, CHUNK_SIZE)
+                    if not data:
+                        break
+                    on_output(data)
+
+                if check_interrupt:
+                    check_interrupt()
+
+                spent = time.time() - started_on
+                if spent > timeout:
+                    raise BuilderTimeOutError("Build timeout expired. Time limit: {}s, time spent: {}s"
+                                              .format(timeout, int(spent)))
+            return self.proc.wait()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Closes the connection if the command is still running
+        """
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stdin.close()
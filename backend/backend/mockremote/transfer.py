@@ -0,0 +1,256 @@
+# coding: utf-8
+
+"""
+Retrieval of build results from the builder
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+from contextlib import closing, contextmanager
+import fcntl
+import hashlib
+import os
+import pipes
+from subprocess import Popen, PIPE
+import tarfile
+import tempfile
+import time
+
+from munch import Munch
+
+from ..exceptions import BuilderError
+
+
+SSH_OPTS = ["-o", "PasswordAuthentication=no", "-o", "StrictHostKeyChecking=no"]
+CHUNK_SIZE = 64 * 1024
+
+# lists regular files of the directory as lines "<size> <sha256> <relative path>"
+MANIFEST_CMD = (
+    "cd {} && find . -type f -printf '%s %P\\n' | "
+    "while read -r size name; do "
+    "echo \"$size $(sha256sum -- \"$name\" | cut -d' ' -f1) $name\"; "
+    "done"
+)
+
+
+def get_manifest_cmd(remote_dir):
+    """
+    :param str remote_dir: results directory on the builder
+    :return str: shell command which prints the manifest of the directory
+    """
+    return MANIFEST_CMD.format(pipes.quote(remote_dir))
+
+
+def parse_manifest(output):
+    """
+    :param str output: stdout of the manifest command
+    :return dict: relative path -> Munch with ``size`` and ``sha256``
+    """
+    manifest = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        size, sha256, name = line.split(" ", 2)
+        manifest[name] = Munch(size=int(size), sha256=sha256)
+    return manifest
+
+
+class Throttle(object):
+    """
+    Slows down the consumer to ``rate`` bytes per second
+
+    :param int rate: max bytes per second, 0 or None for unlimited
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = None
+        self.consumed = 0
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        if self.start is None:
+            self.start = time.time()
+        self.consumed += size
+        delay = self.start + self.consumed / self.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TransferSlots(object):
+    """
+    Limits the number of concurrent transfers of all workers of the backend.
+
+    Each transfer holds the flock of one of ``count`` slot files in ``lock_dir``,
+    the lock is released by the kernel when the worker dies.
+
+    :param str lock_dir: directory for the slot files, created when missing
+    :param int count: max number of concurrent transfers, 0 for unlimited
+    :param float poll_interval: how long to wait when all slots are taken
+    """
+    def __init__(self, lock_dir, count, poll_interval=1):
+        self.lock_dir = lock_dir
+        self.count = count
+        self.poll_interval = poll_interval
+
+    @contextmanager
+    def acquire(self):
+        """
+        Blocks until a free slot is found
+
+        :return: slot number, None when unlimited
+        :raises BuilderError: slot files can't be created
+        """
+        if not self.count:
+            yield None
+            return
+
+        try:
+            if not os.path.exists(self.lock_dir):
+                os.makedirs(self.lock_dir)
+        except OSError as error:
+            raise BuilderError("Failed to create results transfer slots: {}".format(error))
+
+        while True:
+            for idx in range(self.count):
+                try:
+                    handle = open(os.path.join(self.lock_dir, "slot-{}.lock".format(idx)), "a")
+                except IOError as error:
+                    raise BuilderError("Failed to open results transfer slot: {}".format(error))
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    handle.close()
+                    continue
+
+                try:
+                    yield idx
+                finally:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                    handle.close()
+                return
+
+            time.sleep(self.poll_interval)
+
+
+class ResultTransfer(object):
+    """
+    Streams the results directory from the builder through one
+    ``ssh ... tar -c`` pipe. Files are written as they arrive, each one
+    is hashed on the fly and compared with the manifest generated on the builder.
+
+    :param str user: user on the builder
+    :param str host: builder hostname or ip
+    :param str remote_dir: results directory on the builder
+    :param dict manifest: see :py:func:`parse_manifest`
+    :param callable progress: [optional] called with the transferred and total bytes
+    :param int bandwidth: [optional] max bytes per second, 0 for unlimited
+    """
+    def __init__(self, user, host, remote_dir, manifest, progress=None, bandwidth=0):
+        self.user = user
+        self.host = host
+        self.remote_dir = remote_dir
+        self.manifest = manifest
+        self.progress = progress
+        self.throttle = Throttle(bandwidth)
+
+        self.total = sum(item.size for item in manifest.values())
+        self.transferred = 0
+
+    def get_command(self):
+        return ["ssh"] + SSH_OPTS + [
+            "{}@{}".format(self.user, self.host),
+            "tar -C {} -cf - .".format(pipes.quote(self.remote_dir))]
+
+    def run(self, target_dir):
+        """
+        :param str target_dir: local directory for the results
+        :return dict: relative path -> sha256 of the received files
+        :raises BuilderError: transfer failed or files don't match the manifest
+        """
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                proc = Popen(self.get_command(), stdout=PIPE, stderr=stderr)
+            except OSError as error:
+                raise BuilderError("Failed to start results transfer: {}".format(error))
+
+            received = None
+            receive_error = None
+            try:
+                received = self.receive(proc.stdout, target_dir)
+            except (tarfile.TarError, IOError, OSError) as error:
+                receive_error = error
+            finally:
+                # remote tar gets SIGPIPE when the stream wasn't read to the end
+                proc.stdout.close()
+                proc.wait()
+
+            if proc.returncode != 0:
+                stderr.seek(0)
+                raise BuilderError("Failed to download results from builder{}".format(
+                    ": {}".format(receive_error) if receive_error else ""),
+                    return_code=proc.returncode, stderr=stderr.read())
+            if receive_error:
+                raise BuilderError("Failed to receive results: {}".format(receive_error))
+
+        self.verify(received, target_dir)
+        return received
+
+    def receive(self, stream, target_dir):
+        """
+        Unpacks the tar stream into ``target_dir``
+
+        :return dict: relative path -> sha256 of the received files
+        """
+        received = {}
+        with closing(tarfile.open(fileobj=stream, mode="r|")) as archive:
+            for member in archive:
+                name = os.path.normpath(member.name)
+                if os.path.isabs(name) or name.split(os.sep)[0] == "..":
+                    raise BuilderError("Refusing to write outside of the results dir: {}"
+                                       .format(member.name))
+                path = os.path.join(target_dir, name)
+                if member.isdir():
+                    if not os.path.exists(path):
+                        os.makedirs(path)
+                elif member.isfile():
+                    received[name] = self._receive_file(archive.extractfile(member), path)
+                # links and special files aren't part of the results
+        return received
+
+    def _receive_file(self, source, path):
+        checksum = hashlib.sha256()
+        part_path = os.path.join(os.path.dirname(path), ".{}.part".format(os.path.basename(path)))
+        with open(part_path, "wb") as handle:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                handle.write(chunk)
+                checksum.update(chunk)
+
+                self.transferred += len(chunk)
+                self.throttle.consume(len(chunk))
+                if self.progress:
+                    self.progress(self.transferred, self.total)
+        os.rename(part_path, path)
+        return checksum.hexdigest()
+
+    def verify(self, received, target_dir):
+        """
+        Removes received files with the wrong checksum
+
+        :raises BuilderError: some files from the manifest are missing or corrupted
+        """
+        missing = sorted(set(self.manifest) - set(received))
+        corrupted = sorted(name for name, sha256 in received.items()
+                           if name in self.manifest and self.manifest[name].sha256 != sha256)
+        for name in corrupted:
+            os.remove(os.path.join(target_dir, name))
+
+        if missing or corrupted:
+            raise BuilderError("Downloaded results don't match the builder manifest, "
+                               "missing: {}, corrupted: {}".format(missing, corrupted))
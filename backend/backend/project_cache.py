@@ -0,0 +1,122 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import json
+import time
+
+from munch import Munch
+from copr.client import CoprClient
+from requests import RequestException
+
+from .frontend import FrontendClient
+from .helpers import get_redis_connection
+
+# default number of seconds for which project settings are cached
+DEFAULT_PROJECT_CACHE_TTL = 3600
+
+# json with settings of one project, expires after ``opts.project_cache_ttl``
+KEY_PROJECT = "copr:backend:project_cache:project::{owner}/{project}"
+# exists while settings of all projects loaded by one request are fresh
+KEY_LOADED = "copr:backend:project_cache:loaded::"
+
+
+class ProjectCache(object):
+    """
+    Settings of projects shared by all backend processes in redis,
+    so that createrepo and the results pruner don't ask frontend
+    for every project.
+
+    Settings of all projects are loaded by a single request to frontend,
+    project missing there (e.g. created after the load) is fetched alone.
+    Job grabber drops changed projects from the cache, frontend pushes their
+    names and actions like rename or delete touch them too.
+
+    Cached project settings:
+
+        - auto_createrepo: bool
+
+    :param Munch opts: backend config
+    """
+
+    def __init__(self, opts, rc=None, frontend_client=None):
+        self.opts = opts
+        self.rc = rc or get_redis_connection(opts)
+        self.frontend_client = frontend_client or FrontendClient(opts)
+        self.ttl = opts.get("project_cache_ttl") or DEFAULT_PROJECT_CACHE_TTL
+
+    def store(self, projects, pipe=None):
+        """
+        :param list projects: dicts with `owner`, `project` and the settings
+        """
+        pipe = pipe or self.rc.pipeline()
+        for project in projects:
+            key = KEY_PROJECT.format(owner=project["owner"], project=project["project"])
+            pipe.setex(key, self.ttl, json.dumps({
+                "auto_createrepo": project["auto_createrepo"],
+            }))
+        pipe.execute()
+
+    def load_all(self):
+        """
+        Loads settings of all projects from frontend, only one process does
+        that when several processes miss the cache at the same time
+
+        :return bool: True when the settings were loaded
+        """
+        if not self.rc.set(KEY_LOADED, time.time(), ex=self.ttl, nx=True):
+            return False
+        try:
+            statuses = self.frontend_client.get_auto_createrepo_statuses()
+        except (RequestException, ValueError, KeyError):
+            self.rc.delete(KEY_LOADED)
+            raise
+        self.store([{"owner": owner, "project": project, "auto_createrepo": auto_createrepo}
+                    for (owner, project), auto_createrepo in statuses.items()])
+        return True
+
+    def fetch(self, owner, project):
+        """
+        Fetches settings of one project from the API
+
+        :raises CoprRequestException: e.g. when the project doesn't exist
+        """
+        client = CoprClient(copr_url=self.opts.frontend_base_url)
+        detail = client.get_project_details(project, owner).data["detail"]
+        return {
+            "owner": owner,
+            "project": project,
+            "auto_createrepo": bool(detail.get("auto_createrepo", True)),
+        }
+
+    def get(self, owner, project):
+        """
+        :return Munch: cached settings of the project
+        :raises CoprRequestException: when the project is not found
+        """
+        key = KEY_PROJECT.format(owner=owner, project=project)
+        raw = self.rc.get(key)
+        if raw is None and not self.rc.exists(KEY_LOADED):
+            try:
+                if self.load_all():
+                    raw = self.rc.get(key)
+            except (RequestException, ValueError, KeyError):
+                pass
+
+        if raw is None:
+            settings = self.fetch(owner, project)
+            self.store([settings])
+            return Munch(auto_createrepo=settings["auto_createrepo"])
+        return Munch(json.loads(raw))
+
+    def get_auto_createrepo(self, owner, project):
+        """
+        :return bool: auto_createrepo flag of the project
+        """
+        return self.get(owner, project).auto_createrepo
+
+    def invalidate(self, owner, project):
+        self.rc.delete(KEY_PROJECT.format(owner=owner, project=project))
@@ -0,0 +1,160 @@
+# coding: utf-8
+
+"""
+Detection of obsolete builds in the chroot directories from the repository metadata
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import defaultdict
+from functools import cmp_to_key
+import os
+import re
+import time
+
+from munch import Munch
+
+from .createrepo import get_repo_packages
+
+# builds are removed only when they are older than this number of days
+DEFAULT_PRUNE_DAYS = 14
+# number of the newest versions of each package kept in the repository
+DEFAULT_KEEP_BUILDS = 1
+
+_SEGMENT_RE = re.compile(r"~|[0-9]+|[a-zA-Z]+")
+
+
+def rpmvercmp(a, b):
+    """
+    Compares version or release strings the same way as rpm does
+
+    :return int: 1 when `a` is newer, -1 when `b` is newer, 0 when equal
+    """
+    if a == b:
+        return 0
+
+    segments_a = _SEGMENT_RE.findall(a or "")
+    segments_b = _SEGMENT_RE.findall(b or "")
+    for idx in range(max(len(segments_a), len(segments_b)) + 1):
+        x = segments_a[idx] if idx < len(segments_a) else None
+        y = segments_b[idx] if idx < len(segments_b) else None
+
+        # tilde sorts before everything, even the end of the string
+        if x == "~" or y == "~":
+            if x != "~":
+                return 1
+            if y != "~":
+                return -1
+            continue
+
+        if x is None or y is None:
+            if x is None and y is None:
+                return 0
+            # the one with more segments is newer
+            return -1 if x is None else 1
+
+        if x.isdigit() != y.isdigit():
+            # numeric segment is newer than alphabetic
+            return 1 if x.isdigit() else -1
+        if x.isdigit():
+            x, y = int(x), int(y)
+        if x != y:
+            return 1 if x > y else -1
+    return 0
+
+
+def compare_evr(pkg_a, pkg_b):
+    """
+    Compares epoch, version and release of the packages
+
+    :return int: 1 when `pkg_a` is newer, -1 when `pkg_b` is newer, 0 when equal
+    """
+    epoch_a = int(pkg_a.epoch or 0)
+    epoch_b = int(pkg_b.epoch or 0)
+    if epoch_a != epoch_b:
+        return 1 if epoch_a > epoch_b else -1
+    return rpmvercmp(pkg_a.version, pkg_b.version) or rpmvercmp(pkg_a.release, pkg_b.release)
+
+
+def get_kept_locations(packages, keep):
+    """
+    :param list packages: see :py:func:`backend.createrepo.read_primary_xml`
+    :param int keep: number of the newest versions kept for each name and arch
+    :return set: locations of the kept packages
+    """
+    groups = defaultdict(list)
+    for pkg in packages:
+        groups[(pkg.name, pkg.arch)].append(pkg)
+
+    kept = set()
+    for group in groups.values():
+        group.sort(key=cmp_to_key(compare_evr), reverse=True)
+        versions = 0
+        previous = None
+        for pkg in group:
+            if previous is None or compare_evr(pkg, previous) != 0:
+                versions += 1
+                if versions > keep:
+                    break
+            kept.add(pkg.location)
+            previous = pkg
+    return kept
+
+
+def find_obsolete_builds(chroot_path, days=DEFAULT_PRUNE_DAYS, keep=DEFAULT_KEEP_BUILDS, now=None):
+    """
+    Finds successful builds which are older than `days` and don't provide any of
+    the `keep` newest versions of some package in the repository of the chroot.
+
+    Builds with packages unknown to the repository metadata are never returned,
+    the metadata might not be regenerated yet.
+
+    :param str chroot_path: chroot directory with build directories and `repodata`
+    :return list: names of the obsolete build directories, None when
+        the repository metadata can't be read
+    """
+    packages = get_repo_packages(chroot_path)
+    if packages is None:
+        return None
+
+    kept = get_kept_locations(packages, keep)
+    locations = set(pkg.location for pkg in packages)
+    kept_dirs = set(location.split("/")[0] for location in kept if "/" in location)
+
+    max_mtime = (now or time.time()) - days * 24 * 3600
+    obsolete = []
+    for name in sorted(os.listdir(chroot_path)):
+        build_path = os.path.join(chroot_path, name)
+        success_path = os.path.join(build_path, "success")
+        if name in kept_dirs or not os.path.exists(success_path):
+            continue
+        if os.path.getmtime(success_path) > max_mtime:
+            continue
+
+        rpms = ["{}/{}".format(name, filename) for filename in os.listdir(build_path)
+                if filename.endswith(".rpm")]
+        if all(rpm in locations for rpm in rpms):
+            obsolete.append(name)
+    return obsolete
+
+
+def get_prune_policy(opts, owner, project):
+    """
+    :return Munch: `days` and `keep` for the project; the project setting from
+        ``opts.prune_policy_days`` and ``opts.prune_policy_keep`` takes
+        precedence over the owner one and then over the global option
+    """
+    def lookup(overrides, default):
+        overrides = overrides or {}
+        for name in ["{}/{}".format(owner, project), owner]:
+            if name in overrides:
+                return overrides[name]
+        return default
+
+    return Munch(
+        days=lookup(opts.get("prune_policy_days"), opts.get("prune_days") or DEFAULT_PRUNE_DAYS),
+        keep=lookup(opts.get("prune_policy_keep"), opts.get("prune_keep_builds") or DEFAULT_KEEP_BUILDS),
+    )
@@ -0,0 +1,266 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import deque
+
+from .exceptions import CoprBackendError
+
+# the smallest accepted weight, zero weight would starve the flow forever
+MIN_WEIGHT = 0.01
+
+
+class _Flow(object):
+    """
+    One flow of :py:class:`DeficitRoundRobin`
+
+    :param weight: number of items served in one round
+    :param queue: :py:class:`collections.deque` with items
+        or nested :py:class:`DeficitRoundRobin`
+    """
+    __slots__ = ["weight", "deficit", "visited", "queue"]
+
+    def __init__(self, weight, queue):
+        self.weight = weight
+        self.deficit = 0
+        self.visited = False
+        self.queue = queue
+
+
+class DeficitRoundRobin(object):
+    """
+    Deficit round robin over flows identified by keys. In each round
+    flow could serve ``weight`` items, unused credit is carried over to the
+    next round while the flow has items. Items of one flow are served
+    in FIFO order or by another nested :py:class:`DeficitRoundRobin`.
+    """
+    def __init__(self):
+        self.flows = {}
+        self.active = deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, path, item):
+        """
+        :param list path: [(flow key, weight), ...], one pair per nesting level
+        :param item: anything
+        """
+        (key, weight), rest = path[0], path[1:]
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = _Flow(weight, DeficitRoundRobin() if rest else deque())
+            self.flows[key] = flow
+            self.active.append(key)
+        flow.weight = max(weight, MIN_WEIGHT)
+
+        if rest:
+            flow.queue.push(rest, item)
+        else:
+            flow.queue.append(item)
+        self.size += 1
+
+    def pop(self, is_blocked=None):
+        """
+        Take the next item
+
+        :param is_blocked: callable, takes flow key and returns True when
+            the flow can't be served now. Blocked flows are skipped and
+            they don't get any credit.
+        :return: item or None when all flows are empty or blocked
+        """
+        blocked = 0
+        while blocked < len(self.active):
+            key = self.active[0]
+            flow = self.flows[key]
+            if is_blocked is not None and is_blocked(key):
+                flow.visited = False
+                self.active.rotate(-1)
+                blocked += 1
+                continue
+
+            blocked = 0
+            if not flow.visited:
+                flow.visited = True
+                flow.deficit += flow.weight
+
+            if flow.deficit >= 1:
+                flow.deficit -= 1
+                if isinstance(flow.queue, deque):
+                    item = flow.queue.popleft()
+                else:
+                    item = flow.queue.pop()
+                self.size -= 1
+                if not flow.queue:
+                    del self.flows[key]
+                    self.active.popleft()
+                return item
+
+            flow.visited = False
+            self.active.rotate(-1)
+
+        return None
+
+    def copy(self):
+        """
+        :return: independent copy of the scheduling state, items are shared
+        """
+        result = DeficitRoundRobin()
+        result.active = deque(self.active)
+        result.size = self.size
+        for key, flow in self.flows.items():
+            if isinstance(flow.queue, deque):
+                queue = deque(flow.queue)
+            else:
+                queue = flow.queue.copy()
+            result.flows[key] = _Flow(flow.weight, queue)
+            result.flows[key].deficit = flow.deficit
+            result.flows[key].visited = flow.visited
+        return result
+
+
+class Scheduler(object):
+    """
+    Backlog of build tasks of one builders group, decides the order
+    in which tasks are given to the :py:class:`~backend.task_queue.TaskQueue`.
+    Task is kept only once, identified by ``task_id``.
+
+    Subclasses implement :py:meth:`_push`, :py:meth:`_pop` and :py:meth:`_copy`.
+    """
+    def __init__(self):
+        self.task_ids = set()
+
+    def __len__(self):
+        return len(self.task_ids)
+
+    def __contains__(self, task_id):
+        return task_id in self.task_ids
+
+    def add(self, task):
+        """
+        :param dict task: build task
+        :return bool: False when the task is already in the backlog
+        """
+        if task["task_id"] in self.task_ids:
+            return False
+        self.task_ids.add(task["task_id"])
+        self._push(task)
+        return True
+
+    def pop(self, is_owner_blocked=None):
+        """
+        Take the next task to run
+
+        :param is_owner_blocked: callable, takes project owner and returns True
+            when his tasks can't run now, e.g. he has reached ``max_vm_per_user``
+        :return: build task or None
+        """
+        task = self._pop(is_owner_blocked)
+        if task is not None:
+            self.task_ids.discard(task["task_id"])
+        return task
+
+    def get_order(self):
+        """
+        :return list: ids of the tasks in the order in which they would be
+            popped if no owner was blocked
+        """
+        state = self._copy()
+        order = []
+        while True:
+            task = state._pop(None)
+            if task is None:
+                return order
+            order.append(task["task_id"])
+
+    def _push(self, task):
+        raise NotImplementedError()
+
+    def _pop(self, is_owner_blocked):
+        raise NotImplementedError()
+
+    def _copy(self):
+        raise NotImplementedError()
+
+
+class FifoScheduler(Scheduler):
+    """
+    Tasks are run in the order they were added
+    """
+    def __init__(self):
+        super(FifoScheduler, self).__init__()
+        self.tasks = deque()
+
+    def _push(self, task):
+        self.tasks.append(task)
+
+    def _pop(self, is_owner_blocked):
+        for idx, task in enumerate(self.tasks):
+            if is_owner_blocked is None or not is_owner_blocked(task["project_owner"]):
+                del self.tasks[idx]
+                return task
+        return None
+
+    def _copy(self):
+        result = FifoScheduler()
+        result.tasks = deque(self.tasks)
+        return result
+
+
+class FairShareScheduler(Scheduler):
+    """
+    Tasks are split into priority classes, higher priority is always served first.
+    Within one priority, deficit round robin is applied across project owners
+    and then across projects of the owner, so the owner with thousands of tasks
+    doesn't delay the others. Tasks of one project are run in FIFO order.
+
+    :param dict weights: "owner" or "owner/project" -> relative share, default 1
+    :param dict priorities: "owner" or "owner/project" -> priority, default 0;
+        project setting has a precedence
+    """
+    def __init__(self, weights=None, priorities=None):
+        super(FairShareScheduler, self).__init__()
+        self.weights = weights or {}
+        self.priorities = priorities or {}
+        # priority -> DeficitRoundRobin
+        self.classes = {}
+
+    def _push(self, task):
+        owner = task["project_owner"]
+        project = "{}/{}".format(owner, task.get("project_name"))
+        priority = self.priorities.get(project, self.priorities.get(owner, 0))
+        path = [(owner, self.weights.get(owner, 1)),
+                (project, self.weights.get(project, 1))]
+        self.classes.setdefault(priority, DeficitRoundRobin()).push(path, task)
+
+    def _pop(self, is_owner_blocked):
+        for priority in sorted(self.classes, reverse=True):
+            task = self.classes[priority].pop(is_owner_blocked)
+            if task is not None:
+                if not self.classes[priority]:
+                    del self.classes[priority]
+                return task
+        return None
+
+    def _copy(self):
+        result = FairShareScheduler(self.weights, self.priorities)
+        result.classes = dict((priority, drr.copy())
+                              for priority, drr in self.classes.items())
+        return result
+
+
+def get_scheduler(opts):
+    """
+    :param Munch opts: backend config, uses ``scheduler``,
+        ``scheduler_weights`` and ``scheduler_priorities``
+    :rtype: Scheduler
+    """
+    if opts.scheduler == "fifo":
+        return FifoScheduler()
+    elif opts.scheduler == "fair":
+        return FairShareScheduler(opts.scheduler_weights, opts.scheduler_priorities)
+    raise CoprBackendError("Unknown scheduler: {}".format(opts.scheduler))
@@ -5,8 +5,11 @@
 Wrapper for /bin/sign from obs-sign package
 """
 
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
 import json
+import threading
+import time
 
 import os
 from requests import request
@@ -16,8 +19,18 @@ from .exceptions import CoprSignError, CoprSignNoKeyError, \
 
 
 SIGN_BINARY = "/bin/sign"
+SIGN_COMMAND = ["sudo", SIGN_BINARY]
 DOMAIN = "fedorahosted.org"
 
+# default number of packages signed in parallel
+DEFAULT_SIGN_WORKERS = 4
+# default time in seconds for which the retrieved public key is reused
+DEFAULT_PUBKEY_TTL = 3600
+
+# (username, projectname) -> (expires_on, pubkey)
+_pubkey_cache = {}
+_pubkey_cache_lock = threading.Lock()
+
 
 def create_gpg_email(username, projectname):
     """
@@ -38,7 +51,7 @@ def get_pubkey(username, projectname, outfile=None):
     :raises CoprSignNoKeyError: if there are no such user in keyring
     """
     usermail = create_gpg_email(username, projectname)
-    cmd = ["sudo", SIGN_BINARY, "-u", usermail, "-p"]
+    cmd = SIGN_COMMAND + ["-u", usermail, "-p"]
 
     try:
         handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
@@ -66,8 +79,36 @@ def get_pubkey(username, projectname, outfile=None):
     return stdout
 
 
+def get_cached_pubkey(username, projectname, ttl=DEFAULT_PUBKEY_TTL, outfile=None):
+    """
+    Same as :py:func:`get_pubkey`, but the key is retrieved from the signer
+    host only once per ``ttl`` seconds for each project
+
+    :param int ttl: how long to reuse the retrieved key
+    """
+    now = time.time()
+    with _pubkey_cache_lock:
+        expires_on, pubkey = _pubkey_cache.get((username, projectname), (0, None))
+
+    if expires_on <= now:
+        pubkey = get_pubkey(username, projectname)
+        with _pubkey_cache_lock:
+            _pubkey_cache[(username, projectname)] = (now + ttl, pubkey)
+
+    if outfile:
+        with open(outfile, "w") as handle:
+            handle.write(pubkey)
+
+    return pubkey
+
+
+def clear_pubkey_cache():
+    with _pubkey_cache_lock:
+        _pubkey_cache.clear()
+
+
 def _sign_one(path, email):
-    cmd = ["sudo", SIGN_BINARY, "-u", email, "-r", path]
+    cmd = SIGN_COMMAND + ["-u", email, "-r", path]
 
     try:
         handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
@@ -94,6 +135,9 @@ def sign_rpms_in_dir(username, projectname, path, opts, log):
     """
     Signs rpms using obs-signd.
 
+    Packages are signed in parallel by ``opts.sign_workers`` threads,
+    each of them invokes /bin/sign for one package.
+
     If some some pkgs failed to sign, entire build marked as failed,
     but we continue to try sign other pkgs.
 
@@ -116,23 +160,35 @@ def sign_rpms_in_dir(username, projectname, path, opts, log):
         return
 
     try:
-        get_pubkey(username, projectname)
+        get_cached_pubkey(username, projectname,
+                          ttl=opts.get("sign_pubkey_ttl", DEFAULT_PUBKEY_TTL))
     except CoprSignNoKeyError:
         create_user_keys(username, projectname, opts)
 
-    errors = []  # tuples (rpm_filepath, exception)
-    for rpm in rpm_list:
+    email = create_gpg_email(username, projectname)
+
+    def sign(rpm):
         try:
-            _sign_one(rpm, create_gpg_email(username, projectname))
+            _sign_one(rpm, email)
             log.info("signed rpm: {}".format(rpm))
-
+            return rpm, None
         except CoprSignError as e:
             log.exception("failed to sign rpm: {}".format(rpm))
-            errors.append((rpm, e))
+            return rpm, e
+
+    workers = min(opts.get("sign_workers", DEFAULT_SIGN_WORKERS), len(rpm_list))
+    pool = ThreadPool(max(workers, 1))
+    try:
+        results = pool.map(sign, rpm_list)
+    finally:
+        pool.close()
+        pool.join()
 
+    errors = [(rpm, e) for rpm, e in results if e is not None]
     if errors:
-        raise CoprSignError("Rpm sign failed, affected rpms: {}"
-                            .format([err[0] for err in errors]))
+        raise CoprSignError("Rpm sign failed, affected rpms: {}\n{}".format(
+            [err[0] for err in errors],
+            "\n".join("{}: {}".format(rpm, e) for rpm, e in errors)))
 
 
 def create_user_keys(username, projectname, opts):
@@ -0,0 +1,379 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import json
+import time
+import uuid
+
+from munch import Munch
+
+from .helpers import get_redis_connection
+
+# default time in seconds for which a worker owns the acquired task,
+# worker should renew lease before it expires
+DEFAULT_LEASE_TIMEOUT = 600
+
+# list of task ids waiting for worker
+KEY_PENDING = "copr:backend:task_queue:{name}:pending:list::"
+# hash task_id -> json task data, contains both pending and processed tasks
+KEY_TASKS = "copr:backend:task_queue:{name}:tasks:hash::"
+# sorted set of processed task ids, score is the lease expiration time
+KEY_PROCESSING = "copr:backend:task_queue:{name}:processing:zset::"
+# hash task_id -> lease token of the worker which processes the task
+KEY_LEASES = "copr:backend:task_queue:{name}:leases:hash::"
+# hash project_owner -> number of tasks in the queue (pending + processed)
+KEY_OWNERS = "copr:backend:task_queue:{name}:owners:hash::"
+# set of project owners whose number of tasks was decreased since the last check
+KEY_RELEASED = "copr:backend:task_queue:{name}:released:set::"
+# list of wakeup tokens for idle workers, never longer than the pending list
+KEY_WAKEUP = "copr:backend:task_queue:{name}:wakeup:list::"
+# hash with counters "enqueued" and "finished" of all tasks ever passed the queue
+KEY_STATS = "copr:backend:task_queue:{name}:stats:hash::"
+
+
+# KEYS[1]: pending, KEYS[2]: tasks, KEYS[3]: owners, KEYS[4]: wakeup, KEYS[5]: stats
+# ARGV[1]: task_id
+# ARGV[2]: task json
+# ARGV[3]: project_owner
+enqueue_lua = """
+if redis.call("HSETNX", KEYS[2], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+local pending = redis.call("RPUSH", KEYS[1], ARGV[1])
+redis.call("HINCRBY", KEYS[3], ARGV[3], 1)
+redis.call("HINCRBY", KEYS[5], "enqueued", 1)
+if redis.call("LLEN", KEYS[4]) < pending then
+    redis.call("RPUSH", KEYS[4], 1)
+end
+return 1
+"""
+
+# KEYS[1]: pending, KEYS[2]: tasks, KEYS[3]: processing, KEYS[4]: leases, KEYS[5]: wakeup
+# ARGV[1]: current timestamp
+# ARGV[2]: lease expiration timestamp
+# ARGV[3]: lease token
+acquire_lua = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[3], "-inf", ARGV[1])
+for i = #expired, 1, -1 do
+    redis.call("ZREM", KEYS[3], expired[i])
+    redis.call("HDEL", KEYS[4], expired[i])
+    redis.call("LPUSH", KEYS[1], expired[i])
+end
+
+while true do
+    local task_id = redis.call("LPOP", KEYS[1])
+    if not task_id then
+        redis.call("DEL", KEYS[5])
+        return nil
+    end
+    -- drop tokens of tasks taken by workers that didn't wait for them
+    local pending = redis.call("LLEN", KEYS[1])
+    if pending == 0 then
+        redis.call("DEL", KEYS[5])
+    else
+        redis.call("LTRIM", KEYS[5], 0, pending - 1)
+    end
+    local data = redis.call("HGET", KEYS[2], task_id)
+    if data then
+        redis.call("ZADD", KEYS[3], ARGV[2], task_id)
+        redis.call("HSET", KEYS[4], task_id, ARGV[3])
+        return {task_id, data}
+    end
+end
+"""
+
+# KEYS[1]: processing, KEYS[2]: leases
+# ARGV[1]: task_id
+# ARGV[2]: lease token
+# ARGV[3]: new lease expiration timestamp
+renew_lua = """
+if redis.call("HGET", KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call("ZADD", KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+# KEYS[1]: tasks, KEYS[2]: processing, KEYS[3]: leases, KEYS[4]: owners, KEYS[5]: released,
+# KEYS[6]: stats
+# ARGV[1]: task_id
+# ARGV[2]: lease token
+ack_lua = """
+if redis.call("HGET", KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call("ZREM", KEYS[2], ARGV[1])
+redis.call("HDEL", KEYS[3], ARGV[1])
+redis.call("HINCRBY", KEYS[6], "finished", 1)
+
+local data = redis.call("HGET", KEYS[1], ARGV[1])
+redis.call("HDEL", KEYS[1], ARGV[1])
+if data then
+    local owner = cjson.decode(data)["project_owner"]
+    if owner then
+        if redis.call("HINCRBY", KEYS[4], owner, -1) <= 0 then
+            redis.call("HDEL", KEYS[4], owner)
+        end
+        redis.call("SADD", KEYS[5], owner)
+    end
+end
+return 1
+"""
+
+# KEYS[1]: pending, KEYS[2]: processing, KEYS[3]: leases, KEYS[4]: wakeup
+# ARGV[1]: task_id
+# ARGV[2]: lease token
+requeue_lua = """
+if redis.call("HGET", KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call("ZREM", KEYS[2], ARGV[1])
+redis.call("HDEL", KEYS[3], ARGV[1])
+local pending = redis.call("LPUSH", KEYS[1], ARGV[1])
+if redis.call("LLEN", KEYS[4]) < pending then
+    redis.call("RPUSH", KEYS[4], 1)
+end
+return 1
+"""
+
+
+class TaskQueue(object):
+    """
+    Redis based queue of build tasks for one builders group.
+
+    Task is a dict with mandatory keys ``task_id`` and ``project_owner``.
+    Task stays in the queue since :py:meth:`enqueue` until worker
+    calls :py:meth:`ack`, so the same task is never scheduled twice.
+    Worker obtains task with :py:meth:`acquire` together with the lease token.
+    When lease is not renewed in time, e.g. worker died, the task
+    is returned to the head of the queue and a new lease is granted to another worker.
+    Every transition is done by one Lua script, so it's atomic.
+    Idle workers block in :py:meth:`acquire` until a task is enqueued or requeued,
+    every such task pushes a wakeup token which releases one waiting worker.
+
+    :param rc: redis connection
+    :param str name: queue name, unique for the builders group
+    :param int lease_timeout: lease duration in seconds
+    """
+    def __init__(self, rc, name, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+        self.rc = rc
+        self.name = name
+        self.lease_timeout = lease_timeout
+
+        self.key_pending = KEY_PENDING.format(name=name)
+        self.key_tasks = KEY_TASKS.format(name=name)
+        self.key_processing = KEY_PROCESSING.format(name=name)
+        self.key_leases = KEY_LEASES.format(name=name)
+        self.key_owners = KEY_OWNERS.format(name=name)
+        self.key_released = KEY_RELEASED.format(name=name)
+        self.key_wakeup = KEY_WAKEUP.format(name=name)
+        self.key_stats = KEY_STATS.format(name=name)
+
+        self.lua_scripts = {
+            "enqueue": self.rc.register_script(enqueue_lua),
+            "acquire": self.rc.register_script(acquire_lua),
+            "renew": self.rc.register_script(renew_lua),
+            "ack": self.rc.register_script(ack_lua),
+            "requeue": self.rc.register_script(requeue_lua),
+        }
+
+    def enqueue(self, task):
+        """
+        Add task to the end of the queue
+
+        :param dict task: build task
+        :return bool: False when the task with the same ``task_id`` is already in the queue
+        """
+        result = self.lua_scripts["enqueue"](
+            keys=[self.key_pending, self.key_tasks, self.key_owners, self.key_wakeup,
+                  self.key_stats],
+            args=[task["task_id"], json.dumps(task), task["project_owner"]])
+        return result == 1
+
+    def enqueue_many(self, tasks):
+        """
+        Add tasks to the end of the queue in one round trip
+
+        :param list tasks: build tasks
+        :return list: bool for each task, see :py:meth:`enqueue`
+        """
+        pipe = self.rc.pipeline(transaction=False)
+        for task in tasks:
+            self.lua_scripts["enqueue"](
+                keys=[self.key_pending, self.key_tasks, self.key_owners, self.key_wakeup,
+                      self.key_stats],
+                args=[task["task_id"], json.dumps(task), task["project_owner"]],
+                client=pipe)
+        return [result == 1 for result in pipe.execute()]
+
+    def acquire(self, timeout=None):
+        """
+        Take the first pending task and lease it to the caller
+
+        :param timeout: when there is no pending task, wait at most ``timeout``
+            seconds for a new one, don't wait when None. Tasks with expired lease
+            don't wake up waiting workers, they are recovered after the timeout.
+        :return: Munch with fields ``task_id``, ``data`` (task dict) and ``token``
+            or None when there is nothing to do
+        """
+        lease = self._acquire()
+        if lease is None and timeout:
+            # redis accepts only whole seconds here
+            if self.rc.blpop([self.key_wakeup], timeout=max(1, int(timeout))):
+                lease = self._acquire()
+        return lease
+
+    def _acquire(self):
+        now = time.time()
+        token = uuid.uuid4().hex
+        result = self.lua_scripts["acquire"](
+            keys=[self.key_pending, self.key_tasks, self.key_processing, self.key_leases,
+                  self.key_wakeup],
+            args=[now, now + self.lease_timeout, token])
+        if result is None:
+            return None
+
+        task_id, raw = result
+        return Munch(task_id=task_id, data=json.loads(raw), token=token)
+
+    def renew(self, task_id, token):
+        """
+        Extend lease of the acquired task
+
+        :return bool: False when the lease was lost
+        """
+        result = self.lua_scripts["renew"](
+            keys=[self.key_processing, self.key_leases],
+            args=[task_id, token, time.time() + self.lease_timeout])
+        return result == 1
+
+    def ack(self, task_id, token):
+        """
+        Remove finished task from the queue
+
+        :return bool: False when the lease was lost
+        """
+        result = self.lua_scripts["ack"](
+            keys=[self.key_tasks, self.key_processing, self.key_leases,
+                  self.key_owners, self.key_released, self.key_stats],
+            args=[task_id, token])
+        return result == 1
+
+    def nack(self, task_id, token, requeue=True):
+        """
+        Give up the acquired task
+
+        :param bool requeue: return task to the head of the queue, otherwise remove it
+        :return bool: False when the lease was lost
+        """
+        if not requeue:
+            return self.ack(task_id, token)
+
+        result = self.lua_scripts["requeue"](
+            keys=[self.key_pending, self.key_processing, self.key_leases, self.key_wakeup],
+            args=[task_id, token])
+        return result == 1
+
+    def count_by_owner(self, owner):
+        """
+        :return int: number of tasks of the given owner in the queue, both pending and processed
+        """
+        return int(self.rc.hget(self.key_owners, owner) or 0)
+
+    def get_counts(self, owners=None):
+        """
+        Get number of tasks in the queue in one round trip
+
+        :param owners: project owners of interest, all owners when None
+        :return: (dict project_owner -> number of tasks, total number of tasks)
+        """
+        pipe = self.rc.pipeline(transaction=False)
+        pipe.llen(self.key_pending)
+        pipe.zcard(self.key_processing)
+        if owners is None:
+            pipe.hgetall(self.key_owners)
+        else:
+            owners = list(owners)
+            if owners:
+                pipe.hmget(self.key_owners, owners)
+        result = pipe.execute()
+
+        total = result[0] + result[1]
+        if owners is None:
+            counts = result[2].items()
+        elif owners:
+            counts = zip(owners, result[2])
+        else:
+            counts = []
+        return dict((owner, int(count)) for owner, count in counts
+                    if count is not None), total
+
+    def get_stats(self):
+        """
+        :return: Munch with the current number of ``pending`` and ``processing`` tasks
+            and total number of ``enqueued`` and ``finished`` tasks
+        """
+        pipe = self.rc.pipeline(transaction=False)
+        pipe.llen(self.key_pending)
+        pipe.zcard(self.key_processing)
+        pipe.hmget(self.key_stats, ["enqueued", "finished"])
+        pending, processing, (enqueued, finished) = pipe.execute()
+        return Munch(pending=pending, processing=processing,
+                     enqueued=int(enqueued or 0), finished=int(finished or 0))
+
+    def pop_released_owners(self):
+        """
+        :return set: project owners whose number of tasks was decreased
+            since the last call
+        """
+        pipe = self.rc.pipeline(transaction=True)
+        pipe.smembers(self.key_released)
+        pipe.delete(self.key_released)
+        return pipe.execute()[0]
+
+    def contains_many(self, task_ids):
+        """
+        :param list task_ids: ids of tasks
+        :return list: bool for each task id, True when the task is in the queue
+        """
+        pipe = self.rc.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hexists(self.key_tasks, task_id)
+        return pipe.execute()
+
+    @property
+    def length(self):
+        """
+        :return int: number of pending tasks
+        """
+        return self.rc.llen(self.key_pending)
+
+    @property
+    def processing_count(self):
+        """
+        :return int: number of tasks leased by workers
+        """
+        return self.rc.zcard(self.key_processing)
+
+    def clean(self):
+        """
+        Drop all tasks
+        """
+        self.rc.delete(self.key_pending, self.key_tasks, self.key_processing,
+                       self.key_leases, self.key_owners, self.key_released,
+                       self.key_wakeup, self.key_stats)
+
+
+def get_group_task_queue(opts, group_id, rc=None):
+    """
+    :param Munch opts: backend config
+    :param int group_id: builders group id
+    :param rc: redis connection, new one is created when omitted
+    :rtype: TaskQueue
+    """
+    return TaskQueue(rc or get_redis_connection(opts), "copr-be-{}".format(group_id),
+                     lease_timeout=opts.task_lease_timeout)
@@ -0,0 +1,96 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import itertools
+import json
+import os
+import time
+
+
+class UpdateSpool(object):
+    """
+    Durable on-disk queue of updates for the frontend ``/backend/update/`` handler.
+
+    Each update is one json file, it's written to the temporary name,
+    synced to disk and renamed, so the reader never sees a partial update.
+    File names start with the spool time, so updates are read in the order
+    they were put. Updates are removed only after they were delivered,
+    updates refused by the frontend are moved to the ``rejected`` subdirectory.
+
+    :param str path: spool directory, created when missing
+    """
+    suffix = ".json"
+    rejected_dir = "rejected"
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self._counter = itertools.count()
+
+    def put(self, data):
+        """
+        :param dict data: update with the keys "builds" and/or "actions",
+            values are lists of build or action dicts; or the key "reschedule"
+            with build chroot to be rescheduled
+        """
+        name = "{:.6f}-{}-{:06d}".format(time.time(), os.getpid(), next(self._counter))
+        tmp_path = os.path.join(self.path, ".{}.tmp".format(name))
+        with open(tmp_path, "w") as handle:
+            json.dump(data, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(tmp_path, os.path.join(self.path, name + self.suffix))
+
+    def names(self):
+        """
+        :return list: names of spooled updates, the oldest first
+        """
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith(self.suffix))
+
+    def take(self, limit):
+        """
+        Read the oldest updates, they stay in the spool until :py:meth:`remove`
+
+        :param int limit: max number of updates
+        :return list: (name, data) pairs, data is None for the unreadable update
+        """
+        result = []
+        for name in self.names()[:limit]:
+            try:
+                with open(os.path.join(self.path, name)) as handle:
+                    result.append((name, json.load(handle)))
+            except ValueError:
+                result.append((name, None))
+        return result
+
+    def remove(self, names):
+        """
+        Remove delivered updates
+        """
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def reject(self, names):
+        """
+        Move updates refused by the frontend out of the spool, they are kept for inspection
+        """
+        rejected_path = os.path.join(self.path, self.rejected_dir)
+        if not os.path.exists(rejected_path):
+            os.makedirs(rejected_path)
+        for name in names:
+            try:
+                os.rename(os.path.join(self.path, name), os.path.join(rejected_path, name))
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self.names())
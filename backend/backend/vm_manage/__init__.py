@@ -19,6 +19,9 @@ class EventTopics(object):
     VM_TERMINATION_REQUEST = "vm_termination_request"
     VM_TERMINATED = "vm_terminated"
 
+# argument - group, message is the vm_name of VM which became ready
+PUBSUB_VM_READY = "copr:backend:vm_ready:pubsub::{group}"
+
 # argument - vm_ip
 PUBSUB_INTERRUPT_BUILDER = "copr:backend:interrupt_build:pubsub::{}"
 
@@ -37,3 +40,22 @@ KEY_SERVER_INFO = "copr:backend:server_info:hset::"
 
 KEY_VM_INSTANCE = "copr:backend:vm_instance:hset::{vm_name}"
 # hset to store VmDescriptor
+
+# Index sets of vm_names, maintained by Lua scripts together with VMD state changes,
+# see :py:data:`backend.vm_manage.models.vm_index_lua`
+
+KEY_VM_BY_STATE = "copr:backend:vm_by_state:set::{group}:{state}"
+# VMs of `group` in the given `state`
+
+KEY_VM_READY_CLEAN = "copr:backend:vm_ready_clean:set::{group}"
+# ready VMs of `group` which were never used
+
+KEY_VM_READY_DIRTY = "copr:backend:vm_ready_dirty:set::{group}:{user}"
+# ready VMs of `group` previously used by the `user`, reused only for the same user
+
+KEY_VM_IN_USE_BY_USER = "copr:backend:vm_in_use_by_user:set::{group}:{user}"
+# VMs of `group` currently used by the `user`
+
+KEY_VM_LEASES = "copr:backend:vm_leases:zset::"
+# vm_names of VMs in use, score is the time when the lease expires;
+# builder renews the lease while it uses the VM
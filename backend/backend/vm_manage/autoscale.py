@@ -0,0 +1,139 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import math
+
+from munch import Munch
+
+# default time in seconds after which the old rate observations have half weight
+DEFAULT_RATE_HALF_LIFE = 300
+
+
+class RateMeter(object):
+    """
+    Exponentially weighted moving average of the growth rate of a counter
+
+    :param float half_life: age in seconds at which the observation has half weight
+    """
+    def __init__(self, half_life=DEFAULT_RATE_HALF_LIFE):
+        self.half_life = half_life
+        self.rate = 0.0
+        self.last_time = None
+        self.last_total = None
+
+    def update(self, now, total):
+        """
+        :param float now: current timestamp
+        :param int total: current value of the counter, when it's lower than
+            the previous one the counter was reset and only the reference is updated
+        :return float: rate per second
+        """
+        if self.last_time is not None and now <= self.last_time:
+            return self.rate
+
+        if self.last_time is not None and total >= self.last_total:
+            elapsed = now - self.last_time
+            sample = (total - self.last_total) / elapsed
+            alpha = 1 - 0.5 ** (elapsed / self.half_life)
+            self.rate += alpha * (sample - self.rate)
+
+        self.last_time = now
+        self.last_total = total
+        return self.rate
+
+
+class AutoscalePolicy(object):
+    """
+    Decides how many VMs of one build group should be spawned or terminated.
+
+    The target number of ready VMs covers tasks waiting in the queue and in
+    job grabber (the queue holds only a limited number of tasks), tasks
+    already acquired by a worker which still wait for a VM, tasks
+    expected to arrive during ``spawn_time`` which won't get a VM released by
+    the finishing builds, and ``warm_pool`` spare VMs. Missing VMs are spawned
+    in one batch. Surplus ready VMs are terminated only after the surplus
+    lasts ``scale_down_delay`` seconds, so short gaps in submissions don't
+    drain the pool.
+
+    Policy has no side effects and gets the current time as an argument,
+    so it could be replayed against recorded traces.
+
+    :param int max_vm_total: max number of VMs of the group
+    :param int max_spawn_processes: max number of spawns running in parallel
+    :param int warm_pool: number of ready VMs kept without any demand
+    :param float spawn_time: expected time in seconds from spawn start to the ready VM
+    :param float scale_down_delay: how long in seconds the surplus should last
+        before VMs are terminated
+    :param float rate_half_life: see :py:class:`RateMeter`
+    """
+    def __init__(self, max_vm_total, max_spawn_processes, warm_pool=1, spawn_time=300,
+                 scale_down_delay=600, rate_half_life=DEFAULT_RATE_HALF_LIFE):
+        self.max_vm_total = max_vm_total
+        self.max_spawn_processes = max_spawn_processes
+        self.warm_pool = warm_pool
+        self.spawn_time = spawn_time
+        self.scale_down_delay = scale_down_delay
+
+        self.arrivals = RateMeter(rate_half_life)
+        self.completions = RateMeter(rate_half_life)
+        self.surplus_since = None
+
+    @classmethod
+    def from_group(cls, group):
+        """
+        :param dict group: build group config
+        """
+        return cls(group["max_vm_total"], group["max_spawn_processes"],
+                   warm_pool=group["vm_warm_pool"], spawn_time=group["vm_spawn_time"],
+                   scale_down_delay=group["vm_scale_down_delay"])
+
+    def decide(self, now, state):
+        """
+        :param float now: current timestamp
+        :param Munch state: current state of the group with the fields:
+
+            - pending: number of tasks waiting for a worker
+            - backlog: number of tasks waiting in job grabber, not in the queue yet
+            - processing: number of tasks acquired by workers, with or without a VM
+            - enqueued, finished: total number of enqueued and finished tasks,
+              see :py:meth:`TaskQueue.get_stats <backend.task_queue.TaskQueue.get_stats>`
+            - ready, in_use: number of VMs in these states
+            - starting: number of spawned VMs which are not ready yet
+            - spawning: number of running spawn processes
+
+        :return: Munch with ``spawn`` and ``terminate`` numbers of VMs,
+            ``target_ready`` and the estimated ``arrival_rate`` and ``completion_rate``
+        """
+        arrival_rate = self.arrivals.update(now, state.enqueued)
+        completion_rate = self.completions.update(now, state.finished)
+
+        expected = max(arrival_rate - completion_rate, 0) * self.spawn_time
+        # worker acquires the task before it asks for a VM
+        waiting = state.pending + state.backlog + max(state.processing - state.in_use, 0)
+        target_ready = int(math.ceil(waiting + expected)) + self.warm_pool
+        target_ready = max(min(target_ready, self.max_vm_total - state.in_use), 0)
+
+        upcoming = state.ready + state.starting + state.spawning
+        spawn = 0
+        terminate = 0
+        if upcoming < target_ready:
+            self.surplus_since = None
+            total = state.in_use + upcoming
+            spawn = min(target_ready - upcoming,
+                        self.max_vm_total - total,
+                        self.max_spawn_processes - state.spawning)
+            spawn = max(spawn, 0)
+        elif upcoming > target_ready and state.ready > 0:
+            if self.surplus_since is None:
+                self.surplus_since = now
+            if now - self.surplus_since >= self.scale_down_delay:
+                terminate = min(upcoming - target_ready, state.ready)
+        else:
+            self.surplus_since = None
+
+        return Munch(spawn=spawn, terminate=terminate, target_ready=target_ready,
+                     arrival_rate=arrival_rate, completion_rate=completion_rate)
@@ -7,7 +7,8 @@ import time
 
 from backend.exceptions import VmDescriptorNotFound
 from backend.helpers import get_redis_logger
-from backend.vm_manage import VmStates, PUBSUB_MB, EventTopics
+from backend.vm_manage import VmStates, PUBSUB_MB, PUBSUB_VM_READY, EventTopics
+from backend.vm_manage.models import vm_index_lua, vm_index_keys
 
 
 class Recycle(Thread):
@@ -32,28 +33,41 @@ class Recycle(Thread):
     def terminate(self):
         self._running = False
 
-# KEYS[1]: VMD key
-on_health_check_success_lua = """
+# KEYS[1]: VMD key, index keys
+# ARGV[1]: current timestamp
+# ARGV[2]: prefix of the channel for VM ready notifications, group is appended
+# ARGV[3]: vm_name
+# ARGV[4]: index user
+on_health_check_success_lua = vm_index_lua + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "check_health" and old_state ~= "in_use" then
     return nil
 else
     redis.call("HSET", KEYS[1], "check_fails", 0)
     if old_state == "check_health" then
+        local old_index = vm_index_keys(KEYS[1])
         redis.call("HSET", KEYS[1], "state", "{}")
+        vm_reindex(KEYS[1], old_index)
+        local group = redis.call("HGET", KEYS[1], "group")
+        if group then
+            redis.call("PUBLISH", ARGV[2] .. group, ARGV[3])
+        end
     end
 end
 """.format(VmStates.READY)
 
-# KEYS[1]: VMD key
-record_failure_lua = """
+# KEYS[1]: VMD key, index keys
+# ARGV[1]: index user
+record_failure_lua = vm_index_lua + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "check_health" and old_state ~= "in_use" and old_state ~= "check_health_failed" then
     return nil
 else
     redis.call("HINCRBY", KEYS[1], "check_fails", 1)
     if old_state == "check_health" then
+        local old_index = vm_index_keys(KEYS[1])
         redis.call("HSET", KEYS[1], "state", "{}")
+        vm_reindex(KEYS[1], old_index)
     end
 end
 """.format(VmStates.CHECK_HEALTH_FAILED)
@@ -100,11 +114,16 @@ class EventHandler(Process):
             return
 
         if msg["result"] == "OK":
-            self.lua_scripts["on_health_check_success"](keys=[vmd.vm_key], args=[time.time()])
+            self.lua_scripts["on_health_check_success"](
+                keys=[vmd.vm_key] + vm_index_keys(vmd.group, vmd.bound_to_user),
+                args=[time.time(), PUBSUB_VM_READY.format(group=""), vmd.vm_name,
+                      vmd.bound_to_user or ""])
             self.log.debug("recording success for ip:{} name:{}".format(vmd.vm_ip, vmd.vm_name))
         else:
             self.log.debug("recording check fail: {}".format(msg))
-            self.lua_scripts["record_failure"](keys=[vmd.vm_key])
+            self.lua_scripts["record_failure"](
+                keys=[vmd.vm_key] + vm_index_keys(vmd.group, vmd.bound_to_user),
+                args=[vmd.bound_to_user or ""])
             fails_count = int(vmd.get_field(self.vmm.rc, "check_fails") or 0)
             max_check_fails = self.opts.build_groups[vmd.group]["vm_max_check_fails"]
             if fails_count > max_check_fails and vmd.state != VmStates.IN_USE:
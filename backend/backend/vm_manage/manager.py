@@ -5,7 +5,6 @@ from __future__ import unicode_literals
 from __future__ import division
 from __future__ import absolute_import
 
-from itertools import chain
 import json
 import time
 import weakref
@@ -14,58 +13,88 @@ import datetime
 from backend.exceptions import VmError, NoVmAvailable, VmDescriptorNotFound
 
 from backend.helpers import get_redis_connection
-from .models import VmDescriptor
+from .models import VmDescriptor, VmPoolSnapshot, vm_index_lua, vm_index_keys, reindex_vm_lua
 from . import VmStates, KEY_VM_INSTANCE, KEY_VM_POOL, EventTopics, PUBSUB_MB, KEY_SERVER_INFO, \
-    KEY_VM_POOL_INFO
+    KEY_VM_POOL_INFO, PUBSUB_VM_READY, KEY_VM_BY_STATE, KEY_VM_READY_CLEAN, KEY_VM_READY_DIRTY, \
+    KEY_VM_IN_USE_BY_USER, KEY_VM_LEASES, PUBSUB_INTERRUPT_BUILDER
 from ..helpers import get_redis_logger
 
-# KEYS[1]: VMD key
+# KEYS[1]: VMD key, index keys
 # ARGV[1] current timestamp for `last_health_check`
-set_checking_state_lua = """
+# ARGV[2] index user
+set_checking_state_lua = vm_index_lua + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "got_ip" and old_state ~= "ready" and old_state ~= "in_use" and old_state ~= "check_health_failed" then
     return nil
 else
     if old_state ~= "in_use" then
+        local old_index = vm_index_keys(KEYS[1])
         redis.call("HSET", KEYS[1], "state", "check_health")
+        vm_reindex(KEYS[1], old_index)
     end
     redis.call("HSET", KEYS[1], "last_health_check", ARGV[1])
     return "OK"
 end
 """
 
-# KEYS[1]: VMD key
+# KEYS[1]: ready VMs dirtied by the user, KEYS[2]: clean ready VMs,
+# KEYS[3]: VMs in use by the user, KEYS[4]: server info, KEYS[5]: VM leases,
+# KEYS[6...]: VMD keys of the candidates in the order of preference, index keys
 # ARGV[1]: user to bound;
 # ARGV[2]: pid of the builder process
 # ARGV[3]: current timestamp for `in_use_since`
 # ARGV[4]: task_id
 # ARGV[5]: build_id
 # ARGV[6]: chroot
-acquire_vm_lua = """
-local old_state = redis.call("HGET", KEYS[1], "state")
-if old_state ~= "ready"  then
-    return nil
-else
-    local last_health_check = tonumber(redis.call("HGET", KEYS[1], "last_health_check"))
-    local server_restart_time = tonumber(redis.call("HGET", KEYS[2], "server_start_timestamp"))
-    if last_health_check and server_restart_time and last_health_check > server_restart_time  then
-        redis.call("HMSET", KEYS[1], "state", "in_use", "bound_to_user", ARGV[1],
+# ARGV[7]: max number of VMs used by one user
+# ARGV[8]: lease expiration timestamp
+# ARGV[9]: index user, the same as ARGV[1]
+# returns {"OK", VMD fields...}, {"LIMIT"} or {"NONE"}
+acquire_vm_lua = vm_index_lua + """
+if redis.call("SCARD", KEYS[3]) >= tonumber(ARGV[7]) then
+    return {"LIMIT"}
+end
+
+local server_restart_time = tonumber(redis.call("HGET", KEYS[4], "server_start_timestamp"))
+if not server_restart_time then
+    return {"NONE"}
+end
+
+for i = 6, index_first do
+    local vm_key = KEYS[i]
+    local vm = redis.call("HMGET", vm_key, "vm_name", "state", "last_health_check", "check_fails")
+    local vm_name = vm[1]
+    local last_health_check = tonumber(vm[3])
+    -- candidates were read before the script, the VM could be taken meanwhile
+    if vm_name and (redis.call("SISMEMBER", KEYS[1], vm_name) == 1
+                    or redis.call("SISMEMBER", KEYS[2], vm_name) == 1)
+            and vm[2] == "ready" and last_health_check and last_health_check > server_restart_time
+            and (tonumber(vm[4]) or 0) == 0 then
+        local old_index = vm_index_keys(vm_key)
+        redis.call("HMSET", vm_key, "state", "in_use", "bound_to_user", ARGV[1],
                    "used_by_pid", ARGV[2], "in_use_since", ARGV[3],
                    "task_id",  ARGV[4], "build_id", ARGV[5], "chroot", ARGV[6])
-        return "OK"
-    else
-        return nil
+        vm_reindex(vm_key, old_index)
+        redis.call("ZADD", KEYS[5], ARGV[8], vm_name)
+        local result = redis.call("HGETALL", vm_key)
+        table.insert(result, 1, "OK")
+        return result
     end
 end
+return {"NONE"}
 """
 
-# KEYS[1]: VMD key
+# KEYS[1]: VMD key, KEYS[2]: VM leases, index keys
 # ARGV[1] current timestamp for `last_release`
-release_vm_lua = """
+# ARGV[2] prefix of the channel for VM ready notifications, group is appended
+# ARGV[3] vm_name
+# ARGV[4] index user
+release_vm_lua = vm_index_lua + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "in_use" then
     return nil
 else
+    local old_index = vm_index_keys(KEYS[1])
     redis.call("HMSET", KEYS[1], "state", "ready", "last_release", ARGV[1])
     redis.call("HDEL", KEYS[1], "in_use_since", "used_by_pid", "task_id", "build_id", "chroot")
     redis.call("HINCRBY", KEYS[1], "builds_count", 1)
@@ -73,16 +102,48 @@ else
     local check_fails = tonumber(redis.call("HGET", KEYS[1], "check_fails"))
     if check_fails > 0 then
         redis.call("HSET", KEYS[1], "state", "check_health_failed")
+    else
+        local group = redis.call("HGET", KEYS[1], "group")
+        if group then
+            redis.call("PUBLISH", ARGV[2] .. group, ARGV[3])
+        end
     end
+    vm_reindex(KEYS[1], old_index)
+    redis.call("ZREM", KEYS[2], ARGV[3])
 
     return "OK"
 end
 """
 
-# KEYS [1]: VMD key
+# KEYS[1]: VMD key, KEYS[2]: VM leases
+# ARGV[1]: vm_name
+# ARGV[2]: pid of the builder process which holds the lease
+# ARGV[3]: new lease expiration timestamp
+renew_vm_lease_lua = """
+if redis.call("HGET", KEYS[1], "state") ~= "in_use" or
+        redis.call("HGET", KEYS[1], "used_by_pid") ~= ARGV[2] then
+    return nil
+end
+redis.call("ZADD", KEYS[2], ARGV[3], ARGV[1])
+return "OK"
+"""
+
+# KEYS[1]: VM leases
+# ARGV[1]: current timestamp
+pop_expired_vm_leases_lua = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+if #expired > 0 then
+    redis.call("ZREM", KEYS[1], unpack(expired))
+end
+return expired
+"""
+
+# KEYS [1]: VMD key, KEYS[2]: VM leases, index keys
 # ARGS [1]: allowed_pre_state
 # ARGS [2]: timestamp for `terminating_since`
-terminate_vm_lua = """
+# ARGS [3]: vm_name
+# ARGS [4]: index user
+terminate_vm_lua = vm_index_lua + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 
 if old_state == "in_use" and ARGV[1] ~= "in_use" then
@@ -94,19 +155,39 @@ if ARGV[1] and ARGV[1] ~= "None" and old_state ~= ARGV[1] then
 elseif old_state == "terminating" and ARGV[1] ~= "terminating" then
     return "Already terminating"
 else
+    local old_index = vm_index_keys(KEYS[1])
     redis.call("HMSET", KEYS[1], "state", "terminating", "terminating_since", ARGV[2])
+    vm_reindex(KEYS[1], old_index)
+    redis.call("ZREM", KEYS[2], ARGV[3])
     return "OK"
 end
 """
 
-mark_vm_check_failed_lua = """
+# KEYS[1]: VMD key, index keys
+# ARGV[1]: index user
+mark_vm_check_failed_lua = vm_index_lua + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state == "check_health" then
+    local old_index = vm_index_keys(KEYS[1])
     redis.call("HMSET", KEYS[1], "state", "check_health_failed")
+    vm_reindex(KEYS[1], old_index)
     return "OK"
 end
 """
 
+# KEYS: VMD keys
+# returns list of VMD hashes as flat lists of fields and values, missing VMDs are skipped
+snapshot_lua = """
+local result = {}
+for _, vm_key in ipairs(KEYS) do
+    local raw = redis.call("HGETALL", vm_key)
+    if #raw > 0 then
+        table.insert(result, raw)
+    end
+end
+return result
+"""
+
 
 class VmManager(object):
     """
@@ -141,6 +222,10 @@ class VmManager(object):
         self.lua_scripts["release_vm"] = self.rc.register_script(release_vm_lua)
         self.lua_scripts["terminate_vm"] = self.rc.register_script(terminate_vm_lua)
         self.lua_scripts["mark_vm_check_failed"] = self.rc.register_script(mark_vm_check_failed_lua)
+        self.lua_scripts["snapshot"] = self.rc.register_script(snapshot_lua)
+        self.lua_scripts["renew_vm_lease"] = self.rc.register_script(renew_vm_lease_lua)
+        self.lua_scripts["pop_expired_vm_leases"] = self.rc.register_script(pop_expired_vm_leases_lua)
+        self.lua_scripts["reindex_vm"] = self.rc.register_script(reindex_vm_lua)
 
     def set_logger(self, logger):
         """
@@ -175,6 +260,7 @@ class VmManager(object):
         # print("VMD: {}".format(vmd))
         pipe = self.rc.pipeline()
         pipe.sadd(KEY_VM_POOL.format(group=group), vm_name)
+        pipe.sadd(KEY_VM_BY_STATE.format(group=group, state=vmd.state), vm_name)
         pipe.hmset(KEY_VM_INSTANCE.format(vm_name=vm_name), vmd.to_dict())
         pipe.execute()
         self.log.info("registered new VM: {} {}".format(vmd.vm_name, vmd.vm_ip))
@@ -191,34 +277,41 @@ class VmManager(object):
             if vmd.vm_ip == vm_ip
         ]
 
+    def set_checking_state(self, vmd):
+        """
+        Move VM to the `check_health` state, in_use VM keeps its state
+
+        :type vmd: VmDescriptor
+        :return bool: False when the current state doesn't allow health check
+        """
+        return self.lua_scripts["set_checking_state"](
+            keys=[vmd.vm_key] + vm_index_keys(vmd.group, vmd.bound_to_user),
+            args=[time.time(), vmd.bound_to_user or ""]) == "OK"
+
     def mark_vm_check_failed(self, vm_name):
-        vm_key = KEY_VM_INSTANCE.format(vm_name=vm_name)
-        self.lua_scripts["mark_vm_check_failed"](keys=[vm_key])
+        try:
+            vmd = self.get_vm_by_name(vm_name)
+        except VmDescriptorNotFound:
+            return
+        self.lua_scripts["mark_vm_check_failed"](
+            keys=[vmd.vm_key] + vm_index_keys(vmd.group, vmd.bound_to_user),
+            args=[vmd.bound_to_user or ""])
 
     def mark_server_start(self):
         self.rc.hset(KEY_SERVER_INFO, "server_start_timestamp", time.time())
 
     def can_user_acquire_more_vm(self, username, group):
         """
+        Only informative, the limit is enforced atomically by :py:meth:`acquire_vm`
+
         :return bool: True when user are allowed to acquire more VM
         """
-        vmd_list = self.get_all_vm_in_group(group)
-        vm_count_used_by_user = len([
-            vmd for vmd in vmd_list if
-            vmd.bound_to_user == username and vmd.state == VmStates.IN_USE
-        ])
+        vm_count_used_by_user = self.rc.scard(
+            KEY_VM_IN_USE_BY_USER.format(group=group, user=username))
         self.log.debug("# vm by user: {}, limit:{} ".format(
             vm_count_used_by_user, self.opts.build_groups[group]["max_vm_per_user"]
         ))
-        if vm_count_used_by_user >= self.opts.build_groups[group]["max_vm_per_user"]:
-            # TODO: this check isn't reliable, if two (or more) processes check VM list
-            # at the +- same time, they could acquire more VMs
-            #  proper solution: do this check inside lua script
-            self.log.debug("No VM are available, user `{}` already acquired #{} VMs"
-                           .format(username, vm_count_used_by_user))
-            return False
-        else:
-            return True
+        return vm_count_used_by_user < self.opts.build_groups[group]["max_vm_per_user"]
 
     def acquire_vm(self, group, username, pid, task_id=None, build_id=None, chroot=None):
         """
@@ -227,34 +320,43 @@ class VmManager(object):
         :param group: builder group id, as defined in config
         :type group: int
         :param username: build owner username, VMM prefer to reuse an existing VM which was used by the same user
-        :param pid: builder pid to release VM after build process unhandled death
+        :param pid: builder pid, builder should renew the VM lease with :py:meth:`renew_vm_lease`,
+            otherwise VM is terminated after ``vm_lease_timeout``
 
         :rtype: VmDescriptor
         :raises: NoVmAvailable  when manager couldn't find suitable VM for the given group and user
         """
-        vmd_list = self.get_all_vm_in_group(group)
-        if not self.can_user_acquire_more_vm(username, group):
+        # VM dirtied by this user is preferred, selection, the per user limit check
+        # and state change are done by one script using the index sets
+        dirty_key = KEY_VM_READY_DIRTY.format(group=group, user=username)
+        clean_key = KEY_VM_READY_CLEAN.format(group=group)
+        pipe = self.rc.pipeline(transaction=False)
+        pipe.smembers(dirty_key)
+        pipe.smembers(clean_key)
+        dirty, clean = pipe.execute()
+        candidates = [KEY_VM_INSTANCE.format(vm_name=vm_name)
+                      for vm_name in sorted(dirty) + sorted(clean - dirty)]
+
+        result = self.lua_scripts["acquire_vm"](
+            keys=[dirty_key, clean_key,
+                  KEY_VM_IN_USE_BY_USER.format(group=group, user=username),
+                  KEY_SERVER_INFO, KEY_VM_LEASES] + candidates + vm_index_keys(group, username),
+            args=[username, pid, time.time(), task_id, build_id, chroot,
+                  self.opts.build_groups[group]["max_vm_per_user"],
+                  time.time() + self.opts.vm_lease_timeout, username])
+
+        if result[0] == "LIMIT":
+            self.log.debug("No VM are available, user `{}` already acquired too much VMs"
+                           .format(username))
             raise NoVmAvailable("No VM are available, user `{}` already acquired too much VMs"
                                 .format(username))
-
-        ready_vmd_list = [vmd for vmd in vmd_list if vmd.state == VmStates.READY]
-        # trying to find VM used by this user
-        dirtied_by_user = [vmd for vmd in ready_vmd_list if vmd.bound_to_user == username]
-        clean_list = [vmd for vmd in ready_vmd_list if vmd.bound_to_user is None]
-        all_vms = list(chain(dirtied_by_user, clean_list))
-
-        for vmd in all_vms:
-            if vmd.get_field(self.rc, "check_fails") != "0":
-                self.log.debug("VM {} has check fails, skip acquire".format(vmd.vm_name))
-            vm_key = KEY_VM_INSTANCE.format(vm_name=vmd.vm_name)
-            if self.lua_scripts["acquire_vm"](keys=[vm_key, KEY_SERVER_INFO],
-                                              args=[username, pid, time.time(),
-                                                    task_id, build_id, chroot]) == "OK":
-                self.log.info("Acquired VM :{} {} for pid: {}".format(vmd.vm_name, vmd.vm_ip, pid))
-                return vmd
-        else:
+        elif result[0] != "OK":
             raise NoVmAvailable("No VM are available, please wait in queue. Group: {}".format(group))
 
+        vmd = VmDescriptor.from_dict(dict(zip(result[1::2], result[2::2])))
+        self.log.info("Acquired VM :{} {} for pid: {}".format(vmd.vm_name, vmd.vm_ip, pid))
+        return vmd
+
     def release_vm(self, vm_name):
         """
         Return VM into the pool.
@@ -263,11 +365,87 @@ class VmManager(object):
         """
         # in_use -> ready
         self.log.info("Releasing VM {}".format(vm_name))
-        vm_key = KEY_VM_INSTANCE.format(vm_name=vm_name)
-        lua_result = self.lua_scripts["release_vm"](keys=[vm_key], args=[time.time()])
+        try:
+            vmd = self.get_vm_by_name(vm_name)
+        except VmDescriptorNotFound:
+            return False
+        lua_result = self.lua_scripts["release_vm"](
+            keys=[vmd.vm_key, KEY_VM_LEASES] + vm_index_keys(vmd.group, vmd.bound_to_user),
+            args=[time.time(), PUBSUB_VM_READY.format(group=""), vm_name,
+                  vmd.bound_to_user or ""])
         self.log.debug("release vm result `{}`".format(lua_result))
         return lua_result == "OK"
 
+    def renew_vm_lease(self, vm_name, pid):
+        """
+        Extend lease of the acquired VM by ``vm_lease_timeout``
+
+        :param pid: pid used in :py:meth:`acquire_vm`
+        :return bool: False when VM is no more used by the builder
+        """
+        lua_result = self.lua_scripts["renew_vm_lease"](
+            keys=[KEY_VM_INSTANCE.format(vm_name=vm_name), KEY_VM_LEASES],
+            args=[vm_name, pid, time.time() + self.opts.vm_lease_timeout])
+        return lua_result == "OK"
+
+    def pop_expired_vm_leases(self):
+        """
+        :return list: names of VMs whose builder stopped renewing the lease,
+            the leases are removed
+        """
+        return self.lua_scripts["pop_expired_vm_leases"](
+            keys=[KEY_VM_LEASES], args=[time.time()])
+
+    def restore_vm_leases(self):
+        """
+        Give lease to VMs in use which don't have one, e.g. they were acquired
+        by the older backend version or VM master died before their termination
+        """
+        expire_at = time.time() + self.opts.vm_lease_timeout
+        pipe = self.rc.pipeline(transaction=False)
+        for vmd in self.get_snapshot().get_vm_by_group_and_state_list(None, [VmStates.IN_USE]):
+            pipe.execute_command("ZADD", KEY_VM_LEASES, "NX", expire_at, vmd.vm_name)
+        pipe.execute()
+
+    def rebuild_vm_indexes(self):
+        """
+        Put every VM into the right index sets, VMs added by the older
+        backend version are not indexed at all
+        """
+        for vmd in self.get_snapshot().vmd_list:
+            self.lua_scripts["reindex_vm"](
+                keys=[vmd.vm_key] + vm_index_keys(vmd.group, vmd.bound_to_user),
+                args=[vmd.bound_to_user or ""])
+
+    def subscribe_vm_ready(self, group):
+        """
+        Subscribe to notifications about VMs which became ready in the group,
+        subscribe before :py:meth:`acquire_vm` so no notification is missed.
+
+        :return: redis PubSub, pass it to :py:meth:`wait_vm_ready` and close when done
+        """
+        pubsub = self.rc.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(PUBSUB_VM_READY.format(group=group))
+        return pubsub
+
+    @staticmethod
+    def wait_vm_ready(pubsub, timeout):
+        """
+        Block until some VM becomes ready or timeout expires
+
+        :param pubsub: result of :py:meth:`subscribe_vm_ready`
+        :param float timeout: max wait time in seconds
+        :return: vm_name of the ready VM or None
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            msg = pubsub.get_message(timeout=remaining)
+            if msg and msg["type"] == "message":
+                return msg["data"]
+
     def start_vm_termination(self, vm_name, allowed_pre_state=None):
         """
         Initiate VM termination process using redis publish.
@@ -276,7 +454,9 @@ class VmManager(object):
         :type allowed_pre_state: str constant from VmState
         """
         vmd = self.get_vm_by_name(vm_name)
-        lua_result = self.lua_scripts["terminate_vm"](keys=[vmd.vm_key], args=[allowed_pre_state, time.time()])
+        lua_result = self.lua_scripts["terminate_vm"](
+            keys=[vmd.vm_key, KEY_VM_LEASES] + vm_index_keys(vmd.group, vmd.bound_to_user),
+            args=[allowed_pre_state, time.time(), vm_name, vmd.bound_to_user or ""])
         if lua_result == "OK":
             msg = {
                 "group": vmd.group,
@@ -286,9 +466,8 @@ class VmManager(object):
             }
             self.rc.publish(PUBSUB_MB, json.dumps(msg))
             self.log.info("VM {} queued for termination".format(vmd.vm_name))
-
-            # TODO: remove when refactored build management
-            # self.rc.publish(PUBSUB_INTERRUPT_BUILDER.format(vmd.vm_ip), "vm died")
+            # stops the build running on the VM
+            self.rc.publish(PUBSUB_INTERRUPT_BUILDER.format(vmd.vm_ip), "vm terminated")
         else:
             self.log.debug("VM  termination `{}` skipped due to: {} ".format(vm_name, lua_result))
 
@@ -303,19 +482,41 @@ class VmManager(object):
             raise VmError("VM should have `terminating` state to be removable")
         pipe = self.rc.pipeline()
         pipe.srem(KEY_VM_POOL.format(group=vmd.group), vm_name)
+        pipe.srem(KEY_VM_BY_STATE.format(group=vmd.group, state=VmStates.TERMINATING), vm_name)
+        pipe.zrem(KEY_VM_LEASES, vm_name)
         pipe.delete(KEY_VM_INSTANCE.format(vm_name=vm_name))
         pipe.execute()
         self.log.info("removed vm `{}` from pool".format(vm_name))
 
     def _load_multi_safe(self, vm_name_list):
-        result = []
+        vm_name_list = list(vm_name_list)
+        pipe = self.rc.pipeline(transaction=False)
         for vm_name in vm_name_list:
-            try:
-                result.append(VmDescriptor.load(self.rc, vm_name))
-            except VmDescriptorNotFound:
+            pipe.hgetall(KEY_VM_INSTANCE.format(vm_name=vm_name))
+
+        result = []
+        for vm_name, raw in zip(vm_name_list, pipe.execute()):
+            if raw:
+                result.append(VmDescriptor.from_dict(raw))
+            else:
                 self.log.debug("Failed to load VMD: {}".format(vm_name))
         return result
 
+    def get_snapshot(self):
+        """
+        Load all VMs of all groups at once
+
+        :rtype: VmPoolSnapshot
+        """
+        pipe = self.rc.pipeline(transaction=False)
+        for group in self.vm_groups:
+            pipe.smembers(KEY_VM_POOL.format(group=group))
+        vm_keys = [KEY_VM_INSTANCE.format(vm_name=vm_name)
+                   for vm_names in pipe.execute() for vm_name in sorted(vm_names)]
+        result = self.lua_scripts["snapshot"](keys=vm_keys)
+        return VmPoolSnapshot([VmDescriptor.from_dict(dict(zip(raw[::2], raw[1::2])))
+                               for raw in result])
+
     def get_all_vm_in_group(self, group):
         """
         :rtype: list of VmDescriptor
@@ -1,11 +1,131 @@
 # coding: utf-8
 
 from pprint import pformat
-from . import KEY_VM_INSTANCE
+from . import VmStates, KEY_VM_INSTANCE, KEY_VM_BY_STATE, KEY_VM_READY_CLEAN, \
+    KEY_VM_READY_DIRTY, KEY_VM_IN_USE_BY_USER
 from backend.exceptions import VmDescriptorNotFound
 
 
+# states tracked by KEY_VM_BY_STATE, in the order of the declared index keys
+INDEXED_STATES = [VmStates.GOT_IP, VmStates.CHECK_HEALTH, VmStates.CHECK_HEALTH_FAILED,
+                  VmStates.READY, VmStates.IN_USE, VmStates.TERMINATING]
+
+
+def vm_index_keys(group, user=None):
+    """
+    Index sets a VM of the group bound to the user can be member of,
+    scripts using :py:data:`vm_index_lua` get them as the last KEYS
+    and the user as the last ARGV
+
+    :return list: keys of the index sets
+    """
+    user = user or ""
+    return ([KEY_VM_BY_STATE.format(group=group, state=state) for state in INDEXED_STATES] +
+            [KEY_VM_READY_CLEAN.format(group=group),
+             KEY_VM_READY_DIRTY.format(group=group, user=user),
+             KEY_VM_IN_USE_BY_USER.format(group=group, user=user)])
+
+
+# Lua functions which keep index sets of VMs in sync with VMD hashes.
+# Every script which changes `state` or `bound_to_user` should be prefixed with them
+# and wrap the change:
+#     local old_index = vm_index_keys(KEYS[1])
+#     ... update VMD hash ...
+#     vm_reindex(KEYS[1], old_index)
+# Index sets are not named by the script, the caller declares them by
+# :py:func:`vm_index_keys` at the end of KEYS, the user they are built for
+# is the last ARGV. VM bound to another user raises an error.
+vm_index_lua = """
+local index_first = #KEYS - %(count)d
+local index_user = ARGV[#ARGV]
+local index_by_state = {}
+for i, state in ipairs({%(states)s}) do
+    index_by_state[state] = KEYS[index_first + i]
+end
+local index_ready_clean = KEYS[index_first + %(states_count)d + 1]
+local index_ready_dirty = KEYS[index_first + %(states_count)d + 2]
+local index_in_use_by_user = KEYS[index_first + %(states_count)d + 3]
+
+local function vm_index_user(user)
+    if user ~= index_user then
+        error("index keys declared for user `" .. index_user .. "`, VM is bound to `" .. user .. "`")
+    end
+end
+
+local function vm_index_keys(vm_key)
+    local vm = redis.call("HMGET", vm_key, "vm_name", "group", "state", "bound_to_user")
+    local name, group, state, user = vm[1], vm[2], vm[3], vm[4]
+    if not (name and group and state) then
+        return {}
+    end
+    local keys = {}
+    if index_by_state[state] then
+        table.insert(keys, index_by_state[state])
+    end
+    if state == "ready" then
+        if user then
+            vm_index_user(user)
+            table.insert(keys, index_ready_dirty)
+        else
+            table.insert(keys, index_ready_clean)
+        end
+    elseif state == "in_use" and user then
+        vm_index_user(user)
+        table.insert(keys, index_in_use_by_user)
+    end
+    return {name, keys}
+end
+
+local function vm_reindex(vm_key, old_index)
+    local new_index = vm_index_keys(vm_key)
+    if old_index[1] then
+        for _, key in ipairs(old_index[2]) do
+            redis.call("SREM", key, old_index[1])
+        end
+    end
+    if new_index[1] then
+        for _, key in ipairs(new_index[2]) do
+            redis.call("SADD", key, new_index[1])
+        end
+    end
+end
+""" % {
+    "count": len(vm_index_keys(0)),
+    "states": ", ".join('"{}"'.format(state) for state in INDEXED_STATES),
+    "states_count": len(INDEXED_STATES),
+}
+
+# fields of VMD which define membership in the index sets
+INDEXED_FIELDS = {"vm_name", "group", "state", "bound_to_user"}
+
+# KEYS[1]: VMD key, index keys
+# ARGV: field1, value1, field2, value2, ..., index user
+store_fields_lua = vm_index_lua + """
+local old_index = vm_index_keys(KEYS[1])
+redis.call("HMSET", KEYS[1], unpack(ARGV, 1, #ARGV - 1))
+vm_reindex(KEYS[1], old_index)
+"""
+
+# KEYS[1]: VMD key, index keys
+# ARGV[1]: index user
+# removes VM from all declared index sets and adds it to the right ones
+reindex_vm_lua = vm_index_lua + """
+local name = redis.call("HGET", KEYS[1], "vm_name")
+if not name then
+    return nil
+end
+for i = index_first + 1, #KEYS do
+    redis.call("SREM", KEYS[i], name)
+end
+vm_reindex(KEYS[1], {})
+return "OK"
+"""
+
+
 class VmDescriptor(object):
+    # registered by the first store, then called with the given connection
+    _store_fields_script = None
+
     def __init__(self, vm_ip, vm_name, group, state):
         self.vm_ip = vm_ip
         self.vm_name = vm_name
@@ -52,11 +172,21 @@ class VmDescriptor(object):
             raise VmDescriptorNotFound("VmDescriptor for `{}` not found".format(vm_name))
         return cls.from_dict(raw)
 
+    @classmethod
+    def _store_fields(cls, rc, vm_key, group, user, args):
+        if cls._store_fields_script is None:
+            cls._store_fields_script = rc.register_script(store_fields_lua)
+        cls._store_fields_script(keys=[vm_key] + vm_index_keys(group, user),
+                                 args=args + [user or ""], client=rc)
+
     def store(self, rc):
         """
         :type rc: StrictRedis
         """
-        rc.hmset(KEY_VM_INSTANCE.format(vm_name=self.vm_name), self.__dict__)
+        args = []
+        for field, value in self.to_dict().items():
+            args.extend([field, value])
+        self._store_fields(rc, self.vm_key, self.group, self.bound_to_user, args)
 
     def store_field(self, rc, field, value):
         """
@@ -64,7 +194,10 @@ class VmDescriptor(object):
         """
         # TODO: add option `save_with_existnse_check`, use lua script to ensure that VMD still exists
         setattr(self, field, value)
-        rc.hset(KEY_VM_INSTANCE.format(vm_name=self.vm_name), field, value)
+        if field in INDEXED_FIELDS:
+            self._store_fields(rc, self.vm_key, self.group, self.bound_to_user, [field, value])
+        else:
+            rc.hset(KEY_VM_INSTANCE.format(vm_name=self.vm_name), field, value)
 
     def get_field(self, rc, field):
         """
@@ -79,3 +212,42 @@ class VmDescriptor(object):
     #     :type rc: StrictRedis
     #     """
     #     rc.hincrby(KEY_VM_INSTANCE.format(vm_name=self.vm_name), "check_fails")
+
+
+class VmPoolSnapshot(object):
+    """
+    VmDescriptors of the whole VM pool loaded at once,
+    see :py:meth:`VmManager.get_snapshot <backend.vm_manage.manager.VmManager.get_snapshot>`.
+
+    Fields are not refreshed after load, so state changes should still be done
+    by the VmManager scripts, which verify the current state.
+
+    :param list vmd_list: VmDescriptors
+    """
+    def __init__(self, vmd_list):
+        self.vmd_list = vmd_list
+
+    def __len__(self):
+        return len(self.vmd_list)
+
+    def get_all_vm_in_group(self, group):
+        """
+        :rtype: list of VmDescriptor
+        """
+        return [vmd for vmd in self.vmd_list if vmd.group == group]
+
+    def get_vm_by_group_and_state_list(self, group, state_list):
+        """
+        :param group: build group or None for all groups
+        :param state_list: allowed VM states
+        :rtype: list of VmDescriptor
+        """
+        states = set(state_list)
+        return [vmd for vmd in self.vmd_list
+                if vmd.state in states and (group is None or vmd.group == group)]
+
+    def lookup_vms_by_ip(self, vm_ip):
+        """
+        :rtype: list of VmDescriptor
+        """
+        return [vmd for vmd in self.vmd_list if vmd.vm_ip == vm_ip]
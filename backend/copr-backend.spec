@@ -39,7 +39,6 @@ BuildRequires: python-daemon
 BuildRequires: python-requests
 BuildRequires: python-setproctitle
 # missing python3
-BuildRequires: python-retask
 BuildRequires: python-copr >= 1.60
 BuildRequires: ansible >= 1.2
 BuildRequires: python-IPy
@@ -69,7 +68,6 @@ Requires:   python-daemon
 Requires:   python-lockfile
 Requires:   python-requests
 Requires:   python-setproctitle
-Requires:   python-retask
 Requires:   python-copr
 Requires:   python-six
 Requires:   python-IPy
@@ -127,6 +125,8 @@ popd
 
 install -d %{buildroot}%{_sharedstatedir}/copr
 install -d %{buildroot}%{_sharedstatedir}/copr/jobs
+install -d %{buildroot}%{_sharedstatedir}/copr/update_spool
+install -d %{buildroot}%{_sharedstatedir}/copr/prune
 install -d %{buildroot}%{_sharedstatedir}/copr/public_html/results
 install -d %{buildroot}%{_var}/log/copr
 install -d %{buildroot}%{_pkgdocdir}/lighttpd/
@@ -212,6 +212,8 @@ useradd -r -g copr -G lighttpd -s /bin/bash -c "COPR user" copr
 %{_datadir}/copr/*
 %dir %{_sharedstatedir}/copr
 %dir %attr(0755, copr, copr) %{_sharedstatedir}/copr/jobs/
+%dir %attr(0755, copr, copr) %{_sharedstatedir}/copr/update_spool/
+%dir %attr(0755, copr, copr) %{_sharedstatedir}/copr/prune/
 %dir %attr(0755, copr, copr) %{_sharedstatedir}/copr/public_html/
 %dir %attr(0755, copr, copr) %{_sharedstatedir}/copr/public_html/results
 %dir %attr(0755, copr, copr) %{_var}/log/copr
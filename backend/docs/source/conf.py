@@ -17,7 +17,6 @@ from subprocess import call
 
 TO_INSTALL = [
     # "redis",
-    "retask",
     "ansible",
 ]
 
@@ -0,0 +1,34 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+Serves the build logs while the builds are running,
+see :py:func:`backend.build_log.make_tail_app`
+"""
+
+from __future__ import print_function
+import sys
+from wsgiref.simple_server import make_server
+
+sys.path.append("/usr/share/copr/")
+
+from backend.build_log import make_tail_app
+from backend.helpers import SortedOptParser, BackendConfigReader
+
+
+def main(args):
+    parser = SortedOptParser("copr_log_tail.py [options]")
+    parser.add_option("--host", dest="host", default="127.0.0.1",
+                      help="address to listen on, default is 127.0.0.1")
+    parser.add_option("-p", "--port", dest="port", type="int", default=5010,
+                      help="port to listen on, default is 5010")
+    cli_opts, args = parser.parse_args(args)
+
+    opts = BackendConfigReader().read()
+    server = make_server(cli_opts.host, cli_opts.port, make_tail_app(opts.destdir))
+    print("Serving build logs from {0} on {1}:{2}".format(opts.destdir, cli_opts.host, cli_opts.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -5,11 +5,14 @@ from __future__ import unicode_literals
 from __future__ import division
 from __future__ import absolute_import
 
+import json
 import os
 import shutil
 import sys
 import logging
+from multiprocessing import Pool
 from subprocess import Popen, PIPE
+import tempfile
 import time
 import pwd
 
@@ -21,13 +24,19 @@ from copr.exceptions import CoprException, CoprRequestException
 
 sys.path.append("/usr/share/copr/")
 
-from backend.helpers import BackendConfigReader, get_auto_createrepo_status
+from backend.helpers import BackendConfigReader
 from backend.createrepo import createrepo_unsafe
+from backend.prune import find_obsolete_builds, get_prune_policy
 from backend.exceptions import CreateRepoError
+from backend.project_cache import ProjectCache
 
 
 DEF_DAYS = 14
 DEF_FIND_OBSOLETE_SCRIPT = "/usr/bin/copr_find_obsolete_builds.sh"
+DEF_WORKERS = 4
+DEF_INDEX_PATH = "/var/lib/copr/prune/prune_index.json"
+# how often in seconds the scan index is saved during the run
+INDEX_SAVE_INTERVAL = 30
 
 
 def list_subdir(path):
@@ -35,19 +44,133 @@ def list_subdir(path):
     return dir_names, map(lambda x: os.path.join(path, x), dir_names)
 
 
+class ScanIndex(object):
+    """
+    Remembers the state of the pruned chroot directories between runs, so the
+    chroots which can't have anything to prune are skipped.
+
+    For each chroot path it stores ``mtime`` of the directory after the last
+    prune and ``next_due``, the time when the oldest kept build becomes
+    old enough to be pruned.
+
+    :param str path: json file with the index, None to keep it only in memory
+    """
+    def __init__(self, path):
+        self.path = path
+        self.chroots = {}
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as handle:
+                self.chroots = json.load(handle)
+        except ValueError:
+            log.exception("Broken scan index {}, starting from scratch".format(self.path))
+
+    def save(self):
+        if self.path is None:
+            return
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # the index isn't corrupted when the pruner is killed while saving
+        with tempfile.NamedTemporaryFile("w", dir=dirname, delete=False) as handle:
+            json.dump(self.chroots, handle)
+        os.rename(handle.name, self.path)
+
+    def is_unchanged(self, chroot_path, now=None):
+        """
+        :return bool: nothing was added or removed since the last prune
+            and no build became old enough
+        """
+        entry = self.chroots.get(chroot_path)
+        if entry is None:
+            return False
+        if (now or time.time()) >= entry["next_due"]:
+            return False
+        return os.path.getmtime(chroot_path) == entry["mtime"]
+
+    def update(self, chroot_path, mtime, next_due):
+        self.chroots[chroot_path] = {"mtime": mtime, "next_due": next_due}
+
+
+# pruner of the pool worker process
+worker_pruner = None
+
+
+def init_worker(opts):
+    global worker_pruner
+    worker_pruner = Pruner(opts)
+
+
+def prune_chroot_task(args):
+    """
+    Entry point of the pool workers, see :py:meth:`Pruner.prune_chroot`
+    """
+    chroot_path, label = args
+    try:
+        return worker_pruner.prune_chroot(chroot_path, label)
+    except Exception as err:
+        log.exception("Prune of {} failed with error: {}".format(label, err))
+        return None
+
+
 class Pruner(object):
     def __init__(self, opts):
         self.opts = opts
-        self.days = getattr(self.opts, "prune_days", DEF_DAYS)
+        self.days = getattr(self.opts, "prune_days", None) or DEF_DAYS
         self.find_obsolete_script = getattr(self.opts, "find_obsolete_script", DEF_FIND_OBSOLETE_SCRIPT)
+        self.workers = getattr(self.opts, "prune_workers", DEF_WORKERS)
+        self.index = ScanIndex(getattr(self.opts, "prune_index_path", DEF_INDEX_PATH))
+        self._project_cache = None
+
+    @property
+    def project_cache(self):
+        # pool workers don't need it
+        if self._project_cache is None:
+            self._project_cache = ProjectCache(self.opts)
+        return self._project_cache
+
+    @property
+    def max_age(self):
+        return self.days * 24 * 3600
+
+    def get_policy(self, chroot_path):
+        """
+        :param chroot_path: path to the chroot directory, `destdir/owner/project/chroot`
+        :return Munch: see :py:func:`backend.prune.get_prune_policy`
+        """
+        project_path = os.path.dirname(os.path.normpath(chroot_path))
+        owner = os.path.basename(os.path.dirname(project_path))
+        return get_prune_policy(self.opts, owner, os.path.basename(project_path))
+
+    def get_next_due(self, chroot_path):
+        """
+        :return float: time when the first of the kept builds becomes older than prune days
+        """
+        max_age = self.get_policy(chroot_path).days * 24 * 3600
+        next_due = float("inf")
+        for sub_dir_name in os.listdir(chroot_path):
+            for marker in ["success", "fail"]:
+                marker_path = os.path.join(chroot_path, sub_dir_name, marker)
+                if os.path.exists(marker_path):
+                    due = os.path.getmtime(marker_path) + max_age
+                    if due > time.time():
+                        next_due = min(next_due, due)
+        # json can't hold the infinity
+        return next_due if next_due != float("inf") else time.time() + max_age
 
     def prune_failed_builds(self, chroot_path):
         """
         Deletes subdirs (project directories) which contains file `fail`
-            with mtime older then self.days
+            with mtime older then prune days
 
         :param chroot_path: path to the chroot directory
+        :return int: number of removed builds
         """
+        max_age = self.get_policy(chroot_path).days * 24 * 3600
+        removed = 0
         for sub_dir_name in os.listdir(chroot_path):
             build_path = os.path.join(chroot_path, sub_dir_name)
             if not os.path.isdir(build_path):
@@ -56,29 +179,47 @@ class Pruner(object):
 
             fail_file_path = os.path.join(build_path, "fail")
             if os.path.exists(fail_file_path) and not os.path.exists(os.path.join(build_path, "success")):
-                if time.time() - os.path.getmtime(fail_file_path) > self.days:
+                if time.time() - os.path.getmtime(fail_file_path) > max_age:
                     log.info("Removing failed build: {}".format(build_path))
                     shutil.rmtree(build_path)
+                    removed += 1
+        return removed
 
-    def prune_obsolete_success_builds(self, chroot_path):
+    def find_obsolete_with_script(self, chroot_path, days):
         """
         Uses bash script which invokes repoquery to find obsolete build_dirs
 
-        :param chroot_path: path to the chroot directory
+        :return list: names of the obsolete build dirs, None on error
         """
-        # import ipdb; ipdb.set_trace()
-        cmd = map(str, [self.find_obsolete_script, chroot_path, self.days])
+        cmd = map(str, [self.find_obsolete_script, chroot_path, days])
         handle = Popen(cmd, stdout=PIPE, stderr=PIPE)
         stdout, stderr = handle.communicate()
         if handle.returncode != 0:
             log.error("Failed to prune old builds at: {} \n STDOUT: \n{}\n STDERR: \n{}\n"
                       .format(chroot_path, stdout.decode(), stderr.decode()))
-            return
-        # log.debug("find obsolete returned:\n {}\n stderr: \n {}".format(stdout, stderr))
-        for line in stdout.split("\n"):
-            if not line.strip() or (len(line) > 0 and line[0] == "#"):
-                continue
-            to_delete = line.strip()
+            return None
+        return [line.strip() for line in stdout.split("\n")
+                if line.strip() and not line.startswith("#")]
+
+    def prune_obsolete_success_builds(self, chroot_path):
+        """
+        Removes successful builds which don't provide any of the kept newest
+        packages, they are found from the repodata of the chroot,
+        the script is used only when the repodata can't be read
+
+        :param chroot_path: path to the chroot directory
+        :return int: number of removed builds
+        """
+        policy = self.get_policy(chroot_path)
+        obsolete = find_obsolete_builds(chroot_path, policy.days, policy.keep)
+        if obsolete is None:
+            log.debug("Can't read repodata at: {}, using {}".format(chroot_path, self.find_obsolete_script))
+            obsolete = self.find_obsolete_with_script(chroot_path, policy.days)
+        if obsolete is None:
+            return 0
+
+        removed = 0
+        for to_delete in obsolete:
             log.debug("Obsolete path, check for remove: {}".format(to_delete))
 
             if to_delete in os.listdir(chroot_path):
@@ -86,62 +227,116 @@ class Pruner(object):
                 if os.path.isdir(to_delete_path):
                     log.info("Removing obsolete build: {}".format(to_delete_path))
                     shutil.rmtree(to_delete_path)
+                    removed += 1
+        return removed
 
-    def run(self):
+    def is_acr_enabled(self, username, projectname):
+        """
+        Flags of all projects are loaded into the shared project cache by one
+        request to frontend, see :py:class:`backend.project_cache.ProjectCache`
+        """
+        try:
+            return self.project_cache.get_auto_createrepo(username, projectname)
+        except (CoprException, CoprRequestException) as exception:
+            log.debug("Failed to get project details for {}/{} with error: {}".format(
+                username, projectname, exception))
+            return False
+
+    def collect_chroots(self):
+        """
+        :return list: (chroot path, label) of the chroots which should be pruned
+        """
         results_dir = self.opts.destdir
-        log.info("Pruning results dir: {} ".format(results_dir))
         user_dir_names, user_dirs = list_subdir(results_dir)
-
         log.info("Going to process total number: {} of user's directories".format(len(user_dir_names)))
-        log.info("Going to process user's directories: {}".format(user_dir_names))
 
-        counter = 0
+        chroots = []
+        skipped = 0
         for username, subpath in zip(user_dir_names, user_dirs):
-            log.debug("For user `{}` exploring path: {}".format(username, subpath))
             for projectname, project_path in zip(*list_subdir(subpath)):
-                log.debug("Exploring project `{}` with path: {}".format(projectname, project_path))
-                self.prune_project(project_path, username, projectname)
+                if not self.is_acr_enabled(username, projectname):
+                    log.debug("Skipped {}/{} since auto createrepo option is disabled"
+                              .format(username, projectname))
+                    continue
 
-                counter += 1
-                log.info("Pruned {}. projects".format(counter))
+                for chroot, chroot_path in zip(*list_subdir(project_path)):
+                    if self.index.is_unchanged(chroot_path):
+                        skipped += 1
+                        continue
+                    chroots.append((chroot_path, "{}/{}:{}".format(username, projectname, chroot)))
 
-        log.info("Pruning finished")
+        log.info("Going to prune {} chroots, {} unchanged chroots skipped".format(len(chroots), skipped))
+        return chroots
 
-    def prune_project(self, project_path, username, projectname):
-        log.info("Going to prune {}/{}".format(username, projectname))
-        # get ACR
+    def run(self):
+        log.info("Pruning results dir: {} ".format(self.opts.destdir))
+        self.index.load()
+        chroots = self.collect_chroots()
+
+        pool = Pool(self.workers, initializer=init_worker, initargs=(self.opts,))
+        last_save = time.time()
         try:
-            if not get_auto_createrepo_status(self.opts.frontend_base_url, username, projectname):
-                log.debug("Skipped {}/{} since auto createrepo option is disabled"
-                          .format(username, projectname))
-                return
-        except (CoprException, CoprRequestException) as exception:
-            log.debug("Failed to get project details for {}/{} with error: {}".format(
-                username, projectname, exception))
-            return
+            for counter, result in enumerate(pool.imap_unordered(prune_chroot_task, chroots), 1):
+                if result is not None:
+                    self.index.update(*result)
+                if time.time() - last_save > INDEX_SAVE_INTERVAL:
+                    self.index.save()
+                    last_save = time.time()
+                log.info("Pruned {}/{} chroots".format(counter, len(chroots)))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            # interrupted run continues with the chroots not pruned yet
+            self.index.save()
 
-        # run prune project sh
-        for sub_dir_name in os.listdir(project_path):
-            chroot_path = os.path.join(project_path, sub_dir_name)
-            if not os.path.isdir(chroot_path):
-                continue
+        log.info("Pruning finished")
 
-            try:
-                self.prune_failed_builds(chroot_path)
-                self.prune_obsolete_success_builds(chroot_path)
-            except Exception as err:
-                log.exception(err)
-                log.error("Error during prune copr {}/{}:{}".format(username, projectname, sub_dir_name))
+    def prune_chroot(self, chroot_path, label):
+        """
+        Removes old builds of the chroot and regenerates the repodata
+        when some build was removed
+
+        :return tuple: (chroot path, mtime, next due) for the scan index
+        """
+        removed = 0
+        error = False
+        try:
+            removed += self.prune_failed_builds(chroot_path)
+            removed += self.prune_obsolete_success_builds(chroot_path)
+        except Exception as err:
+            log.exception(err)
+            log.error("Error during prune copr {}".format(label))
+            error = True
 
-            log.debug("Prune done for {}/{}:{}".format(username, projectname, sub_dir_name))
+        log.debug("Prune done for {}".format(label))
 
+        # repodata could be touched by the partial prune
+        if removed or error:
             try:
                 createrepo_unsafe(chroot_path)
-                log.info("Createrepo done for copr {}/{}:{}"
-                         .format(username, projectname, sub_dir_name))
+                log.info("Createrepo done for copr {}".format(label))
             except CreateRepoError as exception:
-                log.exception("Createrepo for copr {}/{}:{} failed with error: {}"
-                              .format(username, projectname, sub_dir_name, exception))
+                log.exception("Createrepo for copr {} failed with error: {}"
+                              .format(label, exception))
+                error = True
+
+        if error:
+            # to be pruned again in the next run
+            return None
+        return chroot_path, os.path.getmtime(chroot_path), self.get_next_due(chroot_path)
+
+    def prune_project(self, project_path, username, projectname):
+        log.info("Going to prune {}/{}".format(username, projectname))
+        if not self.is_acr_enabled(username, projectname):
+            log.debug("Skipped {}/{} since auto createrepo option is disabled"
+                      .format(username, projectname))
+            return
+
+        for sub_dir_name, chroot_path in zip(*list_subdir(project_path)):
+            self.prune_chroot(chroot_path, "{}/{}:{}".format(username, projectname, sub_dir_name))
 
         log.info("Prune finished for copr {}/{}".format(username, projectname))
 
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+Replay recorded submission trace of one builders group through the VM
+autoscaling policy and report task wait times and VM usage.
+
+Trace has the same format as for ``copr_simulate_scheduler.py``,
+one json object per line:
+
+    {"task_id": "12-fedora-23-x86_64", "project_owner": "bob",
+     "project_name": "foo", "submitted_on": 1445000000.0, "duration": 620}
+
+Simulation runs in steps of ``vm_cycle_timeout`` seconds, the policy is asked
+once per step like in VmMaster. Spawned VM becomes ready after ``vm_spawn_time``,
+one VM runs one build at a time and tasks are served in FIFO order. Like in the
+real task queue, a free worker (``max_workers`` of the group) acquires the task
+first and only then waits for a VM.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import deque
+import optparse
+import os
+import sys
+
+from munch import Munch
+
+sys.path.append("/usr/share/copr/")
+
+from backend.helpers import BackendConfigReader
+from backend.vm_manage.autoscale import AutoscalePolicy
+
+from copr_simulate_scheduler import load_trace, percentile
+
+
+def simulate(policy, trace, cycle, spawn_time, initial_vms=0, max_workers=None):
+    """
+    :param AutoscalePolicy policy: fresh policy
+    :param list trace: tasks sorted by ``submitted_on``
+    :param float cycle: seconds between policy decisions
+    :param float spawn_time: seconds from spawn start to the ready VM
+    :param int initial_vms: number of ready VMs at the start
+    :param int max_workers: number of workers, ``max_vm_total`` of the policy by default
+    :return: Munch with ``waits`` (list of wait times in seconds),
+        ``vm_hours`` and ``peak_vms``
+    """
+    if max_workers is None:
+        max_workers = policy.max_vm_total
+
+    waits = []
+    pending = deque()
+    acquired = deque()  # tasks of workers waiting for a VM
+    spawning = []  # ready_at timestamps
+    ready = initial_vms
+    running = []  # finished_on timestamps
+    enqueued = finished = 0
+    vm_seconds = 0
+    peak_vms = ready
+
+    now = trace[0]["submitted_on"] if trace else 0
+    idx = 0
+    while idx < len(trace) or pending or acquired or running:
+        while idx < len(trace) and trace[idx]["submitted_on"] <= now:
+            pending.append(trace[idx])
+            enqueued += 1
+            idx += 1
+
+        done = [end for end in running if end <= now]
+        running = [end for end in running if end > now]
+        ready += len(done)
+        finished += len(done)
+
+        spawned = [ready_at for ready_at in spawning if ready_at <= now]
+        spawning = [ready_at for ready_at in spawning if ready_at > now]
+        ready += len(spawned)
+
+        while pending and len(acquired) + len(running) < max_workers:
+            acquired.append(pending.popleft())
+
+        while acquired and ready:
+            task = acquired.popleft()
+            waits.append(now - task["submitted_on"])
+            running.append(now + task["duration"])
+            ready -= 1
+
+        decision = policy.decide(now, Munch(
+            pending=len(pending), backlog=0, processing=len(acquired) + len(running),
+            enqueued=enqueued, finished=finished, ready=ready, in_use=len(running),
+            starting=0, spawning=len(spawning)))
+        spawning.extend([now + spawn_time] * decision.spawn)
+        ready -= min(decision.terminate, ready)
+
+        vms = ready + len(running) + len(spawning)
+        peak_vms = max(peak_vms, vms)
+        vm_seconds += vms * cycle
+        now += cycle
+
+    return Munch(waits=waits, vm_hours=vm_seconds / 3600, peak_vms=peak_vms)
+
+
+def format_report(result):
+    """
+    :param Munch result: output of :py:func:`simulate`
+    :return str: human readable summary
+    """
+    lines = []
+    if result.waits:
+        values = sorted(result.waits)
+        lines.append("tasks: {}, wait p50: {:.0f}s, p90: {:.0f}s, p99: {:.0f}s, max: {:.0f}s".format(
+            len(values), percentile(values, 50), percentile(values, 90),
+            percentile(values, 99), values[-1]))
+    lines.append("VM hours: {:.1f}, peak VMs: {}".format(result.vm_hours, result.peak_vms))
+    return "\n".join(lines)
+
+
+def main():
+    parser = optparse.OptionParser("\ncopr_simulate_autoscale.py [options] trace_file")
+    parser.add_option("-g", "--group", dest="group_id", default=0, type="int",
+                      help="builders group, defines policy settings")
+    parser.add_option("--warm-pool", dest="warm_pool", default=None, type="int",
+                      help="overrides vm_warm_pool of the group")
+    parser.add_option("--spawn-time", dest="spawn_time", default=None, type="int",
+                      help="overrides vm_spawn_time of the group")
+    parser.add_option("--scale-down-delay", dest="scale_down_delay", default=None, type="int",
+                      help="overrides vm_scale_down_delay of the group")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("trace file is required")
+
+    config_file = os.environ.get("BACKEND_CONFIG", "/etc/copr/copr-be.conf")
+    opts = BackendConfigReader(config_file).read()
+    group = dict(opts.build_groups[options.group_id])
+    for name in ["warm_pool", "spawn_time", "scale_down_delay"]:
+        if getattr(options, name) is not None:
+            group["vm_" + name] = getattr(options, name)
+
+    result = simulate(AutoscalePolicy.from_group(group), load_trace(args[0]),
+                      opts.vm_cycle_timeout, group["vm_spawn_time"],
+                      max_workers=group["max_workers"])
+    print(format_report(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+Replay recorded submission trace through the build task scheduler
+and report wait time percentiles per project owner.
+
+Trace is a file with one json object per line:
+
+    {"task_id": "12-fedora-23-x86_64", "project_owner": "bob",
+     "project_name": "foo", "submitted_on": 1445000000.0, "duration": 620}
+
+``duration`` is the build time in seconds. Simulation is deterministic,
+workers are assigned immediately when free and no owner can run more
+than ``max_vm_per_user`` builds at the same time.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import defaultdict, Counter
+import heapq
+import json
+import optparse
+import os
+import sys
+
+sys.path.append("/usr/share/copr/")
+
+from backend.helpers import BackendConfigReader
+from backend.scheduler import get_scheduler
+
+
+def load_trace(path):
+    """
+    :return list: tasks sorted by submission time
+    """
+    with open(path) as handle:
+        tasks = [json.loads(line) for line in handle if line.strip()]
+    return sorted(tasks, key=lambda task: (task["submitted_on"], task["task_id"]))
+
+
+def simulate(scheduler, trace, workers, max_vm_per_user):
+    """
+    :param Scheduler scheduler: empty scheduler
+    :param list trace: tasks sorted by ``submitted_on``
+    :param int workers: number of builders
+    :param int max_vm_per_user: max number of running builds of one owner
+    :return dict: project_owner -> list of wait times in seconds
+    """
+    waits = defaultdict(list)
+    running = []  # heap of (finished_on, seq, project_owner)
+    owner_running = Counter()
+    seq = 0
+    idx = 0
+
+    def is_blocked(owner):
+        return owner_running[owner] >= max_vm_per_user
+
+    while idx < len(trace) or running or scheduler:
+        next_submit = trace[idx]["submitted_on"] if idx < len(trace) else None
+        next_finish = running[0][0] if running else None
+        if next_finish is None or (next_submit is not None and next_submit < next_finish):
+            now = next_submit
+        else:
+            now = next_finish
+
+        while running and running[0][0] <= now:
+            _, _, owner = heapq.heappop(running)
+            owner_running[owner] -= 1
+        while idx < len(trace) and trace[idx]["submitted_on"] <= now:
+            scheduler.add(trace[idx])
+            idx += 1
+
+        while len(running) < workers:
+            task = scheduler.pop(is_blocked)
+            if task is None:
+                break
+            waits[task["project_owner"]].append(now - task["submitted_on"])
+            owner_running[task["project_owner"]] += 1
+            seq += 1
+            heapq.heappush(running, (now + task["duration"], seq, task["project_owner"]))
+
+        if not running and idx >= len(trace) and scheduler:
+            # can't happen unless max_vm_per_user is zero
+            break
+
+    return waits
+
+
+def percentile(sorted_values, pct):
+    idx = int(round(pct / 100 * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+def format_report(waits):
+    """
+    :param dict waits: project_owner -> list of wait times
+    :return str: table with wait time percentiles per owner
+    """
+    lines = ["{:<24} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        "owner", "tasks", "p50", "p90", "p99", "max")]
+    for owner in sorted(waits):
+        values = sorted(waits[owner])
+        lines.append("{:<24} {:>7} {:>9.0f} {:>9.0f} {:>9.0f} {:>9.0f}".format(
+            owner, len(values), percentile(values, 50), percentile(values, 90),
+            percentile(values, 99), values[-1]))
+    return "\n".join(lines)
+
+
+def main():
+    parser = optparse.OptionParser("\ncopr_simulate_scheduler.py [options] trace_file")
+    parser.add_option("-s", "--scheduler", dest="scheduler", default=None,
+                      help="scheduler to use, overrides backend config")
+    parser.add_option("-g", "--group", dest="group_id", default=0, type="int",
+                      help="builders group, defines number of workers "
+                           "and max_vm_per_user")
+    parser.add_option("-w", "--workers", dest="workers", default=None, type="int",
+                      help="number of workers, overrides group config")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("trace file is required")
+
+    config_file = os.environ.get("BACKEND_CONFIG", "/etc/copr/copr-be.conf")
+    opts = BackendConfigReader(config_file).read()
+    if options.scheduler:
+        opts.scheduler = options.scheduler
+    group = opts.build_groups[options.group_id]
+
+    waits = simulate(get_scheduler(opts), load_trace(args[0]),
+                     options.workers or group["max_workers"], group["max_vm_per_user"])
+    print(format_report(waits))
+
+
+if __name__ == "__main__":
+    main()
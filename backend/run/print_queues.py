@@ -1,23 +1,26 @@
 #!/usr/bin/python
 # coding: utf-8
 
-NUM_QUEUES = 2
-
 import sys
 sys.path.append("/usr/share/copr/")
 
-from retask.task import Task
-from retask.queue import Queue
+import json
+
+from backend.constants import JOB_GRAB_SCHEDULE_HASH
+from backend.helpers import get_backend_opts
+from backend.task_queue import get_group_task_queue
 
-for i in range(0, NUM_QUEUES):
-    print("## Queue {}".format(i))
-    q = Queue("copr-be-{}".format(i))
-    q.connect()
-    save_q = []
-    while q.length != 0:
-    	task = q.dequeue()
-        print task.data
-        save_q.append(task)
-    for t in save_q:
-        q.enqueue(t)
+opts = get_backend_opts()
+for group in opts.build_groups:
+    print("## Queue {}".format(group["id"]))
+    q = get_group_task_queue(opts, group["id"])
+    for task_id in q.rc.lrange(q.key_pending, 0, -1):
+        print("pending: {}".format(q.rc.hget(q.key_tasks, task_id)))
+    for task_id, expire in q.rc.zrange(q.key_processing, 0, -1, withscores=True):
+        print("leased until {}: {}".format(expire, q.rc.hget(q.key_tasks, task_id)))
 
+print("## Waiting in job grabber")
+schedule = [(json.loads(info), task_id) for task_id, info
+            in q.rc.hgetall(JOB_GRAB_SCHEDULE_HASH).items()]
+for info, task_id in sorted(schedule, key=lambda x: (x[0]["position"], x[1])):
+    print("position {} (ETA {}s): {}".format(info["position"], info["eta"], task_id))
@@ -0,0 +1,137 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from munch import Munch
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+import pytest
+
+from backend.actions import ActionType
+from backend.daemons.job_grab import CoprJobGrab
+from backend.helpers import get_redis_connection
+
+
+"""
+REQUIRES RUNNING REDIS
+"""
+
+MODULE_REF = "backend.daemons.job_grab"
+
+# files in the deleted project
+CHROOTS_COUNT = 20
+BUILDS_COUNT = 500
+FILES_PER_BUILD = 10
+
+BATCH_SIZE = 50
+
+
+class TestActionRoutingLatency(object):
+    """
+    Routes batches of build tasks while a huge project is deleted by the action
+    executor, the latency should stay the same as without the delete
+    """
+
+    def setup_method(self, method):
+        self.tmp_dir_name = tempfile.mkdtemp()
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            destdir=self.tmp_dir_name,
+            frontend_base_url="http://example.com",
+            results_baseurl="http://example.com/results",
+            task_lease_timeout=600,
+            scheduler="fair",
+            scheduler_weights={},
+            scheduler_priorities={},
+            build_groups=[
+                {"id": 0, "name": "x86", "archs": ["i386", "x86_64"],
+                 "max_vm_per_user": 10 ** 6, "max_queued_tasks": 10 ** 6},
+            ],
+        )
+        self.rc = get_redis_connection(self.opts)
+
+        for chroot_idx in range(CHROOTS_COUNT):
+            for build_idx in range(BUILDS_COUNT):
+                build_path = os.path.join(self.tmp_dir_name, "foo", "huge", "chroot-{}".format(chroot_idx),
+                                          "{:08d}-pkg".format(build_idx))
+                os.makedirs(build_path)
+                for file_idx in range(FILES_PER_BUILD):
+                    open(os.path.join(build_path, "file-{}".format(file_idx)), "w").close()
+
+    def teardown_method(self, method):
+        keys = self.rc.keys("*")
+        if keys:
+            self.rc.delete(*keys)
+        shutil.rmtree(self.tmp_dir_name)
+
+    @pytest.yield_fixture
+    def jg(self):
+        log = logging.getLogger("backend.benchmark")
+        log.addHandler(logging.NullHandler())
+        log.propagate = False
+        with mock.patch("{}.get_redis_logger".format(MODULE_REF), return_value=log), \
+                mock.patch("backend.action_executor.get_redis_logger", return_value=log), \
+                mock.patch("backend.actions.get_redis_logger", return_value=log):
+            jg = CoprJobGrab(self.opts, MagicMock())
+            jg.connect_queues()
+            jg.action_executor.start()
+            yield jg
+
+    def route_batches(self, jg, count, offset):
+        """
+        :return list: seconds spent on routing of each batch
+        """
+        latencies = []
+        for batch_idx in range(count):
+            tasks = [{"task_id": "{}-fedora-23-x86_64".format(offset + batch_idx * BATCH_SIZE + idx),
+                      "chroot": "fedora-23-x86_64",
+                      "project_owner": "user_{}".format(idx)} for idx in range(BATCH_SIZE)]
+            start = time.time()
+            jg.sync_job_counters()
+            jg.route_build_tasks(tasks)
+            latencies.append(time.time() - start)
+        return latencies
+
+    def test_latency(self, jg):
+        project_path = os.path.join(self.tmp_dir_name, "foo", "huge")
+        idle = self.route_batches(jg, 50, 0)
+
+        start = time.time()
+        jg.process_action({"id": 1, "action_type": ActionType.DELETE, "object_type": "copr",
+                           "old_value": "foo/huge", "data": ""})
+        submit_took = time.time() - start
+
+        busy = []
+        offset = 10 ** 6
+        while os.path.exists(project_path):
+            busy.extend(self.route_batches(jg, 10, offset))
+            offset += 10 * BATCH_SIZE
+        delete_took = time.time() - start
+
+        idle_ms = sorted(idle)[len(idle) // 2] * 1000
+        busy_ms = sorted(busy)[len(busy) // 2] * 1000
+        print("\nsubmit of the delete action took {:.2f} ms, median routing latency of {} tasks: "
+              "idle {:.2f} ms, during {:.1f}s long delete of {} files {:.2f} ms ({} batches)"
+              .format(submit_took * 1000, BATCH_SIZE, idle_ms, delete_took,
+                      CHROOTS_COUNT * BUILDS_COUNT * FILES_PER_BUILD, busy_ms, len(busy)))
+        assert submit_took < 0.1
+        # routing continues during the delete, the delete only competes for CPU
+        assert max(busy) < delete_took / 10
+        assert busy_ms < idle_ms * 10
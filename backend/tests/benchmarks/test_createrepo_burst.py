@@ -0,0 +1,82 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import shutil
+import tempfile
+import threading
+import time
+
+from munch import Munch
+
+from backend.createrepo import CreaterepoCoalescer
+from backend.helpers import get_redis_connection
+
+
+"""
+REQUIRES RUNNING REDIS
+"""
+
+BUILDS_COUNT = 40
+# duration of one createrepo_c --update run
+CREATEREPO_TIME = 0.2
+
+
+class TestCreaterepoBurst(object):
+    """
+    Project finishes 40 builds of one chroot at once, compares the number of
+    createrepo runs and publish latency with and without coalescing
+    """
+
+    def setup_method(self, method):
+        self.opts = Munch(redis_db=9, redis_port=7777, createrepo_batch_delay=0.1)
+        self.rc = get_redis_connection(self.opts)
+        self.path = tempfile.mkdtemp()
+        self.repo_lock = threading.Lock()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.path)
+        keys = self.rc.keys("*")
+        if keys:
+            self.rc.delete(*keys)
+
+    def regenerate(self, changes=None):
+        # createrepo.lock serializes runs of one directory
+        with self.repo_lock:
+            time.sleep(CREATEREPO_TIME)
+
+    def run_burst(self, worker):
+        latencies = []
+        lock = threading.Lock()
+
+        def finish_build():
+            start = time.time()
+            worker()
+            with lock:
+                latencies.append(time.time() - start)
+
+        threads = [threading.Thread(target=finish_build) for _ in range(BUILDS_COUNT)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sorted(latencies)
+
+    def test_burst(self):
+        direct = self.run_burst(self.regenerate)
+
+        coalescer = CreaterepoCoalescer(self.opts)
+        coalesced = self.run_burst(
+            lambda: CreaterepoCoalescer(self.opts).request(self.path).wait(self.regenerate))
+        runs = coalescer.get_stats()["runs"]
+
+        print("\ndirect: {} runs, max publish latency {:.2f}s"
+              .format(BUILDS_COUNT, direct[-1]))
+        print("coalesced: {} runs, max publish latency {:.2f}s"
+              .format(runs, coalesced[-1]))
+
+        assert runs <= 3
+        assert coalesced[-1] < direct[-1] / 4
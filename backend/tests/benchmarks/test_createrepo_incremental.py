@@ -0,0 +1,92 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import pytest
+
+from backend.createrepo import createrepo_unsafe
+
+
+"""
+REQUIRES createrepo_c AND rpmbuild
+"""
+
+RPMS_COUNT = 20000
+
+SPEC = """
+Name: dummy
+Version: 1.0
+Release: 1
+Summary: dummy
+License: MIT
+BuildArch: noarch
+
+%description
+dummy
+
+%files
+"""
+
+pytestmark = pytest.mark.skipif(
+    not os.path.exists("/usr/bin/createrepo_c") or not os.path.exists("/usr/bin/rpmbuild"),
+    reason="createrepo_c and rpmbuild are required")
+
+
+class TestCreaterepoIncremental(object):
+    """
+    Adds one build to the synthetic repository with 20k packages,
+    compares full `createrepo_c --update` with the incremental update
+    """
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "fedora-23-x86_64")
+        os.makedirs(self.path)
+        self.rpm = self.build_rpm()
+
+        # builds share one rpm, createrepo_c reads the header of each file anyway
+        for idx in range(RPMS_COUNT):
+            self.add_build(idx)
+        createrepo_unsafe(self.path)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def build_rpm(self):
+        topdir = os.path.join(self.tmp_dir, "rpmbuild")
+        spec_path = os.path.join(self.tmp_dir, "dummy.spec")
+        with open(spec_path, "w") as handle:
+            handle.write(SPEC)
+        subprocess.check_call(["rpmbuild", "-bb", "--define", "_topdir {}".format(topdir),
+                               spec_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return os.path.join(topdir, "RPMS", "noarch", "dummy-1.0-1.noarch.rpm")
+
+    def add_build(self, idx):
+        build_dir = os.path.join(self.path, "{:08d}-dummy".format(idx))
+        os.makedirs(build_dir)
+        os.link(self.rpm, os.path.join(build_dir, "dummy-1.0-{}.noarch.rpm".format(idx)))
+        return build_dir
+
+    def test_incremental(self):
+        self.add_build(RPMS_COUNT)
+        start = time.time()
+        createrepo_unsafe(self.path)
+        full = time.time() - start
+
+        added = self.add_build(RPMS_COUNT + 1)
+        start = time.time()
+        createrepo_unsafe(self.path, added=[added])
+        incremental = time.time() - start
+
+        print("\n{} packages, full update: {:.2f}s, incremental: {:.2f}s"
+              .format(RPMS_COUNT, full, incremental))
+        assert incremental < full
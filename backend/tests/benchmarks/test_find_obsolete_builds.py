@@ -0,0 +1,89 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+from backend.prune import find_obsolete_builds
+
+
+CHROOTS_COUNT = 200
+BUILDS_PER_CHROOT = 50
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary">
+    <location href="repodata/abc-primary.xml.gz"/>
+  </data>
+</repomd>
+"""
+
+PACKAGE_TEMPLATE = """<package type="rpm">
+  <name>{name}</name>
+  <arch>noarch</arch>
+  <version epoch="0" ver="{version}" rel="1"/>
+  <location href="{build}/{name}-{version}-1.noarch.rpm"/>
+</package>"""
+
+
+class TestFindObsoleteBuilds(object):
+    """
+    Scans synthetic chroots with the history of builds of a few packages,
+    the repoquery script needed about a second per chroot
+    """
+
+    def setup_method(self, method):
+        self.tmp_dir_name = tempfile.mkdtemp()
+        self.chroots = []
+        for chroot_idx in range(CHROOTS_COUNT):
+            chroot_path = os.path.join(self.tmp_dir_name, "chroot-{}".format(chroot_idx))
+            os.makedirs(chroot_path)
+            packages = []
+            for build_idx in range(BUILDS_PER_CHROOT):
+                build = "{:08d}-pkg".format(build_idx)
+                for name in ["pkg{}".format(build_idx % 5), "pkg{}-devel".format(build_idx % 5)]:
+                    packages.append(dict(name=name, version="1.{}".format(build_idx), build=build))
+                self.write_build(os.path.join(chroot_path, build), packages[-2:])
+            self.write_repodata(chroot_path, packages)
+            self.chroots.append(chroot_path)
+
+    def write_build(self, build_path, packages):
+        os.makedirs(build_path)
+        for package in packages:
+            open(os.path.join(build_path, "{name}-{version}-1.noarch.rpm".format(**package)), "w").close()
+        success_path = os.path.join(build_path, "success")
+        open(success_path, "w").close()
+        mtime = time.time() - 30 * 24 * 3600
+        os.utime(success_path, (mtime, mtime))
+
+    def write_repodata(self, chroot_path, packages):
+        repodata = os.path.join(chroot_path, "repodata")
+        os.makedirs(repodata)
+        with open(os.path.join(repodata, "repomd.xml"), "w") as handle:
+            handle.write(REPOMD)
+        with gzip.open(os.path.join(repodata, "abc-primary.xml.gz"), "wb") as handle:
+            handle.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                         '<metadata xmlns="http://linux.duke.edu/metadata/common">\n')
+            handle.write("\n".join(PACKAGE_TEMPLATE.format(**package) for package in packages))
+            handle.write("\n</metadata>\n")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir_name)
+
+    def test_throughput(self):
+        start = time.time()
+        obsolete = 0
+        for chroot_path in self.chroots:
+            obsolete += len(find_obsolete_builds(chroot_path))
+        duration = time.time() - start
+
+        print("\n{} chroots scanned in {:.2f} s, {:.0f} chroots/min"
+              .format(CHROOTS_COUNT, duration, CHROOTS_COUNT / duration * 60))
+        assert obsolete == CHROOTS_COUNT * (BUILDS_PER_CHROOT - 5)
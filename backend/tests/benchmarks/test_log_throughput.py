@@ -0,0 +1,79 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import logging
+import shutil
+import tempfile
+import time
+
+from munch import Munch
+
+from backend.constants import LOG_QUEUE
+from backend.daemons.log import RedisLogHandler
+from backend.helpers import get_redis_connection, RedisPublishHandler
+
+
+RECORDS_COUNT = 20000
+
+
+class TestLogThroughput(object):
+    """
+    Sends debug records of a busy worker through redis to the log router,
+    compares one command per record with the batched sending
+    """
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.opts = Munch(redis_db=9, redis_port=7777, log_dir=self.tmp_dir + "/", log_level="debug")
+        self.rc = get_redis_connection(self.opts)
+        self.rc.delete(LOG_QUEUE)
+
+    def teardown_method(self, method):
+        self.rc.delete(LOG_QUEUE)
+        shutil.rmtree(self.tmp_dir)
+
+    def send(self, batch_size):
+        """
+        :return float: records per second
+        """
+        handler = RedisPublishHandler(self.rc, "worker", batch_size=batch_size, flush_interval=60)
+        log = logging.getLogger("benchmark.log_throughput.{}".format(batch_size))
+        log.propagate = False
+        log.setLevel(logging.DEBUG)
+        log.addHandler(handler)
+        try:
+            start = time.time()
+            for idx in range(RECORDS_COUNT):
+                log.debug("Processing record {} of the build".format(idx))
+            handler.flush()
+            return RECORDS_COUNT / (time.time() - start)
+        finally:
+            log.removeHandler(handler)
+            handler.close()
+
+    def route(self):
+        """
+        :return float: records per second
+        """
+        router = RedisLogHandler(self.opts)
+        router.setup_logging()
+        start = time.time()
+        processed = 0
+        while processed < RECORDS_COUNT:
+            processed += router.process_queue(self.rc)
+        return processed / (time.time() - start)
+
+    def test_throughput(self):
+        unbatched = self.send(1)
+        self.rc.delete(LOG_QUEUE)
+        batched = self.send(100)
+        routed = self.route()
+
+        print("\n{} records, sent one by one: {:.0f} msg/s, in batches: {:.0f} msg/s, "
+              "routed: {:.0f} msg/s".format(RECORDS_COUNT, unbatched, batched, routed))
+        assert batched > unbatched * 2
+        assert self.rc.llen(LOG_QUEUE) == 0
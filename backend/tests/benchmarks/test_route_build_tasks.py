@@ -0,0 +1,115 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import logging
+import time
+
+from munch import Munch
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+import pytest
+
+from backend.daemons.job_grab import CoprJobGrab
+from backend.helpers import get_redis_connection
+
+
+"""
+REQUIRES RUNNING REDIS
+"""
+
+MODULE_REF = "backend.daemons.job_grab"
+
+TASKS_COUNT = 50000
+OWNERS_COUNT = 2000
+# tasks are routed in chunks of the /backend/waiting/ size
+BATCH_SIZE = 200
+
+
+class TestRouteBuildTasks(object):
+    """
+    Routes 50k synthetic tasks from many owners into two builders groups
+    """
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            task_lease_timeout=600,
+            scheduler="fair",
+            scheduler_weights={},
+            scheduler_priorities={},
+            build_groups=[
+                {"id": 0, "name": "x86",
+                 "archs": ["i386", "x86_64"],
+                 "max_vm_per_user": 20, "max_queued_tasks": TASKS_COUNT},
+                {"id": 1, "name": "arm", "archs": ["armv7"],
+                 "max_vm_per_user": 5, "max_queued_tasks": TASKS_COUNT},
+            ],
+        )
+        self.rc = get_redis_connection(self.opts)
+        # each owner submits 25 tasks, 7 of them for arm
+        self.tasks = []
+        for idx in range(TASKS_COUNT):
+            arch = "armv7" if (idx // OWNERS_COUNT) % 4 == 0 else "x86_64"
+            self.tasks.append({
+                "task_id": "{}-fedora-23-{}".format(idx, arch),
+                "chroot": "fedora-23-{}".format(arch),
+                "project_owner": "user_{}".format(idx % OWNERS_COUNT),
+            })
+
+    def teardown_method(self, method):
+        keys = self.rc.keys("*")
+        if keys:
+            self.rc.delete(*keys)
+
+    @pytest.yield_fixture
+    def jg(self):
+        with mock.patch("{}.get_redis_logger".format(MODULE_REF)) as mc_logger:
+            log = logging.getLogger("backend.benchmark")
+            log.addHandler(logging.NullHandler())
+            log.propagate = False
+            mc_logger.return_value = log
+            jg = CoprJobGrab(self.opts, MagicMock())
+        jg.connect_queues()
+        yield jg
+
+    def test_route_50k_tasks(self, jg):
+        start = time.time()
+        count = 0
+        for offset in range(0, TASKS_COUNT, BATCH_SIZE):
+            jg.sync_job_counters()
+            count += jg.route_build_tasks(self.tasks[offset:offset + BATCH_SIZE])
+        took = time.time() - start
+
+        # the same tasks again, all of them are rejected by counters or queue
+        start = time.time()
+        jg.sync_job_counters()
+        assert jg.route_build_tasks(self.tasks) == 0
+        took_again = time.time() - start
+
+        print("\nrouted {} of {} tasks in {:.3f}s ({:.1f} us per task, {:.1f} ms per batch of {}), "
+              "second pass over already queued tasks {:.3f}s"
+              .format(count, TASKS_COUNT, took, took / TASKS_COUNT * 10**6,
+                      took / (TASKS_COUNT / BATCH_SIZE) * 1000, BATCH_SIZE, took_again))
+
+        # all 18 x86 tasks fit into the limit, only 5 of 7 arm tasks are queued,
+        # the rest waits in the scheduler
+        assert count == OWNERS_COUNT * (18 + 5)
+        assert jg.group_jobs_count[0] == OWNERS_COUNT * 18
+        assert jg.group_jobs_count[1] == OWNERS_COUNT * 5
+        assert len(jg.schedulers[1]) == OWNERS_COUNT * 2
+        owners = ["user_{}".format(idx) for idx in range(OWNERS_COUNT)]
+        assert jg.task_queues_by_group["x86"].get_counts(owners) == \
+            (dict(jg.owner_jobs_count[0]), OWNERS_COUNT * 18)
+        assert took < 15
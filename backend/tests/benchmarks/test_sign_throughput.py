@@ -0,0 +1,84 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from munch import Munch
+import pytest
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from backend.exceptions import CoprSignError
+from backend.sign import sign_rpms_in_dir, clear_pubkey_cache
+
+
+RPMS_COUNT = 60
+# time spent by the signer with one package
+SIGN_TIME = 0.05
+
+# mimics /bin/sign: prints the key for -p, fails for packages named bad-*
+STUB_SIGNER = """#!/bin/sh
+case "$*" in
+    *-p) echo "-----BEGIN PGP PUBLIC KEY BLOCK-----"; exit 0;;
+    */bad-*) sleep {delay}; echo "signing failed" >&2; exit 1;;
+    *) sleep {delay}; exit 0;;
+esac
+"""
+
+
+class TestSignThroughput(object):
+    """
+    Signs build with 60 subpackages by the stub signer, compares
+    one-by-one signing with the parallel one
+    """
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.signer = os.path.join(self.tmp_dir, "sign")
+        with open(self.signer, "w") as handle:
+            handle.write(STUB_SIGNER.format(delay=SIGN_TIME))
+        os.chmod(self.signer, stat.S_IRWXU)
+
+        self.pkg_dir = os.path.join(self.tmp_dir, "00000001-foo")
+        os.makedirs(self.pkg_dir)
+        for idx in range(RPMS_COUNT):
+            open(os.path.join(self.pkg_dir, "foo-sub{}-1.0-1.x86_64.rpm".format(idx)), "w").close()
+        clear_pubkey_cache()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def sign(self, workers):
+        opts = Munch(keygen_host="example.com", sign_workers=workers)
+        with mock.patch("backend.sign.SIGN_COMMAND", [self.signer]):
+            start = time.time()
+            sign_rpms_in_dir("foo", "bar", self.pkg_dir, opts, log=MagicMock())
+            return time.time() - start
+
+    def test_throughput(self):
+        serial = self.sign(1)
+        parallel = self.sign(8)
+        print("\n{} packages, 1 worker: {:.2f}s, 8 workers: {:.2f}s"
+              .format(RPMS_COUNT, serial, parallel))
+        assert parallel < serial / 3
+
+    def test_failed_reported(self):
+        open(os.path.join(self.pkg_dir, "bad-1.0-1.x86_64.rpm"), "w").close()
+        with pytest.raises(CoprSignError) as err:
+            self.sign(8)
+        assert "bad-1.0-1.x86_64.rpm: Failed to sign" in str(err.value)
+        assert "foo-sub1-" not in str(err.value)
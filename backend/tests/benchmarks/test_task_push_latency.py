@@ -0,0 +1,106 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+import json
+import time
+
+from munch import Munch
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+import pytest
+
+from backend.constants import JOB_GRAB_TASK_PUSH_LIST
+from backend.daemons.job_grab import CoprJobGrab
+from backend.helpers import get_redis_connection
+
+
+MODULE_REF = "backend.daemons.job_grab"
+
+BURST_SIZE = 10000
+
+
+def percentile(sorted_values, pct):
+    idx = int(round(pct / 100 * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+class TestTaskPushLatency(object):
+    """
+    Measures enqueue-to-dequeue latency of build tasks pushed by frontend
+    when a burst of chroots is submitted at once.
+    """
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            sleeptime=1,
+            tasks_reconcile_period=300,
+            scheduler="fair",
+            scheduler_weights={},
+            scheduler_priorities={},
+            build_groups=[
+                {"id": 0, "name": "x86",
+                 "archs": ["i386", "i686", "x86_64"],
+                 "max_vm_per_user": 5},
+            ],
+        )
+        self.rc = get_redis_connection(self.opts)
+        self.rc.delete(JOB_GRAB_TASK_PUSH_LIST)
+
+    def teardown_method(self, method):
+        self.rc.delete(JOB_GRAB_TASK_PUSH_LIST)
+
+    @pytest.yield_fixture
+    def jg(self):
+        with mock.patch("{}.get_redis_logger".format(MODULE_REF)):
+            jg = CoprJobGrab(self.opts, MagicMock())
+        jg.rc = self.rc
+        yield jg
+
+    def test_burst_latency(self, jg):
+        latencies = []
+
+        def route_build_tasks(tasks):
+            now = time.time()
+            latencies.extend(now - task["submitted_on"] for task in tasks)
+            return len(tasks)
+
+        jg.route_build_tasks = route_build_tasks
+        jg.sync_job_counters = MagicMock()
+
+        start = time.time()
+        pipe = self.rc.pipeline(transaction=False)
+        for idx in range(BURST_SIZE):
+            task = {
+                "task_id": "{}-fedora-22-x86_64".format(idx),
+                "chroot": "fedora-22-x86_64",
+                "project_owner": "user_{}".format(idx % 50),
+                "submitted_on": time.time(),
+            }
+            pipe.lpush(JOB_GRAB_TASK_PUSH_LIST, json.dumps({"type": "build", "task": task}))
+        pipe.execute()
+
+        while len(latencies) < BURST_SIZE:
+            jg.consume_pushed_tasks()
+        total = time.time() - start
+
+        latencies.sort()
+        print("\n{} tasks in {:.3f}s, latency p50={:.4f}s p90={:.4f}s p99={:.4f}s max={:.4f}s"
+              .format(BURST_SIZE, total,
+                      percentile(latencies, 50), percentile(latencies, 90),
+                      percentile(latencies, 99), latencies[-1]))
+
+        # the whole burst must be delivered well within one polling period
+        assert latencies[-1] < 30
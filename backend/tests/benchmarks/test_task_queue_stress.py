@@ -0,0 +1,122 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import Counter
+import random
+import threading
+import time
+
+from munch import Munch
+
+from backend.helpers import get_redis_connection
+from backend.task_queue import get_group_task_queue
+
+
+"""
+REQUIRES RUNNING REDIS
+"""
+
+WORKERS_COUNT = 300
+TASKS_COUNT = 3000
+# probability that a worker dies while holding a task
+DEATH_RATE = 0.05
+LEASE_TIMEOUT = 0.5
+
+
+class TestTaskQueueStress(object):
+    """
+    Hundreds of simulated workers compete for tasks, some of them die
+    with the task leased. Every task must be finished exactly once and
+    no task could be held by two live workers at the same time.
+    """
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            task_lease_timeout=LEASE_TIMEOUT,
+        )
+        self.rc = get_redis_connection(self.opts)
+
+        self.lock = threading.Lock()
+        self.held_by = {}  # task_id -> worker_id
+        self.double_scheduled = []
+        # task_id -> time when the dead holder started to acquire it
+        self.abandoned_lease_start = {}
+        self.early_reacquired = []
+        self.acked = Counter()
+        self.deaths = 0
+
+    def teardown_method(self, method):
+        keys = self.rc.keys("*")
+        if keys:
+            self.rc.delete(*keys)
+
+    def worker(self, worker_id, deadline):
+        rnd = random.Random(worker_id)
+        queue = get_group_task_queue(self.opts, 0)
+        while time.time() < deadline:
+            acquire_start = time.time()
+            lease = queue.acquire()
+            acquired_on = time.time()
+            if lease is None:
+                if not self.rc.exists(queue.key_tasks):
+                    return
+                time.sleep(0.01)
+                continue
+
+            with self.lock:
+                if self.held_by.get(lease.task_id) is not None:
+                    self.double_scheduled.append(lease.task_id)
+                # lease of the dead worker must expire first
+                lease_start = self.abandoned_lease_start.pop(lease.task_id, None)
+                if lease_start and acquired_on < lease_start + LEASE_TIMEOUT:
+                    self.early_reacquired.append(lease.task_id)
+                self.held_by[lease.task_id] = worker_id
+
+            time.sleep(rnd.uniform(0, 0.005))
+
+            if rnd.random() < DEATH_RATE:
+                # worker died, lease expires and task goes to another worker
+                with self.lock:
+                    self.held_by[lease.task_id] = None
+                    self.abandoned_lease_start[lease.task_id] = acquire_start
+                    self.deaths += 1
+                continue
+
+            with self.lock:
+                self.held_by[lease.task_id] = None
+            if queue.ack(lease.task_id, lease.token):
+                with self.lock:
+                    self.acked[lease.task_id] += 1
+
+    def test_stress(self):
+        queue = get_group_task_queue(self.opts, 0, rc=self.rc)
+        for idx in range(TASKS_COUNT):
+            queue.enqueue({"task_id": "{}-fedora-23-x86_64".format(idx),
+                           "project_owner": "user_{}".format(idx % 37)})
+
+        start = time.time()
+        deadline = start + 60
+        threads = [threading.Thread(target=self.worker, args=(worker_id, deadline))
+                   for worker_id in range(WORKERS_COUNT)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        took = time.time() - start
+
+        print("\n{} tasks by {} workers in {:.2f}s, {} leases abandoned by dying workers"
+              .format(TASKS_COUNT, WORKERS_COUNT, took, self.deaths))
+
+        assert self.double_scheduled == []
+        assert self.early_reacquired == []
+        assert len(self.acked) == TASKS_COUNT
+        assert set(self.acked.values()) == {1}
+        assert queue.length == 0
+        assert queue.processing_count == 0
+        assert self.rc.hgetall(queue.key_owners) == {}
@@ -6,8 +6,7 @@ import time
 from munch import Munch
 
 import pytest
-import retask
-from retask import ConnectionError
+from redis.exceptions import ConnectionError
 import six
 import sys
 
@@ -32,7 +31,7 @@ MODULE_REF = "backend.daemons.backend"
 
 @pytest.yield_fixture
 def mc_rt_queue():
-    with mock.patch("{}.Queue".format(MODULE_REF)) as mc_queue:
+    with mock.patch("{}.get_group_task_queue".format(MODULE_REF)) as mc_queue:
         yield mc_queue
 
 @pytest.yield_fixture
@@ -138,39 +137,33 @@ class TestBackend(object):
         assert self.bc_obj.read.called
 
     def test_clean_task_queue_error(self, init_be):
-        mc_queue = MagicMock(length=1)
-        mc_queue.dequeue.side_effect = retask.ConnectionError()
+        mc_queue = MagicMock()
+        mc_queue.clean.side_effect = ConnectionError()
         self.be.task_queues[0] = mc_queue
 
         with pytest.raises(CoprBackendError):
             self.be.clean_task_queues()
 
     def test_clean_task_queue_ok(self, init_be):
-        mc_queue = MagicMock(length=5)
-
-        def decr():
-            mc_queue.length -= 1
-
-        mc_queue.dequeue.side_effect = decr
+        mc_queue = MagicMock()
         self.be.task_queues[0] = mc_queue
         self.be.clean_task_queues()
 
-        assert len(mc_queue.dequeue.call_args_list) == 5
+        assert mc_queue.clean.called
 
     def test_init_task_queues(self, mc_rt_queue, init_be):
 
-        mc_rt_queue.side_effect = lambda name: MagicMock(name=name)
+        mc_rt_queue.side_effect = lambda opts, group_id: MagicMock(name=str(group_id))
         self.be.clean_task_queues = MagicMock()
         self.be.init_task_queues()
 
         assert mc_rt_queue.call_args_list == \
-               [mock.call("copr-be-0"), mock.call("copr-be-1")]
-        assert self.be.task_queues[0].connect.called
-        assert self.be.task_queues[1].connect.called
+               [mock.call(self.be.opts, 0), mock.call(self.be.opts, 1)]
+        assert set(self.be.task_queues.keys()) == {0, 1}
 
     def test_init_task_queues_error(self, mc_rt_queue, init_be):
 
-        mc_rt_queue.return_value.connect.side_effect = ConnectionError()
+        mc_rt_queue.side_effect = ConnectionError()
         self.be.clean_task_queues = MagicMock()
 
         with pytest.raises(CoprBackendError):
@@ -1,4 +1,5 @@
 import json
+import gzip
 import multiprocessing
 import os
 import pprint
@@ -13,8 +14,10 @@ import time
 
 import six
 
-from backend.constants import BuildStatus, JOB_GRAB_TASK_END_PUBSUB
-from backend.exceptions import CoprWorkerError, CoprSpawnFailError, MockRemoteError, NoVmAvailable, VmError
+from backend.constants import BuildStatus
+from backend.exceptions import CoprWorkerError, CoprSpawnFailError, MockRemoteError, NoVmAvailable, VmError, \
+    TaskLeaseLost
+from backend.vm_manage import PUBSUB_INTERRUPT_BUILDER
 from backend.job import BuildJob
 from backend.vm_manage.models import VmDescriptor
 
@@ -27,6 +30,7 @@ else:
 
 
 from backend.daemons.dispatcher import Worker
+from backend.build_log import SegmentedLogWriter
 
 STDOUT = "stdout"
 STDERR = "stderr"
@@ -145,6 +149,10 @@ class TestDispatcher(object):
             results_baseurl="/tmp",
 
             consecutive_failure_threshold=10,
+            task_lease_timeout=600,
+            vm_lease_timeout=120,
+            redis_db=9,
+            redis_port=7777,
         )
         self.job = BuildJob(self.task, self.opts)
 
@@ -321,6 +329,17 @@ class TestDispatcher(object):
         self.worker.copy_mock_logs(self.job)
         assert set(os.listdir(self.job.results_dir)) == set(["rsync.log.gz", "mockchain.log.gz"])
 
+    def test_copy_mock_logs_segmented(self, mc_mr_class, init_worker, reg_vm, mc_register_build_result):
+        os.makedirs(self.job.results_dir)
+        writer = SegmentedLogWriter(self.job.chroot_log_path, 10)
+        writer.write("build log\n" * 5)
+        writer.close()
+
+        self.worker.copy_mock_logs(self.job)
+        assert set(os.listdir(self.job.results_dir)) == set(["mockchain.log.gz"])
+        with gzip.open(os.path.join(self.job.results_dir, "mockchain.log.gz")) as handle:
+            assert handle.read() == "build log\n" * 5
+
     def test_copy_mock_logs_missing_files(self, mc_mr_class, init_worker, reg_vm, mc_register_build_result):
         os.makedirs(self.job.results_dir)
         self.worker.copy_mock_logs(self.job)
@@ -358,35 +377,27 @@ class TestDispatcher(object):
         self.worker.task_queue = mc_tq
         self.worker.starting_build = MagicMock()
 
-        mc_tq.dequeue.return_value = MagicMock(data=self.task)
+        lease = Munch(task_id=self.task["task_id"], data=self.task, token="foo")
+        mc_tq.acquire.return_value = lease
         obtained_job = self.worker.obtain_job()
         assert obtained_job.__dict__ == self.job.__dict__
+        assert self.worker.task_lease == lease
+        assert mc_tq.acquire.call_args == mock.call(timeout=self.worker.opts.sleeptime)
 
-    def test_obtain_job_dequeue_type_error(self, init_worker):
+    def test_obtain_job_acquire_none_result(self, init_worker):
         mc_tq = MagicMock()
         self.worker.task_queue = mc_tq
         self.worker.starting_build = MagicMock()
         self.worker.pkg_built_before = MagicMock()
         self.worker.pkg_built_before.return_value = False
 
-        mc_tq.dequeue.side_effect = TypeError()
+        mc_tq.acquire.return_value = None
         assert self.worker.obtain_job() is None
+        assert self.worker.task_lease is None
         assert not self.worker.starting_build.called
         assert not self.worker.pkg_built_before.called
 
-    def test_obtain_job_dequeue_none_result(self, init_worker):
-        mc_tq = MagicMock()
-        self.worker.task_queue = mc_tq
-        self.worker.starting_build = MagicMock()
-        self.worker.pkg_built_before = MagicMock()
-        self.worker.pkg_built_before.return_value = False
-
-        mc_tq.dequeue.return_value = None
-        assert self.worker.obtain_job() is None
-        assert not self.worker.starting_build.called
-        assert not self.worker.pkg_built_before.called
-
-    def test_dummy_run(self, init_worker, mc_time, mc_grc):
+    def test_dummy_run(self, init_worker, mc_time):
         self.worker.init_fedmsg = MagicMock()
         self.worker.run_cycle = MagicMock()
         self.worker.update_process_title = MagicMock()
@@ -399,8 +410,6 @@ class TestDispatcher(object):
 
         assert self.worker.init_fedmsg.called
         assert self.worker.vmm.post_init.called
-
-        assert mc_grc.called
         assert self.worker.run_cycle.called
 
     def test_group_name_error(self, init_worker):
@@ -425,36 +434,110 @@ class TestDispatcher(object):
         self.worker.update_process_title("foobar")
         assert mc_setproctitle.call_args[0][0] == title_with_name + "foobar"
 
-    def test_dummy_notify_job_grab_about_task_end(self, init_worker):
-        self.worker.rc = MagicMock()
-        self.worker.notify_job_grab_about_task_end(self.job)
-        expected = json.dumps({
-            "action": "remove",
-            "build_id": 12345,
-            "chroot": "fedora-20-x86_64",
-            "task_id": "12345-fedora-20-x86_64"
-        })
-        assert self.worker.rc.publish.call_args == mock.call(JOB_GRAB_TASK_END_PUBSUB, expected)
-
-        self.worker.notify_job_grab_about_task_end(self.job, True)
-        expected2 = json.dumps({
-            "action": "reschedule",
-            "build_id": 12345,
-            "chroot": "fedora-20-x86_64",
-            "task_id": "12345-fedora-20-x86_64"
-        })
-        assert self.worker.rc.publish.call_args == mock.call(JOB_GRAB_TASK_END_PUBSUB, expected2)
+    def test_release_task(self, init_worker):
+        self.worker.task_queue = MagicMock()
+        self.worker.release_task()
+        assert not self.worker.task_queue.ack.called
+
+        self.worker.task_lease = Munch(task_id="foo", token="bar")
+        self.worker.release_task()
+        assert self.worker.task_queue.ack.call_args == mock.call("foo", "bar")
+        assert not self.worker.task_queue.nack.called
+        assert self.worker.task_lease is None
+
+        self.worker.task_lease = Munch(task_id="foo", token="bar")
+        self.worker.task_queue.nack.return_value = False
+        self.worker.release_task(requeue=True)
+        assert self.worker.task_queue.nack.call_args == mock.call("foo", "bar")
+        assert self.worker.task_lease is None
+
+    def test_reschedule_task(self, init_worker):
+        self.worker.release_task = MagicMock()
+        self.frontend_client.reschedule_build.side_effect = IOError()
+
+        self.worker.reschedule_task(self.job)
+        assert self.frontend_client.reschedule_build.call_args == \
+            mock.call(self.job.build_id, self.job.chroot)
+        assert self.worker.release_task.call_args == mock.call(requeue=True)
+
+    def test_keep_task_lease(self, init_worker):
+        self.worker.task_queue = MagicMock(lease_timeout=0.03)
+        self.worker.task_lease = Munch(task_id="foo", token="bar")
+
+        with self.worker.keep_task_lease():
+            time.sleep(0.1)
+        renew_count = len(self.worker.task_queue.renew.call_args_list)
+        assert renew_count >= 2
+        assert self.worker.task_queue.renew.call_args == mock.call("foo", "bar")
+
+        time.sleep(0.05)
+        assert len(self.worker.task_queue.renew.call_args_list) == renew_count
+
+    def test_keep_task_lease_lost(self, init_worker):
+        self.worker.task_queue = MagicMock(lease_timeout=0.03)
+        self.worker.task_queue.renew.return_value = False
+        self.worker.task_lease = Munch(task_id="foo", token="bar")
+
+        self.worker.vm_ip = self.vm_ip
+
+        with self.worker.keep_task_lease():
+            time.sleep(0.1)
+        assert len(self.worker.task_queue.renew.call_args_list) == 1
+        # the build is stopped and its results are not reported
+        assert self.worker.task_lease_lost.is_set()
+        assert self.worker.vmm.rc.publish.call_args == mock.call(
+            PUBSUB_INTERRUPT_BUILDER.format(self.vm_ip), "task lease lost")
+        with pytest.raises(TaskLeaseLost):
+            self.worker.do_job(self.job)
+        assert not self.frontend_client.update.called
+
+    def test_keep_task_lease_redis_error(self, init_worker):
+        self.worker.task_queue = MagicMock(lease_timeout=0.03)
+        self.worker.task_queue.renew.side_effect = [IOError(), IOError(), True, True, True, True]
+        self.worker.task_lease = Munch(task_id="foo", token="bar")
+
+        with self.worker.keep_task_lease():
+            time.sleep(0.1)
+        assert len(self.worker.task_queue.renew.call_args_list) >= 3
+        assert not self.worker.task_lease_lost.is_set()
+        assert not self.worker.vmm.rc.publish.called
+
+    def test_keep_vm_lease(self, init_worker):
+        self.worker.opts.vm_lease_timeout = 0.03
+        self.worker.vmm.renew_vm_lease.side_effect = [True, False]
+
+        self.worker.vm_ip = self.vm_ip
+
+        with self.worker.keep_vm_lease("vm_foo"):
+            time.sleep(0.15)
+        assert self.worker.vmm.renew_vm_lease.call_args_list == \
+            [mock.call("vm_foo", os.getpid())] * 2
+        # the VM is going to be terminated, the interrupted build is rescheduled
+        assert self.worker.vmm.rc.publish.call_args == mock.call(
+            PUBSUB_INTERRUPT_BUILDER.format(self.vm_ip), "vm lease lost")
+        assert not self.worker.task_lease_lost.is_set()
+
+    def test_keep_vm_lease_redis_error(self, init_worker):
+        self.worker.opts.vm_lease_timeout = 0.03
+        self.worker.vm_ip = self.vm_ip
+        self.worker.vmm.renew_vm_lease.side_effect = [IOError(), True, True, True, True, True]
+
+        with self.worker.keep_vm_lease("vm_foo"):
+            time.sleep(0.1)
+        assert len(self.worker.vmm.renew_vm_lease.call_args_list) >= 2
+        assert not self.worker.vmm.rc.publish.called
 
     def test_run_cycle(self, init_worker, mc_time):
         self.worker.update_process_title = MagicMock()
         self.worker.obtain_job = MagicMock()
         self.worker.do_job = MagicMock()
-        self.worker.notify_job_grab_about_task_end = MagicMock()
+        self.worker.release_task = MagicMock()
+        self.worker.reschedule_task = MagicMock()
 
         self.worker.obtain_job.return_value = None
         self.worker.run_cycle()
         assert self.worker.obtain_job.called
-        assert mc_time.sleep.called
+        assert not mc_time.sleep.called
         assert not mc_time.time.called
 
         vmd = VmDescriptor(self.vm_ip, self.vm_name, 0, "ready")
@@ -471,9 +554,9 @@ class TestDispatcher(object):
 
         self.worker.run_cycle()
         assert not self.worker.do_job.called
-        assert self.worker.notify_job_grab_about_task_end.called_once
-        assert self.worker.notify_job_grab_about_task_end.call_args[1]["do_reschedule"]
-        self.worker.notify_job_grab_about_task_end.reset_mock()
+        assert self.worker.reschedule_task.call_args == mock.call(self.job)
+        assert not self.worker.release_task.called
+        self.worker.reschedule_task.reset_mock()
 
         ###  normal work
         def on_release_vm(*args, **kwargs):
@@ -483,8 +566,14 @@ class TestDispatcher(object):
         self.worker.vmm.release_vm.side_effect = on_release_vm
         self.worker.run_cycle()
         assert self.worker.do_job.called_once
-        assert self.worker.notify_job_grab_about_task_end.called_once
-        assert not self.worker.notify_job_grab_about_task_end.call_args[1].get("do_reschedule")
+        assert self.worker.release_task.call_args == mock.call()
+        assert not self.worker.reschedule_task.called
+        # waits for a ready VM instead of sleeping
+        pubsub = self.worker.vmm.subscribe_vm_ready.return_value
+        assert self.worker.vmm.subscribe_vm_ready.call_args == mock.call(self.worker.group_id)
+        assert self.worker.vmm.wait_vm_ready.call_args == mock.call(pubsub, self.worker.opts.sleeptime)
+        assert pubsub.close.called
+        assert not mc_time.sleep.called
 
         assert self.worker.vmm.release_vm.called
 
@@ -492,25 +581,45 @@ class TestDispatcher(object):
         self.worker.vmm.acquire_vm.return_value = vmd
 
         ### handle VmError
-        self.worker.notify_job_grab_about_task_end.reset_mock()
+        self.worker.reschedule_task.reset_mock()
         self.worker.vmm.release_vm.reset_mock()
         self.worker.do_job.side_effect = VmError("foobar")
         self.worker.run_cycle()
 
-        assert self.worker.notify_job_grab_about_task_end.call_args[1]["do_reschedule"]
+        assert self.worker.reschedule_task.call_args == mock.call(self.job)
         assert self.worker.vmm.release_vm.called
 
         ### handle other errors
-        self.worker.notify_job_grab_about_task_end.reset_mock()
+        self.worker.reschedule_task.reset_mock()
         self.worker.vmm.release_vm.reset_mock()
         self.worker.do_job.side_effect = IOError()
         self.worker.run_cycle()
 
-        assert self.worker.notify_job_grab_about_task_end.call_args[1]["do_reschedule"]
+        assert self.worker.reschedule_task.call_args == mock.call(self.job)
+        assert self.worker.vmm.release_vm.called
+
+    def test_run_cycle_task_lease_lost(self, init_worker):
+        self.worker.obtain_job = MagicMock(return_value=self.job)
+        self.worker.task_lease = Munch(task_id=self.job.task_id, token="foo")
+        self.worker.task_queue = MagicMock()
+        self.worker.vmm.acquire_vm.return_value = VmDescriptor(self.vm_ip, self.vm_name, 0, "ready")
+
+        def interrupted(job):
+            self.worker.task_lease_lost.set()
+            raise VmError("Build interrupted by msg: task lease lost")
+
+        self.worker.do_job = MagicMock(side_effect=interrupted)
+        self.worker.run_cycle()
+
+        # another worker builds the task now
+        assert not self.frontend_client.reschedule_build.called
+        assert not self.worker.task_queue.nack.called
+        assert not self.worker.task_queue.ack.called
+        assert self.worker.task_lease is None
         assert self.worker.vmm.release_vm.called
 
     def test_run_cycle_halt_on_can_start_job_false(self, init_worker):
-        self.worker.notify_job_grab_about_task_end = MagicMock()
+        self.worker.release_task = MagicMock()
         self.worker.obtain_job = MagicMock()
         self.worker.obtain_job.return_value = self.job
         self.worker.starting_build = MagicMock()
@@ -520,3 +629,16 @@ class TestDispatcher(object):
         self.worker.run_cycle()
         assert self.worker.starting_build.called
         assert not self.worker.acquire_vm_for_job.called
+        assert self.worker.release_task.call_args == mock.call()
+
+    def test_run_cycle_starting_build_error(self, init_worker):
+        self.worker.release_task = MagicMock()
+        self.worker.obtain_job = MagicMock()
+        self.worker.obtain_job.return_value = self.job
+        self.worker.starting_build = MagicMock()
+        self.worker.starting_build.side_effect = CoprWorkerError("foobar")
+        self.worker.acquire_vm_for_job = MagicMock()
+
+        self.worker.run_cycle()
+        assert not self.worker.acquire_vm_for_job.called
+        assert self.worker.release_task.call_args == mock.call(requeue=True)
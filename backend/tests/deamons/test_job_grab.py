@@ -15,7 +15,7 @@ import requests
 
 from backend.exceptions import CoprJobGrabError
 
-from retask.queue import Queue
+from backend.task_queue import TaskQueue
 
 import tempfile
 import shutil
@@ -32,8 +32,9 @@ else:
 
 import pytest
 
+from backend.constants import JOB_GRAB_TASK_PUSH_LIST, JOB_GRAB_SCHEDULE_HASH, JOB_GRAB_BACKLOG_HASH
 from backend.daemons.job_grab import CoprJobGrab
-import backend.actions
+from backend.helpers import get_redis_connection
 
 
 MODULE_REF = "backend.daemons.job_grab"
@@ -51,12 +52,15 @@ def mc_setproctitle():
 
 
 @pytest.yield_fixture
-def mc_retask_queue():
-    with mock.patch("{}.Queue".format(MODULE_REF)) as mc_queue:
+def mc_task_queue():
+    with mock.patch("{}.get_group_task_queue".format(MODULE_REF)) as mc_queue:
         def make_queue(*args, **kwargs):
-            updated_kwargs = copy.deepcopy(kwargs)
-            updated_kwargs["spec"] = Queue
-            mc = MagicMock(**updated_kwargs)
+            mc = MagicMock(spec=TaskQueue)
+            mc.get_counts.return_value = ({}, 0)
+            mc.pop_released_owners.return_value = set()
+            mc.contains_many.side_effect = lambda task_ids: [False] * len(task_ids)
+            mc.enqueue.return_value = True
+            mc.enqueue_many.side_effect = lambda tasks: [True] * len(tasks)
             return mc
 
         mc_queue.side_effect = make_queue
@@ -86,15 +90,21 @@ class TestJobGrab(object):
             build_groups=[
                 {"id": 0, "name": "x86",
                  "archs": ["i386", "i686", "x86_64"],
-                 "max_vm_per_user": 5},
+                 "max_vm_per_user": 5, "max_queued_tasks": 64},
                 {"id": 1, "name": "arm", "archs": ["armv7"],
-                 "max_vm_per_user": 5},
+                 "max_vm_per_user": 5, "max_queued_tasks": 64},
             ],
+            scheduler="fair",
+            scheduler_weights={},
+            scheduler_priorities={},
             destdir="/dev/null",
             frontend_base_url="http://example.com",
             frontend_auth="foobar",
             results_baseurl="http://example.com/results/",
             sleeptime=1,
+            tasks_reconcile_period=0,
+            redis_db=9,
+            redis_port=7777,
         )
 
         self.queue = MagicMock()
@@ -133,116 +143,215 @@ class TestJobGrab(object):
             yield mc_time
 
     @pytest.fixture
-    def init_jg(self, mc_retask_queue, mc_grc):
+    def init_jg(self, mc_task_queue, mc_grc):
         self.jg = CoprJobGrab(self.opts, self.frontend_client)
         self.jg.connect_queues()
         self.jg.vm_manager = MagicMock()
 
-    def test_connect_queues(self, mc_retask_queue, mc_grc):
+    def test_connect_queues(self, mc_task_queue, mc_grc):
         mc_rc = MagicMock()
         mc_grc.return_value = mc_rc
         self.jg = CoprJobGrab(self.opts, self.frontend_client)
 
         assert len(self.jg.task_queues_by_arch) == 0
         self.jg.connect_queues()
-        # created retask queue
-        expected = [call(u'copr-be-0'), call(u'copr-be-1')]
-        assert mc_retask_queue.call_args_list == expected
-        # connected to them
-        for obj in self.jg.task_queues_by_arch.values():
-            assert obj.connect.called
+        # one queue per group
+        expected = [call(self.opts, 0, rc=mc_rc), call(self.opts, 1, rc=mc_rc)]
+        assert mc_task_queue.call_args_list == expected
+        assert self.jg.task_queues_by_arch["i386"] is self.jg.task_queues_by_group["x86"]
+        assert self.jg.task_queues_by_arch["armv7"] is self.jg.task_queues_by_group["arm"]
 
         assert not mc_rc.pubsub.called
 
-    def test_listen_to_pubsub(self, mc_retask_queue, mc_grc):
-        mc_rc = MagicMock()
-        mc_grc.return_value = mc_rc
-        self.jg = CoprJobGrab(self.opts, self.frontend_client)
+    def test_route_build_tasks_skip_added(self, init_jg):
+        for queue in self.jg.task_queues_by_arch.values():
+            queue.enqueue_many.side_effect = lambda tasks: [False] * len(tasks)
 
-        assert not mc_rc.pubsub.called
-        self.jg.listen_to_pubsub()
+        assert self.jg.route_build_tasks([self.task_dict_1, self.task_dict_2]) == 0
 
-        assert mc_rc.pubsub.called
-        assert mc_rc.pubsub.return_value.subscribe.called
+        # slot was returned
+        assert self.jg.owner_jobs_count[0]["foobar"] == 0
+        assert self.jg.group_jobs_count[0] == 0
+        assert len(self.jg.schedulers[0]) == 0
 
-    def test_route_build_task_skip_added(self, init_jg):
-        for d in [self.task_dict_1, self.task_dict_2]:
-            self.jg.added_jobs_dict[d["task_id"]] = d
+    def test_route_build_tasks_skip_queued(self, init_jg):
+        queue = self.jg.task_queues_by_group["x86"]
+        queue.contains_many.side_effect = lambda task_ids: [True] * len(task_ids)
 
-        assert self.jg.route_build_task(self.task_dict_1) == 0
-        assert self.jg.route_build_task(self.task_dict_2) == 0
-        for obj in self.jg.task_queues_by_arch.values():
-            assert not obj.enqueue.called
+        assert self.jg.route_build_tasks([self.task_dict_1]) == 0
+        assert queue.contains_many.call_args == call([self.task_dict_1["task_id"]])
+        assert not queue.enqueue_many.called
+        assert len(self.jg.schedulers[0]) == 0
 
-    def test_route_build_task_skip_too_much_added(self, init_jg):
-        for i in range(10):
-            task = dict(self.task_dict_1)
-            task["task_id"] = 1000 + i
-            self.jg.added_jobs_dict[task["task_id"]] = task
+    def test_route_build_tasks_skip_too_much_added(self, init_jg):
+        self.jg.owner_jobs_count[0]["foobar"] = 5
 
-        assert self.jg.route_build_task(self.task_dict_1) == 0
+        assert self.jg.route_build_tasks([self.task_dict_1]) == 0
         for obj in self.jg.task_queues_by_arch.values():
-            assert not obj.enqueue.called
+            assert not obj.enqueue_many.called
+        # task waits in the scheduler
+        assert self.task_dict_1["task_id"] in self.jg.schedulers[0]
 
-    def test_route_build_task_missing_task_ud(self, init_jg):
-        assert self.jg.route_build_task({"task": "wrong_key"}) == 0
+    def test_route_build_tasks_skip_wrong_tasks(self, init_jg):
+        assert self.jg.route_build_tasks([{"task": "wrong_key"}, self.task_dict_bad_arch]) == 0
         for obj in self.jg.task_queues_by_arch.values():
-            assert not obj.enqueue.called
-
-    def test_route_build_task_correct_group_1(self, init_jg,):
-
-        assert self.jg.route_build_task(self.task_dict_1) == 1
-        assert self.jg.task_queues_by_arch["x86_64"].enqueue.called
-        assert not self.jg.task_queues_by_arch["armv7"].enqueue.called
-
-    def test_route_build_task_correct_group_2(self, init_jg, ):
-
-        assert self.jg.route_build_task(self.task_dict_2) == 1
-        assert not self.jg.task_queues_by_arch["x86_64"].enqueue.called
-        assert self.jg.task_queues_by_arch["armv7"].enqueue.called
-
-    def test_route_build_task_correct_group_error(self, init_jg):
-
-        with pytest.raises(CoprJobGrabError) as err:
-            self.jg.route_build_task(self.task_dict_bad_arch)
+            assert not obj.enqueue_many.called
+
+    def test_route_build_tasks_correct_group_1(self, init_jg,):
+
+        assert self.jg.route_build_tasks([self.task_dict_1]) == 1
+        assert self.jg.task_queues_by_arch["x86_64"].enqueue_many.called
+        assert not self.jg.task_queues_by_arch["armv7"].enqueue_many.called
+        assert self.jg.owner_jobs_count[0]["foobar"] == 1
+        assert self.jg.group_jobs_count[0] == 1
+        assert self.jg.owner_jobs_count[1]["foobar"] == 0
+
+    def test_route_build_tasks_correct_group_2(self, init_jg, ):
+
+        assert self.jg.route_build_tasks([self.task_dict_2]) == 1
+        assert not self.jg.task_queues_by_arch["x86_64"].enqueue_many.called
+        assert self.jg.task_queues_by_arch["armv7"].enqueue_many.called
+
+    def test_get_task_group_id(self, init_jg):
+        assert self.jg.get_task_group_id(self.task_dict_1) == 0
+        assert self.jg.get_task_group_id(self.task_dict_2) == 1
+        with pytest.raises(CoprJobGrabError):
+            self.jg.get_task_group_id(self.task_dict_bad_arch)
+
+    def test_sync_job_counters(self, init_jg):
+        queue = self.jg.task_queues_by_group["x86"]
+        queue.pop_released_owners.return_value = {"foo", "baz"}
+        queue.get_counts.return_value = ({"foo": 2}, 7)
+        self.jg.owner_jobs_count[0].update({"foo": 3, "bar": 4, "baz": 1})
+
+        self.jg.sync_job_counters()
+        assert queue.get_counts.call_args == call({"foo", "baz"})
+        assert self.jg.owner_jobs_count[0] == {"foo": 2, "bar": 4}
+        assert self.jg.group_jobs_count[0] == 7
+        assert self.jg.owner_jobs_count[1] == {}
+        assert self.jg.group_jobs_count[1] == 0
+
+    def test_sync_job_counters_full(self, init_jg):
+        queue = self.jg.task_queues_by_group["x86"]
+        queue.get_counts.return_value = ({"foo": 2, "baz": 1}, 3)
+        self.jg.owner_jobs_count[0].update({"foo": 3, "bar": 4})
+
+        self.jg.sync_job_counters(full=True)
+        assert queue.pop_released_owners.called
+        assert queue.get_counts.call_args == call()
+        assert self.jg.owner_jobs_count[0] == {"foo": 2, "baz": 1}
+        assert self.jg.group_jobs_count[0] == 3
+
+    def test_route_build_tasks(self, init_jg):
+        tasks = []
+        for i in range(8):
+            task = dict(self.task_dict_1)
+            task["task_id"] = 1000 + i
+            tasks.append(task)
+        tasks.append(self.task_dict_2)
+        tasks.append(self.task_dict_bad_arch)
+        tasks.append({"task": "wrong_key"})
+
+        queue_x86 = self.jg.task_queues_by_group["x86"]
+        queue_arm = self.jg.task_queues_by_group["arm"]
+        # the second task is already in the queue
+        queue_x86.enqueue_many.side_effect = lambda tasks: [True, False] + [True] * (len(tasks) - 2)
+
+        # 5 tasks fit into the limit, one of them was already queued
+        assert self.jg.route_build_tasks(tasks) == 5
+        assert queue_x86.enqueue_many.call_args == call(tasks[:5])
+        assert queue_arm.enqueue_many.call_args == call([self.task_dict_2])
+
+        assert self.jg.owner_jobs_count[0]["foobar"] == 4
+        assert self.jg.group_jobs_count[0] == 4
+        assert self.jg.owner_jobs_count[1]["foobar"] == 1
+        assert len(self.jg.schedulers[0]) == 3
+
+        # the same tasks are ignored, one more waiting task fits into the limit
+        queued_ids = set(task["task_id"] for task in tasks[:5] + [self.task_dict_2])
+        for queue in [queue_x86, queue_arm]:
+            queue.contains_many.side_effect = lambda task_ids: [i in queued_ids for i in task_ids]
+        queue_x86.enqueue_many.side_effect = lambda tasks: [True] * len(tasks)
+        assert self.jg.route_build_tasks(tasks) == 1
+        assert queue_x86.enqueue_many.call_args == call(tasks[5:6])
+        assert len(self.jg.schedulers[0]) == 2
+
+    def test_dispatch_tasks_fair(self, init_jg):
+        self.opts.build_groups[0]["max_queued_tasks"] = 4
+        self.jg.group_jobs_count[0] = 1
+        tasks = [dict(self.task_dict_1, task_id=idx) for idx in range(4)] + \
+            [dict(self.task_dict_1, task_id=idx, project_owner="bob") for idx in range(4, 6)]
+        for task in tasks:
+            self.jg.schedulers[0].add(task)
+
+        assert self.jg.dispatch_tasks() == 3
+        queue = self.jg.task_queues_by_group["x86"]
+        assert queue.enqueue_many.call_args == call([tasks[0], tasks[4], tasks[1]])
+        assert self.jg.group_jobs_count[0] == 4
+        assert len(self.jg.schedulers[0]) == 3
+
+        # no room in the queue
+        assert self.jg.dispatch_tasks() == 0
+        assert len(queue.enqueue_many.call_args_list) == 1
+
+    def test_publish_schedule(self, init_jg, push_rc, mc_time):
+        self.jg.rc = push_rc
+        for idx in range(3):
+            self.jg.schedulers[0].add(dict(self.task_dict_1, task_id=idx))
+        self.jg.schedulers[1].add(self.task_dict_2)
+        self.jg.dispatched_on[0].extend([self.test_time - 20, self.test_time - 10])
+
+        self.jg.publish_schedule()
+        schedule = dict((int(task_id), json.loads(value)) for task_id, value
+                        in push_rc.hgetall(JOB_GRAB_SCHEDULE_HASH).items())
+        assert schedule == {
+            0: {"position": 1, "eta": 10},
+            1: {"position": 2, "eta": 20},
+            2: {"position": 3, "eta": 30},
+            self.task_dict_2["task_id"]: {"position": 1, "eta": None},
+        }
+        assert push_rc.hgetall(JOB_GRAB_BACKLOG_HASH) == {"0": "3", "1": "1"}
+        assert push_rc.ttl(JOB_GRAB_BACKLOG_HASH) > 0
 
-        assert not self.jg.task_queues_by_arch["x86_64"].enqueue.called
-        assert not self.jg.task_queues_by_arch["armv7"].enqueue.called
+        for scheduler in self.jg.schedulers.values():
+            while scheduler.pop():
+                pass
+        self.jg.publish_schedule()
+        assert not push_rc.exists(JOB_GRAB_SCHEDULE_HASH)
+        assert not push_rc.exists(JOB_GRAB_BACKLOG_HASH)
 
-    @mock.patch("backend.daemons.job_grab.Action", spec=backend.actions.Action)
-    def test_process_action(self, mc_action, init_jg):
+    def test_process_action(self, init_jg):
         test_action = MagicMock()
+        self.jg.action_executor = MagicMock()
 
         self.jg.process_action(test_action)
 
-        expected_call = call(self.opts, test_action, frontend_client=self.jg.frontend_client)
-        assert expected_call == mc_action.call_args
-        assert mc_action.return_value.run.called
+        assert self.jg.action_executor.submit.call_args == call(test_action)
 
     @mock.patch("backend.daemons.job_grab.get")
     def test_load_tasks_error_request(self, mc_get, init_jg):
         mc_get.side_effect = requests.RequestException()
 
-        self.jg.route_build_task = MagicMock()
+        self.jg.route_build_tasks = MagicMock()
         self.jg.event = MagicMock()
         self.jg.process_action = MagicMock()
 
         assert self.jg.load_tasks() is None
 
-        assert not self.jg.route_build_task.called
+        assert not self.jg.route_build_tasks.called
         assert not self.jg.process_action.called
 
     @mock.patch("backend.daemons.job_grab.get")
     def test_load_tasks_error_request_json(self, mc_get, init_jg):
         mc_get.return_value.json.side_effect = ValueError()
 
-        self.jg.route_build_task = MagicMock()
+        self.jg.route_build_tasks = MagicMock()
         self.jg.event = MagicMock()
         self.jg.process_action = MagicMock()
 
         assert self.jg.load_tasks() is None
 
-        assert not self.jg.route_build_task.called
+        assert not self.jg.route_build_tasks.called
         assert not self.jg.process_action.called
 
     @mock.patch("backend.daemons.job_grab.get")
@@ -255,18 +364,16 @@ class TestJobGrab(object):
             ]
         }
 
-        self.jg.route_build_task = MagicMock()
-        self.jg.route_build_task.side_effect = [
-            1,
-            1,
-            CoprJobGrabError("foobar"),
-        ]
+        self.jg.route_build_tasks = MagicMock(return_value=2)
+        self.jg.sync_job_counters = MagicMock()
         self.jg.event = MagicMock()
         self.jg.process_action = MagicMock()
 
         self.jg.load_tasks()
 
-        assert len(self.jg.route_build_task.call_args_list) == 3
+        assert self.jg.sync_job_counters.call_args == call(full=True)
+        assert self.jg.route_build_tasks.call_args == \
+            call([self.task_dict_1, self.task_dict_2, self.task_dict_2])
         assert not self.jg.process_action.called
 
     @mock.patch("backend.daemons.job_grab.get")
@@ -281,7 +388,7 @@ class TestJobGrab(object):
             "builds": [],
         }
 
-        self.jg.route_build_task = MagicMock()
+        self.jg.route_build_tasks = MagicMock()
         self.jg.event = MagicMock()
         self.jg.process_action = MagicMock()
 
@@ -305,7 +412,7 @@ class TestJobGrab(object):
             "builds": [],
         }
 
-        self.jg.route_build_task = MagicMock()
+        self.jg.route_build_tasks = MagicMock()
         self.jg.event = MagicMock()
         self.jg.process_action = MagicMock()
 
@@ -317,69 +424,11 @@ class TestJobGrab(object):
         expected_calls = [call(action_1), call(action_2)]
         assert self.jg.process_action.call_args_list == expected_calls
 
-    # todo: replace with test for method on_pubsub_event
-    # def test_process_task_end_pubsub(self, init_jg, mc_grc):
-    #     self.jg.added_jobs = MagicMock()
-    #     self.jg.frontend_client = MagicMock()
-    #     mc_rc = MagicMock()
-    #     mc_grc.return_value = mc_rc
-    #     mc_ch = MagicMock()
-    #     mc_rc.pubsub.return_value = mc_ch
-    #     self.jg.channel = mc_ch
-    #     self.stage = 0
-    #
-    #     def on_get_message():
-    #         self.stage += 1
-    #
-    #         if self.stage == 1:
-    #             return {}
-    #         elif self.stage == 2:
-    #             assert not self.jg.added_jobs.remove.called
-    #             return {"type": "subscribe"}  # wrong type
-    #         elif self.stage == 3:
-    #             assert not self.jg.added_jobs.remove.called
-    #             return {"type": "message", "data": "{{{"}  # mall-formed json
-    #         elif self.stage == 4:
-    #             assert not self.jg.added_jobs.remove.called
-    #             return {"type": "message", "data": json.dumps({})}  # missing action
-    #         elif self.stage == 5:
-    #             assert not self.jg.added_jobs.remove.called
-    #             return {"type": "message", "data": json.dumps({"action": "foobar"})}  # unsupported action
-    #         elif self.stage == 6:
-    #             assert not self.jg.added_jobs.remove.called
-    #             msg = {"action": "remove"}
-    #             return {"type": "message", "data": json.dumps(msg)}  # missing "task_id"
-    #         elif self.stage == 7:
-    #             assert not self.jg.added_jobs.remove.called
-    #             msg = {"action": "remove", "task_id": "123-fedora"}
-    #             self.jg.added_jobs.__contains__.return_value = False
-    #             return {"type": "message", "data": json.dumps(msg)}  # task "id" not in self.added_jobs
-    #         elif self.stage == 8:
-    #             assert not self.jg.added_jobs.remove.called
-    #             # import ipdb; ipdb.set_trace()
-    #             self.jg.added_jobs.__contains__.return_value = True
-    #             msg = {"action": "remove", "task_id": "123-fedora"}         # should be removed from added job,
-    #             return {"type": "message", "data": json.dumps(msg)}  # reschedule build not called
-    #         elif self.stage == 9:
-    #             assert self.jg.added_jobs.remove.call_args == mock.call("123-fedora")
-    #             msg = {"action": "reschedule", "task_id": "123-fedora"}
-    #             return {"type": "message", "data": json.dumps(msg)}  # reschedule build not called
-    #         elif self.stage == 10:
-    #             assert self.jg.added_jobs.remove.call_args == mock.call("123-fedora")
-    #             msg = {"action": "reschedule", "task_id": "123-fedora", "build_id": 123, "chroot": "fedora"}
-    #             return {"type": "message", "data": json.dumps(msg)}  # reschedule called
-    #         else:
-    #             assert self.jg.added_jobs.remove.call_args == mock.call("123-fedora")
-    #             assert self.jg.frontend_client.reschedule_build.called
-    #
-    #         return None
-    #
-    #     mc_ch.get_message.side_effect = on_get_message
-    #     self.jg.process_task_end_pubsub()
-
     def test_run(self, mc_time, mc_setproctitle, init_jg, mc_grc):
         self.jg.connect_queues = MagicMock()
-        self.jg.process_task_end_pubsub = MagicMock()
+        self.jg.action_executor = MagicMock()
+        self.jg.consume_pushed_tasks = MagicMock()
+        self.jg.publish_schedule = MagicMock()
         self.jg.load_tasks = MagicMock()
         self.jg.load_tasks.side_effect = [
             None,
@@ -393,3 +442,114 @@ class TestJobGrab(object):
         assert mc_setproctitle.called
         assert self.jg.connect_queues.called_once
         assert self.jg.load_tasks.called
+        assert self.jg.consume_pushed_tasks.called
+        assert self.jg.publish_schedule.called
+
+    def test_run_reconcile_period(self, mc_time, mc_setproctitle, init_jg, mc_grc):
+        self.opts.tasks_reconcile_period = 300
+        self.jg.connect_queues = MagicMock()
+        self.jg.action_executor = MagicMock()
+        self.jg.load_tasks = MagicMock()
+        self.jg.publish_schedule = MagicMock()
+        self.jg.consume_pushed_tasks = MagicMock()
+        self.jg.consume_pushed_tasks.side_effect = [None, None, KeyboardInterrupt]
+
+        self.jg.run()
+        # mc_time doesn't move, so the full query is done only once
+        assert len(self.jg.load_tasks.call_args_list) == 1
+        assert len(self.jg.consume_pushed_tasks.call_args_list) == 3
+        assert len(self.jg.publish_schedule.call_args_list) == 1
+
+    @pytest.yield_fixture
+    def push_rc(self):
+        rc = get_redis_connection(self.opts)
+        rc.delete(JOB_GRAB_TASK_PUSH_LIST, JOB_GRAB_SCHEDULE_HASH, JOB_GRAB_BACKLOG_HASH)
+        yield rc
+        rc.delete(JOB_GRAB_TASK_PUSH_LIST, JOB_GRAB_SCHEDULE_HASH, JOB_GRAB_BACKLOG_HASH)
+
+    def test_fetch_pushed_messages(self, init_jg, push_rc):
+        self.jg.rc = push_rc
+        for idx in range(5):
+            push_rc.lpush(JOB_GRAB_TASK_PUSH_LIST, "msg_{}".format(idx))
+
+        assert self.jg.fetch_pushed_messages() == ["msg_{}".format(idx) for idx in range(5)]
+        assert push_rc.llen(JOB_GRAB_TASK_PUSH_LIST) == 0
+
+    def test_fetch_pushed_messages_batch_limit(self, init_jg, push_rc):
+        self.jg.rc = push_rc
+        with mock.patch("{}.PUSHED_BATCH_SIZE".format(MODULE_REF), 3):
+            for idx in range(6):
+                push_rc.lpush(JOB_GRAB_TASK_PUSH_LIST, "msg_{}".format(idx))
+
+            assert self.jg.fetch_pushed_messages() == ["msg_{}".format(idx) for idx in range(4)]
+            assert self.jg.fetch_pushed_messages() == ["msg_4", "msg_5"]
+
+    def test_fetch_pushed_messages_timeout(self, init_jg, push_rc):
+        self.jg.rc = push_rc
+        assert self.jg.fetch_pushed_messages() == []
+
+    def test_process_pushed_msg(self, init_jg):
+        self.jg.process_action = MagicMock()
+        build_tasks = []
+
+        self.jg.process_pushed_msg("{{{", build_tasks)
+        self.jg.process_pushed_msg(json.dumps({"type": "foo"}), build_tasks)
+        self.jg.process_pushed_msg(json.dumps({"type": "build"}), build_tasks)
+        assert build_tasks == []
+        assert not self.jg.process_action.called
+
+        msg = {"type": "build", "task": self.task_dict_1, "pushed_on": time.time()}
+        self.jg.process_pushed_msg(json.dumps(msg), build_tasks)
+        assert build_tasks == [self.task_dict_1]
+
+        action = {"id": 7, "action_type": 0}
+        self.jg.process_pushed_msg(json.dumps({"type": "action", "action": action}), build_tasks)
+        assert self.jg.process_action.call_args == call(action)
+        assert build_tasks == [self.task_dict_1]
+
+    def test_invalidate_projects(self, init_jg):
+        self.jg.project_cache = MagicMock()
+        self.jg.action_executor = MagicMock()
+
+        self.jg.process_pushed_msg(json.dumps({"type": "project", "owner": "@group", "project": "foo"}), [])
+        assert self.jg.project_cache.invalidate.call_args_list == [call("@group", "foo")]
+
+        self.jg.project_cache.reset_mock()
+        self.jg.process_action({"id": 1, "action_type": 1, "old_value": "bob/foo", "new_value": "bob/bar"})
+        self.jg.process_action({"id": 2, "action_type": 3, "old_value": "",
+                                "data": json.dumps({"username": "bob", "projectname": "baz"})})
+        # delete of a build doesn't change the project
+        self.jg.process_action({"id": 3, "action_type": 0, "object_type": "build", "old_value": "bob/foo"})
+        assert self.jg.project_cache.invalidate.call_args_list == [
+            call("bob", "foo"), call("bob", "bar"), call("bob", "baz")]
+
+    def test_consume_pushed_tasks(self, init_jg):
+        messages = [
+            json.dumps({"type": "build", "task": self.task_dict_1}),
+            json.dumps({"type": "action", "action": {"id": 7}}),
+            json.dumps({"type": "build", "task": self.task_dict_2}),
+        ]
+        self.jg.fetch_pushed_messages = MagicMock(return_value=messages)
+        self.jg.sync_job_counters = MagicMock()
+        self.jg.route_build_tasks = MagicMock(return_value=2)
+        self.jg.process_action = MagicMock(side_effect=IOError())
+
+        # errors are suppressed
+        self.jg.consume_pushed_tasks()
+        assert self.jg.process_action.called
+        assert self.jg.sync_job_counters.called
+        assert self.jg.route_build_tasks.call_args == call([self.task_dict_1, self.task_dict_2])
+
+    def test_consume_pushed_tasks_wo_builds(self, init_jg):
+        self.jg.fetch_pushed_messages = MagicMock(return_value=[])
+        self.jg.route_build_tasks = MagicMock(return_value=0)
+        self.jg.consume_pushed_tasks()
+        # waiting tasks are dispatched anyway
+        assert self.jg.route_build_tasks.call_args == call([])
+
+    def test_process_action_dedup(self, init_jg):
+        self.jg.action_executor = MagicMock()
+        self.jg.process_action({"id": 7})
+        self.jg.process_action({"id": 7})
+        self.jg.process_action({"id": 8})
+        assert len(self.jg.action_executor.submit.call_args_list) == 2
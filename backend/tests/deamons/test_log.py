@@ -20,7 +20,9 @@ else:
 import pytest
 
 import backend.daemons.log as log_module
+from backend.constants import LOG_QUEUE
 from backend.daemons.log import RedisLogHandler
+from backend.helpers import get_redis_connection, RedisPublishHandler
 
 
 @pytest.yield_fixture
@@ -35,6 +37,103 @@ def mc_setproctitle():
         yield mc_spt
 
 
+class TestRedisLogHandler(object):
+
+    def setup_method(self, method):
+        self.tmp_dir_path = tempfile.mkdtemp()
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            log_dir=os.path.join(self.tmp_dir_path, "copr/"),
+            log_level="info",
+        )
+        self.rc = get_redis_connection(self.opts)
+        self.rc.delete(LOG_QUEUE)
+
+        self.handler = RedisLogHandler(self.opts, batch_size=2)
+        self.handler.setup_logging()
+
+    def teardown_method(self, method):
+        self.rc.delete(LOG_QUEUE)
+        shutil.rmtree(self.tmp_dir_path)
+
+    def read_log(self, name):
+        path = os.path.join(self.tmp_dir_path, "copr", "{}.log".format(name))
+        if not os.path.exists(path):
+            return ""
+        with open(path) as handle:
+            return handle.read()
+
+    def publish(self, who, *records):
+        handler = RedisPublishHandler(self.rc, who, batch_size=100)
+        log = logging.getLogger("test_log.{}".format(who))
+        log.setLevel(logging.DEBUG)
+        log.addHandler(handler)
+        try:
+            for level, msg in records:
+                log.log(level, msg)
+        finally:
+            log.removeHandler(handler)
+            handler.close()
+
+    def test_route_by_component(self):
+        self.publish("worker", (logging.INFO, "worker msg"), (logging.DEBUG, "debug msg"))
+        self.publish("vmm", (logging.ERROR, "vmm msg"))
+
+        assert self.handler.process_queue(self.rc) == 2
+        assert self.rc.llen(LOG_QUEUE) == 1
+        assert self.handler.process_queue(self.rc) == 1
+        assert self.rc.llen(LOG_QUEUE) == 0
+
+        worker_log = self.read_log("worker")
+        assert "worker msg" in worker_log
+        assert "[  INFO][test_log.worker][test_log.py:publish:" in worker_log
+        # below log_level
+        assert "debug msg" not in worker_log
+        assert "vmm msg" in self.read_log("vmm")
+        assert self.read_log("backend") == ""
+
+    def test_traceback(self):
+        handler = RedisPublishHandler(self.rc, "backend")
+        log = logging.getLogger("test_log.traceback")
+        log.addHandler(handler)
+        try:
+            raise ValueError("foobar")
+        except ValueError:
+            log.exception("failed")
+        finally:
+            log.removeHandler(handler)
+            handler.close()
+
+        self.handler.process_queue(self.rc)
+        content = self.read_log("backend")
+        assert "failed" in content
+        assert "ValueError: foobar" in content
+
+    def test_bad_messages(self):
+        self.rc.rpush(LOG_QUEUE, "not a json", '{"who": "nobody", "msg": "foo"}', '{"msg": "foo"}')
+        self.publish("actions", (logging.INFO, "good one"))
+
+        self.handler.batch_size = 10
+        assert self.handler.process_queue(self.rc) == 4
+        assert "good one" in self.read_log("actions")
+        errors = self.read_log("logger")
+        assert "unknown `who`" in errors
+        assert "without `who`" in errors
+
+    def test_wait_for_records(self):
+        rc = MagicMock()
+        rc.lrange.return_value = []
+        rc.blpop.return_value = None
+        assert self.handler.process_queue(rc) == 0
+        assert rc.blpop.call_args == mock.call([LOG_QUEUE], timeout=log_module.QUEUE_WAIT_TIMEOUT)
+
+        rc.blpop.return_value = (LOG_QUEUE, '{"who": "worker", "msg": "worker msg"}')
+        assert self.handler.process_queue(rc) == 1
+        assert "worker msg" in self.read_log("worker")
+        assert not rc.ltrim.called
+
+
 class TestLog(object):
 
     def setup_method(self, method):
@@ -0,0 +1,159 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+from munch import Munch
+from requests import RequestException
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock, call
+else:
+    import mock
+    from mock import MagicMock, call
+
+import pytest
+
+from backend.daemons.update_aggregator import CoprUpdateAggregator
+from backend.frontend import FrontendClient, FrontendRejectedError
+
+
+MODULE_REF = "backend.daemons.update_aggregator"
+
+
+@pytest.yield_fixture
+def mc_time():
+    with mock.patch("{}.time".format(MODULE_REF)) as handle:
+        yield handle
+
+
+class TestUpdateAggregator(object):
+
+    @pytest.yield_fixture
+    def aggregator(self, tmpdir):
+        self.opts = Munch(
+            frontend_base_url="http://example.com/",
+            frontend_auth="12345678",
+            update_spool_dir=str(tmpdir.join("spool")),
+            update_batch_size=3,
+            update_max_backoff=10,
+        )
+        self.fc = FrontendClient(self.opts)
+        self.fc.post_update = MagicMock()
+        self.fc.post_reschedule = MagicMock()
+        with mock.patch("{}.get_redis_logger".format(MODULE_REF)):
+            yield CoprUpdateAggregator(self.opts, self.fc)
+
+    def test_merge(self):
+        updates = [
+            {"builds": [{"id": 1, "status": 3}]},
+            {"actions": [{"id": 7}]},
+            {"builds": [{"id": 1, "status": 1}, {"id": 2}]},
+        ]
+        assert CoprUpdateAggregator.merge(updates) == {
+            "builds": [{"id": 1, "status": 3}, {"id": 1, "status": 1}, {"id": 2}],
+            "actions": [{"id": 7}],
+        }
+        assert CoprUpdateAggregator.merge([{"builds": []}]) == {}
+
+    def test_flush(self, aggregator):
+        for idx in range(5):
+            self.fc.update({"builds": [{"id": idx}]})
+
+        assert aggregator.flush() == 3
+        assert self.fc.post_update.call_args == call({"builds": [{"id": 0}, {"id": 1}, {"id": 2}]})
+        assert aggregator.flush() == 2
+        assert self.fc.post_update.call_args == call({"builds": [{"id": 3}, {"id": 4}]})
+        assert aggregator.flush() == 0
+        assert len(self.fc.post_update.call_args_list) == 2
+
+    def test_flush_error_keeps_spool(self, aggregator):
+        self.fc.update({"builds": [{"id": 1}]})
+        self.fc.post_update.side_effect = RequestException()
+
+        with pytest.raises(RequestException):
+            aggregator.flush()
+        assert len(aggregator.spool) == 1
+
+    def test_flush_rejected(self, aggregator, tmpdir):
+        for idx in range(3):
+            self.fc.update({"builds": [{"id": idx}]})
+
+        def post_update(data):
+            if {"id": 1} in data["builds"]:
+                raise FrontendRejectedError()
+        self.fc.post_update.side_effect = post_update
+
+        assert aggregator.flush() == 3
+        assert self.fc.post_update.call_args_list == [
+            call({"builds": [{"id": 0}, {"id": 1}, {"id": 2}]}),
+            call({"builds": [{"id": 0}]}),
+            call({"builds": [{"id": 1}]}),
+            call({"builds": [{"id": 2}]}),
+        ]
+        assert len(aggregator.spool) == 0
+        assert len(tmpdir.join("spool", "rejected").listdir()) == 1
+
+    def test_flush_rejected_then_unavailable(self, aggregator):
+        for idx in range(3):
+            self.fc.update({"builds": [{"id": idx}]})
+        self.fc.post_update.side_effect = [FrontendRejectedError(), None, RequestException()]
+
+        with pytest.raises(RequestException):
+            aggregator.flush()
+        assert [data for _, data in aggregator.spool.take(10)] == \
+            [{"builds": [{"id": 1}]}, {"builds": [{"id": 2}]}]
+
+    def test_flush_reschedule_in_order(self, aggregator):
+        calls = []
+        self.fc.post_update.side_effect = lambda data: calls.append(("update", data))
+        self.fc.post_reschedule.side_effect = lambda data: calls.append(("reschedule", data))
+
+        self.fc.update({"builds": [{"id": 1, "status": 3}]})
+        self.fc.update({"builds": [{"id": 2, "status": 3}]})
+        self.fc.reschedule_build(1, "fedora-20-x86_64")
+        assert aggregator.flush() == 3
+        assert calls == [
+            ("update", {"builds": [{"id": 1, "status": 3}, {"id": 2, "status": 3}]}),
+            ("reschedule", {"build_id": 1, "chroot": "fedora-20-x86_64"}),
+        ]
+
+        del calls[:]
+        self.fc.reschedule_build(1, "fedora-20-x86_64")
+        self.fc.update({"builds": [{"id": 1, "status": 3}]})
+        assert aggregator.flush() == 2
+        assert [kind for kind, _ in calls] == ["reschedule", "update"]
+
+    def test_flush_drops_broken(self, aggregator, tmpdir):
+        tmpdir.join("spool", "0-broken.json").write("{{{")
+        assert aggregator.flush() == 0
+        assert len(aggregator.spool) == 0
+        assert not self.fc.post_update.called
+
+    def test_backoff(self, aggregator, mc_time):
+        self.fc.update({"builds": [{"id": 1}]})
+        self.fc.post_update.side_effect = RequestException()
+
+        for _ in range(6):
+            aggregator.run_cycle()
+        assert mc_time.sleep.call_args_list == [call(1), call(2), call(4), call(8), call(10), call(10)]
+
+        # frontend is back
+        self.fc.post_update.side_effect = None
+        aggregator.run_cycle()
+        assert aggregator.backoff == 0
+        assert len(aggregator.spool) == 0
+        assert len(mc_time.sleep.call_args_list) == 6
+
+        aggregator.run_cycle()
+        assert mc_time.sleep.call_args == call(0.5)
+
+    def test_run(self, aggregator, mc_time):
+        aggregator.run_cycle = MagicMock(side_effect=[None, IOError(), KeyboardInterrupt()])
+        with mock.patch("{}.setproctitle".format(MODULE_REF)):
+            aggregator.run()
+        assert len(aggregator.run_cycle.call_args_list) == 3
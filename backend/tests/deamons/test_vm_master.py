@@ -21,11 +21,11 @@ import shutil
 import os
 
 import six
+from backend.constants import JOB_GRAB_BACKLOG_HASH
 from backend.helpers import get_redis_connection
-from backend.vm_manage import VmStates
+from backend.vm_manage import VmStates, KEY_VM_LEASES
 from backend.vm_manage.manager import VmManager
 from backend.daemons.vm_master import VmMaster
-from backend.constants import JOB_GRAB_TASK_END_PUBSUB
 from backend.exceptions import VmError, VmSpawnLimitReached
 
 
@@ -51,11 +51,6 @@ def mc_time():
     with mock.patch("{}.time".format(MODULE_REF)) as handle:
         yield handle
 
-@pytest.yield_fixture
-def mc_psutil():
-    with mock.patch("{}.psutil".format(MODULE_REF)) as handle:
-        yield handle
-
 @pytest.yield_fixture
 def mc_setproctitle():
     with mock.patch("{}.setproctitle".format(MODULE_REF)) as handle:
@@ -93,6 +88,7 @@ class TestVmMaster(object):
                     "max_spawn_processes": 3,
                     "vm_spawn_min_interval": self.vm_spawn_min_interval,
                     "vm_dirty_terminating_timeout": 120,
+                    "vm_autoscale": False,
                     "vm_health_check_period": 10,
                     "vm_health_check_max_time": 60,
                     "vm_terminating_timeout": 300,
@@ -102,6 +98,7 @@ class TestVmMaster(object):
                     "archs": ["armV7"],
                     "vm_spawn_min_interval": self.vm_spawn_min_interval,
                     "vm_dirty_terminating_timeout": 120,
+                    "vm_autoscale": False,
                     "vm_health_check_period": 10,
                     "vm_health_check_max_time": 60,
                     "vm_terminating_timeout": 300,
@@ -111,6 +108,8 @@ class TestVmMaster(object):
             fedmsg_enabled=False,
             sleeptime=0.1,
             vm_cycle_timeout=10,
+            vm_lease_timeout=120,
+            task_lease_timeout=600,
 
 
         )
@@ -210,63 +209,49 @@ class TestVmMaster(object):
                                in self.vmm.start_vm_termination.call_args_list])
         assert set(["a1", "b1"]) == terminated_names
 
-    def disabled_test_remove_vm_with_dead_builder(self, mc_time, add_vmd, mc_psutil):
-        # todo: re-enable after psutil.Process.cmdline will be in use
-        mc_time.time.return_value = time.time()
-        self.vm_master.log = MagicMock()
-
-        self.vmm.start_vm_termination = MagicMock()
-        self.vmm.start_vm_termination.return_value = "OK"
-
-        for idx, vmd in enumerate([self.vmd_a1, self.vmd_a2,
-                                   self.vmd_b1, self.vmd_b2, self.vmd_b3]):
-            vmd.store_field(self.rc, "state", VmStates.IN_USE)
-            vmd.store_field(self.rc, "chroot", "fedora-20-x86_64")
-            vmd.store_field(self.rc, "task_id", "{}-fedora-20-x86_64".format(idx + 1))
-            vmd.store_field(self.rc, "build_id", idx + 1)
-            vmd.store_field(self.rc, "in_use_since", 0)
-
-        self.rc.hdel(self.vmd_b3.vm_key, "chroot")
-
-        for idx, vmd in enumerate([self.vmd_a1, self.vmd_a2, self.vmd_b2, self.vmd_b3]):
-            vmd.store_field(self.rc, "used_by_pid", idx + 1)
-
-        for vmd in [self.vmd_a3, self.vmd_a3]:
+    def test_remove_vm_with_dead_builder(self, mc_time, add_vmd):
+        for group in [0, 1]:
+            self.opts.build_groups[group]["max_vm_per_user"] = 2
+        for vmd in [self.vmd_a1, self.vmd_a2, self.vmd_b1]:
             vmd.store_field(self.rc, "state", VmStates.READY)
+            vmd.store_field(self.rc, "last_health_check", 1)
+
+        with mock.patch("backend.vm_manage.manager.time") as mc_time_vmm:
+            mc_time_vmm.time.return_value = 0
+            self.vmm.mark_server_start()
+            mc_time_vmm.time.return_value = 10
+            alive = self.vmm.acquire_vm(0, self.username, 1).vm_name
+            dead = self.vmm.acquire_vm(0, self.username, 2).vm_name
+            self.vmm.acquire_vm(1, self.username, 3)
+
+            mc_time_vmm.time.return_value = 10 + self.opts.vm_lease_timeout - 1
+            assert self.vmm.renew_vm_lease(alive, 1)
+            # only the builder which acquired the VM renews its lease
+            assert not self.vmm.renew_vm_lease("b1", 1)
+
+            self.vm_master.remove_vm_with_dead_builder()
+            assert self.vmm.get_vm_by_name(dead).state == VmStates.IN_USE
+
+            mc_time_vmm.time.return_value = 10 + self.opts.vm_lease_timeout + 1
+            self.vm_master.remove_vm_with_dead_builder()
+            # expired leases were removed
+            assert self.vmm.pop_expired_vm_leases() == []
+
+        states = dict((name, self.vmm.get_vm_by_name(name).state)
+                      for name in [alive, dead, "b1"])
+        assert states == {alive: VmStates.IN_USE, dead: VmStates.TERMINATING,
+                          "b1": VmStates.TERMINATING}
+
+    def test_restore_vm_leases(self, add_vmd):
+        self.vmd_a1.store_field(self.rc, "state", VmStates.IN_USE)
+        self.vmd_a2.store_field(self.rc, "state", VmStates.IN_USE)
+        self.rc.zadd(KEY_VM_LEASES, 1, "a2")
 
-        def mc_psutil_process(pid):
-            p = MagicMock()
-            mapping = {
-                "1": "a1",
-                "2": "a2",
-                "3": "b1",
-                "4": "None",
-                "5": "None",
-            }
-            p.cmdline = ["builder vm_name={} suffix".format(mapping.get(str(pid))),]
-            return p
-
-        def mc_psutil_pid_exists(pid):
-            if str(pid) in ["1", "4"]:
-                return True
-
-            return False
-
-        mc_psutil.Process.side_effect = mc_psutil_process
-        mc_psutil.pid_exists.side_effect = mc_psutil_pid_exists
-
-        self.ps = self.vmm.rc.pubsub(ignore_subscribe_messages=True)
-        self.ps.subscribe(JOB_GRAB_TASK_END_PUBSUB)
-        self.vm_master.remove_vm_with_dead_builder()
-
-        msg_list = self.rcv_from_ps_message_bus()
-        assert self.vmm.start_vm_termination.call_args_list == [
-            mock.call('a2', allowed_pre_state='in_use'),
-            mock.call('b2', allowed_pre_state='in_use'),
-            mock.call('b3', allowed_pre_state='in_use')
-        ]
-        # changed logic for the moment
-        # assert set(["2", "4"]) == set([json.loads(m["data"])["build_id"] for m in msg_list])
+        self.vmm.restore_vm_leases()
+        # existing lease is kept
+        assert self.rc.zscore(KEY_VM_LEASES, "a2") == 1
+        assert self.rc.zscore(KEY_VM_LEASES, "a1") > time.time()
+        assert self.rc.zcard(KEY_VM_LEASES) == 2
 
     def test_check_vms_health(self, mc_time, add_vmd):
         self.vm_master.start_vm_check = types.MethodType(MagicMock(), self.vmm)
@@ -417,6 +402,23 @@ class TestVmMaster(object):
         assert self.vm_master.check_vms_health.called
         assert self.vm_master.start_spawn_if_required.called
         assert self.vm_master.spawner.recycle.called
+        assert list(self.vm_master.cycle_timings.keys()) == [
+            "load_snapshot", "remove_old_dirty_vms", "check_vms_health",
+            "start_spawn_if_required", "remove_vm_with_dead_builder",
+            "finalize_long_health_checks", "terminate_again", "spawner_recycle"]
+        # snapshot lives only during the cycle
+        assert self.vm_master.snapshot is None
+
+    def test_do_cycle_uses_one_snapshot(self, add_vmd):
+        self.opts.build_groups[1]["max_vm_total"] = 5
+        self.opts.build_groups[1]["max_spawn_processes"] = 3
+        self.vmm.get_snapshot = MagicMock(wraps=self.vmm.get_snapshot)
+        self.vmm.get_all_vm_in_group = MagicMock()
+        self.vmm.get_vm_by_group_and_state_list = MagicMock()
+        self.vm_master.do_cycle()
+        assert self.vmm.get_snapshot.call_count == 1
+        assert not self.vmm.get_all_vm_in_group.called
+        assert not self.vmm.get_vm_by_group_and_state_list.called
 
     def test_dummy_start_spawn_if_required(self):
         self.vm_master.try_spawn_one = MagicMock()
@@ -425,6 +427,85 @@ class TestVmMaster(object):
             mock.call(group) for group in range(self.opts.build_groups_count)
         ]
 
+    def test_start_spawn_if_required_autoscale(self):
+        self.vm_master.try_spawn_one = MagicMock()
+        self.vm_master.autoscale = MagicMock()
+        self.opts.build_groups[1]["vm_autoscale"] = True
+        self.vm_master.start_spawn_if_required()
+        assert self.vm_master.try_spawn_one.call_args_list == [mock.call(0)]
+        assert self.vm_master.autoscale.call_args_list == [mock.call(1)]
+
+    def test_autoscale(self, mc_time, add_vmd):
+        mc_time.time.return_value = 1000
+        self.opts.build_groups[0].update(vm_warm_pool=1, vm_spawn_time=300,
+                                         vm_scale_down_delay=600, max_vm_total=8)
+        self.vm_master.spawner.get_proc_num_per_group.return_value = 0
+        self.vmm.start_vm_termination = types.MethodType(MagicMock(), self.vmm)
+        queue = self.vm_master.get_task_queue(0)
+        for idx in range(4):
+            queue.enqueue({"task_id": str(idx), "project_owner": "bob"})
+
+        self.vmd_a1.store_field(self.rc, "state", VmStates.READY)
+        self.vmd_a2.store_field(self.rc, "state", VmStates.IN_USE)
+        # a3 is starting
+
+        # 4 pending + 1 warm - 1 ready - 1 starting
+        self.vm_master.autoscale(0)
+        assert self.spawner.start_spawn.call_args_list == [mock.call(0)] * 3
+        assert not self.vmm.start_vm_termination.called
+
+        # queue drained, surplus is terminated after the delay
+        queue.clean()
+        self.spawner.start_spawn.reset_mock()
+        for vmd in [self.vmd_a2, self.vmd_a3]:
+            vmd.store_field(self.rc, "state", VmStates.READY)
+        self.vmd_a1.store_field(self.rc, "bound_to_user", "bob")
+        self.vm_master.autoscale(0)
+        assert not self.vmm.start_vm_termination.called
+
+        mc_time.time.return_value = 1000 + 600
+        self.vm_master.autoscale(0)
+        assert not self.spawner.start_spawn.called
+        terminated = [call[0][1] for call in self.vmm.start_vm_termination.call_args_list]
+        # dirty VM goes first
+        assert len(terminated) == 2
+        assert terminated[0] == "a1"
+
+    def test_autoscale_backlog(self, mc_time, add_vmd):
+        mc_time.time.return_value = 1000
+        self.opts.build_groups[0].update(vm_warm_pool=0, vm_spawn_time=300,
+                                         vm_scale_down_delay=600, max_vm_total=8,
+                                         max_spawn_processes=8)
+        self.vm_master.spawner.get_proc_num_per_group.return_value = 0
+        queue = self.vm_master.get_task_queue(0)
+        queue.enqueue({"task_id": "0", "project_owner": "bob"})
+        # the rest of the burst waits in job grabber
+        self.rc.hset(JOB_GRAB_BACKLOG_HASH, 0, 4)
+
+        self.vmd_a1.store_field(self.rc, "state", VmStates.READY)
+        self.vmd_a2.store_field(self.rc, "state", VmStates.IN_USE)
+        # a3 is starting
+
+        # 1 pending + 4 in backlog - 1 ready - 1 starting
+        self.vm_master.autoscale(0)
+        assert self.spawner.start_spawn.call_args_list == [mock.call(0)] * 3
+
+    def test_autoscale_acquired(self, mc_time):
+        mc_time.time.return_value = 1000
+        self.opts.build_groups[0].update(vm_warm_pool=0, vm_spawn_time=300,
+                                         vm_scale_down_delay=600, max_vm_total=8,
+                                         max_spawn_processes=8)
+        self.vm_master.spawner.get_proc_num_per_group.return_value = 0
+        queue = self.vm_master.get_task_queue(0)
+        for idx in range(4):
+            queue.enqueue({"task_id": str(idx), "project_owner": "bob"})
+        # workers took the tasks and wait for VMs
+        for idx in range(4):
+            assert queue.acquire() is not None
+
+        self.vm_master.autoscale(0)
+        assert self.spawner.start_spawn.call_args_list == [mock.call(0)] * 4
+
     def test__check_total_running_vm_limit_raises(self):
         self.vm_master.log = MagicMock()
         active_vm_states = [VmStates.GOT_IP, VmStates.READY, VmStates.IN_USE, VmStates.CHECK_HEALTH]
@@ -511,13 +592,14 @@ class TestVmMaster(object):
 
     def test__check_total_vm_limit(self):
         self.vm_master.vmm = MagicMock()
+        snapshot = self.vm_master.vmm.get_snapshot.return_value
         for i in range(2 * self.opts.build_groups[0]["max_vm_total"]):
-            self.vm_master.vmm.get_all_vm_in_group.return_value = [1 for _ in range(i)]
+            snapshot.get_all_vm_in_group.return_value = [1 for _ in range(i)]
             self.vm_master._check_total_vm_limit(0)
 
         for i in range(2 * self.opts.build_groups[0]["max_vm_total"],
                        2 * self.opts.build_groups[0]["max_vm_total"] + 10):
-            self.vm_master.vmm.get_all_vm_in_group.return_value = [1 for _ in range(i)]
+            snapshot.get_all_vm_in_group.return_value = [1 for _ in range(i)]
             with pytest.raises(VmSpawnLimitReached):
                 self.vm_master._check_total_vm_limit(0)
 
@@ -5,11 +5,13 @@ from collections import defaultdict
 from pprint import pprint
 import socket
 from munch import Munch
-from backend.exceptions import BuilderError, BuilderTimeOutError, AnsibleCallError, AnsibleResponseError, VmError
+from backend.exceptions import BuilderError, BuilderTimeOutError, AnsibleCallError, AnsibleResponseError, VmError, \
+    BuilderCancelledError
 
 import tempfile
 import shutil
 import os
+import time
 
 import six
 from backend.job import BuildJob
@@ -657,77 +659,84 @@ class TestBuilder(object):
         #     " http://example.com/foovar-2.41.f21.src.rpm")
         # assert result_cmd == expected
 
-    @mock.patch("backend.mockremote.builder.time")
-    def test_run_command_and_wait_timeout(self, mc_time):
+    @mock.patch("backend.mockremote.builder.RemoteCommand")
+    def test_run_command_and_wait(self, mc_command_cls):
         build_cmd = "foo bar"
         builder = self.get_test_builder()
-
-        mc_poller = mock.MagicMock()
-        mc_poller.poll.return_value = {"contacted": {}, "dark": {}}
-        builder.conn.run_async.return_value = None, mc_poller
-        builder.timeout = 50
-
-        mc_time.return_value = None
-
-        with pytest.raises(BuilderTimeOutError) as error:
-            builder.run_build_and_wait(build_cmd)
-
-    @mock.patch("backend.mockremote.builder.time")
-    def test_run_command_and_wait(self, mc_time):
-        build_cmd = "foo bar"
+        builder.setup_pubsub_handler = MagicMock()
+        builder.close_pubsub_handler = MagicMock()
+
+        def run(timeout, on_output, check_interrupt=None):
+            on_output("line 1\r\nli")
+            on_output("ne 2\r\nend")
+            return 0
+
+        mc_command_cls.return_value.run.side_effect = run
+        result = builder.run_build_and_wait(build_cmd)
+
+        assert mc_command_cls.call_args == mock.call(self.BUILDER_USER, self.BUILDER_HOSTNAME, build_cmd)
+        assert mc_command_cls.return_value.run.call_args[0][0] == builder.timeout
+        assert result == {"contacted": {self.BUILDER_HOSTNAME: {
+            "rc": 0, "stdout": "line 1\r\nline 2\r\nend"}}, "dark": {}}
+        logged = [call[0][0] for call in self.mc_logger.info.call_args_list]
+        assert logged[-3:] == ["line 1", "line 2", "end"]
+        assert builder.setup_pubsub_handler.called
+        assert builder.close_pubsub_handler.called
+
+    @mock.patch("backend.mockremote.builder.RemoteCommand")
+    def test_run_command_and_wait_errors(self, mc_command_cls):
         builder = self.get_test_builder()
+        builder.setup_pubsub_handler = MagicMock()
+        builder.close_pubsub_handler = MagicMock()
 
-        mc_poller = mock.MagicMock()
-        builder.conn.run_async.return_value = None, mc_poller
-        builder.timeout = 100
-
-        expected_result = {"contacted": {self.BUILDER_HOSTNAME: True}, "dark": {}}
-
-        def poll():
-            if self.stage < 2:
-                return {"contacted": {}, "dark": {}}
-            else:
-                return expected_result
-
-        mc_poller.poll.side_effect = poll
-
-        def incr_stage(*args, **kwargs):
-            self.stage += 1
+        mc_command_cls.return_value.run.return_value = 255
+        result = builder.run_build_and_wait("foo bar")
+        with pytest.raises(VmError):
+            builder_module.check_for_ans_error(result, self.BUILDER_HOSTNAME)
 
-        mc_time.sleep.side_effect = incr_stage
-        builder.run_build_and_wait(build_cmd)
+        mc_command_cls.return_value.run.side_effect = BuilderTimeOutError("timeout")
+        with pytest.raises(BuilderTimeOutError):
+            builder.run_build_and_wait("foo bar")
+        assert builder.close_pubsub_handler.call_count == 2
 
-    @mock.patch("backend.mockremote.builder.Popen")
-    def test_download(self, mc_popen):
+    @mock.patch("backend.mockremote.builder.ResultTransfer")
+    def test_download(self, mc_transfer_cls):
         builder = self.get_test_builder()
-
-        for ret_code, expected_success in [(0, True), (1, False), (23, False)]:
-            mc_cmd = mock.MagicMock()
-            mc_cmd.communicate.return_value = self.STDOUT, self.STDERR
-            mc_cmd.returncode = ret_code
-            mc_popen.return_value = mc_cmd
-            if expected_success:
-                builder.download("target_dir")
-            else:
-                with pytest.raises(BuilderError) as err:
-                    builder.download("target_dir")
-                assert err.value.return_code == ret_code
-                # assert err.value.stderr == self.STDERR
-                # assert err.value.stdout == self.STDOUT
-            #
-            # expected_arg = (
-            #     "/usr/bin/rsync -avH -e 'ssh -o PasswordAuthentication=no -o StrictHostKeyChecking=no'"
-            #     " copr_builder@example.com:/tmp/copr-backend-test-tmp/build/results/fedora-20-i386/foovar-2.41.f21 "
-            #     "'/tmp/copr-backend-test'/ &> '/tmp/copr-backend-test'/build-00012345.rsync.log")
-            #
-            # assert mc_popen.call_args[0][0] == expected_arg
-
-    @mock.patch("backend.mockremote.builder.Popen")
-    def test_download_popen_error(self, mc_popen):
+        builder.remote_pkg_name = self.BUILDER_PKG_BASE
+        builder.run_ansible_with_check = MagicMock()
+        builder.run_ansible_with_check.return_value = {"contacted": {self.BUILDER_HOSTNAME: {
+            "stdout": "3 abc foo.rpm\n4 def build.log.gz"}}, "dark": {}}
+        mc_transfer = mc_transfer_cls.return_value
+        mc_transfer.run.return_value = {"foo.rpm": "abc", "build.log.gz": "def"}
+        mc_transfer.transferred = 7
+
+        target_dir = tempfile.mkdtemp()
+        try:
+            builder.download(target_dir)
+            with open(os.path.join(target_dir, self.job.rsync_log_name)) as handle:
+                assert handle.read() == "def  build.log.gz\nabc  foo.rpm\n"
+        finally:
+            shutil.rmtree(target_dir)
+
+        assert "sha256sum" in builder.run_ansible_with_check.call_args[0][0]
+        args = mc_transfer_cls.call_args[0]
+        assert args[:3] == (self.BUILDER_USER, self.BUILDER_HOSTNAME,
+                            builder._get_remote_results_dir())
+        assert set(args[3]) == {"foo.rpm", "build.log.gz"}
+        assert mc_transfer.run.call_args == mock.call(target_dir)
+
+    @mock.patch("backend.mockremote.builder.ResultTransfer")
+    def test_download_error(self, mc_transfer_cls):
         builder = self.get_test_builder()
-        mc_popen.side_effect = IOError()
-        with pytest.raises(BuilderError):
+        builder.remote_pkg_name = self.BUILDER_PKG_BASE
+        builder.run_ansible_with_check = MagicMock()
+        builder.run_ansible_with_check.return_value = {"contacted": {self.BUILDER_HOSTNAME: {
+            "stdout": ""}}, "dark": {}}
+        mc_transfer_cls.return_value.run.side_effect = BuilderError("foo", return_code=23)
+
+        with pytest.raises(BuilderError) as err:
             builder.download(self.RESULT_DIR)
+        assert err.value.return_code == 23
 
     def test_build(self):
         builder = self.get_test_builder()
@@ -825,11 +834,34 @@ class TestBuilder(object):
         builder = self.get_test_builder()
         builder.callback = MagicMock()
         builder.ps = MagicMock()
-        for val in [None, {}, {"foo": "bar"}, {"type": "subscribe"}]:
-            builder.ps.get_message.return_value = val
-            builder.check_pubsub()
+        builder.ps.get_message.side_effect = [{}, {"foo": "bar"}, {"type": "subscribe"}, None]
+        builder.check_pubsub()
+        assert builder.ps.get_message.call_count == 4
 
-        builder.ps.get_message.return_value = {"type": "message", "data": ""}
+        builder.ps.get_message.side_effect = [None, {"type": "message", "data": ""}]
+        builder.check_pubsub()
         with pytest.raises(VmError):
             builder.check_pubsub()
 
+        builder.ps.get_message.side_effect = [{"type": "message", "data": "",
+                                               "channel": builder.cancel_channel}]
+        with pytest.raises(BuilderCancelledError):
+            builder.check_pubsub()
+
+    def test_pubsub_handler(self):
+        builder = self.get_test_builder()
+        builder.opts.redis_db = 9
+        builder.opts.redis_port = 7777
+        builder.job.task_id = "12345-fedora-20-i386"
+        builder.job.build_id = 12345
+        builder.setup_pubsub_handler()
+        try:
+            builder.check_pubsub()
+            builder.rc.publish(builder.cancel_channel, "cancelled by user")
+            time.sleep(0.05)
+            with pytest.raises(BuilderCancelledError):
+                builder.check_pubsub()
+        finally:
+            builder.close_pubsub_handler()
+        assert builder.ps is None
+
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+import time
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+import pytest
+
+from backend.exceptions import BuilderError, BuilderTimeOutError, BuilderCancelledError
+from backend.mockremote.channel import RemoteCommand
+
+
+def local_command(command):
+    remote = RemoteCommand("copr", "example.com", command)
+    # local shell takes place of the ssh connection
+    remote.get_command = lambda: ["sh", "-c", command]
+    return remote
+
+
+class TestRemoteCommand(object):
+
+    def test_get_command(self):
+        command = RemoteCommand("copr", "example.com", "mockchain -r foo").get_command()
+        assert command[:2] == ["ssh", "-tt"]
+        assert command[-2:] == ["copr@example.com", "mockchain -r foo"]
+
+    def test_run(self):
+        output = []
+        remote = local_command("echo foo; echo bar >&2; exit 3")
+        assert remote.run(10, output.append) == 3
+        assert "".join(output) == "foo\nbar\n"
+
+    def test_run_finished_immediately(self):
+        start = time.time()
+        local_command("sleep 0.2").run(10, MagicMock(), poll_interval=5)
+        # end of the command isn't noticed by polling
+        assert time.time() - start < 1
+
+    def test_run_streams_output(self):
+        received_on = []
+        start = time.time()
+        local_command("echo first; sleep 0.5; echo second").run(
+            10, lambda data: received_on.append(time.time() - start))
+        assert received_on[0] < 0.4
+
+    def test_run_timeout(self):
+        remote = local_command("sleep 10")
+        start = time.time()
+        with pytest.raises(BuilderTimeOutError):
+            remote.run(0.3, MagicMock(), poll_interval=0.1)
+        assert time.time() - start < 2
+        # command is killed
+        assert remote.proc.poll() is not None
+
+    def test_run_interrupted(self):
+        check_interrupt = MagicMock()
+        check_interrupt.side_effect = [None, BuilderCancelledError("cancelled")]
+        remote = local_command("sleep 10")
+        with pytest.raises(BuilderCancelledError):
+            remote.run(10, MagicMock(), check_interrupt=check_interrupt, poll_interval=0.1)
+        assert remote.proc.poll() is not None
+
+    def test_run_popen_error(self):
+        remote = RemoteCommand("copr", "example.com", "foo")
+        remote.get_command = lambda: ["/nonexistent/ssh"]
+        with pytest.raises(BuilderError):
+            remote.run(10, MagicMock())
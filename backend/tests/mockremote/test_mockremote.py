@@ -104,15 +104,15 @@ class TestMockRemote(object):
 
         out, err = capsys.readouterr()
 
-    @mock.patch("backend.mockremote.get_pubkey")
+    @mock.patch("backend.mockremote.get_cached_pubkey")
     def test_add_pubkey(self, mc_get_pubkey, f_mock_remote):
         self.mr.add_pubkey()
         assert mc_get_pubkey.called
         expected_path = os.path.join(self.DESTDIR, "pubkey.gpg")
         assert mc_get_pubkey.call_args == mock.call(
-            COPR_OWNER, COPR_NAME, expected_path)
+            COPR_OWNER, COPR_NAME, outfile=expected_path, ttl=3600)
 
-    @mock.patch("backend.mockremote.get_pubkey")
+    @mock.patch("backend.mockremote.get_cached_pubkey")
     def test_add_pubkey_on_exception(self, mc_get_pubkey, f_mock_remote):
         mc_get_pubkey.side_effect = CoprSignError("foobar")
         # doesn't raise an error
@@ -146,9 +146,28 @@ class TestMockRemote(object):
             base_url=u"/".join([self.BASE_URL, COPR_OWNER, COPR_NAME, self.CHROOT]),
             username=COPR_OWNER,
             projectname=COPR_NAME,
+            added=[self.JOB.results_dir],
+            removed=[],
+            opts=self.mr.opts,
         )
         assert mc_createrepo.call_args == expected_call
 
+    @mock.patch("backend.mockremote.createrepo")
+    def test_do_createrepo_coalesced(self, mc_createrepo, f_mock_remote):
+        mc_ticket = MagicMock(requested_on=0)
+        # changes of other builds were merged in
+        changes = Munch(added=[self.JOB.results_dir, "other"], removed=["old"])
+        mc_ticket.wait.side_effect = lambda regenerate: regenerate(changes) and False
+        self.mr.createrepo_coalescer = MagicMock()
+        self.mr.createrepo_coalescer.request.return_value = mc_ticket
+
+        self.mr.do_createrepo()
+        assert self.mr.createrepo_coalescer.request.call_args == \
+            mock.call(os.path.join(self.DESTDIR, self.CHROOT), added=[self.JOB.results_dir])
+        assert mc_createrepo.call_args[1]["path"] == os.path.join(self.DESTDIR, self.CHROOT)
+        assert mc_createrepo.call_args[1]["added"] == changes.added
+        assert mc_createrepo.call_args[1]["removed"] == changes.removed
+
     @mock.patch("backend.mockremote.createrepo")
     def test_do_createrepo_on_error(self, mc_createrepo, f_mock_remote):
         err_msg = "error occured"
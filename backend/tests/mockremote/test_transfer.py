@@ -0,0 +1,162 @@
+# coding: utf-8
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+import pytest
+
+from backend.exceptions import BuilderError
+from backend.mockremote.transfer import ResultTransfer, TransferSlots, Throttle, \
+    get_manifest_cmd, parse_manifest
+
+
+MODULE_REF = "backend.mockremote.transfer"
+
+
+class TestTransfer(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.remote_dir = os.path.join(self.tmp_dir, "remote")
+        self.target_dir = os.path.join(self.tmp_dir, "target")
+        os.makedirs(self.target_dir)
+
+        self.files = {
+            "foo-1.0-1.fc23.x86_64.rpm": b"x" * 200000,
+            "foo-1.0-1.fc23.src.rpm": b"source",
+            "build.log.gz": b"log",
+            "sub dir/state.log": b"state",
+        }
+        for name, content in self.files.items():
+            path = os.path.join(self.remote_dir, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as handle:
+                handle.write(content)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_manifest(self):
+        output = subprocess.check_output(get_manifest_cmd(self.remote_dir), shell=True)
+        return parse_manifest(output.decode("utf-8"))
+
+    def get_transfer(self, manifest, **kwargs):
+        transfer = ResultTransfer("copr", "example.com", self.remote_dir, manifest, **kwargs)
+        # local tar takes place of the ssh pipe
+        transfer.get_command = lambda: ["tar", "-C", self.remote_dir, "-cf", "-", "."]
+        return transfer
+
+    def test_manifest(self):
+        manifest = self.get_manifest()
+        assert set(manifest) == set(self.files)
+        for name, content in self.files.items():
+            assert manifest[name].size == len(content)
+            assert manifest[name].sha256 == hashlib.sha256(content).hexdigest()
+
+    def test_get_command(self):
+        transfer = ResultTransfer("copr", "example.com", "/tmp/build dir", {})
+        command = transfer.get_command()
+        assert command[0] == "ssh"
+        assert command[-2:] == ["copr@example.com", "tar -C '/tmp/build dir' -cf - ."]
+
+    def test_run(self):
+        progress = MagicMock()
+        transfer = self.get_transfer(self.get_manifest(), progress=progress)
+        received = transfer.run(self.target_dir)
+
+        assert set(received) == set(self.files)
+        for name, content in self.files.items():
+            with open(os.path.join(self.target_dir, name), "rb") as handle:
+                assert handle.read() == content
+
+        total = sum(len(content) for content in self.files.values())
+        assert transfer.transferred == total
+        assert progress.call_args == mock.call(total, total)
+        # big file is reported in chunks
+        assert progress.call_count > len(self.files)
+        assert not [name for name in os.listdir(self.target_dir) if name.endswith(".part")]
+
+    def test_run_corrupted(self):
+        manifest = self.get_manifest()
+        manifest["build.log.gz"].sha256 = "0" * 64
+        manifest["missing.rpm"] = manifest["build.log.gz"]
+
+        with pytest.raises(BuilderError) as err:
+            self.get_transfer(manifest).run(self.target_dir)
+        assert "missing: ['missing.rpm'], corrupted: ['build.log.gz']" in str(err.value)
+        assert not os.path.exists(os.path.join(self.target_dir, "build.log.gz"))
+        assert os.path.exists(os.path.join(self.target_dir, "foo-1.0-1.fc23.src.rpm"))
+
+    def test_run_command_error(self):
+        transfer = self.get_transfer(self.get_manifest())
+        transfer.get_command = lambda: ["tar", "-C", "/nonexistent", "-cf", "-", "."]
+        with pytest.raises(BuilderError) as err:
+            transfer.run(self.target_dir)
+        assert err.value.return_code
+
+    def test_run_popen_error(self):
+        transfer = self.get_transfer({})
+        transfer.get_command = lambda: ["/nonexistent/ssh"]
+        with pytest.raises(BuilderError):
+            transfer.run(self.target_dir)
+
+    @mock.patch("{}.time".format(MODULE_REF))
+    def test_throttle(self, mc_time):
+        mc_time.time.return_value = 1000
+        throttle = Throttle(100)
+        throttle.consume(50)
+        assert mc_time.sleep.call_args == mock.call(0.5)
+
+        mc_time.time.return_value = 1002
+        throttle.consume(50)
+        assert mc_time.sleep.call_count == 1
+
+        Throttle(0).consume(10 ** 9)
+        assert mc_time.sleep.call_count == 1
+
+    def test_transfer_slots(self):
+        slots = TransferSlots(os.path.join(self.tmp_dir, "slots"), 2, poll_interval=0.01)
+        acquired = []
+
+        def transfer():
+            with slots.acquire() as slot:
+                acquired.append(slot)
+
+        with slots.acquire() as first:
+            with slots.acquire() as second:
+                assert {first, second} == {0, 1}
+                thread = threading.Thread(target=transfer)
+                thread.start()
+                time.sleep(0.05)
+                # all slots are taken
+                assert acquired == []
+            thread.join()
+        assert acquired == [second]
+
+    def test_transfer_slots_error(self):
+        # lock dir can't be created under a file
+        lock_parent = os.path.join(self.tmp_dir, "file")
+        open(lock_parent, "w").close()
+        slots = TransferSlots(os.path.join(lock_parent, "slots"), 2)
+        with pytest.raises(BuilderError):
+            with slots.acquire():
+                pass
+
+    def test_transfer_slots_unlimited(self):
+        with TransferSlots(None, 0).acquire() as slot:
+            assert slot is None
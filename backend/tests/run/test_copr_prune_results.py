@@ -9,6 +9,7 @@ import time
 from munch import Munch
 from subprocess import Popen, PIPE
 from copr.exceptions import CoprException
+from copr.exceptions import CoprRequestException
 
 import pytest
 
@@ -43,8 +44,8 @@ def mc_cru():
         yield handle
 
 @pytest.yield_fixture
-def mc_gacs():
-    with mock.patch("{}.get_auto_createrepo_status".format(MODULE_REF)) as handle:
+def mc_cache():
+    with mock.patch("{}.ProjectCache".format(MODULE_REF)) as handle:
         yield handle
 
 @pytest.yield_fixture
@@ -52,7 +53,7 @@ def mc_pruner():
     with mock.patch("{}.Pruner".format(MODULE_REF)) as handle:
         yield handle
 
-from copr_prune_results import Pruner
+from copr_prune_results import Pruner, ScanIndex
 from copr_prune_results import main as prune_main
 
 
@@ -200,7 +201,8 @@ class TestPruneResults(object):
         mc_handle.communicate.return_value = ("foo", "bar")
 
         # doesn't touch FS if `find_obsolete_build` produce error return code
-        self.pruner.prune_obsolete_success_builds(os.path.join(self.tmp_dir_name, self.prj, self.chroots[0]))
+        with mock.patch("{}.find_obsolete_builds".format(MODULE_REF), return_value=None):
+            self.pruner.prune_obsolete_success_builds(os.path.join(self.tmp_dir_name, self.prj, self.chroots[0]))
         assert mc_popen.called
 
         assert_same_dirs(
@@ -208,7 +210,7 @@ class TestPruneResults(object):
             os.path.join(self.expect_dir_name, self.prj, self.chroots[0]),
         )
 
-    def test_prune_project_ok(self, test_pruner, mc_cru, mc_gacs):
+    def test_prune_project_ok(self, test_pruner, mc_cru, mc_cache):
         self.pruner.prune_failed_builds = MagicMock()
         self.pruner.prune_obsolete_success_builds = MagicMock()
         mc_cru.return_value = (0, "", "")
@@ -233,11 +235,11 @@ class TestPruneResults(object):
             mc_cru.call_args_list
         ]) == expected_path_set
 
-    def test_prune_project_handle_gacs_error(self, test_pruner, mc_cru, mc_gacs):
+    def test_prune_project_handle_gacs_error(self, test_pruner, mc_cru, mc_cache):
         self.pruner.prune_failed_builds = MagicMock()
         self.pruner.prune_obsolete_success_builds = MagicMock()
 
-        mc_gacs.side_effect = CoprException()
+        mc_cache.return_value.get_auto_createrepo.side_effect = CoprException()
 
         self.pruner.prune_project(os.path.join(self.tmp_dir_name, self.prj),
                                   self.username, self.coprname)
@@ -245,10 +247,10 @@ class TestPruneResults(object):
         assert not self.pruner.prune_failed_builds.called
         assert not self.pruner.prune_obsolete_success_builds.called
 
-    def test_prune_project_handle_errors(self, test_pruner, mc_cru, mc_gacs):
+    def test_prune_project_handle_errors(self, test_pruner, mc_cru, mc_cache):
         self.pruner.prune_failed_builds = MagicMock()
         self.pruner.prune_obsolete_success_builds = MagicMock()
-        mc_gacs.return_value = True
+        mc_cache.return_value.get_auto_createrepo.return_value = True
 
         #  0. createrepo_unsafe failure
         mc_cru.side_effect = CreateRepoError("test exception", ["foo", "bar"], 1)
@@ -286,11 +288,11 @@ class TestPruneResults(object):
 
         assert mc_cru.called
 
-    def test_prune_project_skip_when_acr_disabled(self, test_pruner, mc_cru, mc_gacs):
+    def test_prune_project_skip_when_acr_disabled(self, test_pruner, mc_cru, mc_cache):
         self.pruner.prune_failed_builds = MagicMock()
         self.pruner.prune_obsolete_success_builds = MagicMock()
 
-        mc_gacs.return_value = False
+        mc_cache.return_value.get_auto_createrepo.return_value = False
 
         self.pruner.prune_project(os.path.join(self.tmp_dir_name, self.prj),
                                   self.username, self.coprname)
@@ -314,3 +316,120 @@ class TestPruneResults(object):
         prune_main()
         assert mc_bcr.call_args[0][0] == "foobar"
 
+
+
+def touch(path, mtime=None):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, "w").close()
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+class TestParallelPruner(object):
+
+    def setup_method(self, method):
+        self.tmp_dir_name = tempfile.mkdtemp()
+        self.destdir = os.path.join(self.tmp_dir_name, "results")
+        self.find_obsolete = os.path.join(self.tmp_dir_name, "find_obsolete.sh")
+        with open(self.find_obsolete, "w") as handle:
+            handle.write("#!/bin/sh\necho '# nothing obsolete'\n")
+        os.chmod(self.find_obsolete, 0o755)
+
+        self.opts = Munch(
+            prune_days=14,
+            find_obsolete_script=self.find_obsolete,
+            frontend_base_url="http://example.com",
+            frontend_auth="12345678",
+            destdir=self.destdir,
+            prune_workers=2,
+            prune_index_path=os.path.join(self.tmp_dir_name, "index", "prune_index.json"),
+        )
+
+        old = time.time() - 30 * 24 * 3600
+        self.chroot_1 = os.path.join(self.destdir, "foo", "bar", "fedora-23-x86_64")
+        self.chroot_2 = os.path.join(self.destdir, "foo", "bar", "epel-7-x86_64")
+        self.chroot_acr_off = os.path.join(self.destdir, "foo", "baz", "fedora-23-x86_64")
+        touch(os.path.join(self.chroot_1, "00000001-old-failed", "fail"), old)
+        touch(os.path.join(self.chroot_1, "00000002-recent-failed", "fail"))
+        touch(os.path.join(self.chroot_2, "00000003-old-success", "success"), old)
+        touch(os.path.join(self.chroot_acr_off, "00000004-old-failed", "fail"), old)
+
+        self.cache_patcher = mock.patch("{}.ProjectCache".format(MODULE_REF))
+        self.mc_cache = self.cache_patcher.start()
+        self.statuses = {("foo", "bar"): True, ("foo", "baz"): False}
+        self.mc_cache.return_value.get_auto_createrepo.side_effect = \
+            lambda owner, project: self.statuses[(owner, project)]
+
+    def teardown_method(self, method):
+        self.cache_patcher.stop()
+        shutil.rmtree(self.tmp_dir_name)
+
+    def test_run(self, mc_cru):
+        # createrepo runs in the pool workers, leave a trace on the disk
+        mc_cru.side_effect = lambda path: touch(os.path.join(path, "createrepo_done"))
+
+        pruner = Pruner(self.opts)
+        pruner.run()
+
+        assert sorted(os.listdir(self.chroot_1)) == ["00000002-recent-failed", "createrepo_done"]
+        # nothing removed, no createrepo
+        assert os.listdir(self.chroot_2) == ["00000003-old-success"]
+        assert os.listdir(self.chroot_acr_off) == ["00000004-old-failed"]
+        # flags come from the shared project cache, pool workers don't ask for them
+        assert self.mc_cache.call_count == 1
+
+        index = ScanIndex(self.opts.prune_index_path)
+        index.load()
+        assert set(index.chroots) == set([self.chroot_1, self.chroot_2])
+        # the recent build becomes old in 14 days
+        assert index.chroots[self.chroot_1]["next_due"] > time.time() + 13 * 24 * 3600
+
+        # nothing changed since the last run
+        pruner = Pruner(self.opts)
+        pruner.index.load()
+        assert pruner.collect_chroots() == []
+
+        touch(os.path.join(self.chroot_2, "00000005-new-build", "success"))
+        assert pruner.collect_chroots() == [
+            (self.chroot_2, "foo/bar:epel-7-x86_64")]
+
+    def test_project_policy(self):
+        self.opts.prune_policy_days = {"foo/bar": 60}
+        pruner = Pruner(self.opts)
+        assert pruner.get_policy(self.chroot_1) == {"days": 60, "keep": 1}
+        assert pruner.get_policy(self.chroot_acr_off + "/") == {"days": 14, "keep": 1}
+
+        assert pruner.prune_failed_builds(self.chroot_1) == 0
+        assert pruner.get_next_due(self.chroot_1) > time.time() + 29 * 24 * 3600
+
+    def test_deleted_project(self):
+        # project missing in frontend is not pruned
+        self.mc_cache.return_value.get_auto_createrepo.side_effect = \
+            CoprRequestException("Project does not exist")
+
+        pruner = Pruner(self.opts)
+        assert pruner.collect_chroots() == []
+        assert set(call[0] for call in self.mc_cache.return_value.get_auto_createrepo.call_args_list) \
+            == set([("foo", "bar"), ("foo", "baz")])
+
+    def test_scan_index(self):
+        index = ScanIndex(self.opts.prune_index_path)
+        index.load()
+        assert not index.is_unchanged(self.chroot_1)
+
+        index.update(self.chroot_1, os.path.getmtime(self.chroot_1), time.time() + 100)
+        assert index.is_unchanged(self.chroot_1)
+        # some build becomes old enough
+        assert not index.is_unchanged(self.chroot_1, now=time.time() + 200)
+
+        index.save()
+        index = ScanIndex(self.opts.prune_index_path)
+        index.load()
+        assert index.is_unchanged(self.chroot_1)
+
+        with open(self.opts.prune_index_path, "w") as handle:
+            handle.write("{broken")
+        index = ScanIndex(self.opts.prune_index_path)
+        index.load()
+        assert index.chroots == {}
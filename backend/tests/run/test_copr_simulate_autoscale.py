@@ -0,0 +1,64 @@
+# coding: utf-8
+
+import sys
+
+sys.path.append("../../run")
+
+from backend.vm_manage.autoscale import AutoscalePolicy
+
+from copr_simulate_autoscale import simulate, format_report
+
+
+def make_trace():
+    """
+    Burst of 20 builds, then a long pause and one more build
+    """
+    trace = [{"task_id": "{}-fedora-23-x86_64".format(idx), "project_owner": "bob",
+              "project_name": "foo", "submitted_on": idx, "duration": 600}
+             for idx in range(20)]
+    trace.append({"task_id": "late-fedora-23-x86_64", "project_owner": "bob",
+                  "project_name": "foo", "submitted_on": 20000, "duration": 600})
+    return trace
+
+
+class TestSimulateAutoscale(object):
+
+    def make_policy(self, **kwargs):
+        params = dict(max_vm_total=10, max_spawn_processes=5, warm_pool=1,
+                      spawn_time=300, scale_down_delay=600)
+        params.update(kwargs)
+        return AutoscalePolicy(**params)
+
+    def test_simulate(self):
+        result = simulate(self.make_policy(), make_trace(), cycle=60, spawn_time=300)
+
+        assert len(result.waits) == 21
+        assert result.peak_vms == 10
+        # the first VMs are ready after spawn time
+        assert min(result.waits[:20]) >= 300 - 60
+        # the pool was drained during the pause, but warm pool serves the late build
+        # in the next cycle
+        assert result.waits[-1] < 60
+
+    def test_acquired_tasks_get_vms(self):
+        # workers acquire all the tasks at once, the queue looks empty
+        trace = make_trace()[:8]
+        policy = self.make_policy(warm_pool=0, max_spawn_processes=10)
+        result = simulate(policy, trace, cycle=60, spawn_time=300, max_workers=8)
+
+        # all VMs are spawned together, not one by one
+        assert max(result.waits) <= 300 + 60
+
+    def test_warm_pool_costs(self):
+        trace = make_trace()
+        small = simulate(self.make_policy(warm_pool=0), trace, cycle=60, spawn_time=300)
+        large = simulate(self.make_policy(warm_pool=3), trace, cycle=60, spawn_time=300)
+
+        assert large.vm_hours > small.vm_hours
+        assert large.waits[-1] <= small.waits[-1]
+
+    def test_format_report(self):
+        result = simulate(self.make_policy(), make_trace(), cycle=60, spawn_time=300)
+        report = format_report(result)
+        assert "tasks: 21" in report
+        assert "peak VMs: 10" in report
@@ -0,0 +1,70 @@
+# coding: utf-8
+
+import json
+import os
+import sys
+import tempfile
+
+sys.path.append("../../run")
+
+from backend.scheduler import FifoScheduler, FairShareScheduler
+
+from copr_simulate_scheduler import load_trace, simulate, format_report, percentile
+
+
+def make_trace():
+    """
+    Heavy user submits 500 rebuilds at once, a bit later four other users
+    submit a few builds each
+    """
+    trace = []
+    for idx in range(500):
+        trace.append({"task_id": "{}-fedora-23-x86_64".format(idx), "project_owner": "heavy",
+                      "project_name": "mass-rebuild", "submitted_on": 0, "duration": 600})
+    for user_idx in range(4):
+        for idx in range(5):
+            trace.append({"task_id": "{}-{}-fedora-23-x86_64".format(user_idx, idx),
+                          "project_owner": "user_{}".format(user_idx),
+                          "project_name": "foo", "submitted_on": 60 + user_idx * 10 + idx,
+                          "duration": 300})
+    return trace
+
+
+class TestSimulateScheduler(object):
+
+    def test_load_trace(self):
+        trace = make_trace()
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "w") as handle:
+                for task in reversed(trace):
+                    handle.write(json.dumps(task) + "\n")
+                handle.write("\n")
+            loaded = load_trace(path)
+        finally:
+            os.remove(path)
+
+        assert len(loaded) == len(trace)
+        assert [task["submitted_on"] for task in loaded] == \
+            sorted(task["submitted_on"] for task in trace)
+
+    def test_simulate_deterministic(self):
+        first = simulate(FairShareScheduler(), make_trace(), workers=10, max_vm_per_user=10)
+        second = simulate(FairShareScheduler(), make_trace(), workers=10, max_vm_per_user=10)
+        assert first == second
+        assert sorted(first) == ["heavy", "user_0", "user_1", "user_2", "user_3"]
+        assert len(first["heavy"]) == 500
+
+    def test_fair_share_vs_fifo(self):
+        fifo = simulate(FifoScheduler(), make_trace(), workers=10, max_vm_per_user=10)
+        fair = simulate(FairShareScheduler(), make_trace(), workers=10, max_vm_per_user=10)
+
+        for user_idx in range(4):
+            owner = "user_{}".format(user_idx)
+            # with fifo everyone waits for the mass rebuild
+            assert percentile(sorted(fifo[owner]), 50) > 10000
+            assert percentile(sorted(fair[owner]), 90) < 1500
+
+        report = format_report(fair)
+        assert len(report.splitlines()) == 6
+        assert report.splitlines()[1].split()[:2] == ["heavy", "500"]
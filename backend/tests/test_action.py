@@ -314,7 +314,9 @@ class TestAction(object):
             projectname=u'bar',
             base_url=u'http://example.com/results/foo/bar/fedora20',
             path='{}/old_dir/fedora20'.format(self.tmp_dir_name),
-            front_url=None
+            front_url=None,
+            removed=['{}/old_dir/fedora20/foo'.format(self.tmp_dir_name)],
+            opts=self.opts,
         )
         assert mc_createrepo.call_args == create_repo_expected_call
 
@@ -553,10 +555,10 @@ class TestAction(object):
 
         exp_call_1 = mock.call(path=tmp_dir + u'/foo/bar/epel-6-i386',
                                front_url=self.opts.frontend_base_url, override_acr_flag=True,
-                               username=u"foo", projectname=u"bar")
+                               username=u"foo", projectname=u"bar", opts=self.opts)
         exp_call_2 = mock.call(path=tmp_dir + u'/foo/bar/fedora-20-x86_64',
                                front_url=self.opts.frontend_base_url, override_acr_flag=True,
-                               username=u"foo", projectname=u"bar")
+                               username=u"foo", projectname=u"bar", opts=self.opts)
         assert exp_call_1 in mc_createrepo.call_args_list
         assert exp_call_2 in mc_createrepo.call_args_list
         assert len(mc_createrepo.call_args_list) == 2
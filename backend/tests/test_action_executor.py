@@ -0,0 +1,149 @@
+# coding: utf-8
+
+import json
+import logging
+from threading import Event, Lock
+import time
+
+from munch import Munch
+from requests import RequestException
+
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from backend.actions import ActionType
+from backend import action_executor
+from backend.action_executor import ActionExecutor, get_action_owner
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timeout"
+        time.sleep(0.01)
+
+
+def test_get_action_owner():
+    assert get_action_owner({"old_value": "foo/bar", "data": ""}) == "foo"
+    assert get_action_owner({"old_value": "", "data": json.dumps({"username": "@group"})}) == "@group"
+    assert get_action_owner({"old_value": None, "data": "not a json"}) is None
+    assert get_action_owner({}) is None
+
+
+class TestActionExecutor(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            action_workers={"delete": 1},
+        )
+        self.frontend_client = MagicMock()
+
+        self.started = []
+        self.finished = []
+        self.lock = Lock()
+        # actions with "block" in data wait until the test sets the event
+        self.unblock = Event()
+
+        self.action_patcher = mock.patch("backend.action_executor.Action")
+        self.mc_action = self.action_patcher.start()
+        self.mc_action.side_effect = self.make_action
+
+        # worker threads outlive the test, keep their records off the shared redis
+        with mock.patch("backend.action_executor.get_redis_logger") as mc_logger:
+            mc_logger.return_value = logging.getLogger("test_action_executor")
+            self.executor = ActionExecutor(self.opts, self.frontend_client)
+
+    def teardown_method(self, method):
+        self.unblock.set()
+        self.action_patcher.stop()
+
+    def make_action(self, opts, action, frontend_client):
+        def execute():
+            with self.lock:
+                self.started.append(action["id"])
+            if action.get("block"):
+                self.unblock.wait(5)
+            with self.lock:
+                self.finished.append(action["id"])
+            return Munch(id=action["id"], result=1)
+
+        return MagicMock(execute=execute)
+
+    def test_workers_count(self):
+        assert self.executor.get_workers_count(ActionType.DELETE) == 1
+        assert self.executor.get_workers_count(ActionType.RENAME) == action_executor.DEFAULT_ACTION_WORKERS
+
+    def test_slow_delete_doesnt_block_other_owners(self):
+        self.executor.start()
+        self.executor.submit({"id": 1, "action_type": ActionType.DELETE, "old_value": "foo/bar",
+                              "block": True})
+        self.executor.submit({"id": 2, "action_type": ActionType.RENAME, "old_value": "bob/bar"})
+        self.executor.submit({"id": 3, "action_type": ActionType.CREATEREPO, "old_value": "",
+                              "data": json.dumps({"username": "alice"})})
+
+        wait_for(lambda: set(self.finished) == set([2, 3]))
+        assert 1 in self.started
+
+        self.unblock.set()
+        wait_for(lambda: len(self.finished) == 3)
+
+    def test_owner_order(self):
+        self.executor.start()
+        self.executor.submit({"id": 1, "action_type": ActionType.RENAME, "old_value": "foo/bar",
+                              "new_value": "foo/baz", "block": True})
+        self.executor.submit({"id": 2, "action_type": ActionType.DELETE, "old_value": "foo/baz"})
+        self.executor.submit({"id": 3, "action_type": ActionType.CREATEREPO, "old_value": "",
+                              "data": json.dumps({"username": "foo"})})
+
+        time.sleep(0.1)
+        # other action types have free workers, but they wait for the rename
+        assert self.started == [1]
+
+        self.unblock.set()
+        wait_for(lambda: len(self.finished) == 3)
+        assert self.finished == [1, 2, 3]
+        assert not self.executor.waiting
+
+    def test_error_releases_owner(self):
+        self.mc_action.side_effect = [IOError(), MagicMock(execute=lambda: None)]
+        self.executor.start()
+        self.executor.submit({"id": 1, "action_type": ActionType.DELETE, "old_value": "foo/bar"})
+        self.executor.submit({"id": 2, "action_type": ActionType.DELETE, "old_value": "foo/bar"})
+        wait_for(lambda: self.mc_action.call_count == 2 and not self.executor.waiting)
+
+    def test_unknown_type(self):
+        self.executor.submit({"id": 1, "action_type": 42, "old_value": "foo/bar"})
+        assert not self.executor.waiting
+        assert all(queue.empty() for queue in self.executor.queues.values())
+
+    def test_results_batch(self):
+        for idx in range(3):
+            self.executor.execute({"id": idx, "action_type": ActionType.DELETE})
+
+        self.frontend_client.update.side_effect = RequestException()
+        assert self.executor.flush_results() == 0
+        assert len(self.executor.results) == 3
+
+        self.frontend_client.update.side_effect = None
+        assert self.executor.flush_results() == 3
+        assert self.frontend_client.update.call_args == mock.call({"actions": [
+            {"id": 0, "result": 1}, {"id": 1, "result": 1}, {"id": 2, "result": 1}]})
+        assert self.executor.flush_results() == 0
+        assert self.frontend_client.update.call_count == 2
+
+    def test_reporter(self):
+        self.executor.start()
+        for idx in range(5):
+            self.executor.submit({"id": idx, "action_type": ActionType.LEGAL_FLAG})
+        wait_for(lambda: self.frontend_client.update.called and not self.executor.results)
+        reported = [result["id"] for call in self.frontend_client.update.call_args_list
+                    for result in call[0][0]["actions"]]
+        assert sorted(reported) == list(range(5))
@@ -0,0 +1,190 @@
+# coding: utf-8
+
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from backend import build_log
+from backend.build_log import SegmentedLogWriter, SegmentedLogHandler, read_log, read_index, \
+    assemble, get_part_path, make_tail_app
+
+
+class TestSegmentedLog(object):
+
+    def setup_method(self, method):
+        self.tmp_dir_name = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir_name, "build-00000001.log")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir_name)
+
+    def write(self, lines, segment_size=100):
+        writer = SegmentedLogWriter(self.path, segment_size)
+        for line in lines:
+            writer.write(line)
+        return writer
+
+    def test_write_segments(self):
+        # 27 bytes long lines
+        lines = ["line {0:04d} of the build log\n".format(i) for i in range(22)]
+        writer = self.write(lines)
+
+        segments = read_index(self.path)
+        assert len(segments) == 5
+        assert [seg.raw_offset for seg in segments] == [0, 108, 216, 324, 432]
+        assert os.path.exists(get_part_path(self.path, 5))
+        assert not os.path.exists(get_part_path(self.path, 4))
+
+        writer.close()
+        assert len(read_index(self.path)) == 6
+        assert not any(name.startswith("build-00000001.log.part")
+                       for name in os.listdir(self.tmp_dir_name))
+
+        # concatenated segments are valid gzip of the whole log
+        with gzip.open(self.path + ".gz") as handle:
+            assert handle.read() == "".join(lines)
+
+    def test_read_running_log(self):
+        lines = ["line {0:04d} of the build log\n".format(i) for i in range(20)]
+        content = "".join(lines).encode("utf-8")
+        writer = self.write(lines)
+
+        result = read_log(self.path)
+        assert result.data == content
+        assert result.offset == len(content)
+        assert not result.finished
+
+        # ranges crossing the segments and the running part
+        for offset, limit in [(0, 10), (120, 10), (130, 300), (530, 100), (540, 10)]:
+            result = read_log(self.path, offset, limit)
+            assert result.data == content[offset:offset + limit]
+            assert result.offset == offset + len(result.data)
+
+        writer.write("last line\n")
+        result = read_log(self.path, len(content))
+        assert result.data == b"last line\n"
+
+        writer.close()
+        result = read_log(self.path, result.offset)
+        assert result.data == b""
+        assert result.finished
+
+    def test_read_finished_log(self):
+        self.write(["foo\n", "bar\n"], segment_size=1000).close()
+        assert read_log(self.path, 0, 4) == {"data": b"foo\n", "offset": 4, "finished": False}
+        assert read_log(self.path, 4) == {"data": b"bar\n", "offset": 8, "finished": True}
+
+    def test_read_rotated_part(self):
+        writer = self.write(["foo\n"], segment_size=6)
+        orig_read_index = build_log.read_index
+
+        def read_index_and_rotate(path):
+            # the writer finishes the segment right after the reader saw the index
+            segments = orig_read_index(path)
+            if not len(segments):
+                writer.write("bar\n")
+            return segments
+
+        build_log.read_index = read_index_and_rotate
+        try:
+            result = read_log(self.path)
+        finally:
+            build_log.read_index = orig_read_index
+        assert result.data == b"foo\nbar\n"
+        assert not result.finished
+
+    def test_resume(self):
+        self.write(["foo\n"] * 30).close()
+        writer = self.write(["bar\n"] * 30)
+        assert read_log(self.path).data == b"foo\n" * 30 + b"bar\n" * 30
+        writer.close()
+        with gzip.open(self.path + ".gz") as handle:
+            assert handle.read() == "foo\n" * 30 + "bar\n" * 30
+
+    def test_assemble(self):
+        self.write(["foo\n"] * 30).close()
+        dst = os.path.join(self.tmp_dir_name, "mockchain.log.gz")
+        assemble(self.path, dst)
+        with open(self.path + ".gz", "rb") as src, open(dst, "rb") as handle:
+            assert src.read() == handle.read()
+
+    def test_assemble_crashed_writer(self):
+        # writer killed before the log was closed
+        self.write(["foo\n"] * 30)
+        dst = os.path.join(self.tmp_dir_name, "mockchain.log.gz")
+        assemble(self.path, dst)
+        with gzip.open(dst) as handle:
+            assert handle.read() == "foo\n" * 30
+
+    def test_handler(self):
+        logger = logging.getLogger("test_build_log.handler")
+        handler = SegmentedLogHandler(self.path, 100)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        try:
+            logger.error(u"žluťoučký kůň")
+            assert read_log(self.path).data == u"žluťoučký kůň\n".encode("utf-8")
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        assert read_log(self.path).finished
+
+
+class TestTailApp(object):
+
+    def setup_method(self, method):
+        self.tmp_dir_name = tempfile.mkdtemp()
+        self.app = make_tail_app(self.tmp_dir_name, max_limit=8)
+        os.makedirs(os.path.join(self.tmp_dir_name, "foo", "bar", "fedora-23-x86_64"))
+        self.path = build_log.get_log_path(self.tmp_dir_name, "foo", "bar", "fedora-23-x86_64", 12)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir_name)
+
+    def request(self, path, query=""):
+        environ = {"PATH_INFO": path, "QUERY_STRING": query}
+        setup_testing_defaults(environ)
+        response = {}
+
+        def start_response(status, headers):
+            response["status"] = status
+            response["headers"] = dict(headers)
+
+        response["body"] = b"".join(self.app(environ, start_response))
+        return response
+
+    def test_tail(self):
+        writer = SegmentedLogWriter(self.path, 10)
+        writer.write("first line\nsecond line\n")
+
+        response = self.request("/foo/bar/fedora-23-x86_64/12", "offset=3")
+        assert response["status"] == "200 OK"
+        assert response["body"] == b"st line\n"
+        assert response["headers"]["X-Log-Offset"] == "11"
+        assert response["headers"]["X-Log-Finished"] == "0"
+
+        writer.close()
+        response = self.request("/foo/bar/fedora-23-x86_64/12", "offset=20&limit=100")
+        assert response["body"] == b"ne\n"
+        assert response["headers"]["X-Log-Offset"] == "23"
+        assert response["headers"]["X-Log-Finished"] == "1"
+
+    @pytest.mark.parametrize("path", [
+        "/foo/bar/fedora-23-x86_64/13",
+        "/foo/bar/fedora-23-x86_64/abc",
+        "/foo/../fedora-23-x86_64/12",
+        "/foo/bar/12",
+    ])
+    def test_not_found(self, path):
+        SegmentedLogWriter(self.path).close()
+        assert self.request(path)["status"] == "404 Not Found"
+
+    @pytest.mark.parametrize("query", ["offset=foo", "offset=-1", "limit=-5"])
+    def test_bad_request(self, query):
+        SegmentedLogWriter(self.path).close()
+        assert self.request("/foo/bar/fedora-23-x86_64/12", query)["status"] == "400 Bad Request"
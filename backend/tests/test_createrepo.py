@@ -1,11 +1,15 @@
 import os
 import copy
+import gzip
 import tarfile
 import tempfile
 import shutil
+import threading
 import time
 import pytest
 
+from munch import Munch
+
 import six
 
 
@@ -17,8 +21,13 @@ else:
     from mock import MagicMock
 
 
-from backend.createrepo import createrepo, createrepo_unsafe, add_appdata, run_cmd_unsafe
+from munch import Munch
+from lockfile import LockFile
+
+from backend.createrepo import createrepo, createrepo_unsafe, add_appdata, run_cmd_unsafe, \
+    CreaterepoCoalescer, get_repo_locations, get_incremental_pkglist
 from backend.exceptions import CreateRepoError
+from backend.helpers import get_redis_connection
 
 @mock.patch('backend.createrepo.createrepo_unsafe')
 @mock.patch('backend.createrepo.add_appdata')
@@ -50,7 +59,59 @@ def test_createrepo_conditional_false(mc_client, mc_create_unsafe):
     createrepo(path="/tmp/", front_url="http://example.com/api",
                username="foo", projectname="bar", base_url=base_url)
 
-    assert mc_create_unsafe.call_args == mock.call('/tmp/', dest_dir='devel', base_url=base_url)
+    assert mc_create_unsafe.call_args == mock.call('/tmp/', dest_dir='devel', base_url=base_url,
+                                                       added=None, removed=None)
+
+
+@mock.patch('backend.createrepo.createrepo_unsafe')
+@mock.patch('backend.createrepo.ProjectCache')
+@mock.patch('backend.helpers.CoprClient')
+def test_createrepo_project_cache(mc_client, mc_cache, mc_create_unsafe):
+    opts = Munch(frontend_base_url="http://example.com/api")
+    mc_cache.return_value.get_auto_createrepo.return_value = False
+
+    createrepo(path="/tmp/", front_url="http://example.com/api",
+               username="foo", projectname="bar", opts=opts)
+
+    assert mc_cache.call_args == mock.call(opts)
+    assert mc_cache.return_value.get_auto_createrepo.call_args == mock.call("foo", "bar")
+    assert not mc_client.called
+    assert mc_create_unsafe.call_args[1]["dest_dir"] == "devel"
+
+
+REPOMD_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo" xmlns:rpm="http://linux.duke.edu/metadata/rpm">
+  <data type="primary">
+    <location href="repodata/abc-primary.xml.gz"/>
+  </data>
+  <data type="filelists">
+    <location href="repodata/abc-filelists.xml.gz"/>
+  </data>
+</repomd>
+"""
+
+PRIMARY_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common" xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="{count}">
+{packages}
+</metadata>
+"""
+
+PACKAGE_TEMPLATE = """<package type="rpm">
+  <name>foo</name>
+  <location href="{href}"/>
+  <format><rpm:license>MIT</rpm:license></format>
+</package>"""
+
+
+def write_repodata(repo_dir, locations):
+    repodata = os.path.join(repo_dir, "repodata")
+    os.makedirs(repodata)
+    with open(os.path.join(repodata, "repomd.xml"), "w") as handle:
+        handle.write(REPOMD_TEMPLATE)
+    with gzip.open(os.path.join(repodata, "abc-primary.xml.gz"), "wb") as handle:
+        handle.write(PRIMARY_TEMPLATE.format(
+            count=len(locations),
+            packages="\n".join(PACKAGE_TEMPLATE.format(href=href) for href in locations)))
 
 
 @pytest.yield_fixture
@@ -246,3 +307,179 @@ class TestCreaterepo(object):
 
             createrepo_unsafe(path, base_url=self.base_url, dest_dir="devel")
             assert os.path.exists(os.path.join(path, "devel"))
+
+
+class TestIncrementalCreaterepo(object):
+    def setup_method(self, method):
+        self.path = tempfile.mkdtemp()
+        self.old = ["00000001-foo/foo-1.0-1.fc23.src.rpm",
+                    "00000001-foo/foo-1.0-1.fc23.x86_64.rpm",
+                    "00000002-bar/bar-1.0-1.fc23.x86_64.rpm"]
+        for href in self.old:
+            self.touch(href)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.path)
+
+    def touch(self, href):
+        path = os.path.join(self.path, href)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").close()
+
+    def test_get_repo_locations(self):
+        assert get_repo_locations(self.path) is None
+        write_repodata(self.path, self.old)
+        assert get_repo_locations(self.path) == set(self.old)
+
+    def test_get_incremental_pkglist(self):
+        assert get_incremental_pkglist(self.path, self.path, ["00000003-baz"]) is None
+
+        write_repodata(self.path, self.old)
+        self.touch("00000003-baz/baz-1.0-1.fc23.x86_64.rpm")
+        self.touch("00000003-baz/build.log.gz")
+        shutil.rmtree(os.path.join(self.path, "00000002-bar"))
+        # package missing in the metadata and not mentioned in changes is not picked up
+        self.touch("00000004-new/new-1.0-1.fc23.x86_64.rpm")
+
+        pkglist = get_incremental_pkglist(
+            self.path, self.path, [os.path.join(self.path, "00000003-baz"), "00000002-bar"])
+        assert pkglist == ["00000001-foo/foo-1.0-1.fc23.src.rpm",
+                           "00000001-foo/foo-1.0-1.fc23.x86_64.rpm",
+                           "00000003-baz/baz-1.0-1.fc23.x86_64.rpm"]
+
+    def test_createrepo_unsafe_incremental(self, mc_run_cmd_unsafe):
+        pkglists = []
+
+        def on_run(cmd, lock_path):
+            # package list was computed under the lock held for the command
+            assert lock_path is None
+            assert LockFile(os.path.join(self.path, "createrepo.lock")).is_locked()
+            pkglist_path = cmd.split("--pkglist ")[1].split()[0]
+            with open(pkglist_path) as handle:
+                pkglists.append(handle.read().split())
+            return "ok"
+
+        mc_run_cmd_unsafe.side_effect = on_run
+        write_repodata(self.path, self.old)
+        self.touch("00000003-baz/baz-1.0-1.fc23.x86_64.rpm")
+
+        added = [os.path.join(self.path, "00000003-baz")]
+        assert createrepo_unsafe(self.path, added=added) == "ok"
+        cmd = mc_run_cmd_unsafe.call_args[0][0]
+        assert "--update --skip-stat --pkglist" in cmd
+        assert pkglists == [self.old + ["00000003-baz/baz-1.0-1.fc23.x86_64.rpm"]]
+        # temporary package list is removed
+        assert not os.path.exists(cmd.split("--pkglist ")[1].split()[0])
+
+    def test_createrepo_unsafe_incremental_rebuild(self, mc_run_cmd_unsafe):
+        # rebuilt packages have the same locations as the old metadata
+        write_repodata(self.path, self.old)
+        createrepo_unsafe(self.path, added=["00000001-foo"])
+        cmd = mc_run_cmd_unsafe.call_args[0][0]
+        assert "--update --pkglist" in cmd
+        assert "--skip-stat" not in cmd
+
+    def test_createrepo_unsafe_incremental_devel(self, mc_run_cmd_unsafe):
+        write_repodata(os.path.join(self.path, "devel"), self.old)
+        createrepo_unsafe(self.path, dest_dir="devel", removed=["00000002-bar"])
+        cmd = mc_run_cmd_unsafe.call_args[0][0]
+        assert "--outputdir {}/devel".format(self.path) in cmd
+        assert "--skip-stat --pkglist" in cmd
+
+    def test_createrepo_unsafe_incremental_fallback(self, mc_run_cmd_unsafe):
+        # no metadata to update, scans the whole directory
+        createrepo_unsafe(self.path, added=["00000001-foo"])
+        cmd = mc_run_cmd_unsafe.call_args[0][0]
+        assert "--pkglist" not in cmd
+        assert "--update" not in cmd
+
+
+class TestCreaterepoCoalescer(object):
+    def setup_method(self, method):
+        self.opts = Munch(redis_db=9, redis_port=7777, createrepo_batch_delay=0)
+        self.rc = get_redis_connection(self.opts)
+        self.coalescer = CreaterepoCoalescer(self.opts)
+        self.path = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.path)
+        keys = self.rc.keys("*")
+        if keys:
+            self.rc.delete(*keys)
+
+    def test_sequential(self):
+        regenerate = MagicMock()
+        first = self.coalescer.request(self.path)
+        assert not first.published
+        assert first.wait(regenerate)
+        assert first.published
+
+        second = self.coalescer.request(self.path)
+        assert second.number == first.number + 1
+        assert not second.published
+        assert second.wait(regenerate)
+        assert regenerate.call_count == 2
+
+    def test_coalesce_pending_requests(self):
+        regenerate = MagicMock()
+        tickets = [self.coalescer.request(self.path) for _ in range(5)]
+
+        assert tickets[2].wait(regenerate)
+        assert regenerate.call_args == mock.call(None)
+        # one run covered all pending requests
+        assert all(ticket.published for ticket in tickets)
+        assert not any(ticket.wait(regenerate) for ticket in tickets)
+        assert regenerate.call_count == 1
+        assert self.coalescer.get_stats() == {"requests": 5, "runs": 1}
+
+    def test_merge_changes(self):
+        regenerate = MagicMock()
+        self.coalescer.request(self.path, added=["a"])
+        self.coalescer.request(self.path, removed=["b"])
+        ticket = self.coalescer.request(self.path, added=["c"])
+        assert ticket.wait(regenerate)
+        assert regenerate.call_args == mock.call(Munch(added=["a", "c"], removed=["b"]))
+
+        # covered changes were consumed
+        ticket = self.coalescer.request(self.path, added=["d"])
+        assert ticket.wait(regenerate)
+        assert regenerate.call_args == mock.call(Munch(added=["d"], removed=[]))
+
+        # request without changes forces the full regeneration
+        self.coalescer.request(self.path, added=["e"])
+        ticket = self.coalescer.request(self.path)
+        assert ticket.wait(regenerate)
+        assert regenerate.call_args == mock.call(None)
+
+    def test_failed_run_not_published(self):
+        tickets = [self.coalescer.request(self.path, added=[name]) for name in ["a", "b"]]
+        with pytest.raises(CreateRepoError):
+            tickets[0].wait(MagicMock(side_effect=CreateRepoError("foo", "cmd")))
+
+        assert not tickets[1].published
+        regenerate = MagicMock()
+        assert tickets[1].wait(regenerate)
+        assert tickets[0].published
+        # changes of the failed run are retried
+        assert regenerate.call_args == mock.call(Munch(added=["a", "b"], removed=[]))
+
+    def test_concurrent_workers(self):
+        self.coalescer.batch_delay = 0.05
+        runs = []
+
+        def regenerate(changes):
+            time.sleep(0.05)
+            runs.append(time.time())
+
+        def worker():
+            CreaterepoCoalescer(self.opts).request(self.path).wait(regenerate)
+
+        threads = [threading.Thread(target=worker) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert 1 <= len(runs) <= 3
+        assert self.coalescer.get_published(self.path) == 20
@@ -6,7 +6,7 @@ from munch import Munch
 from requests import RequestException
 import six
 
-from backend.frontend import FrontendClient
+from backend.frontend import FrontendClient, FrontendRejectedError
 
 
 if six.PY3:
@@ -21,8 +21,8 @@ import pytest
 
 @pytest.yield_fixture
 def post_req():
-    with mock.patch("backend.frontend.post") as obj:
-        yield obj
+    with mock.patch("backend.frontend.Session") as obj:
+        yield obj.return_value.post
 
 
 @pytest.yield_fixture
@@ -67,6 +67,19 @@ class TestFrontendClient(object):
 
         assert post_req.called
 
+    def test_post_to_frontend_rejected(self, post_req):
+        for status_code in [400, 404, 500]:
+            post_req.return_value.status_code = status_code
+            with pytest.raises(FrontendRejectedError):
+                self.fc._post_to_frontend(self.data, self.url_path)
+
+    def test_post_to_frontend_unavailable(self, post_req):
+        for status_code in [502, 503, 504]:
+            post_req.return_value.status_code = status_code
+            with pytest.raises(RequestException) as err:
+                self.fc._post_to_frontend(self.data, self.url_path)
+            assert not isinstance(err.value, FrontendRejectedError)
+
     def test_post_to_frontend_post_error(self, post_req):
         post_req.side_effect = RequestException()
         with pytest.raises(RequestException):
@@ -95,9 +108,20 @@ class TestFrontendClient(object):
         self.ptf.side_effect = RequestException()
 
         with pytest.raises(RequestException):
+            self.fc._post_to_frontend_repeatedly(self.data, self.url_path, max_repeats=6)
+
+        # the same backoff as the update aggregator uses
+        assert mc_time.sleep.call_args_list == [
+            mock.call(1), mock.call(2), mock.call(4), mock.call(8), mock.call(16)]
+
+    def test_post_to_frontend_repeated_rejected(self, mask_post_to_fe, mc_time):
+        self.ptf.side_effect = FrontendRejectedError()
+
+        with pytest.raises(FrontendRejectedError):
             self.fc._post_to_frontend_repeatedly(self.data, self.url_path)
 
-        assert mc_time.sleep.called
+        assert len(self.ptf.call_args_list) == 1
+        assert not mc_time.sleep.called
 
     def test_update(self):
         ptfr = MagicMock()
@@ -105,6 +129,49 @@ class TestFrontendClient(object):
         self.fc.update(self.data)
         assert ptfr.call_args == mock.call(self.data, "update")
 
+    def test_update_spooled(self, tmpdir):
+        self.opts.update_spool_dir = str(tmpdir.join("spool"))
+        self.fc = FrontendClient(self.opts)
+        self.fc._post_to_frontend_repeatedly = MagicMock()
+
+        self.fc.update(self.data)
+        assert not self.fc._post_to_frontend_repeatedly.called
+        assert [data for _, data in self.fc.update_spool.take(10)] == [self.data]
+
+    def test_post_update(self, mask_post_to_fe):
+        self.ptf.return_value.json.return_value = {"updated_builds_ids": [1]}
+        assert self.fc.post_update(self.data) == {"updated_builds_ids": [1]}
+        assert self.ptf.call_args == mock.call(self.data, "update")
+
+    def test_session_per_process(self, post_req):
+        post_req.return_value.status_code = 200
+        self.fc._post_to_frontend(self.data, self.url_path)
+        session = self.fc.session
+        assert self.fc.session is session
+
+        with mock.patch("backend.frontend.os.getpid") as mc_getpid:
+            mc_getpid.return_value = -1
+            # forked worker must not reuse connections of the parent
+            assert self.fc._session_pid != -1
+            self.fc.session
+            assert self.fc._session_pid == -1
+
+    def test_get_auto_createrepo_statuses(self):
+        with mock.patch("backend.frontend.Session") as mc_session:
+            mc_get = mc_session.return_value.get
+            mc_get.return_value.status_code = 200
+            mc_get.return_value.json.return_value = {"projects": [
+                {"owner": "foo", "project": "bar", "auto_createrepo": True},
+                {"owner": "@group", "project": "baz", "auto_createrepo": False},
+            ]}
+            assert self.fc.get_auto_createrepo_statuses() == {
+                ("foo", "bar"): True, ("@group", "baz"): False}
+            assert mc_get.call_args[0][0] == "http://example.com//backend/auto_createrepo/"
+
+            mc_get.return_value.status_code = 500
+            with pytest.raises(RequestException):
+                self.fc.get_auto_createrepo_statuses()
+
     def test_starting_build(self):
         ptfr = MagicMock()
         self.fc._post_to_frontend_repeatedly = ptfr
@@ -135,3 +202,13 @@ class TestFrontendClient(object):
         expected = mock.call({'build_id': self.build_id, 'chroot': self.chroot_name},
                              'reschedule_build_chroot')
         assert ptfr.call_args == expected
+
+    def test_reschedule_build_spooled(self, tmpdir):
+        self.opts.update_spool_dir = str(tmpdir.join("spool"))
+        self.fc = FrontendClient(self.opts)
+        self.fc._post_to_frontend_repeatedly = MagicMock()
+
+        self.fc.reschedule_build(self.build_id, self.chroot_name)
+        assert not self.fc._post_to_frontend_repeatedly.called
+        assert [data for _, data in self.fc.update_spool.take(10)] == [
+            {"reschedule": {"build_id": self.build_id, "chroot": self.chroot_name}}]
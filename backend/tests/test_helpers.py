@@ -3,6 +3,8 @@
 
 from Queue import Empty
 import json
+import logging
+import os
 import shutil
 from subprocess import CalledProcessError
 import tempfile
@@ -13,10 +15,12 @@ import types
 from munch import Munch
 from redis import ConnectionError
 import six
-from backend.exceptions import CoprSpawnFailError
+from backend.exceptions import CoprSpawnFailError, CoprBackendError
 
 from backend.exceptions import BuilderError
-from backend.helpers import get_redis_connection, get_redis_logger, BackendConfigReader
+from backend.constants import LOG_QUEUE
+from backend.helpers import get_redis_connection, get_redis_logger, BackendConfigReader, \
+    RedisPublishHandler, remove_tree
 from backend.vm_manage import EventTopics, PUBSUB_MB
 from backend.vm_manage.check import HealthChecker, check_health
 
@@ -53,3 +57,81 @@ class TestHelpers(object):
             raise BuilderError("foobar", return_code=1, stdout="STDOUT", stderr="STDERR")
         except Exception as err:
             log.exception("error occurred: {}".format(err))
+
+    def test_redis_publish_handler_batches(self):
+        rc = get_redis_connection(self.opts)
+        rc.delete(LOG_QUEUE)
+        handler = RedisPublishHandler(rc, "worker", batch_size=3, flush_interval=60)
+        log = logging.getLogger("test_helpers.batches")
+        log.addHandler(handler)
+        log.setLevel(logging.DEBUG)
+        try:
+            log.debug("foo %s", 1)
+            log.info("bar")
+            assert rc.llen(LOG_QUEUE) == 0
+            log.info("baz")
+            assert rc.llen(LOG_QUEUE) == 3
+
+            # errors don't wait for the batch
+            log.error("error")
+            assert rc.llen(LOG_QUEUE) == 4
+        finally:
+            log.removeHandler(handler)
+            handler.close()
+
+        records = [json.loads(raw) for raw in rc.lrange(LOG_QUEUE, 0, -1)]
+        assert [(r["who"], r["level"], r["msg"]) for r in records] == [
+            ("worker", "debug", "foo 1"), ("worker", "info", "bar"),
+            ("worker", "info", "baz"), ("worker", "error", "error")]
+        assert records[0]["funcName"] == "test_redis_publish_handler_batches"
+        rc.delete(LOG_QUEUE)
+
+    def test_redis_publish_handler_flush_interval(self):
+        rc = get_redis_connection(self.opts)
+        rc.delete(LOG_QUEUE)
+        handler = RedisPublishHandler(rc, "worker", batch_size=100, flush_interval=0.1)
+        log = logging.getLogger("test_helpers.flush_interval")
+        log.addHandler(handler)
+        try:
+            log.warning("foo")
+            assert rc.llen(LOG_QUEUE) == 0
+            time.sleep(0.3)
+            assert rc.llen(LOG_QUEUE) == 1
+        finally:
+            log.removeHandler(handler)
+            handler.close()
+        rc.delete(LOG_QUEUE)
+
+    def test_read_scheduler_config(self):
+        tmp_dir = tempfile.mkdtemp()
+        config_file = os.path.join(tmp_dir, "copr-be.conf")
+        try:
+            with open(config_file, "w") as handle:
+                handle.write("[backend]\n"
+                             "destdir=/tmp\n"
+                             "scheduler_weights=@copr:2, bob/foo:0.5\n"
+                             "scheduler_priorities=bob:-1\n"
+                             "group0_max_queued_tasks=10\n")
+            opts = BackendConfigReader(config_file).read()
+            assert opts.scheduler == "fair"
+            assert opts.scheduler_weights == {"@copr": 2.0, "bob/foo": 0.5}
+            assert opts.scheduler_priorities == {"bob": -1}
+            assert opts.build_groups[0]["max_queued_tasks"] == 10
+
+            with open(config_file, "a") as handle:
+                handle.write("scheduler_priorities=bob:high\n")
+            with pytest.raises(CoprBackendError):
+                BackendConfigReader(config_file).read()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_remove_tree(self):
+        tmp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tmp_dir, "foo", "bar"))
+        open(os.path.join(tmp_dir, "foo", "bar", "baz"), "w").close()
+        remove_tree(os.path.join(tmp_dir, "foo"))
+        assert os.listdir(tmp_dir) == []
+
+        # missing tree is fine
+        remove_tree(os.path.join(tmp_dir, "foo"))
+        os.rmdir(tmp_dir)
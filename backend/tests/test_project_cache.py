@@ -0,0 +1,96 @@
+# coding: utf-8
+
+import json
+
+from munch import Munch
+from requests import RequestException
+import pytest
+import six
+
+if six.PY3:
+    from unittest import mock
+    from unittest.mock import MagicMock
+else:
+    import mock
+    from mock import MagicMock
+
+from copr.exceptions import CoprRequestException
+
+from backend.helpers import get_redis_connection
+from backend.project_cache import ProjectCache, KEY_LOADED, KEY_PROJECT
+
+
+class TestProjectCache(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            frontend_base_url="http://example.com",
+            project_cache_ttl=60,
+        )
+        self.rc = get_redis_connection(self.opts)
+        self.clean()
+
+        self.frontend_client = MagicMock()
+        self.frontend_client.get_auto_createrepo_statuses.return_value = {
+            ("foo", "bar"): False,
+            ("@group", "baz"): True,
+        }
+        self.cache = ProjectCache(self.opts, rc=self.rc, frontend_client=self.frontend_client)
+
+        self.client_patcher = mock.patch("backend.project_cache.CoprClient")
+        self.mc_client = self.client_patcher.start()
+        self.mc_client.return_value.get_project_details.return_value.data = {"detail": {
+            "auto_createrepo": True, "yum_repos": {"epel-7-x86_64": "url"}}}
+
+    def teardown_method(self, method):
+        self.client_patcher.stop()
+        self.clean()
+
+    def clean(self):
+        keys = self.rc.keys("copr:backend:project_cache:*")
+        if keys:
+            self.rc.delete(*keys)
+
+    def test_bulk_load(self):
+        assert self.cache.get("foo", "bar") == {"auto_createrepo": False}
+        assert self.cache.get_auto_createrepo("@group", "baz") is True
+        assert self.frontend_client.get_auto_createrepo_statuses.call_count == 1
+        assert not self.mc_client.called
+        assert 0 < self.rc.ttl(KEY_PROJECT.format(owner="foo", project="bar")) <= 60
+
+        # another process shares the cache
+        other = ProjectCache(self.opts, frontend_client=self.frontend_client)
+        assert other.get_auto_createrepo("foo", "bar") is False
+        assert self.frontend_client.get_auto_createrepo_statuses.call_count == 1
+
+    def test_fetch_missing_project(self):
+        assert self.cache.get("new", "project") == {"auto_createrepo": True}
+        assert self.mc_client.return_value.get_project_details.call_args == mock.call("project", "new")
+        assert self.cache.get("new", "project").auto_createrepo is True
+        assert self.mc_client.return_value.get_project_details.call_count == 1
+
+        self.mc_client.return_value.get_project_details.side_effect = \
+            CoprRequestException("Project does not exists")
+        with pytest.raises(CoprRequestException):
+            self.cache.get("deleted", "project")
+
+    def test_invalidate(self):
+        self.cache.get("foo", "bar")
+        self.cache.invalidate("foo", "bar")
+        # bulk load is still fresh, only the changed project is fetched
+        assert self.cache.get("foo", "bar").auto_createrepo is True
+        assert self.frontend_client.get_auto_createrepo_statuses.call_count == 1
+
+        self.rc.delete(KEY_LOADED)
+        self.cache.invalidate("foo", "bar")
+        assert self.cache.get("foo", "bar").auto_createrepo is False
+        assert self.frontend_client.get_auto_createrepo_statuses.call_count == 2
+
+    def test_frontend_error(self):
+        self.frontend_client.get_auto_createrepo_statuses.side_effect = RequestException()
+        assert self.cache.get_auto_createrepo("foo", "bar") is True
+        assert self.mc_client.called
+        # next miss tries the bulk load again
+        assert not self.rc.exists(KEY_LOADED)
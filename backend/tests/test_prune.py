@@ -0,0 +1,184 @@
+# coding: utf-8
+
+import bz2
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from munch import Munch
+import pytest
+
+from backend.createrepo import read_primary_db, read_primary_xml, get_repo_packages
+from backend.prune import rpmvercmp, compare_evr, get_kept_locations, find_obsolete_builds, \
+    get_prune_policy
+
+
+REPOMD_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo" xmlns:rpm="http://linux.duke.edu/metadata/rpm">
+  <data type="primary">
+    <location href="repodata/abc-primary.xml.gz"/>
+  </data>
+  {primary_db}
+</repomd>
+"""
+
+PRIMARY_DB_TEMPLATE = """<data type="primary_db">
+    <location href="repodata/abc-primary.sqlite.bz2"/>
+  </data>"""
+
+PRIMARY_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common" xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="{count}">
+{packages}
+</metadata>
+"""
+
+PACKAGE_TEMPLATE = """<package type="rpm">
+  <name>{name}</name>
+  <arch>{arch}</arch>
+  <version epoch="{epoch}" ver="{version}" rel="{release}"/>
+  <location href="{location}"/>
+</package>"""
+
+
+def pkg(name, version, release="1", epoch="0", arch="x86_64", build=None):
+    return Munch(name=name, arch=arch, epoch=epoch, version=version, release=release,
+                 location="{}/{}-{}-{}.{}.rpm".format(build or "00000001-" + name,
+                                                      name, version, release, arch))
+
+
+def write_repodata(repo_dir, packages, with_db=False):
+    repodata = os.path.join(repo_dir, "repodata")
+    os.makedirs(repodata)
+    with open(os.path.join(repodata, "repomd.xml"), "w") as handle:
+        handle.write(REPOMD_TEMPLATE.format(primary_db=PRIMARY_DB_TEMPLATE if with_db else ""))
+    with gzip.open(os.path.join(repodata, "abc-primary.xml.gz"), "wb") as handle:
+        handle.write(PRIMARY_TEMPLATE.format(
+            count=len(packages),
+            packages="\n".join(PACKAGE_TEMPLATE.format(**p) for p in packages)))
+
+    if with_db:
+        db_path = os.path.join(repodata, "primary.sqlite")
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE packages (name TEXT, arch TEXT, epoch TEXT, version TEXT, "
+                     "release TEXT, location_href TEXT)")
+        conn.executemany("INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?)",
+                         [(p.name, p.arch, p.epoch, p.version, p.release, p.location)
+                          for p in packages])
+        conn.commit()
+        conn.close()
+        with open(db_path, "rb") as src:
+            with open(os.path.join(repodata, "abc-primary.sqlite.bz2"), "wb") as dst:
+                dst.write(bz2.compress(src.read()))
+        os.unlink(db_path)
+
+
+def write_build(chroot_path, build, files, age_days):
+    build_path = os.path.join(chroot_path, build)
+    os.makedirs(build_path)
+    for name in files + ["success"]:
+        open(os.path.join(build_path, name), "w").close()
+    mtime = time.time() - age_days * 24 * 3600
+    os.utime(os.path.join(build_path, "success"), (mtime, mtime))
+
+
+@pytest.mark.parametrize("a,b,expected", [
+    ("1.0", "1.0", 0),
+    ("1.0", "1.1", -1),
+    ("1.10", "1.9", 1),
+    ("1.0", "1.0.1", -1),
+    ("1.0a", "1.0", 1),
+    ("1.a", "1.1", -1),
+    ("2.0.1", "2.0_1", 0),
+    ("1.0~rc1", "1.0", -1),
+    ("1.0~rc1", "1.0~rc2", -1),
+    ("1.0~rc1", "1.0~", 1),
+    ("5.fc23", "5.fc22", 1),
+    ("010", "10", 0),
+])
+def test_rpmvercmp(a, b, expected):
+    assert rpmvercmp(a, b) == expected
+    assert rpmvercmp(b, a) == -expected
+
+
+def test_compare_evr():
+    assert compare_evr(pkg("foo", "1.0", epoch="1"), pkg("foo", "2.0")) == 1
+    assert compare_evr(pkg("foo", "1.0", epoch=None), pkg("foo", "1.0", epoch="0")) == 0
+    assert compare_evr(pkg("foo", "1.0", "2"), pkg("foo", "1.0", "10")) == -1
+
+
+def test_get_kept_locations():
+    packages = [
+        pkg("foo", "1.0", build="01"),
+        pkg("foo", "1.2", build="03"),
+        pkg("foo", "1.1", build="02"),
+        # same version rebuilt in two builds
+        pkg("foo", "1.2", build="04"),
+        pkg("foo", "1.2", arch="i686", build="01"),
+        pkg("bar", "0.1", build="02"),
+    ]
+    assert get_kept_locations(packages, 1) == set(
+        p.location for p in [packages[1], packages[3], packages[4], packages[5]])
+    assert packages[2].location in get_kept_locations(packages, 2)
+    assert packages[0].location not in get_kept_locations(packages, 2)
+
+
+class TestFindObsoleteBuilds(object):
+
+    def setup_method(self, method):
+        self.tmp_dir_name = tempfile.mkdtemp()
+        self.chroot_path = os.path.join(self.tmp_dir_name, "fedora-23-x86_64")
+        os.makedirs(self.chroot_path)
+
+        self.packages = [
+            pkg("foo", "1.0", build="00000001-foo"),
+            pkg("foo", "1.1", build="00000002-foo"),
+            pkg("foo", "1.2", build="00000003-foo"),
+            pkg("bar", "0.1", build="00000004-bar"),
+        ]
+        for p, age in zip(self.packages, [30, 20, 20, 30]):
+            build, filename = p.location.split("/")
+            write_build(self.chroot_path, build, [filename, "build.log"], age)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir_name)
+
+    @pytest.mark.parametrize("with_db", [False, True])
+    def test_read_packages(self, with_db):
+        write_repodata(self.chroot_path, self.packages, with_db)
+        packages = get_repo_packages(self.chroot_path)
+        assert sorted(packages) == sorted(self.packages)
+        assert (read_primary_db(self.chroot_path) is not None) == with_db
+        assert sorted(read_primary_xml(self.chroot_path)) == sorted(self.packages)
+
+    @pytest.mark.parametrize("with_db", [False, True])
+    def test_find(self, with_db):
+        write_repodata(self.chroot_path, self.packages, with_db)
+        assert find_obsolete_builds(self.chroot_path) == ["00000001-foo", "00000002-foo"]
+        assert find_obsolete_builds(self.chroot_path, keep=2) == ["00000001-foo"]
+        assert find_obsolete_builds(self.chroot_path, days=25) == ["00000001-foo"]
+        assert find_obsolete_builds(self.chroot_path, days=40) == []
+
+    def test_unknown_packages_kept(self):
+        # new build not yet in the repodata
+        write_repodata(self.chroot_path, self.packages[1:])
+        write_build(self.chroot_path, "00000005-foo", ["foo-0.9-1.x86_64.rpm"], 30)
+        assert find_obsolete_builds(self.chroot_path) == ["00000002-foo"]
+
+    def test_missing_repodata(self):
+        assert find_obsolete_builds(self.chroot_path) is None
+
+
+def test_get_prune_policy():
+    opts = Munch(
+        prune_days=20,
+        prune_keep_builds=2,
+        prune_policy_days={"foo": 30, "foo/bar": 60},
+        prune_policy_keep={"foo/baz": 5},
+    )
+    assert get_prune_policy(opts, "foo", "bar") == {"days": 60, "keep": 2}
+    assert get_prune_policy(opts, "foo", "baz") == {"days": 30, "keep": 5}
+    assert get_prune_policy(opts, "other", "bar") == {"days": 20, "keep": 2}
+    assert get_prune_policy(Munch(), "foo", "bar") == {"days": 14, "keep": 1}
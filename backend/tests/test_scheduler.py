@@ -0,0 +1,150 @@
+# coding: utf-8
+
+from munch import Munch
+
+import pytest
+
+from backend.exceptions import CoprBackendError
+from backend.scheduler import DeficitRoundRobin, FifoScheduler, FairShareScheduler, \
+    get_scheduler
+
+
+def make_task(task_id, owner, project="foo"):
+    return {"task_id": task_id, "project_owner": owner, "project_name": project}
+
+
+def pop_all(scheduler, is_owner_blocked=None):
+    result = []
+    while True:
+        task = scheduler.pop(is_owner_blocked)
+        if task is None:
+            return result
+        result.append(task["task_id"])
+
+
+class TestDeficitRoundRobin(object):
+
+    def test_round_robin(self):
+        drr = DeficitRoundRobin()
+        for item in ["a1", "a2", "a3"]:
+            drr.push([("a", 1)], item)
+        for item in ["b1", "b2"]:
+            drr.push([("b", 1)], item)
+
+        assert len(drr) == 5
+        assert [drr.pop() for _ in range(6)] == ["a1", "b1", "a2", "b2", "a3", None]
+        assert len(drr) == 0
+        assert drr.flows == {}
+
+    def test_weights(self):
+        drr = DeficitRoundRobin()
+        for idx in range(6):
+            drr.push([("a", 2)], "a{}".format(idx))
+            drr.push([("b", 0.5)], "b{}".format(idx))
+
+        assert [drr.pop() for _ in range(6)] == ["a0", "a1", "a2", "a3", "b0", "a4"]
+
+    def test_nested(self):
+        drr = DeficitRoundRobin()
+        for item in ["x1", "x2", "x3"]:
+            drr.push([("a", 1), ("x", 1)], item)
+        drr.push([("a", 1), ("y", 1)], "y1")
+        drr.push([("b", 1), ("z", 1)], "z1")
+
+        assert [drr.pop() for _ in range(5)] == ["x1", "z1", "y1", "x2", "x3"]
+
+    def test_blocked(self):
+        drr = DeficitRoundRobin()
+        for item in ["a1", "a2"]:
+            drr.push([("a", 1)], item)
+        drr.push([("b", 1)], "b1")
+
+        assert drr.pop(lambda key: True) is None
+        assert drr.pop(lambda key: key == "a") == "b1"
+        assert drr.pop(lambda key: key == "a") is None
+        assert drr.pop() == "a1"
+
+    def test_copy(self):
+        drr = DeficitRoundRobin()
+        drr.push([("a", 1), ("x", 1)], "x1")
+        drr.push([("a", 1), ("x", 1)], "x2")
+        drr.push([("b", 1), ("y", 1)], "y1")
+
+        clone = drr.copy()
+        assert [clone.pop() for _ in range(3)] == ["x1", "y1", "x2"]
+        assert len(drr) == 3
+        assert [drr.pop() for _ in range(3)] == ["x1", "y1", "x2"]
+
+
+class TestSchedulers(object):
+
+    def setup_method(self, method):
+        self.tasks = [make_task("1-a", "alice")] + \
+            [make_task("{}-b".format(idx), "bob") for idx in range(2, 6)] + \
+            [make_task("6-c", "@copr")]
+
+    def test_add_dedup(self):
+        scheduler = FairShareScheduler()
+        assert scheduler.add(self.tasks[0])
+        assert not scheduler.add(self.tasks[0])
+        assert len(scheduler) == 1
+        assert "1-a" in scheduler
+
+        scheduler.pop()
+        assert "1-a" not in scheduler
+        assert scheduler.add(self.tasks[0])
+
+    def test_fifo(self):
+        scheduler = FifoScheduler()
+        for task in self.tasks:
+            scheduler.add(task)
+
+        assert scheduler.get_order() == ["1-a", "2-b", "3-b", "4-b", "5-b", "6-c"]
+        assert scheduler.pop(lambda owner: owner != "bob")["task_id"] == "2-b"
+        assert pop_all(scheduler, lambda owner: owner == "bob") == ["1-a", "6-c"]
+        assert len(scheduler) == 3
+
+    def test_fair_share(self):
+        scheduler = FairShareScheduler()
+        for task in self.tasks:
+            scheduler.add(task)
+
+        order = scheduler.get_order()
+        assert order == ["1-a", "2-b", "6-c", "3-b", "4-b", "5-b"]
+        assert len(scheduler) == 6
+        assert pop_all(scheduler) == order
+
+    def test_fair_share_projects(self):
+        scheduler = FairShareScheduler(weights={"bob/bar": 2})
+        for idx in range(4):
+            scheduler.add(make_task("foo{}".format(idx), "bob", "foo"))
+            scheduler.add(make_task("bar{}".format(idx), "bob", "bar"))
+
+        assert pop_all(scheduler) == ["foo0", "bar0", "bar1", "foo1",
+                                      "bar2", "bar3", "foo2", "foo3"]
+
+    def test_fair_share_priorities(self):
+        scheduler = FairShareScheduler(priorities={"bob": -1, "@copr": 5, "alice/bar": 10})
+        for task in self.tasks:
+            scheduler.add(task)
+        scheduler.add(make_task("7-a", "alice", "bar"))
+
+        assert scheduler.get_order() == ["7-a", "6-c", "1-a", "2-b", "3-b", "4-b", "5-b"]
+        # lower priority is served when the higher one is blocked
+        assert scheduler.pop(lambda owner: owner != "bob")["task_id"] == "2-b"
+        assert pop_all(scheduler) == ["7-a", "6-c", "1-a", "3-b", "4-b", "5-b"]
+        assert scheduler.classes == {}
+
+    def test_get_scheduler(self):
+        opts = Munch(scheduler="fair", scheduler_weights={"bob": 2},
+                     scheduler_priorities={})
+        scheduler = get_scheduler(opts)
+        assert isinstance(scheduler, FairShareScheduler)
+        assert scheduler.weights == {"bob": 2}
+
+        opts.scheduler = "fifo"
+        assert isinstance(get_scheduler(opts), FifoScheduler)
+
+        opts.scheduler = "foo"
+        with pytest.raises(CoprBackendError):
+            get_scheduler(opts)
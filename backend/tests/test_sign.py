@@ -1,6 +1,7 @@
 import os
 import tempfile
 import shutil
+import threading
 import time
 
 from munch import Munch
@@ -16,7 +17,8 @@ else:
     import mock
     from mock import MagicMock
 
-from backend.sign import get_pubkey, _sign_one, sign_rpms_in_dir, create_user_keys
+from backend.sign import get_pubkey, _sign_one, sign_rpms_in_dir, create_user_keys, \
+    get_cached_pubkey, clear_pubkey_cache
 
 
 STDOUT = "stdout"
@@ -34,6 +36,7 @@ class TestSign(object):
         self.tmp_dir_path = None
 
         self.opts = Munch(keygen_host="example.com")
+        clear_pubkey_cache()
 
     def teardown_method(self, method):
         if self.tmp_dir_path:
@@ -179,6 +182,37 @@ class TestSign(object):
                 create_user_keys(self.username, self.projectname, self.opts)
             assert "Failed to create key-pair for user: foo, project:bar" in str(err)
 
+    @mock.patch("backend.sign.time")
+    @mock.patch("backend.sign.get_pubkey")
+    def test_get_cached_pubkey(self, mc_gp, mc_time, tmp_dir):
+        mc_gp.return_value = "key"
+        mc_time.time.return_value = 1000
+        outfile = os.path.join(self.tmp_dir_path, "pubkey.gpg")
+
+        assert get_cached_pubkey(self.username, self.projectname, ttl=60) == "key"
+        assert get_cached_pubkey(self.username, self.projectname, ttl=60,
+                                 outfile=outfile) == "key"
+        with open(outfile) as handle:
+            assert handle.read() == "key"
+        assert mc_gp.call_count == 1
+
+        # other project has own key
+        get_cached_pubkey(self.username, "other", ttl=60)
+        assert mc_gp.call_count == 2
+
+        mc_time.time.return_value = 1060
+        mc_gp.return_value = "new key"
+        assert get_cached_pubkey(self.username, self.projectname, ttl=60) == "new key"
+        assert mc_gp.call_count == 3
+
+    @mock.patch("backend.sign.get_pubkey")
+    def test_get_cached_pubkey_no_key(self, mc_gp):
+        # missing key isn't cached, it's created right after the check
+        mc_gp.side_effect = [CoprSignNoKeyError("foobar"), "key"]
+        with pytest.raises(CoprSignNoKeyError):
+            get_cached_pubkey(self.username, self.projectname)
+        assert get_cached_pubkey(self.username, self.projectname) == "key"
+
     @mock.patch("backend.sign._sign_one")
     @mock.patch("backend.sign.create_user_keys")
     @mock.patch("backend.sign.get_pubkey")
@@ -249,17 +283,52 @@ class TestSign(object):
     def test_sign_rpms_id_dir_sign_error_one(
             self, mc_gp, mc_cuk, mc_so, tmp_dir, tmp_files):
 
-        mc_so.side_effect = [
-            None, CoprSignError("foobar"), None
-        ]
-        with pytest.raises(CoprSignError):
+        bad_rpm = os.path.join(self.tmp_dir_path, "bar.rpm")
+
+        def sign_one(path, email):
+            if path == bad_rpm:
+                raise CoprSignError("foobar")
+
+        mc_so.side_effect = sign_one
+        with pytest.raises(CoprSignError) as err:
             sign_rpms_in_dir(self.username, self.projectname,
                              self.tmp_dir_path, self.opts, log=MagicMock())
 
         assert mc_gp.called
         assert not mc_cuk.called
 
-        assert mc_so.called
+        assert mc_so.call_count == 2
+        # only the failed package is reported
+        assert "{}: foobar".format(bad_rpm) in str(err.value)
+        assert "foo.rpm" not in str(err.value)
+
+    @mock.patch("backend.sign._sign_one")
+    @mock.patch("backend.sign.create_user_keys")
+    @mock.patch("backend.sign.get_pubkey")
+    def test_sign_rpms_in_dir_parallel(self, mc_gp, mc_cuk, mc_so, tmp_dir):
+        for idx in range(20):
+            with open(os.path.join(self.tmp_dir_path, "{}.rpm".format(idx)), "w") as handle:
+                handle.write("1")
+
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def sign_one(path, email):
+            with lock:
+                running.append(path)
+                max_running.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(path)
+
+        mc_so.side_effect = sign_one
+        self.opts.sign_workers = 3
+        sign_rpms_in_dir(self.username, self.projectname,
+                         self.tmp_dir_path, self.opts, log=MagicMock())
+
+        assert mc_so.call_count == 20
+        assert max(max_running) == 3
 
     @mock.patch("backend.sign._sign_one")
     @mock.patch("backend.sign.create_user_keys")
@@ -0,0 +1,236 @@
+# coding: utf-8
+
+from munch import Munch
+import six
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+import pytest
+
+from backend.helpers import get_redis_connection
+from backend.task_queue import TaskQueue, get_group_task_queue
+
+
+"""
+REQUIRES RUNNING REDIS
+"""
+
+MODULE_REF = "backend.task_queue"
+
+
+@pytest.yield_fixture
+def mc_time():
+    with mock.patch("{}.time".format(MODULE_REF)) as handle:
+        handle.time.return_value = 1000
+        yield handle
+
+
+class TestTaskQueue(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            task_lease_timeout=60,
+        )
+        self.rc = get_redis_connection(self.opts)
+        self.queue = get_group_task_queue(self.opts, 0, rc=self.rc)
+
+        self.tasks = [
+            {"task_id": "1-fedora-22-x86_64", "project_owner": "bob"},
+            {"task_id": "1-fedora-23-x86_64", "project_owner": "bob"},
+            {"task_id": "2-fedora-22-x86_64", "project_owner": "alice"},
+        ]
+
+    def teardown_method(self, method):
+        keys = self.rc.keys("*")
+        if keys:
+            self.rc.delete(*keys)
+
+    def test_get_group_task_queue(self):
+        assert self.queue.name == "copr-be-0"
+        assert self.queue.lease_timeout == 60
+
+    def test_enqueue(self):
+        for task in self.tasks:
+            assert self.queue.enqueue(task)
+        assert not self.queue.enqueue(self.tasks[0])
+
+        assert self.queue.length == 3
+        assert self.queue.count_by_owner("bob") == 2
+        assert self.queue.count_by_owner("alice") == 1
+        assert self.queue.count_by_owner("eve") == 0
+
+    def test_enqueue_many(self):
+        assert self.queue.enqueue(self.tasks[1])
+        assert self.queue.enqueue_many(self.tasks) == [True, False, True]
+        assert self.queue.enqueue_many([]) == []
+
+        assert [self.queue.acquire().task_id for _ in self.tasks] == \
+            [self.tasks[i]["task_id"] for i in [1, 0, 2]]
+        assert self.queue.get_counts(["bob", "alice", "eve"]) == ({"bob": 2, "alice": 1}, 3)
+        assert self.queue.get_counts([]) == ({}, 3)
+        assert self.queue.get_counts() == ({"bob": 2, "alice": 1}, 3)
+
+    def test_contains_many(self):
+        self.queue.enqueue(self.tasks[1])
+        assert self.queue.contains_many([task["task_id"] for task in self.tasks]) == \
+            [False, True, False]
+        assert self.queue.contains_many([]) == []
+
+    def test_acquire_order(self):
+        assert self.queue.acquire() is None
+        for task in self.tasks:
+            self.queue.enqueue(task)
+
+        leases = [self.queue.acquire() for _ in self.tasks]
+        assert [lease.data for lease in leases] == self.tasks
+        assert [lease.task_id for lease in leases] == [t["task_id"] for t in self.tasks]
+        assert len(set(lease.token for lease in leases)) == 3
+        assert self.queue.acquire() is None
+
+        assert self.queue.length == 0
+        assert self.queue.processing_count == 3
+        # processed tasks still count and block re-submission
+        assert self.queue.count_by_owner("bob") == 2
+        assert not self.queue.enqueue(self.tasks[0])
+
+    def test_ack(self):
+        for task in self.tasks:
+            self.queue.enqueue(task)
+        lease = self.queue.acquire()
+
+        assert not self.queue.ack(lease.task_id, "wrong token")
+        assert self.queue.ack(lease.task_id, lease.token)
+        assert not self.queue.ack(lease.task_id, lease.token)
+
+        assert self.queue.processing_count == 0
+        assert self.queue.count_by_owner("bob") == 1
+
+        # finished task could be submitted again
+        assert self.queue.enqueue(self.tasks[0])
+
+    def test_ack_drops_owner(self):
+        self.queue.enqueue(self.tasks[2])
+        lease = self.queue.acquire()
+        assert self.queue.ack(lease.task_id, lease.token)
+        assert self.rc.hgetall(self.queue.key_owners) == {}
+
+    def test_pop_released_owners(self):
+        for task in self.tasks:
+            self.queue.enqueue(task)
+        assert self.queue.pop_released_owners() == set()
+
+        leases = [self.queue.acquire() for _ in self.tasks]
+        self.queue.ack(leases[0].task_id, leases[0].token)
+        self.queue.nack(leases[1].task_id, leases[1].token)
+        self.queue.nack(leases[2].task_id, leases[2].token, requeue=False)
+        # requeued task is still counted
+        assert self.queue.pop_released_owners() == {"bob", "alice"}
+        assert self.queue.pop_released_owners() == set()
+
+    def test_nack(self):
+        for task in self.tasks:
+            self.queue.enqueue(task)
+        lease = self.queue.acquire()
+
+        assert not self.queue.nack(lease.task_id, "wrong token")
+        assert self.queue.nack(lease.task_id, lease.token)
+        assert not self.queue.nack(lease.task_id, lease.token)
+
+        # requeued task goes first
+        assert self.queue.length == 3
+        assert self.queue.acquire().task_id == lease.task_id
+
+    def test_nack_wo_requeue(self):
+        self.queue.enqueue(self.tasks[0])
+        lease = self.queue.acquire()
+        assert self.queue.nack(lease.task_id, lease.token, requeue=False)
+        assert self.queue.length == 0
+        assert self.queue.processing_count == 0
+        assert self.queue.count_by_owner("bob") == 0
+
+    def test_lease_expiration(self, mc_time):
+        for task in self.tasks:
+            self.queue.enqueue(task)
+        lease = self.queue.acquire()
+
+        mc_time.time.return_value = 1000 + 59
+        assert self.queue.renew(lease.task_id, lease.token)
+
+        # renewed lease is valid for another lease_timeout
+        mc_time.time.return_value = 1000 + 100
+        second = self.queue.acquire()
+        assert second.task_id != lease.task_id
+
+        mc_time.time.return_value = 1000 + 59 + 61
+        third = self.queue.acquire()
+        assert third.task_id == lease.task_id
+        assert third.token != lease.token
+
+        # the original worker lost its lease
+        assert not self.queue.renew(lease.task_id, lease.token)
+        assert not self.queue.ack(lease.task_id, lease.token)
+        assert self.queue.ack(third.task_id, third.token)
+
+    def test_ack_after_expiration_before_reacquire(self, mc_time):
+        self.queue.enqueue(self.tasks[0])
+        lease = self.queue.acquire()
+
+        mc_time.time.return_value = 1000 + 120
+        assert self.queue.ack(lease.task_id, lease.token)
+        assert self.queue.acquire() is None
+
+    def test_get_stats(self):
+        for task in self.tasks:
+            self.queue.enqueue(task)
+        self.queue.enqueue(self.tasks[0])
+        first = self.queue.acquire()
+        second = self.queue.acquire()
+        self.queue.ack(first.task_id, first.token)
+        self.queue.nack(second.task_id, second.token)
+
+        stats = self.queue.get_stats()
+        assert stats.pending == 2
+        assert stats.processing == 0
+        # duplicate and requeued tasks are not counted again
+        assert stats.enqueued == 3
+        assert stats.finished == 1
+
+    def test_clean(self):
+        for task in self.tasks:
+            self.queue.enqueue(task)
+        self.queue.acquire()
+
+        self.queue.clean()
+        assert self.rc.llen(self.queue.key_wakeup) == 0
+        assert self.queue.length == 0
+        assert self.queue.processing_count == 0
+        assert self.queue.count_by_owner("bob") == 0
+        assert self.queue.acquire() is None
+
+    def test_acquire_wait(self):
+        # nothing to do, waits for the timeout
+        assert self.queue.acquire(timeout=1) is None
+
+        # one wakeup token per pending task
+        for task in self.tasks:
+            self.queue.enqueue(task)
+        assert self.rc.llen(self.queue.key_wakeup) == 3
+        assert self.queue.acquire(timeout=1).task_id == self.tasks[0]["task_id"]
+        assert self.rc.llen(self.queue.key_wakeup) == 2
+
+        # worker which didn't wait leaves no surplus tokens
+        self.queue.acquire()
+        assert self.rc.llen(self.queue.key_wakeup) == 1
+
+        lease = self.queue.acquire(timeout=1)
+        assert self.rc.llen(self.queue.key_wakeup) == 0
+
+        # requeued task wakes up a worker
+        self.queue.nack(lease.task_id, lease.token)
+        assert self.rc.llen(self.queue.key_wakeup) == 1
+        assert self.queue.acquire(timeout=1).task_id == lease.task_id
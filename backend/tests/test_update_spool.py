@@ -0,0 +1,52 @@
+# coding: utf-8
+
+import os
+
+from backend.update_spool import UpdateSpool
+
+
+class TestUpdateSpool(object):
+
+    def test_put_take_remove(self, tmpdir):
+        spool = UpdateSpool(str(tmpdir.join("spool")))
+        assert len(spool) == 0
+        assert spool.take(10) == []
+
+        updates = [{"builds": [{"id": idx}]} for idx in range(5)]
+        for data in updates:
+            spool.put(data)
+        assert len(spool) == 5
+        # no temporary files are left
+        assert sorted(os.listdir(spool.path)) == spool.names()
+
+        batch = spool.take(3)
+        assert [data for _, data in batch] == updates[:3]
+        # updates stay in the spool until removed
+        assert [data for _, data in spool.take(3)] == updates[:3]
+
+        spool.remove([name for name, _ in batch])
+        spool.remove(["not-there.json"])
+        assert [data for _, data in spool.take(10)] == updates[3:]
+
+    def test_survives_restart(self, tmpdir):
+        path = str(tmpdir.join("spool"))
+        UpdateSpool(path).put({"actions": [{"id": 1}]})
+        assert [data for _, data in UpdateSpool(path).take(10)] == [{"actions": [{"id": 1}]}]
+
+    def test_take_broken(self, tmpdir):
+        spool = UpdateSpool(str(tmpdir))
+        tmpdir.join("0-broken.json").write("{{{")
+        tmpdir.join(".1-partial.json.tmp").write("{")
+        spool.put({"builds": []})
+
+        assert [data for _, data in spool.take(10)] == [None, {"builds": []}]
+
+    def test_reject(self, tmpdir):
+        spool = UpdateSpool(str(tmpdir.join("spool")))
+        spool.put({"builds": [{"id": 1}]})
+        spool.put({"builds": [{"id": 2}]})
+        name = spool.names()[0]
+
+        spool.reject([name])
+        assert [data for _, data in spool.take(10)] == [{"builds": [{"id": 2}]}]
+        assert tmpdir.join("spool", "rejected", name).check()
@@ -0,0 +1,111 @@
+# coding: utf-8
+
+from munch import Munch
+
+from backend.vm_manage.autoscale import RateMeter, AutoscalePolicy
+
+
+def make_state(**kwargs):
+    state = Munch(pending=0, backlog=0, processing=0, enqueued=0, finished=0, ready=0,
+                  in_use=0, starting=0, spawning=0)
+    state.update(kwargs)
+    return state
+
+
+class TestRateMeter(object):
+
+    def test_rate(self):
+        meter = RateMeter(half_life=10)
+        assert meter.update(0, 100) == 0
+        # one observation of the half life has half weight
+        assert meter.update(10, 120) == 1
+        assert meter.update(10, 500) == 1
+        assert 1 < meter.update(20, 140) < 2
+
+    def test_counter_reset(self):
+        meter = RateMeter(half_life=10)
+        meter.update(0, 100)
+        rate = meter.update(10, 5)
+        assert rate == 0
+        assert meter.update(20, 25) == 1
+
+
+class TestAutoscalePolicy(object):
+
+    def setup_method(self, method):
+        self.policy = AutoscalePolicy(max_vm_total=10, max_spawn_processes=4,
+                                      warm_pool=1, spawn_time=100, scale_down_delay=50)
+
+    def test_spawn_for_pending(self):
+        decision = self.policy.decide(0, make_state(pending=3, ready=1))
+        assert decision.target_ready == 4
+        assert decision.spawn == 3
+        assert decision.terminate == 0
+
+        # VMs on the way are counted
+        decision = self.policy.decide(1, make_state(pending=3, ready=1, starting=1, spawning=2))
+        assert decision.spawn == 0
+
+    def test_spawn_for_backlog(self):
+        # tasks over the queue limit wait in job grabber
+        decision = self.policy.decide(0, make_state(pending=2, backlog=5))
+        assert decision.target_ready == 8
+        assert decision.spawn == 4
+
+    def test_spawn_for_acquired(self):
+        # workers took the tasks from the queue and wait for VMs
+        policy = AutoscalePolicy(max_vm_total=10, max_spawn_processes=10,
+                                 warm_pool=0, spawn_time=100, scale_down_delay=50)
+        decision = policy.decide(0, make_state(processing=8))
+        assert decision.target_ready == 8
+        assert decision.spawn == 8
+
+        # tasks being built don't need another VM
+        decision = policy.decide(1, make_state(processing=8, in_use=8))
+        assert decision.target_ready == 0
+        assert decision.spawn == 0
+
+    def test_spawn_limits(self):
+        decision = self.policy.decide(0, make_state(pending=20))
+        assert decision.spawn == 4
+
+        decision = self.policy.decide(1, make_state(pending=20, in_use=8, spawning=1))
+        assert decision.target_ready == 2
+        assert decision.spawn == 1
+
+    def test_predicted_arrivals(self):
+        self.policy.decide(0, make_state())
+        # 0.1 task per second observed for one half life gives rate 0.05,
+        # 5 tasks are expected during the spawn time
+        decision = self.policy.decide(300, make_state(enqueued=30))
+        assert decision.arrival_rate == 0.05
+        assert decision.target_ready == 6
+
+        # finishing builds cover the arrivals
+        policy = AutoscalePolicy(10, 4, warm_pool=1, spawn_time=100)
+        policy.decide(0, make_state())
+        decision = policy.decide(300, make_state(enqueued=30, finished=30))
+        assert decision.target_ready == 1
+
+    def test_scale_down_delay(self):
+        state = make_state(ready=5)
+        decision = self.policy.decide(0, state)
+        assert decision.terminate == 0
+
+        decision = self.policy.decide(49, state)
+        assert decision.terminate == 0
+
+        decision = self.policy.decide(50, state)
+        assert decision.terminate == 4
+
+        # demand returns before the delay, counting starts again
+        self.policy.decide(60, make_state(pending=10, ready=5))
+        assert self.policy.decide(70, state).terminate == 0
+        assert self.policy.decide(120, state).terminate == 4
+
+    def test_from_group(self):
+        policy = AutoscalePolicy.from_group({
+            "max_vm_total": 5, "max_spawn_processes": 2, "vm_warm_pool": 0,
+            "vm_spawn_time": 60, "vm_scale_down_delay": 30})
+        assert (policy.max_vm_total, policy.max_spawn_processes, policy.warm_pool,
+                policy.spawn_time, policy.scale_down_delay) == (5, 2, 0, 60, 30)
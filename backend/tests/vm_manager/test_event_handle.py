@@ -13,7 +13,7 @@ import six
 
 from backend.exceptions import VmDescriptorNotFound
 from backend.helpers import get_redis_connection
-from backend.vm_manage import VmStates
+from backend.vm_manage import VmStates, PUBSUB_VM_READY
 from backend.vm_manage.event_handle import EventHandler, Recycle
 from backend.vm_manage.models import VmDescriptor
 
@@ -185,9 +185,16 @@ class TestEventHandle(object):
         msg = self.msg
         msg["result"] = "OK"
 
+        pubsub = self.rc.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(PUBSUB_VM_READY.format(group=self.group))
+        pubsub.get_message(timeout=1)
+
         self.eh.on_health_check_result(msg)
         assert self.vmd.get_field(self.rc, "state") == VmStates.READY
         assert int(self.vmd.get_field(self.rc, "check_fails")) == 0
+        # workers waiting for VM are notified
+        assert pubsub.get_message(timeout=1)["data"] == self.vm_name
+        pubsub.close()
 
         # if old state in "in_use" don't change it
         self.vmd.store_field(self.rc, "state", VmStates.IN_USE)
@@ -7,12 +7,15 @@ import time
 from multiprocessing import Queue
 
 from munch import Munch
+from redis import ResponseError
 import six
 
 from backend import exceptions
 from backend.exceptions import VmError, NoVmAvailable
-from backend.vm_manage import VmStates, KEY_VM_POOL, PUBSUB_MB, EventTopics, KEY_SERVER_INFO
+from backend.vm_manage import VmStates, KEY_VM_POOL, PUBSUB_MB, EventTopics, KEY_SERVER_INFO, \
+    KEY_VM_INSTANCE, KEY_VM_BY_STATE, KEY_VM_READY_CLEAN, KEY_VM_READY_DIRTY, KEY_VM_IN_USE_BY_USER
 from backend.vm_manage.manager import VmManager
+from backend.vm_manage.models import VmDescriptor
 from backend.daemons.vm_master import VmMaster
 from backend.helpers import get_redis_connection
 
@@ -64,6 +67,7 @@ class TestManager(object):
 
             fedmsg_enabled=False,
             sleeptime=0.1,
+            vm_lease_timeout=120,
             do_sign=True,
             timeout=1800,
             # destdir=self.tmp_dir_path,
@@ -216,9 +220,11 @@ class TestManager(object):
 
         with pytest.raises(NoVmAvailable):
             self.vmm.acquire_vm(0, self.username, 42)
+        # other users are not limited
+        self.vmm.acquire_vm(0, "alice", 43)
 
-        acquired_vmd_list[-1].store_field(self.rc, "state", VmStates.READY)
-        self.vmm.acquire_vm(0, self.username, 42)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        assert self.vmm.acquire_vm(0, self.username, 42).vm_name == vmd.vm_name
 
     def test_acquire_only_ready_state(self, mc_time):
         mc_time.time.return_value = 0
@@ -257,6 +263,123 @@ class TestManager(object):
         vmd_got_another = self.vmm.acquire_vm(group=self.group, username=self.username, pid=self.pid)
         assert vmd_got_another.vm_name == self.vm_name
 
+    def test_release_vm_notifies_ready(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+
+        pubsub = self.vmm.subscribe_vm_ready(self.group)
+        self.vmm.acquire_vm(group=self.group, username=self.username, pid=self.pid)
+        mc_time.time.side_effect = time.time
+        assert self.vmm.wait_vm_ready(pubsub, 0.1) is None
+
+        assert self.vmm.release_vm(self.vm_name)
+        assert self.vmm.wait_vm_ready(pubsub, 1) == self.vm_name
+
+        # VM with failed health check isn't ready after release
+        mc_time.time.side_effect = None
+        self.vmm.acquire_vm(group=self.group, username=self.username, pid=self.pid)
+        vmd.store_field(self.rc, "check_fails", 1)
+        assert self.vmm.release_vm(self.vm_name)
+        mc_time.time.side_effect = time.time
+        assert self.vmm.wait_vm_ready(pubsub, 0.1) is None
+        pubsub.close()
+
+    def get_index(self):
+        result = {}
+        for key in self.rc.keys("copr:backend:vm_*:set::*"):
+            if not key.startswith(KEY_VM_POOL.format(group="")):
+                result[key] = self.rc.smembers(key)
+        return result
+
+    def test_vm_index(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+        by_state = lambda state: KEY_VM_BY_STATE.format(group=self.group, state=state)
+
+        self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        assert self.get_index() == {by_state(VmStates.GOT_IP): {self.vm_name}}
+
+        mc_time.time.return_value = 2
+        assert self.vmm.set_checking_state(self.vmm.get_vm_by_name(self.vm_name))
+        assert self.get_index() == {by_state(VmStates.CHECK_HEALTH): {self.vm_name}}
+
+        vmd = self.vmm.get_vm_by_name(self.vm_name)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        assert self.get_index() == {
+            by_state(VmStates.READY): {self.vm_name},
+            KEY_VM_READY_CLEAN.format(group=self.group): {self.vm_name},
+        }
+
+        self.vmm.acquire_vm(self.group, self.username, self.pid)
+        assert self.get_index() == {
+            by_state(VmStates.IN_USE): {self.vm_name},
+            KEY_VM_IN_USE_BY_USER.format(group=self.group, user=self.username): {self.vm_name},
+        }
+
+        self.vmm.release_vm(self.vm_name)
+        assert self.get_index() == {
+            by_state(VmStates.READY): {self.vm_name},
+            KEY_VM_READY_DIRTY.format(group=self.group, user=self.username): {self.vm_name},
+        }
+
+        self.vmm.start_vm_termination(self.vm_name)
+        assert self.get_index() == {by_state(VmStates.TERMINATING): {self.vm_name}}
+
+        self.vmm.remove_vm_from_pool(self.vm_name)
+        assert self.get_index() == {}
+
+    def test_rebuild_vm_indexes(self):
+        by_state = lambda state: KEY_VM_BY_STATE.format(group=self.group, state=state)
+        # VMs stored by the older backend version aren't indexed
+        for vm_name, state, user in [("a", VmStates.READY, None),
+                                     ("b", VmStates.READY, self.username),
+                                     ("c", VmStates.IN_USE, self.username)]:
+            self.vmm.add_vm_to_pool(self.vm_ip, vm_name, self.group)
+            self.rc.hset(KEY_VM_INSTANCE.format(vm_name=vm_name), "state", state)
+            if user:
+                self.rc.hset(KEY_VM_INSTANCE.format(vm_name=vm_name), "bound_to_user", user)
+        assert self.get_index() == {by_state(VmStates.GOT_IP): {"a", "b", "c"}}
+
+        self.vmm.rebuild_vm_indexes()
+        expected = {
+            by_state(VmStates.READY): {"a", "b"},
+            by_state(VmStates.IN_USE): {"c"},
+            KEY_VM_READY_CLEAN.format(group=self.group): {"a"},
+            KEY_VM_READY_DIRTY.format(group=self.group, user=self.username): {"b"},
+            KEY_VM_IN_USE_BY_USER.format(group=self.group, user=self.username): {"c"},
+        }
+        assert self.get_index() == expected
+
+        self.vmm.rebuild_vm_indexes()
+        assert self.get_index() == expected
+
+    def test_store_field_registers_script_once(self):
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        VmDescriptor._store_fields_script = None
+        with mock.patch.object(self.rc, "register_script",
+                               wraps=self.rc.register_script) as mc_register:
+            vmd.store_field(self.rc, "state", VmStates.READY)
+            vmd.store_field(self.rc, "state", VmStates.CHECK_HEALTH)
+        assert len(mc_register.call_args_list) == 1
+        assert self.get_index() == {
+            KEY_VM_BY_STATE.format(group=self.group, state=VmStates.CHECK_HEALTH): {self.vm_name}}
+
+    def test_index_keys_of_another_user(self):
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "bound_to_user", self.username)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+
+        # stale VMD doesn't know the user, index of the VM is left intact
+        stale = VmDescriptor(self.vm_ip, self.vm_name, self.group, VmStates.READY)
+        with pytest.raises(ResponseError):
+            stale.store_field(self.rc, "state", VmStates.TERMINATING)
+        assert self.vmm.get_vm_by_name(self.vm_name).state == VmStates.READY
+        assert self.rc.sismember(
+            KEY_VM_READY_DIRTY.format(group=self.group, user=self.username), self.vm_name)
+
     def test_release_only_in_use(self):
         vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
 
@@ -342,6 +465,23 @@ class TestManager(object):
         self.vmm.remove_vm_from_pool(self.vm_name)
         assert self.vmm.rc.scard(KEY_VM_POOL.format(group=self.group)) == 0
 
+    def test_get_snapshot(self, f_second_group):
+        self.vmm.add_vm_to_pool(self.vm_ip, "a1", 0)
+        self.vmm.add_vm_to_pool(self.vm_ip, "a2", 0).store_field(self.rc, "state", VmStates.READY)
+        self.vmm.add_vm_to_pool("127.0.0.2", "b1", 1)
+        # broken record is skipped
+        self.rc.sadd(KEY_VM_POOL.format(group=1), "b2")
+
+        snapshot = self.vmm.get_snapshot()
+        assert len(snapshot) == 3
+        assert set(vmd.vm_name for vmd in snapshot.get_all_vm_in_group(0)) == {"a1", "a2"}
+        assert [vmd.vm_name for vmd in snapshot.get_vm_by_group_and_state_list(
+            None, [VmStates.READY])] == ["a2"]
+        assert [vmd.vm_name for vmd in snapshot.get_vm_by_group_and_state_list(
+            1, [VmStates.GOT_IP])] == ["b1"]
+        assert len(snapshot.lookup_vms_by_ip(self.vm_ip)) == 2
+        assert [vmd.vm_name for vmd in self.vmm.get_all_vm_in_group(1)] == ["b1"]
+
     def test_get_vms(self, f_second_group, capsys):
         vmd_1 = self.vmm.add_vm_to_pool(self.vm_ip, "a1", self.group)
         vmd_2 = self.vmm.add_vm_to_pool(self.vm_ip, "a2", self.group)
@@ -0,0 +1,47 @@
+"""add build summary columns
+
+Revision ID: 2d8b4722918b
+Revises: 3341bf554454
+Create Date: 2015-12-03 14:07:22.631958
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d8b4722918b'
+down_revision = '3341bf554454'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('build', sa.Column('summary_status', sa.Integer(), nullable=True))
+    op.add_column('build', sa.Column('summary_started_on', sa.Integer(), nullable=True))
+    op.add_column('build', sa.Column('summary_ended_on', sa.Integer(), nullable=True))
+    op.add_column('build', sa.Column('summary_pkg_name', sa.Text(), nullable=True))
+    op.create_index('build_copr_id_id', 'build', ['copr_id', 'id'])
+    op.create_index('build_copr_id_submitted_on_id', 'build', ['copr_id', 'submitted_on', 'id'])
+
+    op.execute(sa.text("""
+UPDATE build SET
+    summary_started_on = (SELECT MIN(started_on) FROM build_chroot WHERE build_chroot.build_id = build.id),
+    summary_ended_on = (SELECT MAX(ended_on) FROM build_chroot WHERE build_chroot.build_id = build.id),
+    summary_pkg_name = (SELECT name FROM package WHERE package.id = build.package_id)
+"""))
+
+    # status_to_order and order_to_status exist only in postgresql
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute(sa.text("""
+UPDATE build SET summary_status = NULLIF(order_to_status(
+    (SELECT MIN(status_to_order(status)) FROM build_chroot WHERE build_chroot.build_id = build.id)
+), 1000)
+"""))
+
+
+def downgrade():
+    op.drop_index('build_copr_id_submitted_on_id', table_name='build')
+    op.drop_index('build_copr_id_id', table_name='build')
+    op.drop_column('build', 'summary_pkg_name')
+    op.drop_column('build', 'summary_ended_on')
+    op.drop_column('build', 'summary_started_on')
+    op.drop_column('build', 'summary_status')
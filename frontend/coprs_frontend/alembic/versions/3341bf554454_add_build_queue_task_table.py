@@ -0,0 +1,50 @@
+"""add build_queue_task table
+
+Build tasks waiting for backend are kept serialized in this table. The queued
+build chroots are copied here without the tasks, they are serialized when
+backend reads the queue; `manage.py rebuild_build_queue` serializes them at once.
+
+Revision ID: 3341bf554454
+Revises: 573044986ee9
+Create Date: 2015-12-01 10:21:43.517212
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3341bf554454'
+down_revision = '573044986ee9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('build_queue_task',
+    sa.Column('build_id', sa.Integer(), nullable=False),
+    sa.Column('mock_chroot_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.Integer(), nullable=False),
+    sa.Column('started_on', sa.Integer(), nullable=True),
+    sa.Column('ended_on', sa.Integer(), nullable=True),
+    sa.Column('task', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['build_id', 'mock_chroot_id'],
+                            ['build_chroot.build_id', 'build_chroot.mock_chroot_id'],
+                            ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('build_id', 'mock_chroot_id')
+    )
+    op.create_index('ix_build_queue_task_status', 'build_queue_task', ['status'], unique=False)
+
+    # pending (4), starting (6) and running (3) build chroots of not canceled builds,
+    # see QUEUED_STATES in coprs.logic.builds_logic
+    op.execute(sa.text("""
+INSERT INTO build_queue_task (build_id, mock_chroot_id, status, started_on, ended_on, task)
+SELECT build_chroot.build_id, build_chroot.mock_chroot_id, build_chroot.status,
+       build_chroot.started_on, build_chroot.ended_on, NULL
+FROM build_chroot JOIN build ON build.id = build_chroot.build_id
+WHERE build_chroot.status IN (4, 6, 3)
+    AND (build.canceled IS NULL OR NOT build.canceled)
+"""))
+
+
+def downgrade():
+    op.drop_index('ix_build_queue_task_status', table_name='build_queue_task')
+    op.drop_table('build_queue_task')
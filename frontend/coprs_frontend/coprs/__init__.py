@@ -38,6 +38,7 @@ import coprs.log
 from coprs.log import setup_log
 import coprs.models
 import coprs.whoosheers
+import coprs.logic.backend_logic
 
 from coprs.helpers import RedisConnectionProvider
 rcp = RedisConnectionProvider(config=app.config)
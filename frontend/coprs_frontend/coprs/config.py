@@ -53,6 +53,16 @@ class Config(object):
 
     SRPM_STORAGE_DIR = "/var/lib/copr/data/srpm_storage/"
 
+    # redis of copr-backend, new tasks are pushed there, None disables push
+    BACKEND_REDIS_HOST = None
+    BACKEND_REDIS_PORT = 6379
+    # seconds, push must not hold web requests when backend is unreachable
+    BACKEND_REDIS_TIMEOUT = 1
+
+    # build queue counters shown on the public pages are kept in redis
+    # and recounted in the database at most once per this many seconds
+    QUEUE_COUNTERS_RECOUNT_PERIOD = 600
+
 
 class ProductionConfig(Config):
     DEBUG = False
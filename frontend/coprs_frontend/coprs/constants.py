@@ -26,3 +26,17 @@ MAX_BUILD_MEMORY = 4096
 DEFAULT_BUILD_TIMEOUT = 3600 * 6  # 6 hours
 MIN_BUILD_TIMEOUT = 0
 MAX_BUILD_TIMEOUT = 36000
+
+# states of build chroots by priority, the first one present is the state of the build
+BUILD_STATES_ORDER = ["failed", "running", "starting", "importing", "pending", "succeeded", "skipped"]
+
+# number of builds on one page of the project builds listing
+BUILDS_PER_PAGE = 100
+
+# redis list on backend where new build tasks and actions are pushed,
+# must match backend.constants.JOB_GRAB_TASK_PUSH_LIST
+BACKEND_TASK_PUSH_LIST = "copr:backend:daemons:job_grab:task_push:list::"
+
+# redis pubsub channel on backend, builders of the build stop when a message comes,
+# must match backend.constants.PUBSUB_CANCEL_BUILD
+BACKEND_CANCEL_BUILD_CHANNEL = "copr:backend:cancel_build:pubsub::{build_id}"
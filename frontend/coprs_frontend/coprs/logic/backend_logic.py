@@ -1,8 +1,17 @@
 # coding: utf-8
 
+from collections import OrderedDict
+import itertools
 import json
+import time
+import weakref
+
+from redis import StrictRedis
 from sqlalchemy import or_
 from sqlalchemy import and_
+from sqlalchemy.event import listen
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.sql import false
 
 from coprs import app
@@ -10,11 +19,253 @@ from coprs import db
 from coprs import exceptions
 from coprs import models
 from coprs import helpers
+from coprs.constants import BACKEND_TASK_PUSH_LIST, BACKEND_CANCEL_BUILD_CHANNEL
 
-from coprs.logic.coprs_logic import MockChrootsLogic
+from coprs.logic.coprs_logic import MockChrootsLogic, CoprChrootsLogic
 
 log = app.logger
 
+# session -> messages for backend flushed in its transaction, pushed on commit
+_push_messages = weakref.WeakKeyDictionary()
+# session -> ids of builds cancelled in its transaction, published on commit
+_cancelled_builds = weakref.WeakKeyDictionary()
+
 
 class BackendLogic(object):
-    pass
+
+    # shared by all requests, created on the first push
+    _push_connection = None
+
+    @classmethod
+    def get_build_task_dict(cls, task):
+        """
+        Serialize `models.BuildChroot` into the build task for backend
+
+        :type task: models.BuildChroot
+        :rtype: dict
+        """
+        copr = task.build.copr
+
+        # we are using fake username's here
+        if copr.is_a_group_project:
+            user_name = u"@{}".format(copr.group.name)
+        else:
+            user_name = copr.owner.name
+
+        record = {
+            "task_id": "{}-{}".format(task.build.id, task.mock_chroot.name),
+            "build_id": task.build.id,
+            "project_owner": user_name,
+            "project_name": task.build.copr.name,
+            "submitter": task.build.user.name,
+            "pkgs": task.build.pkgs,  # TODO to be removed
+            "chroot": task.mock_chroot.name,
+
+            "repos": task.build.repos,
+            "memory_reqs": task.build.memory_reqs,
+            "timeout": task.build.timeout,
+            "enable_net": task.build.enable_net,
+            "git_repo": task.build.package.dist_git_repo,
+            "git_hash": task.git_hash,
+            "git_branch": helpers.chroot_to_branch(task.mock_chroot.name),
+            "package_name": task.build.package.name,
+            "package_version": task.build.pkg_version
+        }
+        # copr chroots are usually loaded together with the build chroot,
+        # don't query them one by one
+        record["buildroot_pkgs"] = ""
+        for copr_chroot in copr.copr_chroots:
+            if copr_chroot.mock_chroot_id == task.mock_chroot_id:
+                record["buildroot_pkgs"] = copr_chroot.buildroot_pkgs
+                break
+
+        return record
+
+    @classmethod
+    def get_importing_task_dict(cls, row):
+        """
+        Serialize a row of `BuildsLogic.get_build_importing_queue_rows()`
+        into the import task for dist-git
+
+        :rtype: dict
+        """
+        # we are using fake username's here
+        if row.group_name is not None:
+            user_name = u"@{}".format(row.group_name)
+        else:
+            user_name = row.owner_name
+
+        branch = helpers.chroot_to_branch(
+            "{}-{}-{}".format(row.os_release, row.os_version, row.arch))
+        return {
+            "task_id": "{}-{}".format(row.build_id, branch),
+            "user": user_name,
+            "project": row.copr_name,
+
+            "branch": branch,
+            "source_type": row.source_type,
+            "source_json": row.source_json,
+        }
+
+    @classmethod
+    def get_action_dict(cls, action):
+        """
+        Serialize `models.Action` for backend
+
+        :type action: models.Action
+        :rtype: dict
+        """
+        return action.to_dict(options={
+            "__columns_except__": ["result", "message", "ended_on"]
+        })
+
+    @classmethod
+    def get_push_connection(cls):
+        """
+        :return: redis connection used to push tasks to backend or None when push is disabled
+        """
+        if not app.config.get("BACKEND_REDIS_HOST"):
+            return None
+        if cls._push_connection is None:
+            # pushing happens inside of web requests, don't let unreachable
+            # backend block them
+            timeout = app.config.get("BACKEND_REDIS_TIMEOUT", 1)
+            cls._push_connection = StrictRedis(
+                host=app.config["BACKEND_REDIS_HOST"],
+                port=int(app.config.get("BACKEND_REDIS_PORT", 6379)),
+                socket_timeout=timeout,
+                socket_connect_timeout=timeout)
+        return cls._push_connection
+
+    @classmethod
+    def get_push_messages(cls, session):
+        """
+        Select changes of the flush which backend should know about right away:
+            - build chroots (re-)entering pending state
+            - new waiting actions
+            - changed projects and their chroots, backend drops them from its cache
+
+        Runs in after_flush, so the lazy relations of the changed objects can still be loaded.
+
+        :return list: (key, json string) pairs, a later message of the same key replaces the earlier one
+        """
+        pushed_on = time.time()
+        messages = []
+        changed_projects = set()
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, (models.Copr, models.CoprChroot)):
+                copr = obj if isinstance(obj, models.Copr) else obj.copr
+                # new projects can't be cached on backend yet
+                if copr is not None and copr not in session.new:
+                    changed_projects.add(copr.full_name)
+                continue
+
+            if obj in session.deleted:
+                continue
+
+            try:
+                if isinstance(obj, models.BuildChroot):
+                    if obj.status != helpers.StatusEnum("pending"):
+                        continue
+                    key = ("build", obj.build_id, obj.mock_chroot_id)
+                    msg = {"type": "build", "task": cls.get_build_task_dict(obj)}
+
+                elif isinstance(obj, models.Action):
+                    if obj not in session.new or \
+                            obj.result != helpers.BackendResultEnum("waiting") or \
+                            obj.action_type == helpers.ActionTypeEnum("legal-flag"):
+                        continue
+                    key = ("action", obj.id)
+                    msg = {"type": "action", "action": cls.get_action_dict(obj)}
+
+                else:
+                    continue
+            except Exception as err:
+                # backend picks the task up from /backend/waiting/ anyway
+                log.exception(err)
+                continue
+
+            msg["pushed_on"] = pushed_on
+            messages.append((key, json.dumps(msg)))
+
+        for full_name in sorted(changed_projects):
+            owner, project = full_name.split("/", 1)
+            messages.append((("project", full_name), json.dumps({
+                "type": "project", "owner": owner, "project": project, "pushed_on": pushed_on})))
+
+        return messages
+
+    @classmethod
+    def get_cancelled_builds(cls, session):
+        """
+        :return set: ids of the builds cancelled by the flush, see `BuildsLogic.cancel_build()`
+        """
+        return set(obj.id for obj in session.dirty
+                   if isinstance(obj, models.Build) and True in get_history(obj, "canceled").added)
+
+    @classmethod
+    def publish_cancelled_builds(cls, build_ids):
+        """
+        Stop running builders of the cancelled builds, builds which
+        haven't started yet are dropped from /backend/waiting/
+        """
+        rc = cls.get_push_connection()
+        if rc is None or not build_ids:
+            return
+
+        try:
+            pipe = rc.pipeline(transaction=False)
+            for build_id in sorted(build_ids):
+                pipe.publish(BACKEND_CANCEL_BUILD_CHANNEL.format(build_id=build_id), "cancelled")
+            pipe.execute()
+        except Exception as err:
+            log.exception("Failed to publish cancelled builds to backend: {}".format(err))
+
+    @classmethod
+    def push_messages(cls, messages):
+        """
+        Push new tasks to backend, backend still picks up everything what
+        wasn't delivered here by periodical query of /backend/waiting/
+        """
+        rc = cls.get_push_connection()
+        if rc is None or not messages:
+            return
+
+        try:
+            rc.lpush(BACKEND_TASK_PUSH_LIST, *messages)
+        except Exception as err:
+            log.exception("Failed to push tasks to backend: {}".format(err))
+
+
+def on_after_flush(session, flush_context):
+    """
+    Serialize messages for backend while the flushed objects are still
+    loadable, they are pushed only when the transaction commits
+    """
+    if not app.config.get("BACKEND_REDIS_HOST"):
+        return
+    messages = BackendLogic.get_push_messages(session)
+    if messages:
+        _push_messages.setdefault(session, OrderedDict()).update(messages)
+    cancelled = BackendLogic.get_cancelled_builds(session)
+    if cancelled:
+        _cancelled_builds.setdefault(session, set()).update(cancelled)
+
+
+def on_after_commit(session):
+    messages = _push_messages.pop(session, None)
+    if messages:
+        BackendLogic.push_messages(list(messages.values()))
+    cancelled = _cancelled_builds.pop(session, None)
+    if cancelled:
+        BackendLogic.publish_cancelled_builds(cancelled)
+
+
+def on_after_rollback(session):
+    _push_messages.pop(session, None)
+    _cancelled_builds.pop(session, None)
+
+
+listen(Session, "after_flush", on_after_flush)
+listen(Session, "after_commit", on_after_commit)
+listen(Session, "after_rollback", on_after_rollback)
@@ -5,14 +5,22 @@ import json
 import os
 import pprint
 import time
+import weakref
 import flask
+import itertools
 import sqlite3
-from sqlalchemy.sql import text
 from sqlalchemy import or_
 from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy.event import listen
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload_all
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import false
+from redis import RedisError
 from werkzeug.utils import secure_filename
 
 from coprs import app
@@ -20,6 +28,7 @@ from coprs import db
 from coprs import exceptions
 from coprs import models
 from coprs import helpers
+from coprs import rcp
 from coprs.constants import DEFAULT_BUILD_TIMEOUT, MAX_BUILD_TIMEOUT
 from coprs.exceptions import MalformedArgumentException, ActionInProgressException, InsufficientRightsException
 from coprs.helpers import StatusEnum
@@ -28,11 +37,46 @@ from coprs.logic import coprs_logic
 from coprs.logic import users_logic
 from coprs.logic import packages_logic
 from coprs.logic.actions_logic import ActionsLogic
+from coprs.logic.backend_logic import BackendLogic
 from coprs.models import BuildChroot
+from coprs.rmodels import QueueCounters
 from .coprs_logic import MockChrootsLogic
 
 log = app.logger
 
+# states of build chroots kept in the build task queue table
+QUEUED_STATES = [
+    StatusEnum("pending"),
+    StatusEnum("starting"),
+    StatusEnum("running"),
+]
+
+# states of build chroots counted by the queue counters in redis
+COUNTED_STATES = [
+    StatusEnum("importing"),
+    StatusEnum("pending"),
+    StatusEnum("starting"),
+    StatusEnum("running"),
+]
+
+# columns of the related models serialized into the build tasks,
+# see `BackendLogic.get_build_task_dict()`
+BUILD_TASK_ATTRIBUTES = [
+    (models.Copr, ["name", "owner_id", "group_id"]),
+    (models.Group, ["name"]),
+    (models.Package, ["name"]),
+    (models.User, ["username"]),
+]
+
+# sort keys of the project builds listing, all of them are indexed together with copr_id
+BUILDS_LIST_SORT = {
+    "id": models.Build.id,
+    "submitted_on": models.Build.submitted_on,
+}
+
+# session -> counter deltas flushed in its transaction, applied on commit
+_queue_counter_deltas = weakref.WeakKeyDictionary()
+
 
 class BuildsLogic(object):
     @classmethod
@@ -74,36 +118,361 @@ class BuildsLogic(object):
         query = query.order_by(models.BuildChroot.build_id.asc())
         return query
 
+    @classmethod
+    def get_build_importing_queue_rows(cls):
+        """
+        Same queue as `get_build_importing_queue()`, but selects only the columns
+        needed by dist-git into plain rows, no ORM objects are loaded
+        """
+        return (cls.get_build_importing_queue()
+                .join(models.MockChroot,
+                      models.BuildChroot.mock_chroot_id == models.MockChroot.id)
+                .join(models.Copr, models.Build.copr_id == models.Copr.id)
+                .join(models.User, models.Copr.owner_id == models.User.id)
+                .outerjoin(models.Group, models.Copr.group_id == models.Group.id)
+                .with_entities(
+                    models.Build.id.label("build_id"),
+                    models.Build.source_type,
+                    models.Build.source_json,
+                    models.MockChroot.os_release,
+                    models.MockChroot.os_version,
+                    models.MockChroot.arch,
+                    models.Copr.name.label("copr_name"),
+                    models.User.username.label("owner_name"),
+                    models.Group.name.label("group_name")))
+
+    @classmethod
+    def load_build_task_relations(cls, query):
+        """
+        Eager loads everything touched by `BackendLogic.get_build_task_dict()`
+        and the status pages together with the BuildChroots
+        """
+        return query.options(
+            joinedload(models.BuildChroot.mock_chroot),
+            joinedload_all("build.user"),
+            joinedload_all("build.package"),
+            joinedload_all("build.copr.owner"),
+            joinedload_all("build.copr.group"),
+            joinedload_all("build.copr.copr_chroots"))
+
+    @classmethod
+    def _filter_build_task_queue(cls, query):
+        """
+        Filters BuildQueueTask rows which are - waiting to be built or
+                                              - older than 2 hours and unfinished
+        """
+        # canceled builds and other states are never stored in the queue table
+        return query.filter(or_(
+            models.BuildQueueTask.status == helpers.StatusEnum("pending"),
+            models.BuildQueueTask.status == helpers.StatusEnum("starting"),
+            and_(
+                # We are moving ended_on to the BuildChroot, now it should be reliable,
+                # so we don't want to reschedule failed chroots
+                models.BuildQueueTask.status == helpers.StatusEnum("running"),
+                models.BuildQueueTask.started_on < int(time.time() - 1.1 * MAX_BUILD_TIMEOUT),
+                models.BuildQueueTask.ended_on.is_(None)
+            ))
+        ).order_by(models.BuildQueueTask.build_id.asc())
+
     @classmethod
     def get_build_task_queue(cls):
         """
         Returns BuildChroots which are - waiting to be built or
                                        - older than 2 hours and unfinished
         """
-        # todo: filter out build without package
-        query = (models.BuildChroot.query.join(models.Build)
-                 .filter(models.Build.canceled == false())
-                 .filter(or_(
-                     models.BuildChroot.status == helpers.StatusEnum("pending"),
-                     models.BuildChroot.status == helpers.StatusEnum("starting"),
-                     and_(
-                         # We are moving ended_on to the BuildChroot, now it should be reliable,
-                         # so we don't want to reschedule failed chroots
-                         # models.BuildChroot.status.in_([
-                         # # Bug 1206562 - Cannot delete Copr because it incorrectly thinks
-                         # # there are unfinished builds. Solution: `failed` but unfinished
-                         # # (ended_on is null) builds should be rescheduled.
-                         # # todo: we need to be sure that correct `failed` set is set together wtih `ended_on`
-                         # helpers.StatusEnum("running"),
-                         # helpers.StatusEnum("failed")
-                         #]),
-                         models.BuildChroot.status == helpers.StatusEnum("running"),
-                         models.BuildChroot.started_on < int(time.time() - 1.1 * MAX_BUILD_TIMEOUT),
-                         models.BuildChroot.ended_on.is_(None)
-                     ))
-        ))
-        query = query.order_by(models.BuildChroot.build_id.asc())
-        return query
+        query = models.BuildChroot.query.join(models.BuildQueueTask, and_(
+            models.BuildQueueTask.build_id == models.BuildChroot.build_id,
+            models.BuildQueueTask.mock_chroot_id == models.BuildChroot.mock_chroot_id))
+        return cls.load_build_task_relations(cls._filter_build_task_queue(query))
+
+    @classmethod
+    def get_build_task_queue_tasks(cls):
+        """
+        Same queue as `get_build_task_queue()`, but returns BuildQueueTask rows
+        with the build tasks already serialized for backend
+        """
+        return cls._filter_build_task_queue(models.BuildQueueTask.query)
+
+    @classmethod
+    def get_build_task_queue_dicts(cls, limit=None):
+        """
+        Build tasks of `get_build_task_queue_tasks()` for backend, rows which
+        couldn't be serialized when their build chroot changed are serialized
+        again, tasks which still fail are left out
+
+        :return list: dicts of `BackendLogic.get_build_task_dict()`
+        """
+        query = cls.get_build_task_queue_tasks()
+        if limit is not None:
+            query = query.limit(limit)
+
+        result = []
+        for task in query:
+            if task.task is not None:
+                result.append(task.task_dict)
+                continue
+            build_chroot = models.BuildChroot.query.filter_by(
+                build_id=task.build_id, mock_chroot_id=task.mock_chroot_id).one()
+            try:
+                result.append(BackendLogic.get_build_task_dict(build_chroot))
+            except Exception as err:
+                log.exception("Failed to serialize build task {}-{}: {}".format(
+                    task.build_id, task.mock_chroot_id, err))
+        return result
+
+    @classmethod
+    def is_queued(cls, build_chroot):
+        """
+        :return bool: True when the build chroot belongs to the build task queue table
+        """
+        return build_chroot.status in QUEUED_STATES and not build_chroot.build.canceled
+
+    @classmethod
+    def get_build_task_queue_row(cls, build_chroot):
+        """
+        :return dict: values of BuildQueueTask for the build chroot,
+            None when it doesn't belong to the queue
+        """
+        if not cls.is_queued(build_chroot):
+            return None
+        try:
+            task = json.dumps(BackendLogic.get_build_task_dict(build_chroot))
+        except Exception as err:
+            # the row stays in the queue, `get_build_task_queue_dicts()` tries again
+            log.exception("Failed to serialize build task {}-{}: {}".format(
+                build_chroot.build_id, build_chroot.mock_chroot_id, err))
+            task = None
+        return {
+            "build_id": build_chroot.build_id,
+            "mock_chroot_id": build_chroot.mock_chroot_id,
+            "status": build_chroot.status,
+            "started_on": build_chroot.started_on,
+            "ended_on": build_chroot.ended_on,
+            "task": task,
+        }
+
+    @classmethod
+    def rebuild_build_task_queue(cls):
+        """
+        Fills the build task queue table from scratch, e.g. after the migration
+        which created it
+        """
+        table = models.BuildQueueTask.__table__
+        db.session.execute(table.delete())
+        query = cls.load_build_task_relations(
+            models.BuildChroot.query.join(models.Build)
+            .filter(models.Build.canceled == false())
+            .filter(models.BuildChroot.status.in_(QUEUED_STATES)))
+        rows = [row for row in map(cls.get_build_task_queue_row, query) if row is not None]
+        if rows:
+            db.session.execute(table.insert(), rows)
+        return len(rows)
+
+    @classmethod
+    def get_queue_counter_deltas(cls, session):
+        """
+        :return dict: state name -> change of the number of build chroots
+            in `COUNTED_STATES` made by the flush
+        """
+        deltas = defaultdict(int)
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            if not isinstance(obj, models.BuildChroot):
+                continue
+            history = get_history(obj, "status")
+            if obj in session.new:
+                old, new = [], [obj.status]
+            elif obj in session.deleted:
+                old, new = history.deleted or history.unchanged, []
+            elif history.has_changes():
+                old, new = history.deleted, history.added
+            else:
+                continue
+
+            for status in old:
+                if status in COUNTED_STATES:
+                    deltas[StatusEnum(status)] -= 1
+            for status in new:
+                if status in COUNTED_STATES:
+                    deltas[StatusEnum(status)] += 1
+        return deltas
+
+    @classmethod
+    def count_queues(cls):
+        """
+        :return dict: state name -> number of build chroots counted in the database
+        """
+        counts = dict((StatusEnum(status), 0) for status in COUNTED_STATES)
+        query = (db.session.query(models.BuildChroot.status, func.count(models.BuildChroot.build_id))
+                 .filter(models.BuildChroot.status.in_(COUNTED_STATES))
+                 .group_by(models.BuildChroot.status))
+        for status, count in query:
+            counts[StatusEnum(status)] = count
+        return counts
+
+    @classmethod
+    def recount_queue_counters(cls):
+        """
+        Resets the queue counters in redis to the numbers counted in the database
+        """
+        counts = cls.count_queues()
+        QueueCounters.reset(rcp.get_connection(), counts)
+        return counts
+
+    @classmethod
+    def get_queue_counters(cls):
+        """
+        Numbers of build chroots in `COUNTED_STATES` kept in redis, these are
+        recounted in the database when missing or at most once
+        per QUEUE_COUNTERS_RECOUNT_PERIOD seconds
+
+        :return dict: state name -> count
+        """
+        rc = rcp.get_connection()
+        try:
+            counts = QueueCounters.get_counts(rc)
+            if counts is None or QueueCounters.claim_recount(
+                    rc, app.config["QUEUE_COUNTERS_RECOUNT_PERIOD"]):
+                counts = cls.recount_queue_counters()
+        except RedisError as err:
+            log.exception("Failed to get queue counters: {}".format(err))
+            return cls.count_queues()
+        return counts
+
+    @classmethod
+    def update_queue_counters(cls, deltas):
+        """
+        Applies the changes made by a committed transaction, errors are only
+        logged, the counters are fixed by the next recount
+        """
+        try:
+            QueueCounters.incr(rcp.get_connection(), deltas)
+        except RedisError as err:
+            log.exception("Failed to update queue counters: {}".format(err))
+
+    @classmethod
+    def get_build_summary(cls, build, build_chroots):
+        """
+        :return dict: values of the build summary columns
+        """
+        started_on = [bc.started_on for bc in build_chroots if bc.started_on is not None]
+        ended_on = [bc.ended_on for bc in build_chroots if bc.ended_on is not None]
+        return {
+            "summary_status": models.Build.get_chroots_status(
+                [bc.status for bc in build_chroots]),
+            "summary_started_on": min(started_on) if started_on else None,
+            "summary_ended_on": max(ended_on) if ended_on else None,
+            "summary_pkg_name": build.package.name if build.package else None,
+        }
+
+    @classmethod
+    def sync_build_summaries(cls, session):
+        """
+        Updates summary columns of the builds whose build chroots
+        or package were changed by the flush
+        """
+        builds = set()
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, models.BuildChroot) and obj.build is not None:
+                builds.add(obj.build)
+            elif isinstance(obj, models.Build):
+                builds.add(obj)
+
+        table = models.Build.__table__
+        for build in builds:
+            if build in session.deleted:
+                continue
+            build_chroots = [bc for bc in build.build_chroots if bc not in session.deleted]
+            summary = cls.get_build_summary(build, build_chroots)
+            if all(getattr(build, key) == value for key, value in summary.items()):
+                continue
+
+            session.execute(table.update().where(table.c.id == build.id).values(**summary))
+            for key, value in summary.items():
+                set_committed_value(build, key, value)
+
+    @classmethod
+    def changes_build_task(cls, obj):
+        """
+        :return bool: True when the flushed changes of `obj` are serialized
+            into the build tasks of other objects, e.g. a renamed project
+        """
+        for model, attributes in BUILD_TASK_ATTRIBUTES:
+            if isinstance(obj, model):
+                return any(get_history(obj, attr).has_changes() for attr in attributes)
+        return False
+
+    @classmethod
+    def get_queued_build_chroots(cls, session, obj):
+        """
+        :param obj: changed CoprChroot or an object of `BUILD_TASK_ATTRIBUTES`
+        :return: query of the build chroots in the build task queue table
+            whose build task includes `obj`
+        """
+        query = (session.query(models.BuildChroot)
+                 .join(models.Build)
+                 .join(models.BuildQueueTask, and_(
+                     models.BuildQueueTask.build_id == models.BuildChroot.build_id,
+                     models.BuildQueueTask.mock_chroot_id == models.BuildChroot.mock_chroot_id)))
+        if isinstance(obj, models.CoprChroot):
+            return (query.filter(models.Build.copr_id == obj.copr_id)
+                    .filter(models.BuildChroot.mock_chroot_id == obj.mock_chroot_id))
+        elif isinstance(obj, models.Copr):
+            return query.filter(models.Build.copr_id == obj.id)
+        elif isinstance(obj, models.Package):
+            return query.filter(models.Build.package_id == obj.id)
+        elif isinstance(obj, models.Group):
+            return query.join(models.Build.copr).filter(models.Copr.group_id == obj.id)
+        elif isinstance(obj, models.User):
+            # the owner of the project or the submitter of the build
+            return query.join(models.Build.copr).filter(or_(
+                models.Copr.owner_id == obj.id, models.Build.user_id == obj.id))
+        raise TypeError("No build tasks of {}".format(obj))
+
+    @classmethod
+    def sync_build_task_queue(cls, session):
+        """
+        Refreshes BuildQueueTask rows of the build chroots changed by the flush,
+        including changes of their builds, of the buildroot packages and
+        of the project, group, package or user names in the build tasks
+        """
+        deleted = set()
+        changed = set()
+        for obj in session.deleted:
+            if isinstance(obj, models.BuildChroot):
+                deleted.add((obj.build_id, obj.mock_chroot_id))
+
+        for obj in itertools.chain(session.new, session.dirty):
+            if isinstance(obj, models.BuildChroot):
+                changed.add(obj)
+            elif isinstance(obj, models.Build):
+                changed.update(obj.build_chroots)
+            elif isinstance(obj, models.CoprChroot):
+                changed.update(cls.get_queued_build_chroots(session, obj))
+            elif obj in session.dirty and cls.changes_build_task(obj):
+                # new objects can't be in the queued build tasks yet
+                changed.update(cls.get_queued_build_chroots(session, obj))
+
+        changed = set(bc for bc in changed if bc not in session.deleted)
+        if not deleted and not changed:
+            return
+
+        rows = []
+        for build_chroot in changed:
+            deleted.add((build_chroot.build_id, build_chroot.mock_chroot_id))
+            row = cls.get_build_task_queue_row(build_chroot)
+            if row is not None:
+                rows.append(row)
+
+        table = models.BuildQueueTask.__table__
+        by_build = defaultdict(list)
+        for build_id, mock_chroot_id in deleted:
+            by_build[build_id].append(mock_chroot_id)
+        for build_id, mock_chroot_ids in by_build.items():
+            session.execute(table.delete().where(and_(
+                table.c.build_id == build_id,
+                table.c.mock_chroot_id.in_(mock_chroot_ids))))
+        if rows:
+            session.execute(table.insert(), rows)
 
     @classmethod
     def get_multiple(cls):
@@ -124,70 +493,50 @@ class BuildsLogic(object):
             models.Copr.owner == user)
 
     @classmethod
-    def get_copr_builds_list(cls, copr):
-        query_select = """
-SELECT build.id, MAX(package.name) AS pkg_name, build.pkg_version, build.submitted_on,
-    MIN(statuses.started_on) AS started_on, MAX(statuses.ended_on) AS ended_on, order_to_status(MIN(statuses.st)) AS status,
-    build.canceled, MIN("group".name) AS group_name, MIN(copr.name) as copr_name, MIN("user".username) as owner_name
-FROM build
-LEFT OUTER JOIN package
-    ON build.package_id = package.id
-LEFT OUTER JOIN (SELECT build_chroot.build_id, started_on, ended_on, status_to_order(status) AS st FROM build_chroot) AS statuses
-    ON statuses.build_id=build.id
-LEFT OUTER JOIN copr
-    ON copr.id = build.copr_id
-LEFT OUTER JOIN "user"
-    ON copr.owner_id = "user".id
-LEFT OUTER JOIN "group"
-    ON copr.group_id = "group".id
-WHERE build.copr_id = {copr_id}
-GROUP BY
-    build.id;
-""".format(copr_id=copr.id)
-
-        if db.engine.url.drivername == "sqlite":
-            def sqlite_status_to_order(x):
-                if x == 0:
-                    return 0
-                elif x == 3:
-                    return 1
-                elif x == 6:
-                    return 2
-                elif x == 7:
-                    return 3
-                elif x == 4:
-                    return 4
-                elif x == 1:
-                    return 5
-                elif x == 5:
-                    return 6
-                return 1000
-
-            def sqlite_order_to_status(x):
-                if x == 0:
-                    return 0
-                elif x == 1:
-                    return 3
-                elif x == 2:
-                    return 6
-                elif x == 3:
-                    return 7
-                elif x == 4:
-                    return 4
-                elif x == 5:
-                    return 1
-                elif x == 6:
-                    return 5
-                return 1000
-
-            conn = db.engine.connect()
-            conn.connection.create_function("status_to_order", 1, sqlite_status_to_order)
-            conn.connection.create_function("order_to_status", 1, sqlite_order_to_status)
-            result = conn.execute(text(query_select))
+    def get_copr_builds_list(cls, copr, sort="id", desc=True, after=None, limit=None):
+        """
+        Rows of the project builds listing read from the build summary columns,
+        ordered by `sort` and build id
+
+        :param sort: key of `BUILDS_LIST_SORT`
+        :param after: (sort value, build id) of the last row of the previous slice
+        """
+        column = BUILDS_LIST_SORT[sort]
+        query = (models.Build.query
+                 .join(models.Copr, models.Build.copr_id == models.Copr.id)
+                 .join(models.User, models.Copr.owner_id == models.User.id)
+                 .outerjoin(models.Group, models.Copr.group_id == models.Group.id)
+                 .filter(models.Build.copr_id == copr.id)
+                 .with_entities(
+                     models.Build.id,
+                     models.Build.summary_pkg_name.label("pkg_name"),
+                     models.Build.pkg_version,
+                     models.Build.submitted_on,
+                     models.Build.summary_started_on.label("started_on"),
+                     models.Build.summary_ended_on.label("ended_on"),
+                     models.Build.summary_status.label("status"),
+                     models.Build.canceled,
+                     models.Group.name.label("group_name"),
+                     models.Copr.name.label("copr_name"),
+                     models.User.username.label("owner_name")))
+
+        if after is not None:
+            value, build_id = after
+            if desc:
+                query = query.filter(or_(column < value,
+                                         and_(column == value, models.Build.id < build_id)))
+            else:
+                query = query.filter(or_(column > value,
+                                         and_(column == value, models.Build.id > build_id)))
+
+        if desc:
+            query = query.order_by(column.desc(), models.Build.id.desc())
         else:
-            result = db.engine.execute(text(query_select))
+            query = query.order_by(column.asc(), models.Build.id.asc())
 
-        return result
+        if limit is not None:
+            query = query.limit(limit)
+        return query
 
     @classmethod
     def join_group(cls, query):
@@ -651,6 +1000,7 @@ GROUP BY
         if not build.cancelable:
             raise exceptions.RequestCannotBeExecuted(
                 "Cannot cancel build {}".format(build.id))
+        # backend stops running builders after commit, see BackendLogic.get_cancelled_builds()
         build.canceled = True
         for chroot in build.build_chroots:
             chroot.status = 2  # canceled
@@ -715,6 +1065,34 @@ GROUP BY
         return query.filter(models.Group.name == group_name)
 
 
+def on_after_flush(session, flush_context):
+    """ Keep the build task queue table in sync with the flushed changes """
+    BuildsLogic.sync_build_task_queue(session)
+    BuildsLogic.sync_build_summaries(session)
+
+    deltas = BuildsLogic.get_queue_counter_deltas(session)
+    if deltas:
+        pending = _queue_counter_deltas.setdefault(session, defaultdict(int))
+        for state, delta in deltas.items():
+            pending[state] += delta
+
+
+def on_after_commit(session):
+    """ Queue counters in redis change only with committed data """
+    deltas = _queue_counter_deltas.pop(session, None)
+    if deltas:
+        BuildsLogic.update_queue_counters(deltas)
+
+
+def on_after_rollback(session):
+    _queue_counter_deltas.pop(session, None)
+
+
+listen(Session, "after_flush", on_after_flush)
+listen(Session, "after_commit", on_after_commit)
+listen(Session, "after_rollback", on_after_rollback)
+
+
 class BuildChrootsLogic(object):
     @classmethod
     def get_by_build_id_and_name(cls, build_id, name):
@@ -122,14 +122,11 @@ class ComplexLogic(object):
 
     @staticmethod
     def get_queues_size():
-        # todo: check if count works slowly
-
-        waiting = BuildsLogic.get_build_task_queue().count()
-        running = BuildsLogic.get_build_tasks(StatusEnum("running")).count()
-        importing = BuildsLogic.get_build_tasks(helpers.StatusEnum("importing")).count()
+        # counters are kept in redis, see BuildsLogic.get_queue_counters()
+        counts = BuildsLogic.get_queue_counters()
         return dict(
-            waiting=waiting,
-            running=running,
-            importing=importing
+            waiting=counts.get("pending", 0) + counts.get("starting", 0),
+            running=counts.get("running", 0),
+            importing=counts.get("importing", 0)
         )
 
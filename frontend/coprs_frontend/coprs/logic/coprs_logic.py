@@ -112,6 +112,21 @@ class CoprsLogic(object):
 
         return query
 
+    @classmethod
+    def get_auto_createrepo_statuses(cls):
+        """
+        :return: query of (owner name, group name or None, copr name,
+            auto_createrepo) tuples for all not deleted coprs
+        """
+        return (
+            db.session.query(models.User.username, models.Group.name,
+                             models.Copr.name, models.Copr.auto_createrepo)
+            .select_from(models.Copr)
+            .join(models.Copr.owner)
+            .outerjoin(models.Copr.group)
+            .filter(models.Copr.deleted.is_(False))
+        )
+
     @classmethod
     def set_query_order(cls, query, desc=False):
         if desc:
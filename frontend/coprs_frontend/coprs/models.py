@@ -430,6 +430,12 @@ class Build(db.Model, helpers.Serializer):
     source_json = db.Column(db.Text)
     # Type of failure: type identifier
     fail_type = db.Column(db.Integer, default=helpers.FailTypeEnum("unset"))
+    # summary of build chroots for the builds listing, maintained by
+    # coprs.logic.builds_logic whenever build chroots change
+    summary_status = db.Column(db.Integer)
+    summary_started_on = db.Column(db.Integer)
+    summary_ended_on = db.Column(db.Integer)
+    summary_pkg_name = db.Column(db.Text)
 
     # relations
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
@@ -441,6 +447,12 @@ class Build(db.Model, helpers.Serializer):
 
     chroots = association_proxy("build_chroots", "mock_chroot")
 
+    __table_args__ = (
+        # keyset pagination of the builds listing
+        db.Index("build_copr_id_id", "copr_id", "id"),
+        db.Index("build_copr_id_submitted_on_id", "copr_id", "submitted_on", "id"),
+    )
+
     @property
     def user_name(self):
         return self.user.name
@@ -559,8 +571,16 @@ class Build(db.Model, helpers.Serializer):
         if self.canceled:
             return StatusEnum("canceled")
 
-        for state in ["failed", "running", "starting", "importing", "pending", "succeeded", "skipped"]:
-            if StatusEnum(state) in self.chroot_states:
+        return self.get_chroots_status(self.chroot_states)
+
+    @staticmethod
+    def get_chroots_status(chroot_states):
+        """
+        Aggregate status of build chroots, the first state found in
+        `constants.BUILD_STATES_ORDER` wins
+        """
+        for state in constants.BUILD_STATES_ORDER:
+            if StatusEnum(state) in chroot_states:
                 return StatusEnum(state)
 
     @property
@@ -758,7 +778,9 @@ class BuildChroot(db.Model, helpers.Serializer):
                          primary_key=True)
     build = db.relationship("Build", backref=db.backref("build_chroots"))
     git_hash = db.Column(db.String(40))
-    status = db.Column(db.Integer, default=StatusEnum("importing"))
+    # the old status is loaded when it changes, the queue counters need it
+    status = db.column_property(
+        db.Column(db.Integer, default=StatusEnum("importing")), active_history=True)
 
     started_on = db.Column(db.Integer)
     ended_on = db.Column(db.Integer)
@@ -826,6 +848,35 @@ class BuildChroot(db.Model, helpers.Serializer):
         return "<BuildChroot: {}>".format(self.to_dict())
 
 
+class BuildQueueTask(db.Model, helpers.Serializer):
+
+    """
+    Denormalized copy of BuildChroot waiting for or being built by backend,
+    rows are maintained by `coprs.logic.builds_logic` on every flush
+    """
+
+    build_id = db.Column(db.Integer, primary_key=True)
+    mock_chroot_id = db.Column(db.Integer, primary_key=True)
+    # copy of the BuildChroot columns used to select the queue
+    status = db.Column(db.Integer, nullable=False, index=True)
+    started_on = db.Column(db.Integer)
+    ended_on = db.Column(db.Integer)
+    # build task for backend serialized into json, None when the serialization
+    # failed and the task has to be serialized again when it's read
+    task = db.Column(db.Text)
+
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            ["build_id", "mock_chroot_id"],
+            ["build_chroot.build_id", "build_chroot.mock_chroot_id"],
+            ondelete="CASCADE"),
+    )
+
+    @property
+    def task_dict(self):
+        return json.loads(self.task)
+
+
 class LegalFlag(db.Model, helpers.Serializer):
     id = db.Column(db.Integer, primary_key=True)
     # message from user who raised the flag (what he thinks is wrong)
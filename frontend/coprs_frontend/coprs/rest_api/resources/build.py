@@ -5,6 +5,7 @@ from flask import url_for, make_response
 from flask_restful import Resource
 
 from ... import db
+from ... import models
 from ...exceptions import ActionInProgressException, InsufficientRightsException, RequestCannotBeExecuted
 from ...logic.builds_logic import BuildsLogic
 from ..common import get_project_safe
@@ -27,6 +28,8 @@ class BuildListR(Resource):
 
         parser.add_argument('limit', type=int)
         parser.add_argument('offset', type=int)
+        # keyset pagination, builds are ordered by id descending
+        parser.add_argument('after_id', type=int)
 
         parser.add_argument('is_finished', type=arg_bool)
         # parser.add_argument('package', type=str)
@@ -56,6 +59,9 @@ class BuildListR(Resource):
         else:
             limit = 100
 
+        if req_args["after_id"] is not None:
+            query = query.filter(models.Build.id < req_args["after_id"])
+
         query = query.limit(limit)
 
         if req_args["offset"] is not None:
@@ -65,13 +71,18 @@ class BuildListR(Resource):
 
         self_params = dict(req_args)
         self_params["limit"] = limit
+        links = {
+            "self": {"href": url_for(".buildlistr", **self_params)},
+        }
+        if len(builds) == limit:
+            next_params = dict(self_params, after_id=builds[-1].id, offset=None)
+            links["next"] = {"href": url_for(".buildlistr", **next_params)}
+
         return {
             "builds": [
                 render_build(build) for build in builds
             ],
-            "_links": {
-                "self": {"href": url_for(".buildlistr", **self_params)},
-            },
+            "_links": links,
         }
 
     @staticmethod
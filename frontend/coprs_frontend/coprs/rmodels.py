@@ -115,3 +115,77 @@ class TimedStatEvents(GenericRedisModel):
         to_del = [mb for mb in all_members.keys() if int(mb) < threshold_day]
 
         rconnect.hdel(key, *to_del)
+
+
+class QueueCounters(GenericRedisModel):
+    """
+        Wraps hash with the number of build chroots in each state, where:
+        **key** - counters name, fix prefix
+        **field** - name of the state
+        **value** - build chroots count
+
+        Counters are changed by deltas of committed transactions and
+        periodically reset to the values counted in the database.
+    """
+    _KEY_BASE = "copr:queues"
+
+    @classmethod
+    def incr(cls, rconnect, deltas, name="build_chroots", prefix=None):
+        """
+        Applies changes of the counters, does nothing until the counters
+        are reset for the first time
+        :param rconnect: Connection to a redis
+        :type rconnect: StrictRedis
+        :param deltas: state name -> change of the count
+        :type deltas: dict
+        """
+        key = cls._get_key(name, prefix)
+        if not rconnect.exists(key):
+            return
+
+        pipe = rconnect.pipeline()
+        for state, delta in deltas.items():
+            if delta:
+                pipe.hincrby(key, state, delta)
+        pipe.execute()
+
+    @classmethod
+    def get_counts(cls, rconnect, name="build_chroots", prefix=None):
+        """
+        :param rconnect: Connection to a redis
+        :type rconnect: StrictRedis
+        :return: state name -> count, None when the counters were never reset
+        :rtype: dict
+        """
+        counts = rconnect.hgetall(cls._get_key(name, prefix))
+        if not counts:
+            return None
+        return dict((state.decode("utf-8") if isinstance(state, bytes) else state, int(count))
+                    for state, count in counts.items())
+
+    @classmethod
+    def reset(cls, rconnect, counts, name="build_chroots", prefix=None):
+        """
+        Replaces all counters
+        :param rconnect: Connection to a redis
+        :type rconnect: StrictRedis
+        :param counts: state name -> count, must contain at least one state
+        :type counts: dict
+        """
+        key = cls._get_key(name, prefix)
+        pipe = rconnect.pipeline()
+        pipe.delete(key)
+        pipe.hmset(key, counts)
+        pipe.execute()
+
+    @classmethod
+    def claim_recount(cls, rconnect, period, name="build_chroots", prefix=None):
+        """
+        Only one caller per `period` gets True and is expected to reset the counters
+        :param rconnect: Connection to a redis
+        :type rconnect: StrictRedis
+        :param period: seconds between recounts
+        :rtype: bool
+        """
+        key = cls._get_key("{}:recounted".format(name), prefix)
+        return bool(rconnect.set(key, int(time.time()), ex=int(period), nx=True))
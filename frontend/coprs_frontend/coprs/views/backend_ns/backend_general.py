@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 import flask
 import sys
 import time
@@ -6,9 +8,10 @@ from coprs import db, app
 from coprs import helpers
 from coprs.helpers import StatusEnum
 from coprs.logic import actions_logic
+from coprs.logic.backend_logic import BackendLogic
 from coprs.logic.builds_logic import BuildsLogic
 from coprs.logic.complex_logic import ComplexLogic
-from coprs.logic.coprs_logic import CoprChrootsLogic
+from coprs.logic.coprs_logic import CoprsLogic
 from coprs.logic.packages_logic import PackagesLogic
 
 from coprs.views import misc
@@ -27,24 +30,12 @@ def dist_git_importing_queue():
     Return list of builds that are waiting for dist git to import the sources.
     """
     builds_list = []
-    for task in BuildsLogic.get_build_importing_queue().limit(200):
-        copr = task.build.copr
-
-        # we are using fake username's here
-        if copr.is_a_group_project:
-            user_name = u"@{}".format(copr.group.name)
-        else:
-            user_name = copr.owner.name
-        task_dict = {
-            "task_id": "{}-{}".format(task.build.id, helpers.chroot_to_branch(task.mock_chroot.name)),
-            "user": user_name,
-            "project": task.build.copr.name,
-
-            "branch": helpers.chroot_to_branch(task.mock_chroot.name),
-            "source_type": task.build.source_type,
-            "source_json": task.build.source_json,
-        }
-        if task_dict not in builds_list:
+    task_ids = set()
+    for row in BuildsLogic.get_build_importing_queue_rows().limit(200):
+        task_dict = BackendLogic.get_importing_task_dict(row)
+        # all chroots of the same branch are imported by one task
+        if task_dict["task_id"] not in task_ids:
+            task_ids.add(task_dict["task_id"])
             builds_list.append(task_dict)
 
     response_dict = {"builds": builds_list}
@@ -124,61 +115,44 @@ def waiting():
 
     # models.Actions
     actions_list = [
-        action.to_dict(options={
-            "__columns_except__": ["result", "message", "ended_on"]
-        })
+        BackendLogic.get_action_dict(action)
         for action in actions_logic.ActionsLogic.get_waiting()
     ]
 
-    # tasks represented by models.BuildChroot with some other stuff
-    builds_list = []
-    for task in BuildsLogic.get_build_task_queue().limit(200):
-        try:
-            copr = task.build.copr
+    # tasks are serialized into models.BuildQueueTask when build chroots change
+    builds_list = BuildsLogic.get_build_task_queue_dicts(limit=200)
 
-            # we are using fake username's here
-            if copr.is_a_group_project:
-                user_name = u"@{}".format(copr.group.name)
-            else:
-                user_name = copr.owner.name
-
-            record = {
-                "task_id": "{}-{}".format(task.build.id, task.mock_chroot.name),
-                "build_id": task.build.id,
-                "project_owner": user_name,
-                "project_name": task.build.copr.name,
-                "submitter": task.build.user.name,
-                "pkgs": task.build.pkgs,  # TODO to be removed
-                "chroot": task.mock_chroot.name,
-
-                "repos": task.build.repos,
-                "memory_reqs": task.build.memory_reqs,
-                "timeout": task.build.timeout,
-                "enable_net": task.build.enable_net,
-                "git_repo": task.build.package.dist_git_repo,
-                "git_hash": task.git_hash,
-                "git_branch": helpers.chroot_to_branch(task.mock_chroot.name),
-                "package_name": task.build.package.name,
-                "package_version": task.build.pkg_version
-            }
-            copr_chroot = CoprChrootsLogic.get_by_name_safe(task.build.copr, task.mock_chroot.name)
-            if copr_chroot:
-                record["buildroot_pkgs"] = copr_chroot.buildroot_pkgs
-            else:
-                record["buildroot_pkgs"] = ""
+    response_dict = {"actions": actions_list, "builds": builds_list}
+    return flask.jsonify(response_dict)
 
-            builds_list.append(record)
 
-        except Exception as err:
-            app.logger.exception(err)
+@backend_ns.route("/auto_createrepo/")
+#@misc.backend_authenticated
+def auto_createrepo_statuses():
+    """
+    Return auto_createrepo flags of all projects at once, used by the results pruner.
+    """
+    projects = []
+    for owner_name, group_name, copr_name, auto_createrepo in \
+            CoprsLogic.get_auto_createrepo_statuses():
+        projects.append({
+            # the same fake username as used for the results directory
+            "owner": u"@{}".format(group_name) if group_name else owner_name,
+            "project": copr_name,
+            "auto_createrepo": bool(auto_createrepo),
+        })
 
-    response_dict = {"actions": actions_list, "builds": builds_list}
-    return flask.jsonify(response_dict)
+    return flask.jsonify({"projects": projects})
 
 
 @backend_ns.route("/update/", methods=["POST", "PUT"])
 @misc.backend_authenticated
 def update():
+    """
+    Apply batch of build and action updates in one transaction.
+    Several updates of the same object (e.g. different chroots of one build)
+    are applied in the order they were sent.
+    """
     result = {}
 
     request_data = flask.request.json
@@ -188,36 +162,38 @@ def update():
         if typ not in request_data:
             continue
 
-        to_update = {}
+        to_update = defaultdict(list)
         for obj in request_data[typ]:
-            to_update[obj["id"]] = obj
+            to_update[obj["id"]].append(obj)
 
         existing = {}
-        for obj in logic_cls.get_by_ids(to_update.keys()).all():
-            existing[obj.id] = obj
+        if to_update:
+            for obj in logic_cls.get_by_ids(to_update.keys()).all():
+                existing[obj.id] = obj
 
         non_existing_ids = list(set(to_update.keys()) - set(existing.keys()))
 
         for i, obj in existing.items():
-            logic_cls.update_state_from_dict(obj, to_update[i])
-
-        i = 5
-        exc_info = None
-        while i > 0:
-            try:
-                db.session.commit()
-                i = -100
-            except LockError:
-                i -= 1
-                exc_info = sys.exc_info()[2]
-                time.sleep(5)
-
-        if i != -100:
-            raise LockError(None).with_traceback(exc_info)
+            for upd_dict in to_update[i]:
+                logic_cls.update_state_from_dict(obj, upd_dict)
 
         result.update({"updated_{0}_ids".format(typ): list(existing.keys()),
                        "non_existing_{0}_ids".format(typ): non_existing_ids})
 
+    i = 5
+    exc_info = None
+    while i > 0:
+        try:
+            db.session.commit()
+            i = -100
+        except LockError:
+            i -= 1
+            exc_info = sys.exc_info()[2]
+            time.sleep(5)
+
+    if i != -100:
+        raise LockError(None).with_traceback(exc_info)
+
     return flask.jsonify(result)
 
 
@@ -9,6 +9,7 @@ import json
 from werkzeug import secure_filename
 
 from coprs import app
+from coprs import constants
 from coprs import db
 from coprs import forms
 from coprs import helpers
@@ -83,10 +84,34 @@ def group_copr_builds(copr):
 
 
 def render_copr_builds(copr):
-    builds_query = builds_logic.BuildsLogic.get_copr_builds_list(copr=copr)
+    sort = flask.request.args.get("sort", "id")
+    if sort not in builds_logic.BUILDS_LIST_SORT:
+        sort = "id"
+    desc = flask.request.args.get("order") != "asc"
+
+    after = None
+    after_id = flask.request.args.get("after_id", type=int)
+    if after_id is not None:
+        after = (flask.request.args.get("after_value", after_id, type=int), after_id)
+
+    per_page = constants.BUILDS_PER_PAGE
+    builds = builds_logic.BuildsLogic.get_copr_builds_list(
+        copr=copr, sort=sort, desc=desc, after=after, limit=per_page + 1).all()
+
+    # arguments of the link to the next slice, None on the last one
+    next_args = None
+    if len(builds) > per_page:
+        builds = builds[:per_page]
+        next_args = dict(flask.request.view_args,
+                         sort=sort, order="desc" if desc else "asc",
+                         after_id=builds[-1].id, after_value=getattr(builds[-1], sort))
+
     return flask.render_template("coprs/detail/builds.html",
                                  copr=copr,
-                                 builds=builds_query)
+                                 builds=builds,
+                                 sort=sort,
+                                 desc=desc,
+                                 next_args=next_args)
 
 
 @coprs_ns.route("/<username>/<coprname>/package/<package_name>/")
@@ -12,6 +12,7 @@ from coprs import app
 from coprs import db
 from coprs import exceptions
 from coprs import models
+from coprs.logic import builds_logic
 from coprs.logic import coprs_logic
 from coprs.views.misc import create_user_wrapper
 from coprs.whoosheers import CoprUserWhoosheer
@@ -295,6 +296,29 @@ class UpdateIndexesCommand(Command):
         writer.commit(optimize=True)
 
 
+class RebuildBuildQueueCommand(Command):
+    """
+    fills the build task queue table from the current build chroots
+    """
+
+    def run(self):
+        count = builds_logic.BuildsLogic.rebuild_build_task_queue()
+        db.session.commit()
+        print("{0} build tasks queued".format(count))
+
+
+class RecountQueuesCommand(Command):
+    """
+    resets the build queue counters in redis to the numbers in the database,
+    run it periodically e.g. from cron
+    """
+
+    def run(self):
+        counts = builds_logic.BuildsLogic.recount_queue_counters()
+        for state in sorted(counts):
+            print("{0}: {1}".format(state, counts[state]))
+
+
 class GenerateRepoPackagesCommand(Command):
     """
     go through all coprs and create configuration rpm packages
@@ -317,6 +341,8 @@ manager.add_command("drop_chroot", DropChrootCommand())
 manager.add_command("alter_user", AlterUserCommand())
 manager.add_command("add_debug_user", AddDebugUserCommand())
 manager.add_command("update_indexes", UpdateIndexesCommand())
+manager.add_command("rebuild_build_queue", RebuildBuildQueueCommand())
+manager.add_command("recount_queues", RecountQueuesCommand())
 manager.add_command("generate_repo_packages", GenerateRepoPackagesCommand())
 
 if __name__ == "__main__":
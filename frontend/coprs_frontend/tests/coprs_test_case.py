@@ -10,6 +10,9 @@ import datetime
 import pytest
 import decorator
 import shutil
+from redis import ConnectionError
+from sqlalchemy.engine import Engine
+from sqlalchemy.event import listen
 
 import coprs
 
@@ -78,6 +81,15 @@ class CoprsTestCase(object):
 
         self.rmodel_TSE_coprs_general_patcher.stop()
 
+        # queue counters would be out of sync with the emptied database
+        try:
+            rc = coprs.rcp.get_connection()
+            keys = rc.keys("copr:queues:*")
+            if keys:
+                rc.delete(*keys)
+        except ConnectionError:
+            pass
+
     @property
     def auth_header(self):
         return {"Authorization": b"Basic " +
@@ -360,7 +372,7 @@ class CoprsTestCase(object):
     def f_actions(self):
         # if using actions, we need to flush coprs into db, so that we can get
         # their ids
-        self.f_db()
+        self.db.session.commit()
         self.a1 = models.Action(action_type=helpers.ActionTypeEnum("rename"),
                                 object_type="copr",
                                 object_id=self.c1.id,
@@ -468,3 +480,33 @@ class TransactionDecorator(object):
                     session["openid"] = getattr(fn_self, self.user).username
                 return fn(fn_self, *args)
         return decorator.decorator(wrapper, fn)
+
+
+class StatementCounter(object):
+    """
+    Records SQL statements executed inside of the `with` block:
+
+    with StatementCounter() as counter:
+        self.tc.get("/backend/waiting/")
+    assert len(counter.statements) == 2
+    """
+
+    active = None
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        StatementCounter.active = self
+        return self
+
+    def __exit__(self, *args):
+        StatementCounter.active = None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if StatementCounter.active is not None:
+        StatementCounter.active.statements.append(statement)
+
+
+listen(Engine, "before_cursor_execute", before_cursor_execute)
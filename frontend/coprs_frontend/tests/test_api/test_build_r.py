@@ -134,6 +134,23 @@ class TestBuildResource(CoprsTestCase):
         r = self.tc.get(href)
         assert r.status_code == 200
 
+    def test_build_collection_after_id(
+            self, f_users, f_mock_chroots, f_coprs, f_builds, f_db):
+
+        self.db.session.commit()
+        expected = [build.id for build in BuildsLogic.get_multiple()]
+
+        received = []
+        href = "/api_2/builds?limit=3"
+        while href:
+            r = self.tc.get(href)
+            assert r.status_code == 200
+            obj = json.loads(r.data.decode("utf-8"))
+            received.extend(b_dict["build"]["id"] for b_dict in obj["builds"])
+            href = obj["_links"].get("next", {}).get("href")
+
+        assert received == expected
+
     def test_build_post_bad_content_type(
             self, f_users, f_coprs, f_db, f_mock_chroots,
             f_mock_chroots_many, f_build_many_chroots,
@@ -0,0 +1,131 @@
+# -*- encoding: utf-8 -*-
+import json
+
+import six
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+from coprs import helpers
+from coprs.constants import BACKEND_TASK_PUSH_LIST, BACKEND_CANCEL_BUILD_CHANNEL
+from coprs.helpers import StatusEnum
+from coprs.logic.backend_logic import BackendLogic
+from coprs.logic.builds_logic import BuildsLogic
+
+from tests.coprs_test_case import CoprsTestCase
+
+
+class TestBackendLogic(CoprsTestCase):
+
+    def setup_method(self, method):
+        super(TestBackendLogic, self).setup_method(method)
+        self.redis_patcher = mock.patch("coprs.logic.backend_logic.StrictRedis")
+        self.mc_redis = self.redis_patcher.start()
+        self.app.config["BACKEND_REDIS_HOST"] = "127.0.0.1"
+        BackendLogic._push_connection = None
+
+    def teardown_method(self, method):
+        self.app.config["BACKEND_REDIS_HOST"] = None
+        BackendLogic._push_connection = None
+        self.redis_patcher.stop()
+        super(TestBackendLogic, self).teardown_method(method)
+
+    def pushed_messages(self, msg_type=None):
+        result = []
+        for call in self.mc_redis.return_value.lpush.call_args_list:
+            assert call[0][0] == BACKEND_TASK_PUSH_LIST
+            result.extend(json.loads(raw) for raw in call[0][1:])
+        if msg_type is not None:
+            result = [msg for msg in result if msg["type"] == msg_type]
+        return result
+
+    def test_push_pending_build_chroot(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        assert self.pushed_messages("build") == []
+        self.mc_redis.return_value.lpush.reset_mock()
+
+        self.b3_bc[0].status = StatusEnum("pending")
+        self.db.session.commit()
+
+        messages = self.pushed_messages()
+        assert len(messages) == 1
+        assert messages[0]["type"] == "build"
+        assert messages[0]["task"]["task_id"] == "{}-{}".format(
+            self.b3.id, self.b3_bc[0].mock_chroot.name)
+        assert messages[0]["task"]["project_owner"] == self.b3.copr.owner.name
+        assert "pushed_on" in messages[0]
+
+    def test_push_after_commit_only(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.mc_redis.return_value.lpush.reset_mock()
+
+        self.b3_bc[0].status = StatusEnum("pending")
+        self.db.session.flush()
+        assert self.pushed_messages() == []
+        self.db.session.rollback()
+        assert self.pushed_messages() == []
+
+        # the same task flushed twice is pushed once
+        self.b3_bc[0].status = StatusEnum("pending")
+        self.db.session.flush()
+        self.b3_bc[0].git_hash = "deadbeef"
+        self.db.session.commit()
+        messages = self.pushed_messages()
+        assert len(messages) == 1
+        assert messages[0]["task"]["git_hash"] == "deadbeef"
+
+    def test_push_connection_shared(self):
+        rc = BackendLogic.get_push_connection()
+        assert BackendLogic.get_push_connection() is rc
+        assert self.mc_redis.call_count == 1
+        kwargs = self.mc_redis.call_args[1]
+        assert kwargs["socket_timeout"] == self.app.config["BACKEND_REDIS_TIMEOUT"]
+        assert kwargs["socket_connect_timeout"] == self.app.config["BACKEND_REDIS_TIMEOUT"]
+
+    def test_push_new_actions(self, f_users, f_coprs, f_actions, f_db):
+        messages = self.pushed_messages("action")
+        # a3 is already finished
+        assert sorted(msg["action"]["id"] for msg in messages) == sorted([self.a1.id, self.a2.id])
+        assert all(msg["type"] == "action" for msg in messages)
+
+    def test_push_disabled(self, f_users, f_coprs, f_actions, f_db):
+        self.app.config["BACKEND_REDIS_HOST"] = None
+        self.mc_redis.return_value.lpush.reset_mock()
+        self.a1.result = helpers.BackendResultEnum("waiting")
+        self.db.session.commit()
+        assert not self.mc_redis.return_value.lpush.called
+
+    def test_push_error_suppressed(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.mc_redis.return_value.lpush.side_effect = IOError()
+        self.b3_bc[0].status = StatusEnum("pending")
+        self.db.session.commit()
+        assert self.mc_redis.return_value.lpush.called
+
+    def test_publish_cancelled_build(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroot in self.b1_bc:
+            build_chroot.status = StatusEnum("pending")
+        self.db.session.commit()
+        pipe = self.mc_redis.return_value.pipeline.return_value
+
+        BuildsLogic.cancel_build(self.u1, self.b1)
+        self.db.session.flush()
+        assert not pipe.publish.called
+
+        self.db.session.commit()
+        assert pipe.publish.call_args_list == [
+            mock.call(BACKEND_CANCEL_BUILD_CHANNEL.format(build_id=self.b1.id), "cancelled")]
+        assert pipe.execute.called
+
+    def test_push_changed_projects(self, f_users, f_coprs, f_mock_chroots, f_db):
+        # new projects aren't pushed
+        assert self.pushed_messages() == []
+        self.mc_redis.return_value.lpush.reset_mock()
+
+        self.c1.auto_createrepo = False
+        self.c2.copr_chroots.pop()
+        self.db.session.commit()
+
+        messages = self.pushed_messages()
+        projects = sorted((msg["owner"], msg["project"]) for msg in messages if msg["type"] == "project")
+        assert projects == sorted([(self.c1.owner.name, self.c1.name),
+                                   (self.c2.owner.name, self.c2.name)])
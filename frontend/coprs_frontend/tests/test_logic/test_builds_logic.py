@@ -3,17 +3,22 @@ import json
 
 import pytest
 import time
+from redis import ConnectionError
 from sqlalchemy.orm.exc import NoResultFound
 from coprs import helpers
+from coprs import rcp
 from coprs.constants import MAX_BUILD_TIMEOUT
 
 from coprs.exceptions import ActionInProgressException, InsufficientRightsException, MalformedArgumentException
 from coprs.helpers import StatusEnum
 from coprs.logic.actions_logic import ActionsLogic
+from coprs.logic.backend_logic import BackendLogic
 from coprs.logic.builds_logic import BuildsLogic
 from coprs.logic.builds_logic import BuildsMonitorLogic
+from coprs.logic.complex_logic import ComplexLogic
+from coprs.rmodels import QueueCounters
 
-from tests.coprs_test_case import CoprsTestCase
+from tests.coprs_test_case import CoprsTestCase, StatementCounter
 
 
 class TestBuildsLogic(CoprsTestCase):
@@ -117,6 +122,177 @@ class TestBuildsLogic(CoprsTestCase):
         data = BuildsLogic.get_build_task_queue().all()
         assert len(data) == 0
 
+    def test_build_queue_table_sync(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroot in self.b2_bc + self.b3_bc:
+            build_chroot.status = StatusEnum("pending")
+        self.db.session.commit()
+
+        tasks = BuildsLogic.get_build_task_queue_tasks().all()
+        assert [task.build_id for task in tasks] == [self.b2.id, self.b3.id, self.b3.id]
+        assert set(task.task_dict["task_id"] for task in tasks) == set([
+            "{}-fedora-18-x86_64".format(self.b2.id),
+            "{}-fedora-17-x86_64".format(self.b3.id),
+            "{}-fedora-17-i386".format(self.b3.id),
+        ])
+
+        self.b2_bc[0].status = StatusEnum("succeeded")
+        self.b3.canceled = True
+        self.db.session.commit()
+        assert BuildsLogic.get_build_task_queue_tasks().count() == 0
+
+        self.b3.canceled = False
+        self.c2.copr_chroots[0].buildroot_pkgs = "gcc"
+        self.db.session.commit()
+        tasks = BuildsLogic.get_build_task_queue_tasks().all()
+        assert len(tasks) == 2
+        assert set(task.task_dict["buildroot_pkgs"] for task in tasks) == set(["gcc", None])
+
+        for build_chroot in self.b3_bc:
+            self.db.session.delete(build_chroot)
+        self.db.session.commit()
+        assert BuildsLogic.get_build_task_queue_tasks().count() == 0
+
+    def test_build_queue_table_related_changes(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroot in self.b3_bc:
+            build_chroot.status = StatusEnum("pending")
+        self.db.session.commit()
+
+        self.c2.name = "renamed"
+        self.p2.name = "hello"
+        self.u2.username = "bob"
+        self.db.session.commit()
+        tasks = [task.task_dict for task in BuildsLogic.get_build_task_queue_tasks()]
+        assert len(tasks) == 2
+        for task in tasks:
+            assert task["project_name"] == "renamed"
+            assert task["package_name"] == "hello"
+            assert task["git_repo"] == "bob/renamed/hello"
+            assert task["project_owner"] == task["submitter"] == "bob"
+
+    def test_build_queue_table_serialization_error(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.b3.package = None
+        for build_chroot in self.b3_bc:
+            build_chroot.status = StatusEnum("pending")
+        self.db.session.commit()
+
+        # the rows are kept and serialized again when the queue is read
+        tasks = BuildsLogic.get_build_task_queue_tasks().all()
+        assert [task.task for task in tasks] == [None, None]
+        assert BuildsLogic.get_build_task_queue_dicts() == []
+
+        self.b3.package = self.p2
+        self.db.session.commit()
+        assert all(task.task is not None for task in BuildsLogic.get_build_task_queue_tasks())
+        assert len(BuildsLogic.get_build_task_queue_dicts()) == 2
+
+        # a row marked for re-sync is serialized when it's read
+        table = self.models.BuildQueueTask.__table__
+        self.db.session.execute(table.update().values(task=None))
+        tasks = BuildsLogic.get_build_task_queue_dicts()
+        assert sorted(task["task_id"] for task in tasks) == [
+            "{}-fedora-17-i386".format(self.b3.id),
+            "{}-fedora-17-x86_64".format(self.b3.id),
+        ]
+
+    def test_rebuild_build_task_queue(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroot in self.b2_bc + self.b3_bc + self.b4_bc:
+            build_chroot.status = StatusEnum("pending")
+        self.db.session.commit()
+        expected = sorted(task.task for task in BuildsLogic.get_build_task_queue_tasks())
+
+        self.db.session.execute(self.models.BuildQueueTask.__table__.delete())
+        assert BuildsLogic.rebuild_build_task_queue() == 5
+        self.db.session.commit()
+        assert sorted(task.task for task in BuildsLogic.get_build_task_queue_tasks()) == expected
+
+    def test_build_task_queue_statements_count(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        counts = []
+        for build_chroots in [self.b2_bc, self.b3_bc + self.b4_bc]:
+            for build_chroot in build_chroots:
+                build_chroot.status = StatusEnum("pending")
+            self.db.session.commit()
+            self.db.session.expire_all()
+
+            with StatementCounter() as counter:
+                for task in BuildsLogic.get_build_task_queue():
+                    BackendLogic.get_build_task_dict(task)
+            counts.append(len(counter.statements))
+
+        assert counts[0] == counts[1]
+
+    def test_queue_counters(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        rc = rcp.get_connection()
+        try:
+            rc.ping()
+        except ConnectionError:
+            return
+
+        self.db.session.commit()
+        assert BuildsLogic.recount_queue_counters() == {
+            "importing": 5, "pending": 0, "starting": 0, "running": 0}
+
+        for build_chroot in self.b2_bc + self.b3_bc:
+            build_chroot.status = StatusEnum("pending")
+        self.b4_bc[0].status = StatusEnum("running")
+        self.db.session.commit()
+        expected = {"importing": 1, "pending": 3, "starting": 0, "running": 1}
+        assert QueueCounters.get_counts(rc) == expected
+
+        # rolled back changes are not counted
+        self.b2_bc[0].status = StatusEnum("starting")
+        self.db.session.flush()
+        self.db.session.rollback()
+        assert QueueCounters.get_counts(rc) == expected
+
+        self.db.session.delete(self.b3_bc[0])
+        self.db.session.commit()
+        assert QueueCounters.get_counts(rc) == BuildsLogic.count_queues() == {
+            "importing": 1, "pending": 2, "starting": 0, "running": 1}
+        assert ComplexLogic.get_queues_size() == {"waiting": 2, "running": 1, "importing": 1}
+
+    def test_build_summary(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.db.session.commit()
+        assert self.b3.summary_status == StatusEnum("importing")
+        assert self.b3.summary_pkg_name == "hello-world"
+        assert self.b3.summary_started_on is None
+
+        self.b3_bc[0].status = StatusEnum("running")
+        self.b3_bc[0].started_on = 100
+        self.b3_bc[1].status = StatusEnum("succeeded")
+        self.b3_bc[1].started_on = 50
+        self.b3_bc[1].ended_on = 200
+        self.db.session.commit()
+        self.db.session.expire_all()
+
+        build = BuildsLogic.get(self.b3.id).one()
+        assert (build.summary_status, build.summary_started_on, build.summary_ended_on) == \
+            (StatusEnum("running"), 50, 200)
+
+        running = [bc for bc in build.build_chroots if bc.status == StatusEnum("running")]
+        self.db.session.delete(running[0])
+        self.db.session.commit()
+        self.db.session.expire_all()
+        assert BuildsLogic.get(self.b3.id).one().summary_status == StatusEnum("succeeded")
+
+    def test_copr_builds_list(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.db.session.commit()
+
+        def ids(**kwargs):
+            return [row.id for row in BuildsLogic.get_copr_builds_list(self.c2, **kwargs)]
+
+        assert ids() == [self.b4.id, self.b3.id]
+        assert ids(desc=False) == [self.b3.id, self.b4.id]
+        assert ids(limit=1) == [self.b4.id]
+        assert ids(after=(self.b4.id, self.b4.id)) == [self.b3.id]
+        assert ids(after=(self.b3.id, self.b3.id)) == []
+        assert ids(sort="submitted_on", desc=False, after=(10, self.b3.id)) == [self.b4.id]
+
+        row = BuildsLogic.get_copr_builds_list(self.c2).first()
+        assert (row.pkg_name, row.status, row.copr_name, row.owner_name, row.group_name) == \
+            ("hello-world", StatusEnum("importing"), "foocopr", "user2", None)
+
     def test_delete_build_exceptions(
             self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
         for bc in self.b4_bc:
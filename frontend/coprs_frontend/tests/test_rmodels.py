@@ -5,7 +5,7 @@ import pytest
 
 from redis import StrictRedis, ConnectionError
 
-from coprs.rmodels import TimedStatEvents
+from coprs.rmodels import TimedStatEvents, QueueCounters
 
 
 class TestRModels(object):
@@ -59,3 +59,27 @@ class TestRModels(object):
         assert TimedStatEvents.get_count(self.rc, name="foobar", prefix=self.prefix,
                                          day_min=self.time_now - 5000000) == 3
 
+    def test_queue_counters(self):
+        if self.disabled:
+            return
+
+        assert QueueCounters.get_counts(self.rc, prefix=self.prefix) is None
+        # nothing to increment before the first reset
+        QueueCounters.incr(self.rc, {"pending": 1}, prefix=self.prefix)
+        assert QueueCounters.get_counts(self.rc, prefix=self.prefix) is None
+
+        QueueCounters.reset(self.rc, {"pending": 2, "running": 0}, prefix=self.prefix)
+        QueueCounters.incr(self.rc, {"pending": -1, "running": 1, "importing": 0},
+                           prefix=self.prefix)
+        assert QueueCounters.get_counts(self.rc, prefix=self.prefix) == \
+            {"pending": 1, "running": 1}
+
+        QueueCounters.reset(self.rc, {"importing": 3}, prefix=self.prefix)
+        assert QueueCounters.get_counts(self.rc, prefix=self.prefix) == {"importing": 3}
+
+    def test_queue_counters_claim_recount(self):
+        if self.disabled:
+            return
+
+        assert QueueCounters.claim_recount(self.rc, 600, prefix=self.prefix)
+        assert not QueueCounters.claim_recount(self.rc, 600, prefix=self.prefix)
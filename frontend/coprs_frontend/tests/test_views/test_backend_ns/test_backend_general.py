@@ -1,6 +1,9 @@
 import json
 
-from tests.coprs_test_case import CoprsTestCase
+from coprs import models
+from coprs.helpers import StatusEnum
+
+from tests.coprs_test_case import CoprsTestCase, StatementCounter
 
 
 class TestWaitingBuilds(CoprsTestCase):
@@ -20,6 +23,97 @@ class TestWaitingBuilds(CoprsTestCase):
         r = self.tc.get("/backend/waiting/", headers=self.auth_header)
         assert len(json.loads(r.data.decode("utf-8"))["builds"]) == 5
 
+    def test_waiting_builds_statements_count(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        # the request detaches the fixture objects, load the build chroots by id
+        rounds = [[dict(build_id=bc.build_id, mock_chroot_id=bc.mock_chroot_id)
+                   for bc in build_chroots]
+                  for build_chroots in [self.b2_bc, self.b3_bc + self.b4_bc]]
+        counts = []
+        for build_chroot_ids in rounds:
+            for build_chroot_id in build_chroot_ids:
+                build_chroot = models.BuildChroot.query.filter_by(**build_chroot_id).one()
+                build_chroot.status = StatusEnum("pending")
+            self.db.session.commit()
+            self.db.session.expire_all()
+
+            with StatementCounter() as counter:
+                r = self.tc.get("/backend/waiting/", headers=self.auth_header)
+            counts.append(len(counter.statements))
+
+        assert len(json.loads(r.data.decode("utf-8"))["builds"]) == 5
+        assert counts[0] == counts[1]
+
+
+class TestImportingBuilds(CoprsTestCase):
+
+    def add_importing_builds(self, copr_id, count):
+        # the request detaches the fixture objects, load the copr by id;
+        # package is assigned to the build only after the import
+        copr = models.Copr.query.get(copr_id)
+        for _ in range(count):
+            build = models.Build(copr=copr, user=copr.owner,
+                                 submitted_on=10, source_type=1, source_json="{}")
+            for chroot in copr.active_chroots:
+                self.db.session.add(models.BuildChroot(
+                    build=build, mock_chroot=chroot, status=StatusEnum("importing")))
+        self.db.session.commit()
+        self.db.session.expire_all()
+
+    def test_importing_builds(self, f_users, f_coprs, f_mock_chroots, f_db):
+        self.add_importing_builds(self.c2.id, 2)
+        r = self.tc.get("/backend/importing/")
+        builds = json.loads(r.data.decode("utf-8"))["builds"]
+
+        # fedora-17-x86_64 and fedora-17-i386 are imported by a single task
+        assert len(builds) == 2
+        assert builds[0]["task_id"] != builds[1]["task_id"]
+        for build in builds:
+            assert build["task_id"].endswith("-f17")
+            assert build["user"] == "user2"
+            assert build["project"] == "foocopr"
+            assert build["branch"] == "f17"
+            assert build["source_type"] == 1
+            assert build["source_json"] == "{}"
+
+    def test_importing_builds_group_project(self, f_users, f_coprs, f_mock_chroots, f_db):
+        self.c2.group = models.Group(name="group1", fas_name="fas_1")
+        self.add_importing_builds(self.c2.id, 1)
+        r = self.tc.get("/backend/importing/")
+        builds = json.loads(r.data.decode("utf-8"))["builds"]
+        assert [build["user"] for build in builds] == ["@group1"]
+
+    def test_importing_builds_statements_count(
+            self, f_users, f_coprs, f_mock_chroots, f_db):
+
+        copr_id = self.c2.id
+        counts = []
+        for count in [1, 20]:
+            self.add_importing_builds(copr_id, count)
+            with StatementCounter() as counter:
+                r = self.tc.get("/backend/importing/")
+            counts.append(len(counter.statements))
+
+        assert len(json.loads(r.data.decode("utf-8"))["builds"]) == 21
+        assert counts[0] == counts[1]
+
+
+class TestAutoCreaterepoStatuses(CoprsTestCase):
+
+    def test_auto_createrepo_statuses(self, f_users, f_coprs, f_db):
+        # whooshee reindexes the changed projects after commit, it can't load their owners then
+        models.Copr.query.filter(models.Copr.id == self.c2.id).update({"auto_createrepo": False})
+        models.Copr.query.filter(models.Copr.id == self.c3.id).update({"deleted": True})
+        self.db.session.commit()
+
+        r = self.tc.get("/backend/auto_createrepo/", headers=self.auth_header)
+        projects = json.loads(r.data.decode("utf-8"))["projects"]
+        assert sorted((p["owner"], p["project"], p["auto_createrepo"]) for p in projects) == sorted([
+            (u"user1", u"foocopr", True),
+            (u"user2", u"foocopr", False),
+        ])
+
 
 # status = 0 # failure
 # status = 1 # succeeded
@@ -135,6 +229,30 @@ class TestUpdateBuilds(CoprsTestCase):
         assert ended.chroots_ended_on == {'fedora-18-x86_64': 139086644000}
 
 
+    def test_update_batch(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.db.session.commit()
+        data = {
+            "builds": [
+                {"id": 3, "chroot": "fedora-17-x86_64", "status": 3},
+                {"id": 3, "chroot": "fedora-17-i386", "status": 3},
+                {"id": 3, "chroot": "fedora-17-x86_64", "status": 1, "ended_on": 149086644000},
+            ],
+            "actions": [],
+        }
+        r = self.tc.post("/backend/update/",
+                         content_type="application/json",
+                         headers=self.auth_header,
+                         data=json.dumps(data))
+        result = json.loads(r.data.decode("utf-8"))
+        assert result["updated_builds_ids"] == [3]
+        assert result["updated_actions_ids"] == []
+
+        updated = self.models.Build.query.filter(self.models.Build.id == 3).one()
+        # all updates of the build were applied in order
+        statuses = dict((bc.name, bc.status) for bc in updated.build_chroots)
+        assert statuses == {"fedora-17-x86_64": 1, "fedora-17-i386": 3}
+
+
 class TestWaitingActions(CoprsTestCase):
 
     def test_no_waiting_actions(self):
@@ -1,7 +1,7 @@
 import json
 from coprs import models
 from coprs.helpers import StatusEnum
-from tests.coprs_test_case import CoprsTestCase, TransactionDecorator
+from tests.coprs_test_case import CoprsTestCase, TransactionDecorator, mock
 
 
 class TestCoprShowBuilds(CoprsTestCase):
@@ -13,6 +13,26 @@ class TestCoprShowBuilds(CoprsTestCase):
             "/coprs/{0}/{1}/builds/".format(self.u2.name, self.c2.name))
         assert r.data.count(b'<tr class="build-') == 2
 
+    def test_copr_show_builds_slices(self, f_users, f_coprs, f_mock_chroots,
+                                     f_builds, f_db):
+        self.db.session.commit()
+        url = "/coprs/{0}/{1}/builds/".format(self.u2.name, self.c2.name)
+        # the request detaches the fixture objects
+        b3_id, b4_id = self.b3.id, self.b4.id
+
+        with mock.patch("coprs.constants.BUILDS_PER_PAGE", 1):
+            r = self.tc.get(url)
+        assert r.data.count(b'<tr class="build-') == 1
+        assert "after_id={}".format(b4_id).encode("utf-8") in r.data
+
+        r = self.tc.get("{}?after_id={}".format(url, b4_id))
+        assert r.data.count(b'<tr class="build-') == 1
+        assert "/build/{}/".format(b3_id).encode("utf-8") in r.data
+        assert b"after_id=" not in r.data
+
+        r = self.tc.get("{}?order=asc&sort=submitted_on".format(url))
+        assert r.data.count(b'<tr class="build-') == 2
+
 
 class TestCoprAddBuild(CoprsTestCase):
 
@@ -90,10 +110,10 @@ class TestCoprCancelBuild(CoprsTestCase):
                                                    f_mock_chroots,
                                                    f_builds, f_db):
 
+        self.db.session.add_all(self.b1_bc)
         for bc in self.b1_bc:
             bc.status = StatusEnum("pending")
             bc.ended_on = None
-        self.db.session.add_all(self.b1_bc)
         self.db.session.add_all([self.u1, self.c1, self.b1])
         self.test_client.post("/coprs/{0}/{1}/cancel_build/{2}/"
                               .format(self.u1.name, self.c1.name, self.b1.id),
@@ -107,10 +127,10 @@ class TestCoprCancelBuild(CoprsTestCase):
                                                           f_coprs,
                                                           f_mock_chroots,
                                                           f_builds, f_db):
+        self.db.session.add_all(self.b1_bc)
         for bc in self.b1_bc:
             bc.status = StatusEnum("pending")
             bc.ended_on = None
-        self.db.session.add_all(self.b1_bc)
         self.db.session.add_all([self.u1, self.c1, self.b1])
         self.test_client.post("/coprs/{0}/{1}/cancel_build/{2}/"
                               .format(self.u1.name, self.c1.name, self.b1.id),